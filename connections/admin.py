@@ -1,18 +1,54 @@
 from django.contrib import admin
-from .models import Like, Match
+from match_up.pagination import EstimatedCountPaginator
+from .models import Like, Match, Message, OutboxEvent
 
 
 @admin.register(Like)
 class LikeAdmin(admin.ModelAdmin):
     list_display = ['from_user', 'to_user', 'action', 'created_at']
-    list_filter = ['action', 'created_at']
-    search_fields = ['from_user__username', 'to_user__username']
+    list_filter = ['action']
+    list_select_related = ['from_user', 'to_user']
+    date_hierarchy = 'created_at'
+    search_fields = ['=from_user__username', '=to_user__username']
+    autocomplete_fields = ['from_user', 'to_user']
     readonly_fields = ['created_at']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 @admin.register(Match)
 class MatchAdmin(admin.ModelAdmin):
     list_display = ['user1', 'user2', 'is_active', 'created_at']
-    list_filter = ['is_active', 'created_at']
-    search_fields = ['user1__username', 'user2__username']
+    list_filter = ['is_active']
+    list_select_related = ['user1', 'user2']
+    date_hierarchy = 'created_at'
+    search_fields = ['=user1__username', '=user2__username']
+    autocomplete_fields = ['user1', 'user2']
     readonly_fields = ['created_at']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+    list_display = [
+        'id', 'kind', 'created_at', 'processed_at', 'failed_at', 'attempts']
+    list_filter = ['kind']
+    date_hierarchy = 'created_at'
+    readonly_fields = [
+        'kind', 'payload', 'created_at', 'available_at', 'processed_at',
+        'failed_at', 'attempts', 'last_error']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(Message)
+class MessageAdmin(admin.ModelAdmin):
+    list_display = ['id', 'match', 'sender', 'created_at']
+    list_select_related = ['match__user1', 'match__user2', 'sender']
+    search_fields = ['=sender__username']
+    raw_id_fields = ['match']
+    autocomplete_fields = ['sender']
+    readonly_fields = ['created_at']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
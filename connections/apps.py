@@ -6,5 +6,6 @@ class ConnectionsConfig(AppConfig):
     name = 'connections'
 
     def ready(self):
-        """Import signals when app is ready"""
+        """Import signals and outbox handlers when app is ready"""
         import connections.signals  # noqa: F401
+        import connections.notifications  # noqa: F401
@@ -0,0 +1,550 @@
+"""
+In-memory columnar catalog of the profile attributes discovery filters on.
+
+Every process keeps one ``ProfileCatalog``: user id, age, gender,
+location bucket, creation time and completeness of every profile, stored
+column by column in ``array`` module arrays. Rows are refreshed
+incrementally from ``Profile.updatedAt`` at most every
+``DISCOVERY_CATALOG_REFRESH_SECONDS``.
+
+Filters are bitmaps held in Python integers, one bit per row, so combining
+them is a handful of big-integer operations instead of a loop over every
+profile. Bitmaps are built from the columns with ``bytes.translate``, and
+kept up to date row by row as profiles change. Only the profiles on the
+page being shown are loaded from the database.
+"""
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+
+from dating.models import Profile
+
+GENDER_CODES = tuple(code for code, _ in Profile.GENDER_CHOICES)
+# Columns select() builds bitmaps of
+FILTER_COLUMNS = ('ages', 'genders', 'locations', 'complete', 'alive')
+CATALOG_FIELDS = (
+    'id', 'user_id', 'age', 'gender', 'location', 'createdAt',
+    'is_profile_complete', 'updatedAt',
+)
+# Rows saved by transactions that commit late can carry an updatedAt
+# older than the newest one already seen, so refreshes look back this far
+REFRESH_OVERLAP = timedelta(seconds=60)
+# Column values a flag such as ``alive`` or ``complete`` is set for
+NONZERO = frozenset(range(1, 256))
+# Bytes counted at once when looking for a position in a selection
+COUNT_BLOCK = 1 << 16
+
+# BIT_TABLES[k] maps a byte of a bitmap to bit k of it, so translating a
+# bitmap's bytes with it gives the flags of every eighth row
+BIT_TABLES = tuple(bytes((value >> k) & 1 for value in range(256))
+                   for k in range(8))
+
+
+def gender_code(gender):
+    """Position of a gender in GENDER_CODES; unknown values sort last"""
+    try:
+        return GENDER_CODES.index(gender)
+    except ValueError:
+        return len(GENDER_CODES)
+
+
+def location_key(location):
+    """Bucket key of a location: case and surrounding space ignored"""
+    return ' '.join((location or '').split()).casefold()
+
+
+def _pack(data, values):
+    """Bitmap of the bytes of ``data`` that are in ``values``"""
+    bitmap = 0
+    for k in range(8):
+        table = bytes(1 << k if value in values else 0 for value in range(256))
+        bitmap |= int.from_bytes(data[k::8].translate(table), 'little')
+    return bitmap
+
+
+def matching_bitmap(column, values):
+    """
+    Bitmap of the rows of a column holding one of ``values``.
+
+    Args:
+        column: Array or memoryview of unsigned integers
+        values: Set of the values to match
+
+    A one-byte column is translated to bits directly. Wider columns are
+    split into byte planes: a row matches when its low byte is one of
+    the values' low bytes and each higher byte matches one of them too.
+    """
+    data = memoryview(column).cast('B').tobytes()
+    width = column.itemsize
+    if width == 1:
+        return _pack(data, values)
+    planes = [data[i::width] for i in range(width)]
+    if sys.byteorder == 'big':
+        planes.reverse()
+    by_high = {}
+    for value in values:
+        by_high.setdefault(value >> 8, set()).add(value & 0xFF)
+    bitmap = 0
+    for high, lows in by_high.items():
+        mask = _pack(planes[0], lows)
+        for plane in planes[1:]:
+            mask &= _pack(plane, {high & 0xFF})
+            high >>= 8
+        bitmap |= mask
+    return bitmap
+
+
+def unpack_bitmap(bits):
+    """One byte per row of a bitmap's bytes: 1 where the bit is set"""
+    flags = bytearray(len(bits) * 8)
+    for k, table in enumerate(BIT_TABLES):
+        flags[k::8] = bits.translate(table)
+    return flags
+
+
+def order_runs(order):
+    """
+    Split a sequence of row numbers into slices of consecutive rows.
+
+    Rows are mostly loaded and appended oldest first, so the newest-first
+    order is usually a handful of descending runs; selections use them
+    to put their rows in order with a few slices.
+    """
+    runs = []
+    first = last = None
+    step = 0
+    for row in order:
+        if first is not None and abs(row - last) == 1 and (
+                step in (0, row - last)):
+            step = row - last
+            last = row
+            continue
+        if first is not None:
+            runs.append(_run_slice(first, last, step))
+        first = last = row
+        step = 0
+    if first is not None:
+        runs.append(_run_slice(first, last, step))
+    return runs
+
+
+def _run_slice(first, last, step):
+    if step < 0:
+        return slice(first, last - 1 if last else None, -1)
+    return slice(first, last + 1)
+
+
+def _run_rows(run):
+    if run.step == -1:
+        return range(run.start, -1 if run.stop is None else run.stop, -1)
+    return range(run.start, run.stop)
+
+
+def _join_runs(first, second):
+    """Concatenate two lists of runs, merging descending runs that meet"""
+    if not first or not second:
+        return first + second
+    end, start = _run_rows(first[-1]), _run_rows(second[0])
+    descending = all(
+        rows.step == -1 or len(rows) == 1 for rows in (end, start))
+    if descending and end[-1] - 1 == start[0]:
+        return first[:-1] + [_run_slice(end[0], start[-1], -1)] + second[1:]
+    return first + second
+
+
+def _nth_set(flags, n):
+    """Index of the ``n``-th (from 0) byte of ``flags`` that is 1, or -1"""
+    position, size = 0, len(flags)
+    while True:
+        if position >= size:
+            return -1
+        end = min(position + COUNT_BLOCK, size)
+        count = flags.count(1, position, end)
+        if count > n:
+            break
+        n -= count
+        position = end
+    while end - position > 1:
+        middle = (position + end) // 2
+        count = flags.count(1, position, middle)
+        if count > n:
+            end = middle
+        else:
+            n -= count
+            position = middle
+    return position
+
+
+class ColumnarProfiles:
+    """
+    Filtering shared by the catalog kinds.
+
+    Subclasses provide the ``profile_ids``, ``user_ids``, ``ages``,
+    ``genders``, ``locations`` and ``complete`` columns, the newest-first
+    ``order`` of rows and the same order as ``order_runs`` slices,
+    ``location_buckets`` and ``row_for_user``.
+    """
+
+    def row_for_user(self, user_id):
+        """Row of a user's profile, or None"""
+        raise NotImplementedError
+
+    def _alive_bitmap(self):
+        raise NotImplementedError
+
+    def _bitmap(self, name, values):
+        """Bitmap of the rows whose ``name`` column holds one of ``values``"""
+        key = (name, values)
+        bitmap = self._bitmaps.get(key)
+        if bitmap is None:
+            bitmap = self._bitmaps[key] = matching_bitmap(
+                getattr(self, name), values)
+        return bitmap
+
+    def _rows_bitmap(self, rows):
+        bits = bytearray((len(self.profile_ids) + 7) // 8)
+        for row in rows:
+            bits[row >> 3] |= 1 << (row & 7)
+        return int.from_bytes(bits, 'little')
+
+    def _users_bitmap(self, user_ids):
+        rows = (self.row_for_user(user_id) for user_id in user_ids)
+        return self._rows_bitmap(row for row in rows if row is not None)
+
+    def select(self, exclude_user_ids=(), min_age=None, max_age=None,
+               genders=None, locations=None, complete_only=False):
+        """
+        Select the profiles matching some filters.
+
+        Args:
+            exclude_user_ids: Users to leave out, such as those swiped
+            min_age: Youngest age to include
+            max_age: Oldest age to include
+            genders: Gender codes to include, e.g. ['F', 'O']
+            locations: Locations to include; compared by location_key
+            complete_only: Only include complete profiles
+
+        Returns:
+            CatalogSelection of the matching profiles, newest first
+        """
+        mask = self._alive_bitmap()
+        if min_age is not None or max_age is not None:
+            low = min_age if min_age is not None else 0
+            high = max_age if max_age is not None else 255
+            mask &= self._bitmap(
+                'ages', frozenset(range(max(low, 0), min(high, 255) + 1)))
+        if genders is not None:
+            mask &= self._bitmap(
+                'genders', frozenset(map(gender_code, genders)))
+        if locations is not None:
+            mask &= self._bitmap('locations', frozenset(
+                self.location_buckets[key]
+                for key in map(location_key, locations)
+                if key in self.location_buckets
+            ))
+        if complete_only:
+            mask &= self._bitmap('complete', NONZERO)
+        if exclude_user_ids:
+            mask &= ~self._users_bitmap(exclude_user_ids)
+        return CatalogSelection(
+            self, mask, self.order_runs, self.profile_ids)
+
+
+class ProfileCatalog(ColumnarProfiles):
+    """
+    Column arrays of every profile, in the order rows were loaded.
+
+    ``order`` holds row numbers newest first, the order discovery shows
+    profiles in. Deleted profiles keep their row with ``alive`` cleared
+    until the next full reload.
+
+    Cached bitmaps are patched for the rows a refresh changed, so rows
+    fetched again unchanged cost nothing.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._checked_at = None
+        self._clear()
+
+    def _clear(self):
+        self.profile_ids = array('q')
+        self.user_ids = array('q')
+        self.ages = array('B')
+        self.genders = array('B')
+        self.locations = array('I')
+        self.created = array('d')
+        self.complete = array('B')
+        self.alive = array('B')
+        self.order = array('I')
+        self.order_runs = []
+        self.location_buckets = {}
+        self.row_by_profile = {}
+        self.row_by_user = {}
+        self.alive_count = 0
+        self.high_water = None
+        self.loaded = False
+        self._bitmaps = {}
+
+    def __len__(self):
+        return self.alive_count
+
+    def refresh(self, force=False):
+        """
+        Bring the catalog up to date with the profiles table.
+
+        Changed rows are fetched by ``updatedAt``. When the number of
+        profiles still differs afterwards, some were deleted elsewhere and
+        the catalog is reloaded from scratch.
+
+        Args:
+            force: Refresh even if the last check is recent
+        """
+        with self._lock:
+            now = time.monotonic()
+            if (not force and self.loaded and now - self._checked_at <
+                    settings.DISCOVERY_CATALOG_REFRESH_SECONDS):
+                return
+            self._checked_at = now
+            if not self.loaded:
+                self.reload()
+                return
+            changed = Profile.objects.order_by()
+            if self.high_water is not None:
+                changed = changed.filter(
+                    updatedAt__gte=self.high_water - REFRESH_OVERLAP)
+            self._apply(changed.values_list(*CATALOG_FIELDS))
+            if Profile.objects.count() != self.alive_count:
+                self.reload()
+
+    def reload(self):
+        """Load every profile again"""
+        with self._lock:
+            self._clear()
+            # Oldest first, so the newest-first order is one run of rows
+            self._apply(
+                Profile.objects.order_by('createdAt', 'id').values_list(
+                    *CATALOG_FIELDS).iterator(chunk_size=5000),
+                full=True)
+            self.loaded = True
+            self._checked_at = time.monotonic()
+
+    def update(self, profile):
+        """Apply a profile saved in this process without waiting"""
+        with self._lock:
+            if self.loaded:
+                self._apply([tuple(
+                    getattr(profile, field) for field in CATALOG_FIELDS)])
+
+    def discard(self, profile_id):
+        """Drop a deleted profile"""
+        with self._lock:
+            row = self.row_by_profile.pop(profile_id, None)
+            if row is None or not self.alive[row]:
+                return
+            self.alive[row] = 0
+            self.alive_count -= 1
+            if self.row_by_user.get(self.user_ids[row]) == row:
+                del self.row_by_user[self.user_ids[row]]
+            self._patch_bitmaps({'alive': {row}})
+
+    def _bucket(self, location):
+        key = location_key(location)
+        bucket = self.location_buckets.get(key)
+        if bucket is None:
+            bucket = self.location_buckets[key] = len(self.location_buckets)
+        return bucket
+
+    def _apply(self, rows, full=False):
+        """Insert or update catalog rows from CATALOG_FIELDS tuples"""
+        new_rows = []
+        resort = full
+        # Rows whose value changed, by column, to patch cached bitmaps
+        changed = {name: set() for name in FILTER_COLUMNS}
+        for (profile_id, user_id, age, gender, location, created,
+                complete, updated) in rows:
+            if self.high_water is None or updated > self.high_water:
+                self.high_water = updated
+            created = created.timestamp()
+            values = {
+                'ages': min(age or 0, 255),
+                'genders': gender_code(gender),
+                'locations': self._bucket(location),
+                'complete': complete,
+            }
+            row = self.row_by_profile.get(profile_id)
+            if row is None:
+                row = len(self.profile_ids)
+                self.profile_ids.append(profile_id)
+                self.user_ids.append(user_id)
+                for name, value in values.items():
+                    getattr(self, name).append(value)
+                self.created.append(created)
+                self.alive.append(1)
+                self.row_by_profile[profile_id] = row
+                self.alive_count += 1
+                new_rows.append(row)
+                if not full:
+                    for rows_changed in changed.values():
+                        rows_changed.add(row)
+            else:
+                old_user_id = self.user_ids[row]
+                if old_user_id != user_id:
+                    if self.row_by_user.get(old_user_id) == row:
+                        del self.row_by_user[old_user_id]
+                    self.user_ids[row] = user_id
+                if self.created[row] != created:
+                    resort = True
+                    self.created[row] = created
+                for name, value in values.items():
+                    column = getattr(self, name)
+                    if column[row] != value:
+                        column[row] = value
+                        changed[name].add(row)
+            self.row_by_user[user_id] = row
+        self._patch_bitmaps(changed)
+
+        if resort:
+            self.order = array('I', sorted(
+                range(len(self.profile_ids)), key=self._sort_key,
+                reverse=True))
+            self.order_runs = order_runs(self.order)
+        elif new_rows:
+            new_rows.sort(key=self._sort_key, reverse=True)
+            if not self.order or (
+                    self._sort_key(new_rows[-1]) >
+                    self._sort_key(self.order[0])):
+                # New signups are the newest profiles, so just prepend them
+                self.order = array('I', new_rows) + self.order
+                self.order_runs = _join_runs(
+                    order_runs(new_rows), self.order_runs)
+            else:
+                self.order = array('I', sorted(
+                    self.order.tolist() + new_rows, key=self._sort_key,
+                    reverse=True))
+                self.order_runs = order_runs(self.order)
+
+    def _patch_bitmaps(self, changed):
+        """Update the cached bitmaps for the rows changed in some columns"""
+        for key, bitmap in list(self._bitmaps.items()):
+            name, values = key
+            rows = changed.get(name)
+            if not rows:
+                continue
+            column = getattr(self, name)
+            if len(rows) > max(64, len(column) // 8):
+                # Rebuilding is cheaper; leave it to the next select
+                del self._bitmaps[key]
+                continue
+            self._bitmaps[key] = bitmap & ~self._rows_bitmap(rows) | (
+                self._rows_bitmap(row for row in rows
+                                  if column[row] in values))
+
+    def _sort_key(self, row):
+        return self.created[row], self.profile_ids[row]
+
+    def row_for_user(self, user_id):
+        return self.row_by_user.get(user_id)
+
+    def _alive_bitmap(self):
+        return self._bitmap('alive', NONZERO)
+
+    def select(self, *args, **kwargs):
+        self.refresh()
+        with self._lock:
+            return super().select(*args, **kwargs)
+
+
+class CatalogSelection:
+    """
+    Profiles picked from the catalog, newest first.
+
+    Counting is a bit count of the selection's bitmap. Slicing lines the
+    selection's flags up in the newest-first order with one slice per
+    run of rows, counts its way to the page with ``bytes.count`` and
+    loads the page's profiles with a single query.
+    """
+    model = Profile
+    ordered = True
+
+    def __init__(self, catalog, mask, order_runs, profile_ids):
+        self.catalog = catalog
+        self.mask = mask
+        self.order_runs = order_runs
+        self.profile_ids = profile_ids
+        self._bits = mask.to_bytes((len(profile_ids) + 7) // 8, 'little')
+
+    def count(self):
+        return self.mask.bit_count()
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return iter(self[0:self.count()])
+
+    def contains_user(self, user_id):
+        """Whether a user's profile is in the selection"""
+        row = self.catalog.row_for_user(user_id)
+        return row is not None and bool(self._bits[row >> 3] >> (row & 7) & 1)
+
+    def exclude_users(self, user_ids):
+        """Return the selection without some users"""
+        return CatalogSelection(
+            self.catalog, self.mask & ~self.catalog._users_bitmap(user_ids),
+            self.order_runs, self.profile_ids)
+
+    def ids(self, start, stop):
+        """Profile ids at positions ``start`` to ``stop``"""
+        ids = []
+        if stop <= start:
+            return ids
+        flags = unpack_bitmap(self._bits)
+        ordered = b''.join(flags[run] for run in self.order_runs)
+        runs = [_run_rows(run) for run in self.order_runs]
+        offsets = [0]
+        for rows in runs:
+            offsets.append(offsets[-1] + len(rows))
+        position = _nth_set(ordered, start)
+        while position != -1 and len(ids) < stop - start:
+            index = bisect_right(offsets, position) - 1
+            row = runs[index][position - offsets[index]]
+            ids.append(self.profile_ids[row])
+            position = ordered.find(1, position + 1)
+        return ids
+
+    def fetch(self, start, stop, user_ids=()):
+        """
+        Load the profiles at ``start`` to ``stop`` and those of some other
+        users with one query.
+
+        Returns:
+            Tuple of (list of Profile in feed order, dict of the other
+            users' Profiles by user id)
+        """
+        ids = self.ids(start, stop)
+        if not ids and not user_ids:
+            return [], {}
+        rows = Profile.objects.select_related('user').filter(
+            Q(pk__in=ids) | Q(user_id__in=list(user_ids))).order_by()
+        by_id = {profile.pk: profile for profile in rows}
+        others = {
+            profile.user_id: profile for profile in by_id.values()
+            if profile.user_id in user_ids
+        }
+        return [by_id[pk] for pk in ids if pk in by_id], others
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self[key:key + 1][0]
+        start, stop, _ = key.indices(self.count())
+        return self.fetch(start, stop)[0]
+
+
+catalog = ProfileCatalog()
@@ -0,0 +1,147 @@
+"""
+Chat between the two users of an active match.
+
+Messages are appended to one table and read back as ranges of
+(match_id, id) from message_match_id_idx: the newest page, the page
+before a message, or the messages after one. A page costs the same
+however long the conversation is.
+
+Each user of a conversation has a ChatReadState with the id of the
+last message they read and their unread count. Sending adds one to the
+recipient's count and reading recounts only the messages after what was
+read, so unread badges never count a whole conversation.
+
+Once committed, a message is published on the match's pub/sub channel,
+where long polls wait for it, and on the recipient's channel for the
+event stream.
+"""
+from django.db import transaction
+from django.db.models import Count, F, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .models import ChatReadState, Match, Message
+from .pubsub import get_pubsub, match_channel, user_channel
+
+
+def get_chat_match(user, match_id):
+    """The active match with this id that the user is part of, or None"""
+    return Match.objects.filter(
+        Q(user1=user) | Q(user2=user), pk=match_id, is_active=True
+    ).select_related('user1__profile', 'user2__profile').first()
+
+
+def serialize_message(message):
+    """JSON-ready representation of a Message"""
+    return {
+        'id': message.pk,
+        'match_id': message.match_id,
+        'sender_id': message.sender_id,
+        'body': message.body,
+        'created_at': message.created_at.isoformat(),
+    }
+
+
+def _add_unread(match_id, user_id):
+    states = ChatReadState.objects.filter(match_id=match_id, user_id=user_id)
+    if states.update(unread_count=F('unread_count') + 1):
+        return
+    state, created = ChatReadState.objects.get_or_create(
+        match_id=match_id, user_id=user_id, defaults={'unread_count': 1})
+    if not created:
+        states.update(unread_count=F('unread_count') + 1)
+
+
+def send_message(match, sender, body):
+    """
+    Append a message to a match's conversation.
+
+    Args:
+        match: The Match, which the sender must be part of
+        sender: The sending User
+        body: Message text
+
+    Returns:
+        The saved Message
+    """
+    recipient_id = (
+        match.user2_id if sender.pk == match.user1_id else match.user1_id)
+    with transaction.atomic():
+        message = Message.objects.create(
+            match=match, sender=sender, body=body)
+        _add_unread(match.pk, recipient_id)
+
+    data = serialize_message(message)
+
+    def push():
+        pubsub = get_pubsub()
+        pubsub.publish(match_channel(match.pk), 'message', data)
+        pubsub.publish(user_channel(recipient_id), 'message', {
+            'match_id': match.pk, 'message_id': message.pk})
+
+    transaction.on_commit(push)
+    return message
+
+
+def get_history(match, before=None, limit=50):
+    """
+    Get one page of a conversation, going back in time.
+
+    Args:
+        match: The Match
+        before: Id of the oldest message already shown, or None for the
+                newest page
+        limit: Number of messages per page
+
+    Returns:
+        Tuple of (list of Message oldest first, whether older messages
+        exist)
+    """
+    messages = Message.objects.filter(match=match)
+    if before is not None:
+        messages = messages.filter(id__lt=before)
+    page = list(messages.order_by('-id')[:limit + 1])
+    return page[:limit][::-1], len(page) > limit
+
+
+def get_messages_after(match, after, limit=50):
+    """The first messages of a conversation after a message id, in order"""
+    return list(Message.objects.filter(
+        match=match, id__gt=after).order_by('id')[:limit])
+
+
+def mark_read(match, user, up_to):
+    """
+    Record that a user has read a conversation up to a message.
+
+    Only the other user's messages after ``up_to`` are counted, which are
+    those that arrived while the user was reading. Marking an older
+    message read does nothing.
+
+    Args:
+        match: The Match
+        user: The reading User
+        up_to: Id of the last message shown to the user
+    """
+    unread = Message.objects.filter(
+        match=match, id__gt=up_to
+    ).exclude(sender=user).order_by().values('match').annotate(
+        count=Count('id')).values('count')
+    ChatReadState.objects.filter(
+        match=match, user=user, last_read_id__lt=up_to
+    ).update(
+        last_read_id=up_to,
+        unread_count=Coalesce(Subquery(unread), Value(0)))
+
+
+def get_unread_counts(user, match_ids):
+    """Dict of match id to the user's unread messages, for some matches"""
+    return dict(ChatReadState.objects.filter(
+        user=user, match_id__in=match_ids, unread_count__gt=0
+    ).values_list('match_id', 'unread_count'))
+
+
+def get_unread_total(user):
+    """Number of unread messages in all of a user's conversations"""
+    return ChatReadState.objects.filter(
+        user=user, unread_count__gt=0
+    ).aggregate(total=Sum('unread_count'))['total'] or 0
@@ -0,0 +1,157 @@
+"""
+Export of everything the app stores about a user.
+
+export_records yields the user's account and profile, every like they
+sent and received, their matches and the messages of those matches, one
+flat dict at a time. Each table is read with
+``.iterator(chunk_size=EXPORT_CHUNK_SIZE)``, which on PostgreSQL is a
+server-side cursor, so only one chunk of rows is in memory however long
+the user's history is. The writers turn records into NDJSON or CSV and
+can gzip them on the fly, for a StreamingHttpResponse to send as they
+are produced.
+
+Under ASGI, Django 4.2 reads a synchronous streaming response whole
+before sending it, so DataExportView wraps the chunks in an async
+iterator there.
+"""
+import csv
+import json
+import zlib
+
+from django.conf import settings
+from django.db.models import Q
+
+from dating.models import Profile
+from .models import Like, Match, Message
+
+# Column order of CSV exports; each record fills the columns it has
+CSV_FIELDS = [
+    'type', 'id', 'created_at', 'direction', 'other_user', 'action',
+    'is_active', 'match_id', 'body', 'username', 'email', 'last_login',
+    'age', 'gender', 'location', 'bio', 'interests', 'photo',
+]
+# Text is joined into chunks of about this size before it is sent
+CHUNK_BYTES = 64 * 1024
+
+
+def _isoformat(value):
+    return value.isoformat() if value else None
+
+
+def export_records(user, chunk_size=None):
+    """
+    Yield everything stored about a user as flat dicts.
+
+    Args:
+        user: The User to export
+        chunk_size: Rows fetched per database round trip; defaults to
+                    ``EXPORT_CHUNK_SIZE``
+
+    Yields:
+        Dicts with a 'type' of account, profile, like, match or message
+    """
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    yield {
+        'type': 'account', 'id': user.pk, 'username': user.username,
+        'email': user.email, 'created_at': _isoformat(user.date_joined),
+        'last_login': _isoformat(user.last_login),
+    }
+    profile = Profile.objects.filter(user=user).first()
+    if profile is not None:
+        yield {
+            'type': 'profile', 'id': profile.pk,
+            'created_at': _isoformat(profile.createdAt),
+            'age': profile.age, 'gender': profile.get_gender_display(),
+            'location': profile.location, 'bio': profile.bio,
+            'interests': profile.interests,
+            'photo': profile.photo.url if profile.photo else None,
+        }
+
+    for direction, mine, other in (
+            ('sent', 'from_user', 'to_user'),
+            ('received', 'to_user', 'from_user')):
+        likes = Like.objects.filter(**{mine: user}).order_by().values_list(
+            'id', f'{other}__username', 'action', 'created_at')
+        for like_id, username, action, created_at in likes.iterator(
+                chunk_size=chunk_size):
+            yield {
+                'type': 'like', 'id': like_id,
+                'created_at': _isoformat(created_at),
+                'direction': direction, 'other_user': username,
+                'action': action,
+            }
+
+    # One query per side of the match, each reading its own index
+    for mine, other in (('user1', 'user2'), ('user2', 'user1')):
+        matches = Match.objects.filter(**{mine: user}).order_by().values_list(
+            'id', f'{other}__username', 'is_active', 'created_at')
+        for match_id, username, is_active, created_at in matches.iterator(
+                chunk_size=chunk_size):
+            yield {
+                'type': 'match', 'id': match_id,
+                'created_at': _isoformat(created_at),
+                'other_user': username, 'is_active': is_active,
+            }
+
+    match_ids = Match.objects.filter(
+        Q(user1=user) | Q(user2=user)).values('id')
+    messages = Message.objects.filter(
+        match_id__in=match_ids
+    ).values_list('id', 'match_id', 'sender_id', 'body', 'created_at')
+    for message_id, match_id, sender_id, body, created_at in (
+            messages.iterator(chunk_size=chunk_size)):
+        yield {
+            'type': 'message', 'id': message_id, 'match_id': match_id,
+            'created_at': _isoformat(created_at),
+            'direction': 'sent' if sender_id == user.pk else 'received',
+            'body': body,
+        }
+
+
+def _chunked(lines):
+    """Join text lines into UTF-8 chunks of about CHUNK_BYTES"""
+    buffer = []
+    size = 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= CHUNK_BYTES:
+            yield ''.join(buffer).encode()
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer).encode()
+
+
+def ndjson_chunks(records):
+    """Encode records as newline-delimited JSON"""
+    return _chunked(
+        json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+
+
+class _Echo:
+    """File-like object handing back what the csv writer writes"""
+
+    def write(self, value):
+        return value
+
+
+def csv_chunks(records):
+    """Encode records as CSV with a header row of CSV_FIELDS"""
+    writer = csv.DictWriter(_Echo(), CSV_FIELDS)
+
+    def lines():
+        yield writer.writeheader()
+        for record in records:
+            yield writer.writerow(record)
+    return _chunked(lines())
+
+
+def gzip_chunks(chunks, level=6):
+    """Compress byte chunks into one gzip stream as they come"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
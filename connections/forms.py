@@ -0,0 +1,22 @@
+"""
+Forms for connections app
+"""
+from django import forms
+
+from .models import Message
+
+
+class MessageForm(forms.ModelForm):
+    """Chat message form"""
+
+    class Meta:
+        model = Message
+        fields = ['body']
+        labels = {'body': ''}
+        widgets = {
+            'body': forms.Textarea(attrs={
+                'rows': 2,
+                'class': 'form-control',
+                'placeholder': 'Write a message...',
+            }),
+        }
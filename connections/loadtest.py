@@ -0,0 +1,195 @@
+"""
+Concurrent swipe sessions against a running server.
+
+Each virtual user logs in through allauth like a browser would, then
+repeats discover -> like/pass every profile shown -> matches. Latencies,
+errors and the database time reported in ``Server-Timing`` are collected
+in a shared ``LoadStats``.
+"""
+import re
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+from django.db import connections
+
+PROFILE_ID_RE = re.compile(r'data-profile-id="(\d+)"')
+DB_TIMING_RE = re.compile(r'\bdb;dur=([\d.]+)')
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1, round(pct / 100 * len(values)) - 1))
+    return values[rank]
+
+
+class LoadStats:
+    """Thread-safe collector of request timings"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.db_times = []
+        self.matches = 0
+
+    def record(self, label, elapsed, ok, db_time=None):
+        with self._lock:
+            self.latencies[label].append(elapsed)
+            if not ok:
+                self.errors[label] += 1
+            if db_time is not None:
+                self.db_times.append(db_time)
+
+    def record_match(self):
+        with self._lock:
+            self.matches += 1
+
+    def summary(self):
+        """Per-endpoint rows of count, errors and latency percentiles"""
+        rows = []
+        for label in sorted(self.latencies):
+            values = sorted(self.latencies[label])
+            rows.append({
+                'endpoint': label,
+                'requests': len(values),
+                'errors': self.errors[label],
+                'p50': percentile(values, 50),
+                'p90': percentile(values, 90),
+                'p95': percentile(values, 95),
+                'p99': percentile(values, 99),
+                'max': values[-1],
+            })
+        return rows
+
+    @property
+    def total_requests(self):
+        return sum(len(values) for values in self.latencies.values())
+
+    @property
+    def total_errors(self):
+        return sum(self.errors.values())
+
+
+class SwipeSession:
+    """One virtual user swiping through the site"""
+
+    def __init__(self, base_url, username, password, stats, rng,
+                 like_ratio=0.6, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.username = username
+        self.password = password
+        self.stats = stats
+        self.rng = rng
+        self.like_ratio = like_ratio
+        self.timeout = timeout
+        self.http = requests.Session()
+
+    def request(self, label, method, path, **kwargs):
+        """Send a request and record it; returns None on network errors"""
+        kwargs.setdefault('timeout', self.timeout)
+        started = time.perf_counter()
+        try:
+            response = self.http.request(
+                method, self.base_url + path, **kwargs)
+        except requests.RequestException:
+            self.stats.record(label, time.perf_counter() - started, False)
+            return None
+        elapsed = time.perf_counter() - started
+        timing = DB_TIMING_RE.search(response.headers.get('Server-Timing', ''))
+        self.stats.record(
+            label, elapsed, response.status_code < 400,
+            float(timing.group(1)) / 1000 if timing else None)
+        return response
+
+    def _csrf_headers(self):
+        return {'X-CSRFToken': self.http.cookies.get('csrftoken', '')}
+
+    def login(self):
+        """Log in through the allauth form; returns True on success"""
+        self.request('login_form', 'get', '/account/login/')
+        response = self.request(
+            'login', 'post', '/account/login/',
+            data={
+                'login': self.username,
+                'password': self.password,
+                'csrfmiddlewaretoken': self.http.cookies.get(
+                    'csrftoken', ''),
+            },
+            headers=self._csrf_headers(),
+            allow_redirects=False,
+        )
+        return response is not None and response.status_code == 302
+
+    def run(self, iterations):
+        """Log in and repeat discover -> swipe -> matches"""
+        if not self.login():
+            return
+        for _ in range(iterations):
+            response = self.request(
+                'discover', 'get', '/connections/discover/')
+            if response is None:
+                continue
+            profile_ids = dict.fromkeys(PROFILE_ID_RE.findall(response.text))
+            for profile_id in profile_ids:
+                self.swipe(profile_id)
+            self.request('matches', 'get', '/connections/matches/')
+
+    def swipe(self, profile_id):
+        action = 'like' if self.rng.random() < self.like_ratio else 'pass'
+        response = self.request(
+            action, 'post', f'/connections/{action}/{profile_id}/',
+            headers=self._csrf_headers())
+        if response is not None and response.ok and action == 'like':
+            if response.json().get('is_match'):
+                self.stats.record_match()
+
+
+class LockWaitSampler:
+    """
+    Count backends waiting on row or table locks while a test runs.
+
+    Only Postgres exposes lock waits; elsewhere the sampler does nothing and
+    lock contention shows up as failed requests instead.
+    """
+
+    def __init__(self, using='default', interval=0.1):
+        self.using = using
+        self.interval = interval
+        self.samples = []
+        self.supported = connections[using].vendor == 'postgresql'
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        if self.supported:
+            self._thread.start()
+
+    def stop(self):
+        if self.supported:
+            self._stop.set()
+            self._thread.join()
+
+    def _run(self):
+        connection = connections[self.using]
+        try:
+            with connection.cursor() as cursor:
+                while not self._stop.wait(self.interval):
+                    cursor.execute(
+                        "SELECT count(*) FROM pg_stat_activity "
+                        "WHERE wait_event_type = 'Lock' "
+                        "AND datname = current_database()")
+                    self.samples.append(cursor.fetchone()[0])
+        finally:
+            connection.close()
+
+    @property
+    def waiting_share(self):
+        """Share of samples that saw at least one waiting backend"""
+        if not self.samples:
+            return 0.0
+        return sum(1 for count in self.samples if count) / len(self.samples)
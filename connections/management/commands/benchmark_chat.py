@@ -0,0 +1,115 @@
+"""
+Time chat sends and history loads in one long conversation.
+
+Two benchmark users, a match and ``--messages`` messages between them are
+inserted, then sending, loading the newest page, loading pages at random
+depths, loading new messages and marking them read are each timed. The
+benchmark users and their messages are deleted afterwards unless
+``--keep`` is given.
+"""
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from connections.chat import (
+    get_history, get_messages_after, get_unread_total, mark_read,
+    send_message,
+)
+from connections.loadtest import percentile
+from connections.models import Match, Message
+
+PREFIX = 'chatbench'
+
+
+class Command(BaseCommand):
+    help = 'Benchmark sending and loading chat messages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--messages', type=int, default=100_000,
+            help='Messages in the conversation before timing.')
+        parser.add_argument(
+            '--operations', type=int, default=500,
+            help='Times each operation is repeated.')
+        parser.add_argument(
+            '--page-size', type=int, default=50,
+            help='Messages per history page.')
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='Messages per insert while filling the conversation.')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument(
+            '--keep', action='store_true',
+            help='Keep the benchmark users and messages.')
+
+    def handle(self, *args, **options):
+        if User.objects.filter(username__startswith=PREFIX).exists():
+            raise CommandError(
+                f'Users starting with "{PREFIX}" already exist; delete them '
+                f'first.')
+        users = [
+            User.objects.create_user(username=f'{PREFIX}_{name}')
+            for name in ('a', 'b')
+        ]
+        # Without signals, so no outbox event or push is made
+        match = Match.objects.bulk_create([
+            Match(user1=users[0], user2=users[1])])[0]
+        try:
+            self._run(match, users, options)
+        finally:
+            if not options['keep']:
+                User.objects.filter(username__startswith=PREFIX).delete()
+
+    def _run(self, match, users, options):
+        rng = random.Random(options['seed'])
+        page_size = options['page_size']
+
+        started = time.perf_counter()
+        batch = []
+        with transaction.atomic():
+            for number in range(options['messages']):
+                batch.append(Message(
+                    match=match, sender=users[number % 2],
+                    body=f'Message {number}'))
+                if len(batch) == options['batch_size']:
+                    Message.objects.bulk_create(batch)
+                    batch = []
+            Message.objects.bulk_create(batch)
+        self.stdout.write(
+            f'Inserted {options["messages"]} messages in '
+            f'{time.perf_counter() - started:.1f}s')
+
+        ids = list(Message.objects.filter(
+            match=match).order_by('id').values_list('id', flat=True))
+        timings = {}
+
+        def timed(name, func):
+            started = time.perf_counter()
+            func()
+            timings.setdefault(name, []).append(
+                time.perf_counter() - started)
+
+        for number in range(options['operations']):
+            sender = users[number % 2]
+            timed('send', lambda: send_message(
+                match, sender, f'Benchmark message {number}'))
+            timed('newest page', lambda: get_history(
+                match, None, page_size))
+            before = rng.choice(ids)
+            timed('page at random depth', lambda: get_history(
+                match, before, page_size))
+            after = ids[-1] - rng.randrange(page_size)
+            timed('new messages', lambda: get_messages_after(
+                match, after, page_size))
+            timed('mark read', lambda: mark_read(
+                match, users[1], ids[-1] + number))
+            timed('unread total', lambda: get_unread_total(users[0]))
+
+        for name, values in timings.items():
+            values.sort()
+            self.stdout.write(
+                f'{name}: p50 {percentile(values, 50) * 1000:.2f}ms, '
+                f'p95 {percentile(values, 95) * 1000:.2f}ms')
@@ -0,0 +1,119 @@
+"""
+Compare discovery orderings on existing data.
+
+For a sample of users, the first ``--pages`` discover pages are built the
+way DiscoverView builds them, once per ordering. Every profile shown is
+swiped with ``--like-ratio``, and a like counts as a match when the
+profile's user has already liked the viewer. Nothing is written to the
+database, so the command can run against a copy of production or data
+made by generate_synthetic_data.
+"""
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.core.paginator import Paginator
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import CaptureQueriesContext
+
+from connections.loadtest import percentile
+from connections.services import get_discovery_feed, pending_likes
+from connections.views import DiscoverView
+
+ORDERINGS = ('newest', 'reciprocal')
+
+
+class Command(BaseCommand):
+    help = 'Benchmark swipes per match and query cost of discovery orderings.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--prefix', default='synth',
+            help='Username prefix of the users to sample.')
+        parser.add_argument(
+            '--users', type=int, default=100,
+            help='Number of users to sample.')
+        parser.add_argument(
+            '--pages', type=int, default=10,
+            help='Discover pages each user swipes through.')
+        parser.add_argument(
+            '--like-ratio', type=float, default=0.6,
+            help='Share of swipes that are likes.')
+        parser.add_argument(
+            '--seed', type=int, default=1,
+            help='Seed for the like/pass decisions.')
+
+    def handle(self, *args, **options):
+        users = list(
+            User.objects.filter(
+                username__startswith=options['prefix'],
+                profile__isnull=False,
+            ).order_by('id')[:options['users']]
+        )
+        if not users:
+            raise CommandError(
+                f'No users with a profile start with "{options["prefix"]}"; '
+                f'run generate_synthetic_data first.')
+
+        results = {ordering: self._empty() for ordering in ORDERINGS}
+        for user in users:
+            likers = set(pending_likes(user).values_list(
+                'from_user_id', flat=True))
+            for ordering in ORDERINGS:
+                self._swipe(
+                    user, ordering, likers, results[ordering], options,
+                    random.Random(f'{options["seed"]}:{user.pk}'))
+        self._report(results, len(users))
+
+    def _empty(self):
+        return {
+            'swipes': 0, 'matches': 0, 'queries': [], 'times': [],
+            'db_times': [],
+        }
+
+    def _swipe(self, user, ordering, likers, result, options, rng):
+        """Swipe through one user's first pages with an ordering"""
+        connection = connections[DEFAULT_DB_ALIAS]
+        for number in range(1, options['pages'] + 1):
+            # A fresh feed per page, as each page is a separate request
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                paginator = Paginator(
+                    get_discovery_feed(user, order_by=ordering),
+                    DiscoverView.paginate_by)
+                if number > paginator.num_pages:
+                    break
+                profiles = list(paginator.page(number).object_list)
+                elapsed = time.perf_counter() - started
+            result['queries'].append(len(queries))
+            result['times'].append(elapsed)
+            result['db_times'].append(sum(
+                float(query['time']) for query in queries.captured_queries))
+            for profile in profiles:
+                result['swipes'] += 1
+                if (rng.random() < options['like_ratio'] and
+                        profile.user_id in likers):
+                    result['matches'] += 1
+
+    def _report(self, results, users):
+        write = self.stdout.write
+        write(f'{users} users')
+        write(
+            f'{"ordering":<12}{"swipes":>8}{"matches":>9}'
+            f'{"swipes/match":>14}{"queries/page":>14}'
+            f'{"db ms":>8}{"p50 ms":>9}{"p95 ms":>9}')
+        for ordering in ORDERINGS:
+            result = results[ordering]
+            per_match = (
+                f'{result["swipes"] / result["matches"]:.1f}'
+                if result['matches'] else '-')
+            times = sorted(result['times'])
+            pages = len(result['queries']) or 1
+            write(
+                f'{ordering:<12}{result["swipes"]:>8}'
+                f'{result["matches"]:>9}{per_match:>14}'
+                f'{sum(result["queries"]) / pages:>14.1f}'
+                f'{sum(result["db_times"]) / pages * 1000:>8.2f}'
+                f'{percentile(times, 50) * 1000:>9.2f}'
+                f'{percentile(times, 95) * 1000:>9.2f}')
@@ -0,0 +1,169 @@
+"""
+Compare per-worker catalogs with the mmap-shared snapshot.
+
+Starts ``--workers`` processes for each mode, the way gunicorn runs its
+workers. In 'memory' mode every process loads its own ProfileCatalog
+from the database; in 'mmap' mode every process maps the same snapshot
+file. Each worker then times ``--lookups`` discovery selections, and
+while all workers are still alive reports its memory from
+/proc/self/smaps_rollup (Linux only). PSS charges shared pages to the
+processes mapping them in equal parts, so the PSS total across workers
+is what the machine really spends.
+"""
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from connections.catalog import ColumnarProfiles, ProfileCatalog
+from connections.loadtest import percentile
+from connections.snapshot import MappedProfiles, write_snapshot
+
+MODES = ('memory', 'mmap')
+
+
+def memory_usage():
+    """Rss, Pss and private kB of this process, or None off Linux"""
+    try:
+        with open('/proc/self/smaps_rollup') as rollup:
+            lines = rollup.read().splitlines()
+    except OSError:
+        return None
+    values = {}
+    for line in lines[1:]:
+        name, _, rest = line.partition(':')
+        values[name] = int(rest.split()[0])
+    return {
+        'rss': values.get('Rss', 0),
+        'pss': values.get('Pss', 0),
+        'private': (
+            values.get('Private_Clean', 0) + values.get('Private_Dirty', 0)),
+    }
+
+
+def run_worker(mode, path, options, seed, barrier, results):
+    """Load a catalog, time lookups and report memory"""
+    # Shared pages are split between the processes alive at the time
+    barrier.wait()
+    before = memory_usage()
+    started = time.perf_counter()
+    if mode == 'memory':
+        catalog = ProfileCatalog()
+        catalog.reload()
+        connections.close_all()
+    else:
+        catalog = MappedProfiles(path)
+    warmup = time.perf_counter() - started
+
+    rng = random.Random(seed)
+    rows = len(catalog.user_ids)
+    latencies = []
+    for _ in range(options['lookups']):
+        excluded = [
+            catalog.user_ids[rng.randrange(rows)]
+            for _ in range(options['exclude'])
+        ]
+        started = time.perf_counter()
+        selection = ColumnarProfiles.select(
+            catalog, exclude_user_ids=excluded)
+        selection.count()
+        selection.ids(0, options['page_size'])
+        latencies.append(time.perf_counter() - started)
+
+    # Measure only once every worker holds its catalog
+    barrier.wait()
+    after = memory_usage()
+    results.put({
+        'warmup': warmup,
+        'latencies': latencies,
+        'memory': before and after and {
+            key: after[key] - before[key] for key in after},
+    })
+    barrier.wait()
+
+
+class Command(BaseCommand):
+    help = 'Benchmark memory and latency of per-worker and shared catalogs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=8,
+            help='Worker processes per mode.')
+        parser.add_argument(
+            '--lookups', type=int, default=500,
+            help='Discovery selections timed per worker.')
+        parser.add_argument(
+            '--exclude', type=int, default=50,
+            help='Swiped users excluded in each selection.')
+        parser.add_argument(
+            '--page-size', type=int, default=3,
+            help='Profiles picked per selection.')
+        parser.add_argument(
+            '--path',
+            help='Snapshot file to write (default: a temporary file).')
+
+    def handle(self, *args, **options):
+        path = options['path'] or os.path.join(
+            tempfile.mkdtemp(), 'profiles.snapshot')
+        started = time.perf_counter()
+        rows = write_snapshot(path)
+        self.stdout.write(
+            f'Snapshot of {rows} profiles, '
+            f'{os.path.getsize(path) / 1024:.0f} kB, written in '
+            f'{time.perf_counter() - started:.2f}s')
+        if not rows:
+            return
+
+        self.stdout.write(
+            f'{"mode":<8}{"warm-up ms":>12}{"p50 us":>9}{"p95 us":>9}'
+            f'{"private kB":>12}{"PSS kB":>9}{"total PSS kB":>14}')
+        for mode in MODES:
+            self._report(mode, self._run(mode, path, options))
+        if not options['path']:
+            os.remove(path)
+            os.rmdir(os.path.dirname(path))
+
+    def _run(self, mode, path, options):
+        workers = options['workers']
+        # Children must open their own connections
+        connections.close_all()
+        context = multiprocessing.get_context(
+            'fork' if 'fork' in multiprocessing.get_all_start_methods()
+            else 'spawn')
+        barrier = context.Barrier(workers)
+        results = context.Queue()
+        processes = [
+            context.Process(
+                target=run_worker,
+                args=(mode, path, options, seed, barrier, results))
+            for seed in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        reports = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        return reports
+
+    def _report(self, mode, reports):
+        warmups = sorted(report['warmup'] for report in reports)
+        latencies = sorted(
+            latency for report in reports
+            for latency in report['latencies'])
+        memory = [report['memory'] for report in reports]
+        if all(memory):
+            private = sum(m['private'] for m in memory) / len(memory)
+            pss = sum(m['pss'] for m in memory) / len(memory)
+            columns = (
+                f'{private:>12.0f}{pss:>9.0f}'
+                f'{sum(m["pss"] for m in memory):>14.0f}')
+        else:
+            columns = f'{"n/a":>12}{"n/a":>9}{"n/a":>14}'
+        self.stdout.write(
+            f'{mode:<8}{percentile(warmups, 50) * 1000:>12.1f}'
+            f'{percentile(latencies, 50) * 1e6:>9.0f}'
+            f'{percentile(latencies, 95) * 1e6:>9.0f}' + columns)
@@ -0,0 +1,83 @@
+"""
+Time "Similar to me" lookups on a large synthetic index.
+
+Bios and interests are generated in memory from the same vocabulary as
+the load-test data, so no database is needed. Reports the index build
+time and size and the latency of nearest-neighbour lookups.
+"""
+import os
+import random
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from connections.loadtest import percentile
+from connections.similarity import SimilarityIndex, build_index
+from connections.synthetic import BIO_WORDS, INTERESTS
+
+
+def synthetic_profile(seed, index):
+    rng = random.Random(seed * 1_000_003 + index)
+    return (
+        ' '.join(rng.choices(BIO_WORDS, k=rng.randint(6, 30))),
+        ', '.join(rng.sample(INTERESTS, rng.randint(1, 5))),
+    )
+
+
+class Command(BaseCommand):
+    help = 'Benchmark similarity index lookups on synthetic profiles.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--profiles', type=int, default=1_000_000,
+            help='Synthetic profiles to index.')
+        parser.add_argument(
+            '--lookups', type=int, default=500,
+            help='Lookups to time.')
+        parser.add_argument(
+            '--limit', type=int, default=60,
+            help='Similar profiles returned per lookup.')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument(
+            '--path',
+            help='Index file to write (default: a temporary file).')
+
+    def handle(self, *args, **options):
+        seed = options['seed']
+        path = options['path'] or os.path.join(
+            tempfile.mkdtemp(), 'similarity.index')
+
+        def rows():
+            for index in range(options['profiles']):
+                yield (index + 1, *synthetic_profile(seed, index))
+
+        started = time.perf_counter()
+        count = build_index(path, rows)
+        self.stdout.write(
+            f'Indexed {count} profiles, '
+            f'{os.path.getsize(path) / 1024 / 1024:.1f} MB, in '
+            f'{time.perf_counter() - started:.1f}s')
+
+        started = time.perf_counter()
+        index = SimilarityIndex(path)
+        self.stdout.write(
+            f'Mapped in {(time.perf_counter() - started) * 1000:.2f}ms')
+
+        latencies = []
+        found = 0
+        for lookup in range(options['lookups']):
+            bio, interests = synthetic_profile(seed + 1, lookup)
+            started = time.perf_counter()
+            found += len(index.nearest(bio, interests, options['limit']))
+            latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        self.stdout.write(
+            f'{options["lookups"]} lookups: '
+            f'p50 {percentile(latencies, 50) * 1000:.2f}ms, '
+            f'p95 {percentile(latencies, 95) * 1000:.2f}ms, '
+            f'{found / max(options["lookups"], 1):.1f} profiles each')
+        if not options['path']:
+            del index
+            os.remove(path)
+            os.rmdir(os.path.dirname(path))
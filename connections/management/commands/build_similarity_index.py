@@ -0,0 +1,37 @@
+"""
+Build the index behind "Similar to me" discovery.
+
+Run after bulk changes to bios, e.g. from cron; workers pick up the new
+file on their next check without restarting.
+"""
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from connections.similarity import build_index
+from dating.models import Profile
+
+
+class Command(BaseCommand):
+    help = 'Build the profile similarity index used by discovery.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path', default=settings.SIMILARITY_INDEX_PATH,
+            help='Index file (default: SIMILARITY_INDEX_PATH).')
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='Profiles read from the database per query.')
+
+    def handle(self, *args, **options):
+        def rows():
+            return Profile.objects.order_by().values_list(
+                'user_id', 'bio', 'interests').iterator(
+                chunk_size=options['batch_size'])
+
+        started = time.monotonic()
+        count = build_index(options['path'], rows)
+        self.stdout.write(
+            f'Indexed {count} profiles to {options["path"]} in '
+            f'{time.monotonic() - started:.2f}s')
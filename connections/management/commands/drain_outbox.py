@@ -0,0 +1,49 @@
+"""
+Deliver swipe and match events from the outbox to their handlers.
+
+Run it as a long-lived consumer next to the web workers, as many copies
+as needed on PostgreSQL. Delivered events are purged after
+OUTBOX_RETENTION_DAYS and failed ones after OUTBOX_FAILED_RETENTION_DAYS.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from connections.outbox import drain, purge
+
+
+class Command(BaseCommand):
+    help = 'Deliver outbox events to their handlers in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int,
+            help='Events per batch (default: OUTBOX_BATCH_SIZE).')
+        parser.add_argument(
+            '--interval', type=float, default=1.0,
+            help='Seconds to wait when the outbox is empty.')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Stop once the outbox is empty instead of waiting.')
+
+    def handle(self, *args, **options):
+        delivered = failed = 0
+        last_purge = None
+        while True:
+            if last_purge is None or time.monotonic() - last_purge > 3600:
+                purged = purge()
+                if purged:
+                    self.stdout.write(f'Purged {purged} old events')
+                last_purge = time.monotonic()
+            done, errors = drain(options['batch_size'])
+            delivered += done
+            failed += errors
+            if done or errors:
+                continue
+            if options['once']:
+                break
+            close_old_connections()
+            time.sleep(options['interval'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Delivered {delivered} event(s), {failed} failed.'))
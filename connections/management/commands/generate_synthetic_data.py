@@ -0,0 +1,132 @@
+"""
+Fill the database with synthetic users, profiles, swipes and matches.
+
+Chunks of users are generated and inserted in a process pool on Postgres
+(with ``COPY``) and one after another elsewhere (with ``bulk_create``).
+The same seed always produces the same users and swipes.
+"""
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Max
+
+from connections.services import reset_like_counters
+from connections.synthetic import (
+    SyntheticPlan, create_mutual_matches, init_worker, load_chunk,
+    reset_sequences,
+)
+
+
+class Command(BaseCommand):
+    help = 'Generate synthetic users, profiles, likes and matches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users', type=int, default=1000,
+            help='Number of users to create.')
+        parser.add_argument(
+            '--swipes', type=int, default=50,
+            help='Average likes and passes sent per user.')
+        parser.add_argument(
+            '--like-ratio', type=float, default=0.6,
+            help='Share of swipes that are likes.')
+        parser.add_argument(
+            '--reciprocity', type=float, default=0.05,
+            help='Share of swiped pairs that like each other back.')
+        parser.add_argument(
+            '--skew', type=float, default=2.0,
+            help='Popularity exponent; higher concentrates likes.')
+        parser.add_argument(
+            '--seed', type=int, default=1,
+            help='Seed for reproducible data.')
+        parser.add_argument(
+            '--prefix', default='synth',
+            help='Username prefix for generated users.')
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Worker processes on Postgres (default: CPU count).')
+        parser.add_argument(
+            '--chunk-size', type=int, default=10000,
+            help='Users generated per chunk.')
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='Rows per bulk_create batch outside Postgres.')
+        parser.add_argument(
+            '--database', default=DEFAULT_DB_ALIAS,
+            help='Database alias to fill.')
+
+    def handle(self, *args, **options):
+        using = options['database']
+        total = options['users']
+        prefix = options['prefix']
+        if total < 2:
+            raise CommandError('--users must be at least 2.')
+        if User.objects.using(using).filter(
+                username__startswith=prefix).exists():
+            raise CommandError(
+                f'Users named "{prefix}..." already exist; '
+                f'choose another --prefix.')
+
+        last_id = User.objects.using(using).aggregate(
+            last=Max('id'))['last'] or 0
+        plan = SyntheticPlan(
+            seed=options['seed'],
+            users=total,
+            first_id=last_id + 1,
+            prefix=prefix,
+            password=make_password(None),
+            mean_swipes=options['swipes'],
+            like_ratio=options['like_ratio'],
+            reciprocity=options['reciprocity'],
+            skew=options['skew'],
+        )
+        chunk_size = options['chunk_size']
+        chunks = [
+            (start, min(start + chunk_size, total))
+            for start in range(0, total, chunk_size)
+        ]
+
+        started = time.monotonic()
+        for phase in ('users', 'swipes'):
+            rows = self._run_phase(plan, phase, chunks, using, options)
+            self.stdout.write(
+                f'{phase}: {rows} rows in '
+                f'{time.monotonic() - started:.1f}s')
+        reset_sequences(using)
+        matches = create_mutual_matches(plan, using)
+        # Bulk inserts skip the signals that keep inbox counters current
+        reset_like_counters()
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {total} users and {matches} matches in '
+            f'{time.monotonic() - started:.1f}s.'
+        ))
+
+    def _run_phase(self, plan, phase, chunks, using, options):
+        batch_size = options['batch_size']
+        workers = options['workers']
+        # SQLite allows a single writer, so chunks run one at a time
+        if workers < 2 or connections[using].vendor != 'postgresql':
+            return sum(
+                load_chunk(plan, phase, start, stop, using, batch_size)
+                for start, stop in chunks)
+
+        # Children must open their own connections
+        connections.close_all()
+        context = multiprocessing.get_context(
+            'fork' if 'fork' in multiprocessing.get_all_start_methods()
+            else 'spawn')
+        with ProcessPoolExecutor(
+                max_workers=workers, mp_context=context,
+                initializer=init_worker) as pool:
+            futures = [
+                pool.submit(
+                    load_chunk, plan, phase, start, stop, using, batch_size)
+                for start, stop in chunks
+            ]
+            return sum(future.result() for future in futures)
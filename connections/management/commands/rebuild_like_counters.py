@@ -0,0 +1,21 @@
+"""
+Recount every "Liked you" inbox counter from the likes table.
+"""
+from django.core.management.base import BaseCommand
+
+from connections.services import rebuild_like_counters
+
+
+class Command(BaseCommand):
+    help = 'Recount the "Liked you" inbox counters of all users.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='Users compared per batch.')
+
+    def handle(self, *args, **options):
+        users = rebuild_like_counters(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Corrected like counters for {users} user(s).'
+        ))
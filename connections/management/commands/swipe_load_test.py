@@ -0,0 +1,182 @@
+"""
+Run concurrent swipe sessions against a running server.
+
+Start the site the way production does, for example::
+
+    gunicorn match_up.wsgi --workers 4 --threads 4
+
+then point this command at it. Virtual users are existing users whose
+username starts with ``--prefix``, such as those made by
+generate_synthetic_data; ``--set-password`` gives them a known password.
+``--bots`` marks other users with the prefix as like-back bots for the
+run, and unmarks them when it ends; other users are never changed.
+"""
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from connections.loadtest import (
+    LoadStats, LockWaitSampler, SwipeSession, percentile,
+)
+from dating.models import Profile
+
+
+class Command(BaseCommand):
+    help = 'Load test discover, like/pass and matches with many users.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--base-url', default='http://127.0.0.1:8000',
+            help='Root URL of the running server.')
+        parser.add_argument(
+            '--prefix', default='synth',
+            help='Username prefix of the virtual users.')
+        parser.add_argument(
+            '--users', type=int, default=50,
+            help='Number of virtual users.')
+        parser.add_argument(
+            '--concurrency', type=int, default=10,
+            help='Virtual users swiping at the same time.')
+        parser.add_argument(
+            '--iterations', type=int, default=5,
+            help='Discover pages each virtual user swipes through.')
+        parser.add_argument(
+            '--like-ratio', type=float, default=0.6,
+            help='Share of swipes that are likes.')
+        parser.add_argument(
+            '--password', default='load-test-password',
+            help='Password the virtual users log in with.')
+        parser.add_argument(
+            '--set-password', action='store_true',
+            help='Set --password on the virtual users first.')
+        parser.add_argument(
+            '--bots', type=int, default=0,
+            help='Mark this many other users with the prefix as like-back '
+                 'bots for the run.')
+        parser.add_argument(
+            '--seed', type=int, default=1,
+            help='Seed for the like/pass decisions and the bots picked.')
+        parser.add_argument(
+            '--timeout', type=float, default=30,
+            help='Per-request timeout in seconds.')
+
+    def handle(self, *args, **options):
+        users = list(
+            User.objects.filter(
+                username__startswith=options['prefix'],
+                profile__isnull=False,
+            ).order_by('id').values_list('id', 'username')[:options['users']]
+        )
+        if not users:
+            raise CommandError(
+                f'No users with a profile start with "{options["prefix"]}"; '
+                f'run generate_synthetic_data first.')
+        user_ids = [user_id for user_id, _ in users]
+
+        if options['set_password']:
+            User.objects.filter(id__in=user_ids).update(
+                password=make_password(options['password']))
+        bot_ids = []
+        if options['bots']:
+            bot_ids = self._pick_bots(
+                options['prefix'], user_ids, options['bots'], options['seed'])
+            Profile.objects.filter(id__in=bot_ids).update(is_bot=True)
+            self.stdout.write(f'Marked {len(bot_ids)} bot profile(s).')
+        try:
+            stats, sampler, duration = self._run(users, options)
+        finally:
+            if bot_ids:
+                Profile.objects.filter(id__in=bot_ids).update(is_bot=False)
+                self.stdout.write(f'Unmarked {len(bot_ids)} bot profile(s).')
+
+        self._report(stats, sampler, duration, len(users))
+
+    def _pick_bots(self, prefix, user_ids, count, seed):
+        """
+        Ids of up to ``count`` profiles of users with the prefix, other
+        than the virtual users, that are not bots yet; the seed picks
+        which, so that runs can be repeated.
+        """
+        candidates = list(Profile.objects.filter(
+            user__username__startswith=prefix, is_bot=False,
+        ).exclude(user_id__in=user_ids).order_by('id').values_list(
+            'id', flat=True))
+        return random.Random(seed).sample(
+            candidates, min(count, len(candidates)))
+
+    def _run(self, users, options):
+        stats = LoadStats()
+        sampler = LockWaitSampler()
+        sessions = [
+            SwipeSession(
+                options['base_url'], username, options['password'], stats,
+                random.Random(f'{options["seed"]}:{username}'),
+                like_ratio=options['like_ratio'],
+                timeout=options['timeout'],
+            )
+            for _, username in users
+        ]
+
+        sampler.start()
+        started = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(
+                    max_workers=options['concurrency']) as pool:
+                for future in [
+                    pool.submit(session.run, options['iterations'])
+                    for session in sessions
+                ]:
+                    future.result()
+        finally:
+            sampler.stop()
+        return stats, sampler, time.perf_counter() - started
+
+    def _report(self, stats, sampler, duration, sessions):
+        write = self.stdout.write
+        write(
+            f'{sessions} users, {stats.total_requests} requests in '
+            f'{duration:.1f}s ({stats.total_requests / duration:.1f} req/s)')
+        swipes = sum(
+            row['requests'] for row in stats.summary()
+            if row['endpoint'] in ('like', 'pass'))
+        write(
+            f'{swipes} swipes ({swipes / duration:.1f}/s), '
+            f'{stats.matches} matches')
+        write('')
+        write(
+            f'{"endpoint":<12}{"requests":>9}{"errors":>8}{"err %":>7}'
+            f'{"p50":>8}{"p90":>8}{"p95":>8}{"p99":>8}{"max":>8}  (ms)')
+        for row in stats.summary():
+            error_rate = 100 * row['errors'] / row['requests']
+            write(
+                f'{row["endpoint"]:<12}{row["requests"]:>9}'
+                f'{row["errors"]:>8}{error_rate:>7.1f}' + ''.join(
+                    f'{row[key] * 1000:>8.1f}'
+                    for key in ('p50', 'p90', 'p95', 'p99', 'max')))
+        write('')
+
+        db_times = sorted(stats.db_times)
+        if db_times:
+            write(
+                f'Server database time p50 '
+                f'{percentile(db_times, 50) * 1000:.1f} ms, p95 '
+                f'{percentile(db_times, 95) * 1000:.1f} ms')
+        if sampler.supported:
+            write(
+                f'Lock waits: seen in {sampler.waiting_share:.0%} of '
+                f'{len(sampler.samples)} samples, at most '
+                f'{max(sampler.samples, default=0)} waiting backend(s)')
+        else:
+            write(
+                'Lock waits are only sampled on Postgres; on SQLite they '
+                'appear as errors above.')
+
+        if stats.total_errors:
+            write(self.style.WARNING(
+                f'{stats.total_errors} request(s) failed.'))
+        else:
+            write(self.style.SUCCESS('No failed requests.'))
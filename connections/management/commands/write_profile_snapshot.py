@@ -0,0 +1,71 @@
+"""
+Write the shared discovery snapshot read by every worker.
+
+Run once, or with ``--interval`` as the refresher process that
+gunicorn.conf.py starts next to the workers. The refresher keeps a
+ProfileCatalog of its own, so each check only reads the profiles that
+changed, and rewrites the file when any did or when it is half
+``DISCOVERY_SNAPSHOT_MAX_AGE`` old. A failed check is logged and tried
+again at the next interval.
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from connections.catalog import ProfileCatalog
+from connections.snapshot import write_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Write the mmap-shared profile snapshot used by discovery.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path', default=settings.DISCOVERY_SNAPSHOT_PATH,
+            help='Snapshot file (default: DISCOVERY_SNAPSHOT_PATH).')
+        parser.add_argument(
+            '--interval', type=float,
+            help='Keep checking for changed profiles every this many '
+                 'seconds, rewriting the snapshot when there are any.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not path:
+            raise CommandError(
+                'Set DISCOVERY_SNAPSHOT_PATH or pass --path.')
+        interval = options['interval']
+        if not interval:
+            self._write(path, None)
+            return
+
+        profiles = ProfileCatalog()
+        written = written_at = None
+        while True:
+            started = time.monotonic()
+            try:
+                profiles.refresh(force=True)
+                state = (profiles.high_water, profiles.alive_count)
+                if state != written or (
+                        started - written_at >=
+                        settings.DISCOVERY_SNAPSHOT_MAX_AGE / 2):
+                    self._write(path, profiles)
+                    written, written_at = state, started
+            except Exception:
+                # Workers fall back to their own catalogs meanwhile
+                logger.exception('Could not write the profile snapshot')
+                profiles = ProfileCatalog()
+                written = None
+            close_old_connections()
+            time.sleep(max(0, interval - (time.monotonic() - started)))
+
+    def _write(self, path, profiles):
+        started = time.monotonic()
+        rows = write_snapshot(path, profiles)
+        self.stdout.write(
+            f'Wrote {rows} profiles to {path} in '
+            f'{time.monotonic() - started:.2f}s')
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.27 on 2026-10-19 11:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connections', '0002_delete_message'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='like',
+            index=models.Index(fields=['created_at'], name='connections_created_524e3c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='match',
+            index=models.Index(fields=['created_at'], name='connections_created_eb231a_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.27 on 2026-10-19 12:21
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('connections', '0003_like_connections_created_524e3c_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LikeCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField(default=0)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RemoveIndex(
+            model_name='like',
+            name='connections_to_user_11a209_idx',
+        ),
+        migrations.AddIndex(
+            model_name='like',
+            index=models.Index(fields=['to_user', 'action', 'created_at', 'id'], name='connections_to_user_ffbc43_idx'),
+        ),
+        migrations.AddField(
+            model_name='likecounter',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='like_counters', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterUniqueTogether(
+            name='likecounter',
+            unique_together={('user', 'shard')},
+        ),
+    ]
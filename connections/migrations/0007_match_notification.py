@@ -0,0 +1,30 @@
+# Generated by Django 4.2.27 on 2026-10-19 14:15
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('connections', '0006_chat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatchNotification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('match', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to='connections.match')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='match_notifications', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['user', 'id'],
+                'indexes': [models.Index(fields=['created_at', 'user'], name='connections_created_4dfb33_idx')],
+                'unique_together': {('user', 'match')},
+            },
+        ),
+    ]
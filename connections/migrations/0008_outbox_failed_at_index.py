@@ -0,0 +1,17 @@
+# Generated by Django 4.2.27 on 2026-10-19 15:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connections', '0007_match_notification'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='outboxevent',
+            index=models.Index(fields=['failed_at'], name='connections_failed__27ba61_idx'),
+        ),
+    ]
@@ -22,16 +22,26 @@ class Like(models.Model):
         indexes = [
             models.Index(fields=['from_user', 'to_user']),
             models.Index(fields=['from_user', 'action']),
-            models.Index(fields=['to_user', 'action']),
+            # Also serves keyset paging of the "Liked you" inbox
+            models.Index(fields=['to_user', 'action', 'created_at', 'id']),
+            models.Index(fields=['created_at']),
         ]
 
     def __str__(self):
         return f"{self.from_user.username} {self.action}s {self.to_user.username}"  # noqa: E501
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored action so signals can see what changed
+        instance._loaded_action = instance.__dict__.get('action')
+        return instance
+
     def save(self, *args, **kwargs):
         if self.from_user == self.to_user:
             raise ValueError("Users cannot like themselves")
         super().save(*args, **kwargs)
+        self._loaded_action = self.action
 
 
 class Match(models.Model):
@@ -45,7 +55,10 @@ class Match(models.Model):
     class Meta:
         unique_together = ['user1', 'user2']
         ordering = ['-created_at']
-        indexes = [models.Index(fields=['user1', 'user2'])]
+        indexes = [
+            models.Index(fields=['user1', 'user2']),
+            models.Index(fields=['created_at']),
+        ]
 
     def __str__(self):
         return f"Match: {self.user1.username} & {self.user2.username}"
@@ -58,3 +71,156 @@ class Match(models.Model):
 
     def get_other_user(self, user):
         return self.user2 if user == self.user1 else self.user1
+
+
+class LikeCounter(models.Model):
+    """
+    Number of likes waiting in a user's "Liked you" inbox.
+
+    The total is the sum over the user's rows. Popular users get several
+    shards so concurrent likes do not all update the same row.
+    """
+    user = models.ForeignKey(
+            User, on_delete=models.CASCADE, related_name='like_counters')
+    shard = models.PositiveSmallIntegerField(default=0)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ['user', 'shard']
+
+    def __str__(self):
+        return f"{self.user.username} shard {self.shard}: {self.count}"
+
+
+class OutboxEvent(models.Model):
+    """
+    A swipe or match waiting for the outbox consumer.
+
+    Written in the transaction that made the change, so an event exists
+    if and only if the change committed. See connections.outbox.
+    """
+    LIKE = 'like'
+    PASS = 'pass'
+    MATCH = 'match'
+    KIND_CHOICES = [(LIKE, 'Like'), (PASS, 'Pass'), (MATCH, 'Match')]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    payload = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Earliest time the consumer picks the event up, pushed back on retry
+    available_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    failed_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            # The consumer only reads events still waiting
+            models.Index(
+                fields=['available_at', 'id'], name='outbox_pending_idx',
+                condition=models.Q(
+                    processed_at__isnull=True, failed_at__isnull=True)),
+            models.Index(fields=['processed_at']),
+            models.Index(fields=['failed_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} event {self.pk}"
+
+
+class HandledEvent(models.Model):
+    """
+    Marks an outbox event as handled by one handler.
+
+    Saved in the same transaction as the handler's own writes, so a
+    redelivered event does not repeat them.
+    """
+    event = models.ForeignKey(
+            OutboxEvent, on_delete=models.CASCADE, related_name='handled')
+    handler = models.CharField(max_length=200)
+    handled_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ['event', 'handler']
+
+    def __str__(self):
+        return f"{self.handler} handled event {self.event_id}"
+
+
+class Message(models.Model):
+    """
+    A chat message between the two users of a match.
+
+    Messages are only ever appended. A conversation is read by ranges of
+    (match, id), so the id doubles as its cursor and its order.
+    """
+    # Indexed by message_match_id_idx
+    match = models.ForeignKey(
+            Match, on_delete=models.CASCADE, related_name='messages',
+            db_index=False)
+    sender = models.ForeignKey(
+            User, on_delete=models.CASCADE, related_name='sent_messages')
+    body = models.TextField(max_length=1000)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['match', 'id']
+        indexes = [
+            models.Index(fields=['match', 'id'], name='message_match_id_idx'),
+        ]
+
+    def __str__(self):
+        return f"Message {self.pk} in match {self.match_id}"
+
+
+class ChatReadState(models.Model):
+    """
+    How far a user has read a match's conversation.
+
+    unread_count is kept up to date as messages arrive and are read, so
+    unread badges do not count messages.
+    """
+    match = models.ForeignKey(
+            Match, on_delete=models.CASCADE, related_name='read_states')
+    user = models.ForeignKey(
+            User, on_delete=models.CASCADE, related_name='chat_read_states')
+    last_read_id = models.BigIntegerField(default=0)
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ['match', 'user']
+        indexes = [
+            models.Index(fields=['user', 'unread_count']),
+        ]
+
+    def __str__(self):
+        return (
+            f"{self.user.username} has {self.unread_count} unread in "
+            f"match {self.match_id}")
+
+
+class MatchNotification(models.Model):
+    """
+    A new match waiting to go out in its user's next email digest.
+
+    Deleted once the digest is sent. See connections.notifications.
+    """
+    user = models.ForeignKey(
+            User, on_delete=models.CASCADE,
+            related_name='match_notifications')
+    match = models.ForeignKey(
+            Match, on_delete=models.CASCADE, related_name='notifications')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['user', 'id']
+        unique_together = ['user', 'match']
+        indexes = [
+            # Finding users whose oldest notification is due
+            models.Index(fields=['created_at', 'user']),
+        ]
+
+    def __str__(self):
+        return f"Match {self.match_id} for {self.user.username}"
@@ -0,0 +1,144 @@
+"""
+Email digests of new matches.
+
+Match events from the outbox leave a MatchNotification for each user of
+the match; the swipe request itself sends nothing. Every
+``MATCH_EMAIL_WINDOW_SECONDS`` after a user's first unsent notification,
+the send_match_digests task mails them one digest listing all the
+matches made in that window, through the shared Mailer (match_up.mail).
+No email goes out unless both drain_outbox and run_task_worker (with
+the "email" queue) are running, as the Procfile's outbox and worker
+processes do.
+
+Notifications are deleted as their digest goes out. A run that fails
+part way keeps only the notifications it did not send, so no digest
+is sent twice unless the failure comes between the mail server
+accepting it and the delete.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.mail import EmailMultiAlternatives
+from django.db.models import Min
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils import timezone
+
+from match_up.mail import get_mailer
+from .models import MatchNotification, OutboxEvent
+from .outbox import handler
+
+logger = logging.getLogger(__name__)
+
+
+@handler(OutboxEvent.MATCH)
+def queue_match_notifications(event):
+    """Note a new match for both users' next digest"""
+    MatchNotification.objects.bulk_create([
+        MatchNotification(
+            match_id=event.payload['match_id'], user_id=user_id)
+        for user_id in (event.payload['user1_id'], event.payload['user2_id'])
+    ], ignore_conflicts=True)
+
+
+def get_due_user_ids(now=None, limit=None):
+    """
+    Users whose oldest unsent notification has waited out the window.
+
+    Args:
+        now: Current time, for tests
+        limit: Most users to return, longest waiting first
+
+    Returns:
+        List of user ids
+    """
+    cutoff = (now or timezone.now()) - timedelta(
+        seconds=settings.MATCH_EMAIL_WINDOW_SECONDS)
+    due = MatchNotification.objects.filter(
+        created_at__lte=cutoff
+    ).values('user').annotate(first=Min('created_at')).order_by('first')
+    return [row['user'] for row in due[:limit]]
+
+
+def build_digest(user, matches, site):
+    """
+    Build the digest email of some new matches.
+
+    Args:
+        user: Recipient User
+        matches: The user's new Match objects, users' profiles loaded
+        site: Site whose domain goes in links
+
+    Returns:
+        EmailMultiAlternatives
+    """
+    context = {
+        'user': user,
+        'others': [
+            match.user2 if match.user1_id == user.pk else match.user1
+            for match in matches
+        ],
+        'current_site': site,
+        'matches_url': (
+            f'https://{site.domain}{reverse("connections:matches")}'),
+    }
+    subject = render_to_string(
+        'connections/email/match_digest_subject.txt', context).strip()
+    message = EmailMultiAlternatives(
+        subject,
+        render_to_string('connections/email/match_digest.txt', context),
+        to=[user.email])
+    message.attach_alternative(
+        render_to_string('connections/email/match_digest.html', context),
+        'text/html')
+    return message
+
+
+def send_match_digests(now=None, limit=None):
+    """
+    Send the digests that are due.
+
+    Args:
+        now: Current time, for tests
+        limit: Most digests to send; defaults to
+               ``MATCH_EMAIL_BATCH_SIZE``
+
+    Returns:
+        Number of emails sent
+    """
+    user_ids = get_due_user_ids(
+        now, limit or settings.MATCH_EMAIL_BATCH_SIZE)
+    if not user_ids:
+        return 0
+    notifications = {}
+    queryset = MatchNotification.objects.filter(
+        user_id__in=user_ids
+    ).select_related(
+        'user', 'match__user1__profile', 'match__user2__profile')
+    for notification in queryset:
+        notifications.setdefault(notification.user, []).append(
+            notification)
+
+    site = Site.objects.get_current()
+    mailer = get_mailer()
+    sent = 0
+    done = []
+    try:
+        for user, user_notifications in notifications.items():
+            matches = [
+                notification.match for notification in user_notifications
+                if notification.match.is_active
+            ]
+            if matches and user.is_active and user.email:
+                if mailer.send(build_digest(user, matches, site)):
+                    sent += 1
+            # Sent, refused or nothing to send: either way it is done
+            done.extend(
+                notification.pk for notification in user_notifications)
+    finally:
+        if done:
+            MatchNotification.objects.filter(pk__in=done).delete()
+    logger.info('Sent %s match digest(s)', sent)
+    return sent
@@ -0,0 +1,191 @@
+"""
+Transactional outbox for swipe and match events.
+
+Every like, pass and new match gets an OutboxEvent, written by signals
+in the transaction that saves the change (connections.signals). That
+single insert is all the swipe request pays for. Work that reacts to
+the events, such as notifications, analytics or recommendation updates,
+registers a handler and runs in the ``drain_outbox`` consumer.
+
+Delivery is at least once. A batch commits only after its handlers have
+run, so events of a consumer that dies mid-batch are delivered again.
+Each handler runs in a savepoint together with the HandledEvent row for
+(event, handler): its database writes and that row commit or roll back
+together, and a redelivered event skips the handlers that already
+committed. Handlers with effects outside the database must cope with
+seeing an event twice.
+
+On PostgreSQL batches are claimed with ``SELECT ... FOR UPDATE SKIP
+LOCKED``, so several consumers can drain the outbox side by side.
+"""
+import logging
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import HandledEvent, OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+_handlers = {}
+
+
+def handler(*kinds):
+    """
+    Register a function to call with every event of some kinds.
+
+    The function receives the OutboxEvent. It is identified by its dotted
+    path in HandledEvent, so renaming it delivers old events again.
+    """
+    def register(func):
+        name = f'{func.__module__}.{func.__qualname__}'
+        for kind in kinds:
+            if all(name != known for known, _ in _handlers.get(kind, ())):
+                _handlers.setdefault(kind, []).append((name, func))
+        return func
+    return register
+
+
+def get_handlers(kind):
+    """(name, function) of the handlers registered for a kind"""
+    return list(_handlers.get(kind, ()))
+
+
+def publish(kind, payload, using='default'):
+    """Add an event to the outbox in the current transaction"""
+    return OutboxEvent.objects.using(using).create(
+        kind=kind, payload=payload)
+
+
+def retry_delay(attempts):
+    """How long a failed event waits before its next delivery"""
+    return timedelta(seconds=min(
+        settings.OUTBOX_RETRY_SECONDS * 2 ** (attempts - 1),
+        settings.OUTBOX_MAX_RETRY_SECONDS))
+
+
+def _handle(event, handled, using):
+    """
+    Run the handlers of an event that have not handled it yet.
+
+    Returns:
+        The formatted error of a failed handler, or None
+    """
+    error = None
+    for name, func in get_handlers(event.kind):
+        if (event.pk, name) in handled:
+            continue
+        try:
+            with transaction.atomic(using=using):
+                func(event)
+                HandledEvent.objects.using(using).create(
+                    event=event, handler=name)
+        except Exception:
+            logger.exception(
+                'Outbox handler %s failed on event %s', name, event.pk)
+            # The other handlers are independent, so they still run
+            error = traceback.format_exc()
+    return error
+
+
+def drain(batch_size=None, using='default'):
+    """
+    Deliver one batch of waiting events, oldest first.
+
+    A failed event is retried after retry_delay and given up after
+    ``OUTBOX_MAX_ATTEMPTS`` deliveries, keeping its last error.
+
+    Args:
+        batch_size: Events to claim; defaults to ``OUTBOX_BATCH_SIZE``
+        using: Database alias
+
+    Returns:
+        Tuple of (delivered, failed) event counts
+    """
+    now = timezone.now()
+    events = OutboxEvent.objects.using(using)
+    with transaction.atomic(using=using):
+        batch = list(events.filter(
+            processed_at__isnull=True, failed_at__isnull=True,
+            available_at__lte=now,
+        ).order_by('available_at', 'id').select_for_update(
+            skip_locked=True
+        )[:batch_size or settings.OUTBOX_BATCH_SIZE])
+        if not batch:
+            return 0, 0
+        handled = set(HandledEvent.objects.using(using).filter(
+            event__in=batch).values_list('event_id', 'handler'))
+
+        delivered = []
+        failed = 0
+        for event in batch:
+            error = _handle(event, handled, using)
+            if error is None:
+                delivered.append(event.pk)
+                continue
+            failed += 1
+            event.attempts += 1
+            event.last_error = error
+            if event.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                event.failed_at = now
+            else:
+                event.available_at = now + retry_delay(event.attempts)
+            event.save(update_fields=[
+                'attempts', 'last_error', 'failed_at', 'available_at'])
+        events.filter(pk__in=delivered).update(
+            processed_at=now, attempts=F('attempts') + 1)
+    return len(delivered), failed
+
+
+def purge(older_than=None, failed_older_than=None, batch_size=1000,
+          using='default'):
+    """
+    Delete events delivered more than ``OUTBOX_RETENTION_DAYS`` ago and
+    events given up more than ``OUTBOX_FAILED_RETENTION_DAYS`` ago.
+
+    Events and their HandledEvent rows are deleted with plain DELETE
+    statements, ``batch_size`` events at a time, instead of through
+    Django's collector, which would load every expired event first.
+
+    Args:
+        older_than: timedelta to keep delivered events instead
+        failed_older_than: timedelta to keep failed events instead
+        batch_size: Events deleted per transaction
+        using: Database alias
+
+    Returns:
+        Number of events deleted
+    """
+    now = timezone.now()
+    cutoff = now - (
+        older_than or timedelta(days=settings.OUTBOX_RETENTION_DAYS))
+    failed_cutoff = now - (failed_older_than or timedelta(
+        days=settings.OUTBOX_FAILED_RETENTION_DAYS))
+    expired = OutboxEvent.objects.using(using).filter(
+        Q(processed_at__lt=cutoff) | Q(failed_at__lt=failed_cutoff)
+    ).order_by('pk').values_list('pk', flat=True)
+    count = 0
+    while True:
+        with transaction.atomic(using=using):
+            event_ids = list(expired[:batch_size])
+            if not event_ids:
+                return count
+            HandledEvent.objects.using(using).filter(
+                event_id__in=event_ids)._raw_delete(using)
+            OutboxEvent.objects.using(using).filter(
+                pk__in=event_ids)._raw_delete(using)
+        count += len(event_ids)
+        if len(event_ids) < batch_size:
+            return count
+
+
+@handler(OutboxEvent.MATCH)
+def log_match(event):
+    """Record new matches in the log, for analytics pipelines reading it"""
+    logger.info(
+        'New match %s between users %s and %s', event.payload['match_id'],
+        event.payload['user1_id'], event.payload['user2_id'])
@@ -0,0 +1,163 @@
+"""
+Publish/subscribe layer behind push notifications and chat long polls.
+
+Messages are published on a channel, such as a user's or a match's, and
+reach every open subscription to that channel. ``PUBSUB_BACKEND`` names
+the class to use. InMemoryPubSub only reaches subscribers in the process
+that published the message: enough for a single ASGI process, and for
+tests. Several processes or servers need a backend built on a shared
+broker, such as Redis pub/sub, with the same publish and subscribe
+methods.
+
+Publishing is synchronous and may happen on any thread, such as a sync
+view running in a thread pool. Subscriptions are read asynchronously by
+the event loop that opened them.
+"""
+import asyncio
+import itertools
+import threading
+from collections import deque, namedtuple
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+Message = namedtuple('Message', 'id channel event data')
+
+
+def user_channel(user_id):
+    """The channel of a user's notifications"""
+    return f'user:{user_id}'
+
+
+def match_channel(match_id):
+    """The channel of a match's chat messages"""
+    return f'match:{match_id}'
+
+
+class Subscription:
+    """
+    Messages of one channel, in publishing order.
+
+    When the reader falls ``PUBSUB_QUEUE_SIZE`` messages behind, the
+    oldest unread ones are dropped.
+    """
+
+    def __init__(self, pubsub, channel):
+        self.pubsub = pubsub
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(settings.PUBSUB_QUEUE_SIZE)
+        self.closed = False
+
+    def put(self, message):
+        """Queue a message; runs on the subscription's event loop"""
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(message)
+
+    async def get(self, timeout=None):
+        """
+        The next message.
+
+        Returns:
+            The Message, or None when none arrived within timeout seconds
+        """
+        if not self.queue.empty():
+            return self.queue.get_nowait()
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.pubsub.unsubscribe(self)
+
+
+class InMemoryPubSub:
+    """
+    Pub/sub between the threads and event loops of one process.
+
+    The last ``PUBSUB_HISTORY`` messages are kept, so a subscriber that
+    reconnects can get what it missed since the last message it saw.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._subscriptions = {}
+        self._history = deque(maxlen=settings.PUBSUB_HISTORY)
+
+    def publish(self, channel, event, data):
+        """
+        Send a message to the subscribers of a channel.
+
+        Args:
+            channel: Channel name, see user_channel
+            event: Event type, such as 'match'
+            data: JSON-serializable payload
+
+        Returns:
+            The published Message
+        """
+        with self._lock:
+            message = Message(str(next(self._ids)), channel, event, data)
+            self._history.append(message)
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(
+                    subscription.put, message)
+            except RuntimeError:
+                # Its event loop is closed, so nobody will read it again
+                subscription.close()
+        return message
+
+    def subscribe(self, channel, last_id=None):
+        """
+        Open a subscription from the running event loop.
+
+        Args:
+            channel: Channel name
+            last_id: Id of the last message the subscriber saw; the
+                     channel's later messages still in the history are
+                     delivered first
+
+        Returns:
+            A Subscription; close it when done
+        """
+        subscription = Subscription(self, channel)
+        with self._lock:
+            self._subscriptions.setdefault(channel, set()).add(subscription)
+            if last_id is not None and last_id.isdigit():
+                for message in self._history:
+                    if (message.channel == channel and
+                            int(message.id) > int(last_id)):
+                        subscription.put(message)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.channel]
+
+    def subscriber_count(self, channel):
+        with self._lock:
+            return len(self._subscriptions.get(channel, ()))
+
+
+_pubsub = None
+_pubsub_lock = threading.Lock()
+
+
+def get_pubsub():
+    """The process's instance of ``PUBSUB_BACKEND``"""
+    global _pubsub
+    with _pubsub_lock:
+        if _pubsub is None:
+            _pubsub = import_string(settings.PUBSUB_BACKEND)()
+        return _pubsub
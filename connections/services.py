@@ -1,8 +1,30 @@
 """
 Service functions for connection-related operations
 """
+import random
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count, Exists, F, OuterRef, Q, Sum
+from django.utils.encoding import force_str
+from django.utils.functional import cached_property
+from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
+
 from dating.models import Profile
-from .models import Like
+from .catalog import CatalogSelection
+from .models import Like, LikeCounter, Match
+from .similarity import similarity_index
+from .snapshot import get_discovery_catalog
+
+# Inbox counters live in shard 0 until it reaches HOT_COUNTER_THRESHOLD,
+# then increments are spread over LIKE_COUNTER_SHARDS rows
+LIKE_COUNTER_SHARDS = 8
+HOT_COUNTER_THRESHOLD = 500
+# Similar users the SQL feed hides are excluded and the lookup run again,
+# at most this many times
+SIMILARITY_LOOKUPS = 3
 
 
 def get_discoverable_profiles(user, preferences=None, order_by='newest'):
@@ -21,7 +43,7 @@ def get_discoverable_profiles(user, preferences=None, order_by='newest'):
     """
 
     # Start with all profiles except current user
-    queryset = Profile.objects.exclude(user=user)
+    queryset = Profile.objects.select_related('user').exclude(user=user)
 
     # Exclude profiles user has already liked
     liked_user_ids = Like.objects.filter(
@@ -44,3 +66,504 @@ def get_discoverable_profiles(user, preferences=None, order_by='newest'):
         queryset = queryset.order_by('-createdAt')
 
     return queryset
+
+
+class ReciprocalFeed:
+    """
+    Discovery feed with recent admirers interleaved into the first pages.
+
+    Liker ``k`` takes position ``k * spacing`` and the remaining profiles
+    keep their order around them. With a spacing of 1 the given users
+    simply come first, which is how similar profiles are shown. Slicing
+    the feed, which is all a Paginator does, runs one query that loads
+    the likers on that page together with the other profiles.
+
+    Args:
+        profiles: Discoverable profiles in their usual order, a QuerySet
+                  or a CatalogSelection; must include the likers
+        liker_ids: Ids of users who already liked the viewer, in the order
+                   they should appear
+        spacing: Distance between two interleaved likers
+    """
+
+    def __init__(self, profiles, liker_ids, spacing):
+        self.profiles = profiles
+        self.liker_ids = list(liker_ids)
+        self.spacing = max(1, spacing)
+        if isinstance(profiles, CatalogSelection):
+            self.rest = profiles.exclude_users(self.liker_ids)
+        else:
+            self.rest = profiles.exclude(user_id__in=self.liker_ids)
+        self.model = profiles.model
+        self.ordered = True
+
+    @cached_property
+    def _count(self):
+        return self.profiles.count()
+
+    def count(self):
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def _liker_positions(self):
+        rest_count = self.count() - len(self.liker_ids)
+        # Likers bunch up at the end once the other profiles run out
+        return {
+            k + min(k * (self.spacing - 1), rest_count): user_id
+            for k, user_id in enumerate(self.liker_ids)
+        }
+
+    def _fetch(self, start, stop, user_ids):
+        """Load a slice of the other profiles and some likers together"""
+        if isinstance(self.rest, CatalogSelection):
+            return self.rest.fetch(start, stop, user_ids)
+        rows = list(self.profiles.filter(
+            Q(user_id__in=user_ids) |
+            Q(pk__in=self.rest[start:stop].values('pk'))
+        ))
+        likers = {
+            profile.user_id: profile for profile in rows
+            if profile.user_id in user_ids
+        }
+        return [
+            profile for profile in rows if profile.user_id not in likers
+        ], likers
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self[key:key + 1][0]
+        start, stop, _ = key.indices(self.count())
+        positions = self._liker_positions()
+        page_likers = {
+            position: user_id for position, user_id in positions.items()
+            if start <= position < stop
+        }
+        rest_start = start - sum(1 for p in positions if p < start)
+        rest_stop = rest_start + max(0, stop - start - len(page_likers))
+        if not page_likers:
+            return list(self.rest[rest_start:rest_stop])
+
+        rest, likers = self._fetch(
+            rest_start, rest_stop, set(page_likers.values()))
+        rest = iter(rest)
+        # Profiles deleted since the page was counted leave a gap
+        page = [
+            likers.get(page_likers[index]) if index in page_likers
+            else next(rest, None)
+            for index in range(start, stop)
+        ]
+        return [profile for profile in page if profile is not None]
+
+
+def get_discovery_feed(user, order_by='reciprocal'):
+    """
+    Get the discovery feed shown to a user.
+
+    With ``DISCOVERY_CATALOG_ENABLED`` the newest-first candidates are
+    filtered and ordered in the in-memory profile catalog, or the shared
+    snapshot when one is configured, and only the page shown is loaded
+    from the database; otherwise get_discoverable_profiles does the
+    filtering in SQL.
+
+    With 'reciprocal' ordering, up to ``DISCOVERY_RECIPROCAL_LIMIT`` users
+    who liked the viewer and have not been swiped yet are interleaved
+    into the newest-first feed, one every
+    ``DISCOVERY_RECIPROCAL_SPACING`` profiles. Their ids come from one
+    query on the (to_user, action, created_at, id) index, so the extra
+    cost does not grow with the number of profiles or likes.
+
+    With 'similar' ordering, up to ``SIMILARITY_LIMIT`` profiles whose
+    bio and interests are closest to the viewer's come first, then the
+    rest newest first. See connections.similarity.
+
+    Args:
+        user: The User requesting the feed
+        order_by: 'reciprocal' (default), 'similar', 'newest' or 'random'
+
+    Returns:
+        A ReciprocalFeed, a CatalogSelection or a QuerySet of Profile
+        objects
+    """
+    if order_by == 'random':
+        return get_discoverable_profiles(user, order_by=order_by)
+    if settings.DISCOVERY_CATALOG_ENABLED:
+        swiped = Like.objects.filter(
+            from_user=user).values_list('to_user_id', flat=True)
+        profiles = get_discovery_catalog().select(
+            exclude_user_ids=[user.pk, *swiped])
+    else:
+        profiles = get_discoverable_profiles(user, order_by='newest')
+    if order_by == 'similar':
+        similar_ids = get_similar_user_ids(user, profiles)
+        if not similar_ids:
+            return profiles
+        return ReciprocalFeed(profiles, similar_ids, spacing=1)
+
+    limit = settings.DISCOVERY_RECIPROCAL_LIMIT
+    if order_by != 'reciprocal' or limit <= 0:
+        return profiles
+    liker_ids = list(Like.objects.filter(
+        to_user=user, action=Like.LIKE, from_user__profile__isnull=False
+    ).exclude(
+        from_user__in=Like.objects.filter(
+            from_user=user).values('to_user_id')
+    ).order_by('-created_at', '-id').values_list(
+        'from_user_id', flat=True)[:limit])
+    if not liker_ids:
+        return profiles
+    return ReciprocalFeed(
+        profiles, liker_ids, settings.DISCOVERY_RECIPROCAL_SPACING)
+
+
+def get_similar_user_ids(user, profiles):
+    """
+    Discoverable users whose bios and interests resemble the user's.
+
+    Args:
+        user: The User with a profile to compare against
+        profiles: The user's discoverable profiles, a QuerySet or a
+                  CatalogSelection
+
+    Returns:
+        Up to ``SIMILARITY_LIMIT`` user ids, most similar first; empty
+        when no similarity index has been built
+    """
+    index = similarity_index.load()
+    profile = getattr(user, 'profile', None)
+    if index is None or profile is None:
+        return []
+    limit = settings.SIMILARITY_LIMIT
+    if isinstance(profiles, CatalogSelection):
+        return index.nearest(
+            profile.bio, profile.interests, limit,
+            exclude_user_ids=[user.pk], include=profiles.contains_user)
+
+    # Swiped users are the ones usually left out, so they are excluded
+    # before ranking; others the feed hides are found by one query per
+    # lookup and replaced by the next most similar users
+    excluded = {user.pk, *Like.objects.filter(
+        from_user=user).values_list('to_user_id', flat=True)}
+    for _ in range(SIMILARITY_LOOKUPS):
+        similar_ids = index.nearest(
+            profile.bio, profile.interests, limit, exclude_user_ids=excluded)
+        discoverable = set(profiles.filter(
+            user_id__in=similar_ids).values_list('user_id', flat=True))
+        if len(discoverable) == len(similar_ids):
+            break
+        excluded.update(set(similar_ids) - discoverable)
+    return [user_id for user_id in similar_ids if user_id in discoverable]
+
+
+def simulate_bot_like_back(bot_user, user):
+    """
+    Let a bot user answer a like from a real user.
+
+    Bots like back with probability ``BOT_LIKE_BACK_RATE``; the mutual
+    like then creates a Match through the usual signal.
+
+    Args:
+        bot_user: The liked User whose profile has is_bot set
+        user: The User who sent the like
+
+    Returns:
+        True if the bot likes the user back
+    """
+    rate = settings.BOT_LIKE_BACK_RATE
+    if rate <= 0 or random.random() >= rate:
+        return False
+    like, _ = Like.objects.get_or_create(
+        from_user=bot_user,
+        to_user=user,
+        defaults={'action': Like.LIKE}
+    )
+    return like.action == Like.LIKE
+
+
+def create_match_if_mutual(user_id, other_id):
+    """
+    Create the Match between two users if they have liked each other.
+
+    Safe to call repeatedly and from concurrent transactions: the unique
+    (user1, user2) constraint decides which caller inserts the row and
+    the others get the existing one.
+
+    Args:
+        user_id: Id of one user
+        other_id: Id of the other user
+
+    Returns:
+        The Match, or None if the likes are not mutual
+    """
+    likes = Like.objects.filter(
+        Q(from_user_id=user_id, to_user_id=other_id) |
+        Q(from_user_id=other_id, to_user_id=user_id),
+        action=Like.LIKE
+    )
+    if likes.count() < 2:
+        return None
+    user1_id, user2_id = sorted((user_id, other_id))
+    match, _ = Match.objects.get_or_create(
+        user1_id=user1_id,
+        user2_id=user2_id,
+        defaults={'is_active': True}
+    )
+    return match
+
+
+def increment_like_counter(user_id):
+    """Add one like to a user's inbox counter"""
+    counters = LikeCounter.objects.filter(user_id=user_id)
+    if counters.filter(
+            shard=0, count__lt=HOT_COUNTER_THRESHOLD
+    ).update(count=F('count') + 1):
+        return
+    counter, created = LikeCounter.objects.get_or_create(
+        user_id=user_id, shard=0, defaults={'count': 1})
+    if created:
+        return
+    # Shard 0 is hot, spread the write over the other shards
+    shard = random.randrange(1, LIKE_COUNTER_SHARDS)
+    if counters.filter(shard=shard).update(count=F('count') + 1):
+        return
+    counter, created = LikeCounter.objects.get_or_create(
+        user_id=user_id, shard=shard, defaults={'count': 1})
+    if not created:
+        counters.filter(shard=shard).update(count=F('count') + 1)
+
+
+def decrement_like_counter(user_id):
+    """Remove one like from a user's inbox counter"""
+    shard = LikeCounter.objects.filter(
+        user_id=user_id, count__gt=0
+    ).order_by('?').values('pk')[:1]
+    LikeCounter.objects.filter(
+        pk__in=shard, count__gt=0
+    ).update(count=F('count') - 1)
+
+
+def get_like_count(user):
+    """Number of likes waiting in a user's "Liked you" inbox"""
+    return LikeCounter.objects.filter(user=user).aggregate(
+        total=Sum('count'))['total'] or 0
+
+
+def _reverse_action(like):
+    return Like.objects.filter(
+        from_user_id=like.to_user_id,
+        to_user_id=like.from_user_id
+    ).values_list('action', flat=True).first()
+
+
+def update_like_counters(like, previous_action, created):
+    """
+    Keep inbox counters in step with a saved Like.
+
+    A like waits in the receiver's inbox until the receiver swipes the
+    sender. Saving a like can therefore add to or remove from the
+    receiver's inbox, or answer a like waiting in the sender's own inbox.
+
+    Args:
+        like: The saved Like
+        previous_action: Action loaded from the database, if known
+        created: Whether the Like was just inserted
+    """
+    if not created and previous_action in (None, like.action):
+        return
+    reverse_action = _reverse_action(like)
+    if reverse_action is None:
+        if like.action == Like.LIKE:
+            increment_like_counter(like.to_user_id)
+        elif not created:
+            decrement_like_counter(like.to_user_id)
+    elif created and reverse_action == Like.LIKE:
+        decrement_like_counter(like.from_user_id)
+
+
+def update_like_counters_on_delete(like):
+    """Keep inbox counters in step with a deleted Like"""
+    reverse_action = _reverse_action(like)
+    if reverse_action is None:
+        if like.action == Like.LIKE:
+            decrement_like_counter(like.to_user_id)
+    elif reverse_action == Like.LIKE:
+        increment_like_counter(like.from_user_id)
+
+
+def _pending_like_totals(**filters):
+    """(user id, pending likes) rows for the receivers matching filters"""
+    answered = Like.objects.filter(
+        from_user=OuterRef('to_user'), to_user=OuterRef('from_user'))
+    matched = Match.objects.filter(
+        Q(user1=OuterRef('from_user'), user2=OuterRef('to_user')) |
+        Q(user1=OuterRef('to_user'), user2=OuterRef('from_user')))
+    return Like.objects.filter(action=Like.LIKE, **filters).exclude(
+        Exists(answered)).exclude(Exists(matched)).values_list(
+        'to_user_id').annotate(total=Count('id')).order_by()
+
+
+def reconcile_like_counter(user_id):
+    """
+    Recount one user's inbox and put the total right if it drifted.
+
+    The recount runs while holding the lock on the user's counter rows, so
+    a swipe committing meanwhile is either seen by the recount or applies
+    its increment after it, never both or neither.
+
+    Args:
+        user_id: Primary key of the inbox owner
+
+    Returns:
+        Whether the stored total was wrong
+    """
+    with transaction.atomic():
+        LikeCounter.objects.get_or_create(user_id=user_id, shard=0)
+        counters = list(LikeCounter.objects.select_for_update().filter(
+            user_id=user_id))
+        total = dict(_pending_like_totals(to_user_id=user_id)).get(
+            user_id, 0)
+        if sum(counter.count for counter in counters) == total:
+            return False
+        LikeCounter.objects.filter(
+            user_id=user_id, shard__gt=0).update(count=0)
+        LikeCounter.objects.filter(
+            user_id=user_id, shard=0).update(count=total)
+    return True
+
+
+def rebuild_like_counters(batch_size=5000):
+    """
+    Recount every inbox from the likes table.
+
+    Counters are maintained incrementally; this puts right any that
+    drifted, from racing swipes or writes that bypassed signals. Stored
+    and expected totals are compared batch_size users at a time, and only
+    the users that disagree are recounted, each in its own short
+    transaction (reconcile_like_counter), so the rebuild can run
+    alongside live swipes.
+
+    Args:
+        batch_size: Users compared per query
+
+    Returns:
+        Number of users whose counters were corrected
+    """
+    users = User.objects.order_by('pk').values_list('pk', flat=True)
+    corrected = 0
+    last_pk = 0
+    while True:
+        user_ids = list(users.filter(pk__gt=last_pk)[:batch_size])
+        if not user_ids:
+            return corrected
+        last_pk = user_ids[-1]
+        expected = dict(_pending_like_totals(
+            to_user_id__gte=user_ids[0], to_user_id__lte=last_pk))
+        stored = dict(LikeCounter.objects.filter(
+            user_id__gte=user_ids[0], user_id__lte=last_pk
+        ).values_list('user_id').annotate(total=Sum('count')).order_by())
+        for user_id in user_ids:
+            if expected.get(user_id, 0) != stored.get(user_id, 0):
+                corrected += reconcile_like_counter(user_id)
+
+
+def reset_like_counters(batch_size=5000):
+    """
+    Replace every inbox counter with a fresh count, in one transaction.
+
+    Much faster than rebuild_like_counters when most counters are wrong,
+    but swipes saved while it runs can be lost from the counts, so use it
+    only when nothing else is writing likes, such as after a bulk load.
+
+    Returns:
+        Number of users with a non-empty inbox
+    """
+    totals = _pending_like_totals()
+    users = 0
+    with transaction.atomic():
+        LikeCounter.objects.all().delete()
+        batch = []
+        for user_id, total in totals.iterator(chunk_size=batch_size):
+            batch.append(LikeCounter(user_id=user_id, shard=0, count=total))
+            if len(batch) >= batch_size:
+                LikeCounter.objects.bulk_create(batch)
+                users += len(batch)
+                batch = []
+        LikeCounter.objects.bulk_create(batch)
+        users += len(batch)
+    return users
+
+
+def pending_likes(user):
+    """
+    Likes received by a user that are still waiting for an answer.
+
+    Senders the user has liked, passed or matched with are left out.
+    """
+    return Like.objects.filter(
+        to_user=user, action=Like.LIKE
+    ).exclude(
+        from_user__in=Like.objects.filter(
+            from_user=user).values('to_user_id')
+    ).exclude(
+        from_user__in=Match.objects.filter(user1=user).values('user2_id')
+    ).exclude(
+        from_user__in=Match.objects.filter(user2=user).values('user1_id')
+    )
+
+
+def encode_like_cursor(like):
+    """Opaque keyset cursor pointing just after ``like``"""
+    value = f'{like.created_at.isoformat()}|{like.pk}'
+    return urlsafe_base64_encode(value.encode())
+
+
+def decode_like_cursor(cursor):
+    """
+    Parse a cursor made by encode_like_cursor.
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        created_at, like_id = force_str(
+            urlsafe_base64_decode(cursor)).split('|')
+        return datetime.fromisoformat(created_at), int(like_id)
+    except (TypeError, ValueError, UnicodeDecodeError) as error:
+        raise ValueError('Invalid cursor') from error
+
+
+def get_liked_you_page(user, cursor=None, limit=20):
+    """
+    Get one page of a user's "Liked you" inbox, newest first.
+
+    Pages are fetched by keyset on (created_at, id), so every page costs
+    the same however deep it is.
+
+    Args:
+        user: The User whose inbox is shown
+        cursor: Cursor from the previous page, or None for the first page
+        limit: Number of likes per page
+
+    Returns:
+        Tuple of (list of Like with from_user.profile loaded, next cursor
+        or None)
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    likes = pending_likes(user).filter(
+        from_user__profile__isnull=False
+    ).select_related('from_user__profile').order_by('-created_at', '-id')
+    if cursor:
+        created_at, like_id = decode_like_cursor(cursor)
+        likes = likes.filter(
+            Q(created_at__lt=created_at) |
+            Q(created_at=created_at, id__lt=like_id)
+        )
+    page = list(likes[:limit + 1])
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = encode_like_cursor(page[-1])
+    return page, next_cursor
@@ -1,35 +1,130 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from .models import Like, Match
+from dating.models import Profile
+from .catalog import catalog
+from .models import Like, Match, OutboxEvent
+from .outbox import publish
+from .pubsub import get_pubsub, user_channel
+from .services import (
+    create_match_if_mutual, update_like_counters,
+    update_like_counters_on_delete,
+)
 
 
 @receiver(post_save, sender=Like)
-def create_match_on_mutual_like(sender, instance, created, **kwargs):
+def publish_swipe_event(sender, instance, created, using, **kwargs):
+    """
+    Queue a like or pass event in the swipe's transaction.
+    Registered first so the event precedes any match the like creates.
+    """
+    previous_action = getattr(instance, '_loaded_action', None)
+    if not created and previous_action in (None, instance.action):
+        return
+    publish(
+        OutboxEvent.LIKE if instance.action == Like.LIKE
+        else OutboxEvent.PASS,
+        {
+            'like_id': instance.pk,
+            'from_user_id': instance.from_user_id,
+            'to_user_id': instance.to_user_id,
+        },
+        using=using
+    )
+
+
+@receiver(post_save, sender=Like)
+def push_like_notification(sender, instance, created, using, **kwargs):
+    """
+    Tell the liked user about a new like once it is committed.
+    Registered before the match receivers so the like is pushed first.
+    """
+    previous_action = getattr(instance, '_loaded_action', None)
+    if instance.action != Like.LIKE or (
+            not created and previous_action in (None, Like.LIKE)):
+        return
+    channel = user_channel(instance.to_user_id)
+    data = {'like_id': instance.pk, 'from_user_id': instance.from_user_id}
+    transaction.on_commit(
+        lambda: get_pubsub().publish(channel, 'like', data), using=using)
+
+
+@receiver(post_save, sender=Like)
+def create_match_on_mutual_like(sender, instance, using, **kwargs):
     """
     Automatically create a Match when two users like each other.
-    This signal fires after a Like is saved.
+    This signal fires after a Like is saved, including a pass that is
+    changed into a like.
+
+    The reverse like may belong to a concurrent transaction that has not
+    committed yet. Inside a transaction the check is therefore repeated
+    after commit: of two likes racing each other, the one that commits
+    last is then guaranteed to see the other.
     """
-    # Only process if this is a new Like with action='like'
-    if not created or instance.action != Like.LIKE:
+    if instance.action != Like.LIKE:
+        return
+
+    user_id, other_id = instance.from_user_id, instance.to_user_id
+    if create_match_if_mutual(user_id, other_id):
         return
 
-    # Check if the other user has also liked this user back
-    reverse_like = Like.objects.filter(
-        from_user=instance.to_user,
-        to_user=instance.from_user,
-        action=Like.LIKE
-    ).first()
-
-    if reverse_like:
-        # Mutual like exists - create a Match
-        # Ensure stable ordering (user1.id < user2.id) for uniqueness
-        user1, user2 = instance.from_user, instance.to_user
-        if user1.id > user2.id:
-            user1, user2 = user2, user1
-
-        # Use get_or_create to prevent duplicate matches
-        Match.objects.get_or_create(
-            user1=user1,
-            user2=user2,
-            defaults={'is_active': True}
+    if transaction.get_connection(using).in_atomic_block:
+        transaction.on_commit(
+            lambda: create_match_if_mutual(user_id, other_id),
+            using=using
         )
+
+
+@receiver(post_save, sender=Like)
+def update_like_counters_on_save(sender, instance, created, **kwargs):
+    """Keep "Liked you" inbox counters in step with swipes"""
+    update_like_counters(
+        instance, getattr(instance, '_loaded_action', None), created)
+
+
+@receiver(post_save, sender=Match)
+def publish_match_event(sender, instance, created, using, **kwargs):
+    """Queue a match event in the transaction that created the match"""
+    if created:
+        publish(OutboxEvent.MATCH, {
+            'match_id': instance.pk,
+            'user1_id': instance.user1_id,
+            'user2_id': instance.user2_id,
+        }, using=using)
+
+
+@receiver(post_save, sender=Match)
+def push_match_notification(sender, instance, created, using, **kwargs):
+    """Tell both users about a new match once it is committed"""
+    if not created:
+        return
+    pairs = (
+        (instance.user1_id, instance.user2_id),
+        (instance.user2_id, instance.user1_id),
+    )
+
+    def push():
+        pubsub = get_pubsub()
+        for user_id, other_id in pairs:
+            pubsub.publish(user_channel(user_id), 'match', {
+                'match_id': instance.pk, 'user_id': other_id})
+
+    transaction.on_commit(push, using=using)
+
+
+@receiver(post_delete, sender=Like)
+def update_like_counters_after_delete(sender, instance, **kwargs):
+    """Keep "Liked you" inbox counters in step with removed swipes"""
+    update_like_counters_on_delete(instance)
+
+
+@receiver(post_save, sender=Profile)
+def update_catalog_on_save(sender, instance, **kwargs):
+    """Show new and edited profiles in this process's discovery catalog"""
+    catalog.update(instance)
+
+
+@receiver(post_delete, sender=Profile)
+def update_catalog_after_delete(sender, instance, **kwargs):
+    """Remove deleted profiles from this process's discovery catalog"""
+    catalog.discard(instance.pk)
@@ -0,0 +1,312 @@
+"""
+"Similar to me" recommendations from profile bios and interests.
+
+An offline job (build_similarity_index) turns every profile's bio words
+and interests into hashed TF-IDF features and reduces them to a 64-bit
+SimHash signature, i.e. the signs of 64 random projections.
+Profiles with close signatures use similar words.
+
+The signatures are written to an index file with ``TABLES`` LSH tables,
+each keyed on a 16-bit window of the signature: window values sorted
+next to the rows that have them. Workers map the file read-only. A
+lookup probes each table's bucket for the viewer's signature and the
+buckets one bit away, then ranks the candidates by Hamming distance.
+With 65536 buckets per table, buckets stay small even with millions of
+profiles, so every candidate is ranked and the cost of a lookup depends
+on bucket sizes, not on the number of profiles. Indexes of up to
+``FULL_SCAN_ROWS`` profiles are ranked in full instead.
+
+File layout, little-endian::
+
+    header   magic, rows, feature buckets, written at
+    idf      one float per feature bucket
+    users    user id of each row
+    hashes   signature of each row
+    tables   per table, sorted window values then the matching rows
+"""
+import hashlib
+import heapq
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+from django.conf import settings
+
+MAGIC = b'MUPSIM03'
+HEADER = struct.Struct('<8sQQd')
+SIGNATURE_BITS = 64
+# Bios alike enough to recommend still differ in about a third of the
+# bits, so each table is also probed one bit either way, and the windows
+# overlap to give many tables: each bit is in WINDOW_BITS / WINDOW_STEP
+# of them
+WINDOW_BITS = 16
+WINDOW_STEP = 4
+TABLES = SIGNATURE_BITS // WINDOW_STEP
+# Small indexes have too few profiles near any one signature for the
+# tables to find them, and are cheap to rank in full
+FULL_SCAN_ROWS = 4096
+FEATURE_BUCKETS = 1 << 18
+# Weights are summed as integers in 32-bit lanes, one lane per bit
+WEIGHT_SCALE = 100
+INTEREST_WEIGHT = 2
+
+WORD_RE = re.compile(r"[a-z0-9']+")
+STOP_WORDS = frozenset(
+    'a an and are as at be but by for from i i\'m im in is it my of on '
+    'or so that the this to with you me am'.split())
+
+_LANE = struct.Struct('<64I')
+
+
+def profile_features(bio, interests):
+    """
+    Hashed features of a profile with their term counts.
+
+    Returns:
+        Dict of 64-bit feature hash to count
+    """
+    words = [
+        word for word in WORD_RE.findall((bio or '').casefold())
+        if word not in STOP_WORDS
+    ]
+    counts = {}
+    for word in words:
+        key = _feature_hash(f'w:{word}')
+        counts[key] = counts.get(key, 0) + 1
+    for interest in (interests or '').split(','):
+        interest = ' '.join(interest.casefold().split())
+        if interest:
+            key = _feature_hash(f'i:{interest}')
+            counts[key] = counts.get(key, 0) + INTEREST_WEIGHT
+    return counts
+
+
+def _feature_hash(term):
+    return int.from_bytes(
+        hashlib.blake2b(term.encode(), digest_size=8).digest(), 'little')
+
+
+_spread_cache = {}
+
+
+def _spread(feature):
+    """The feature's hash bits as 32-bit lanes holding 0 or 1"""
+    spread = _spread_cache.get(feature)
+    if spread is None:
+        if len(_spread_cache) > 1 << 20:
+            _spread_cache.clear()
+        spread = int.from_bytes(_LANE.pack(*(
+            feature >> bit & 1 for bit in range(SIGNATURE_BITS))), 'little')
+        _spread_cache[feature] = spread
+    return spread
+
+
+def signature(features, idf):
+    """
+    SimHash signature of weighted features.
+
+    Each feature adds its weight to the lanes of its set bits in one
+    big-integer multiply; a signature bit is set when the features with
+    that bit carry more than half of the total weight.
+
+    Args:
+        features: Dict of feature hash to count, see profile_features
+        idf: Inverse document frequency per feature bucket
+    """
+    lanes = 0
+    total = 0
+    for feature, count in features.items():
+        weight = round(
+            count * idf[feature % FEATURE_BUCKETS] * WEIGHT_SCALE)
+        lanes += _spread(feature) * weight
+        total += weight
+    if not total:
+        return 0
+    sums = _LANE.unpack(lanes.to_bytes(_LANE.size, 'little'))
+    result = 0
+    for bit, value in enumerate(sums):
+        if value * 2 > total:
+            result |= 1 << bit
+    return result
+
+
+def window_value(signature_, table):
+    """The window of a signature a table is keyed on"""
+    shift = table * WINDOW_STEP
+    rotated = (signature_ >> shift | signature_ << (SIGNATURE_BITS - shift))
+    return rotated & ((1 << WINDOW_BITS) - 1)
+
+
+def build_index(path, rows):
+    """
+    Build the similarity index file from profile rows.
+
+    Args:
+        path: Index file to write; replaced atomically
+        rows: Callable returning a fresh iterable of (user_id, bio,
+              interests) tuples; it is read twice
+
+    Returns:
+        Number of profiles indexed
+    """
+    frequencies = array('I', bytes(4 * FEATURE_BUCKETS))
+    documents = 0
+    for _, bio, interests in rows():
+        documents += 1
+        for bucket in {
+                feature % FEATURE_BUCKETS
+                for feature in profile_features(bio, interests)}:
+            frequencies[bucket] += 1
+    idf = array('f', (
+        math.log((documents + 1) / (frequency + 1)) + 1
+        for frequency in frequencies))
+
+    user_ids = array('q')
+    signatures = array('Q')
+    for user_id, bio, interests in rows():
+        user_ids.append(user_id)
+        signatures.append(signature(profile_features(bio, interests), idf))
+
+    temporary = f'{path}.{os.getpid()}.tmp'
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(temporary, 'wb') as index:
+        index.write(HEADER.pack(
+            MAGIC, len(user_ids), FEATURE_BUCKETS, time.time()))
+        index.write(idf.tobytes())
+        index.write(user_ids.tobytes())
+        index.write(signatures.tobytes())
+        for table in range(TABLES):
+            values = [window_value(value, table) for value in signatures]
+            order = sorted(range(len(values)), key=values.__getitem__)
+            index.write(array('H', (values[row] for row in order)).tobytes())
+            index.write(array('I', order).tobytes())
+        index.flush()
+        os.fsync(index.fileno())
+    os.replace(temporary, path)
+    return len(user_ids)
+
+
+class SimilarityIndex:
+    """A similarity index file mapped read-only"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as index:
+            self.stat = os.fstat(index.fileno())
+            self._map = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, rows, buckets, self.written_at = HEADER.unpack_from(self._map)
+        if magic != MAGIC or buckets != FEATURE_BUCKETS:
+            raise ValueError(f'{path} is not a similarity index')
+        view = memoryview(self._map)
+        offset = HEADER.size
+
+        def take(typecode, count):
+            nonlocal offset
+            size = count * array(typecode).itemsize
+            column = view[offset:offset + size].cast(typecode)
+            offset += size
+            return column
+
+        self.idf = take('f', buckets)
+        self.user_ids = take('q', rows)
+        self.signatures = take('Q', rows)
+        self.tables = [
+            (take('H', rows), take('I', rows)) for _ in range(TABLES)]
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def signature_for(self, bio, interests):
+        return signature(profile_features(bio, interests), self.idf)
+
+    def candidates(self, signature_):
+        """Rows sharing a window value with the signature, or one bit off"""
+        if len(self) <= FULL_SCAN_ROWS:
+            return range(len(self))
+        rows = set()
+        for table, (values, table_rows) in enumerate(self.tables):
+            value = window_value(signature_, table)
+            for probe in (value, *(
+                    value ^ (1 << bit) for bit in range(WINDOW_BITS))):
+                low = bisect_left(values, probe)
+                high = bisect_right(values, probe, lo=low)
+                rows.update(table_rows[low:high])
+        return rows
+
+    def nearest(self, bio, interests, limit, exclude_user_ids=(),
+                include=None):
+        """
+        Users whose bios and interests are closest to the given ones.
+
+        Users left out are skipped before the closest are picked, so they
+        do not take up any of the ``limit`` places.
+
+        Args:
+            bio: Bio to compare with
+            interests: Comma-separated interests to compare with
+            limit: Most user ids to return
+            exclude_user_ids: Users to leave out
+            include: Optional callable taking a user id; users it
+                     returns False for are left out as well
+
+        Returns:
+            Up to ``limit`` user ids, most similar first
+        """
+        signature_ = self.signature_for(bio, interests)
+        if not signature_:
+            return []
+        excluded = set(exclude_user_ids)
+        signatures = self.signatures
+        user_ids = self.user_ids
+        ranked = heapq.nsmallest(
+            limit,
+            (row for row in self.candidates(signature_)
+             if user_ids[row] not in excluded and (
+                 include is None or include(user_ids[row]))),
+            key=lambda row: ((signatures[row] ^ signature_).bit_count(), row))
+        return [user_ids[row] for row in ranked]
+
+
+class SimilarityIndexLoader:
+    """
+    The index at ``SIMILARITY_INDEX_PATH``, remapped when rebuilt.
+
+    The file is checked for replacement at most every
+    ``DISCOVERY_CATALOG_REFRESH_SECONDS``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checked_at = None
+        self.current = None
+
+    def load(self, force=False):
+        """Return the current index, or None if none has been built"""
+        now = time.monotonic()
+        if (force or self._checked_at is None or
+                now - self._checked_at >=
+                settings.DISCOVERY_CATALOG_REFRESH_SECONDS):
+            with self._lock:
+                self._checked_at = now
+                path = settings.SIMILARITY_INDEX_PATH
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    self.current = None
+                else:
+                    current = self.current
+                    if current is None or (
+                            (current.path, current.stat.st_ino,
+                             current.stat.st_mtime_ns) !=
+                            (path, stat.st_ino, stat.st_mtime_ns)):
+                        self.current = SimilarityIndex(path)
+        return self.current
+
+
+similarity_index = SimilarityIndexLoader()
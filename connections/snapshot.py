@@ -0,0 +1,233 @@
+"""
+Profile catalog snapshot shared by every worker through ``mmap``.
+
+``write_snapshot`` stores the catalog columns of every profile, newest
+first, in one file. Workers open it read-only with ``MappedProfiles`` and
+read the columns in place through memoryviews, so all workers on a
+machine share one copy in the page cache instead of each building a
+ProfileCatalog of their own.
+
+A refresher keeps a ProfileCatalog of its own up to date, which only
+reads the profiles changed since its last refresh, and rewrites the file
+from it when something changed, under a temporary name renamed over the
+old one. Workers notice the new inode and map it; requests already
+holding the old map keep reading it until they finish. A snapshot older
+than ``DISCOVERY_SNAPSHOT_MAX_AGE`` means the refresher has stopped, and
+workers go back to their own catalog until it writes again.
+
+File layout, little-endian::
+
+    header   magic, row count, location text length, written at
+    columns  one per SNAPSHOT_COLUMNS entry, each padded to 8 bytes
+    text     location bucket keys, newline separated
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+
+from .catalog import ColumnarProfiles, ProfileCatalog, catalog
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'MUPSNAP1'
+HEADER = struct.Struct('<8sQQd')
+# Column name and array typecode, in file order
+SNAPSHOT_COLUMNS = (
+    ('profile_ids', 'q'),
+    ('user_ids', 'q'),
+    ('created', 'd'),
+    ('locations', 'I'),
+    ('ages', 'B'),
+    ('genders', 'B'),
+    ('complete', 'B'),
+    # User ids in ascending order and the row of each, for exclusions
+    ('sorted_user_ids', 'q'),
+    ('sorted_user_rows', 'I'),
+)
+# The columns copied from a ProfileCatalog; the others are derived
+CATALOG_COLUMNS = SNAPSHOT_COLUMNS[:7]
+
+
+def _padded(size):
+    return (size + 7) & ~7
+
+
+def _column_offsets(rows):
+    offset = HEADER.size
+    offsets = {}
+    for name, typecode in SNAPSHOT_COLUMNS:
+        offsets[name] = offset
+        offset += _padded(rows * array(typecode).itemsize)
+    return offsets, offset
+
+
+def write_snapshot(path, profiles=None):
+    """
+    Write every profile's catalog columns to ``path`` atomically.
+
+    Args:
+        path: Snapshot file
+        profiles: Up-to-date ProfileCatalog to write, not changed while
+                  it is written; by default every profile is loaded from
+                  the database
+
+    Returns:
+        Number of profiles written
+    """
+    if profiles is None:
+        profiles = ProfileCatalog()
+        profiles.reload()
+    alive = profiles.alive
+    order = [row for row in profiles.order if alive[row]]
+    columns = {
+        name: array(typecode, map(getattr(profiles, name).__getitem__, order))
+        for name, typecode in CATALOG_COLUMNS
+    }
+    # Bucket numbers are the catalog's, which numbers keys as it meets them
+    buckets = list(profiles.location_buckets)
+    rows = len(order)
+    by_user = sorted(range(rows), key=columns['user_ids'].__getitem__)
+    columns['sorted_user_ids'] = array(
+        'q', (columns['user_ids'][row] for row in by_user))
+    columns['sorted_user_rows'] = array('I', by_user)
+
+    text = '\n'.join(buckets).encode()
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as snapshot:
+        snapshot.write(HEADER.pack(MAGIC, rows, len(text), time.time()))
+        for name, _ in SNAPSHOT_COLUMNS:
+            data = columns[name].tobytes()
+            snapshot.write(data)
+            snapshot.write(b'\0' * (_padded(len(data)) - len(data)))
+        snapshot.write(text)
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(temporary, path)
+    return rows
+
+
+class MappedProfiles(ColumnarProfiles):
+    """
+    A snapshot file mapped read-only.
+
+    Columns are memoryviews into the map, so opening a snapshot copies
+    nothing; only filter bitmaps are kept per process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as snapshot:
+            self.stat = os.fstat(snapshot.fileno())
+            self._map = mmap.mmap(
+                snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, rows, text_length, self.written_at = HEADER.unpack_from(
+            self._map)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a profile snapshot')
+        offsets, text_offset = _column_offsets(rows)
+        view = memoryview(self._map)
+        for name, typecode in SNAPSHOT_COLUMNS:
+            size = rows * array(typecode).itemsize
+            setattr(self, name, view[
+                offsets[name]:offsets[name] + size].cast(typecode))
+        text = bytes(view[text_offset:text_offset + text_length]).decode()
+        self.location_buckets = {
+            key: bucket for bucket, key in enumerate(text.split('\n'))
+        } if rows else {}
+        self.order = range(rows)
+        self.order_runs = [slice(0, rows)]
+        self._bitmaps = {}
+
+    def __len__(self):
+        return len(self.profile_ids)
+
+    def row_for_user(self, user_id):
+        index = bisect_left(self.sorted_user_ids, user_id)
+        if (index < len(self.sorted_user_ids) and
+                self.sorted_user_ids[index] == user_id):
+            return self.sorted_user_rows[index]
+        return None
+
+    def _alive_bitmap(self):
+        return (1 << len(self.profile_ids)) - 1
+
+
+class SnapshotCatalog:
+    """
+    The snapshot at ``DISCOVERY_SNAPSHOT_PATH``, remapped when replaced.
+
+    The file is checked for replacement at most every
+    ``DISCOVERY_CATALOG_REFRESH_SECONDS``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checked_at = None
+        self._stale = False
+        self.current = None
+
+    def fresh(self):
+        """
+        The current snapshot, or None when there is none or it is older
+        than ``DISCOVERY_SNAPSHOT_MAX_AGE``.
+        """
+        self.refresh()
+        current = self.current
+        if current is None:
+            return None
+        stale = (time.time() - current.written_at >
+                 settings.DISCOVERY_SNAPSHOT_MAX_AGE)
+        if stale and not self._stale:
+            logger.warning(
+                'Profile snapshot %s was written %.0fs ago; using the '
+                'in-process catalog until it is refreshed',
+                current.path, time.time() - current.written_at)
+        self._stale = stale
+        return None if stale else current
+
+    def refresh(self, force=False):
+        """Map the snapshot again if the file was replaced"""
+        path = settings.DISCOVERY_SNAPSHOT_PATH
+        now = time.monotonic()
+        if (not force and self._checked_at is not None and
+                now - self._checked_at <
+                settings.DISCOVERY_CATALOG_REFRESH_SECONDS):
+            return
+        with self._lock:
+            self._checked_at = now
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                self.current = None
+                return
+            current = self.current
+            if current is None or (
+                    (current.stat.st_ino, current.stat.st_mtime_ns) !=
+                    (stat.st_ino, stat.st_mtime_ns)):
+                self.current = MappedProfiles(path)
+
+
+snapshot = SnapshotCatalog()
+
+
+def get_discovery_catalog():
+    """
+    The catalog discovery should select from.
+
+    The shared snapshot when ``DISCOVERY_SNAPSHOT_PATH`` is set and it
+    was written recently, otherwise this process's own ProfileCatalog.
+    """
+    if settings.DISCOVERY_SNAPSHOT_PATH:
+        current = snapshot.fresh()
+        if current is not None:
+            return current
+    return catalog
@@ -0,0 +1,337 @@
+"""
+Synthetic users, profiles and swipes for load testing.
+
+Every row is derived from the seed and a user's index, so chunks can be
+generated in any process and in any order with the same result. Swipe
+targets follow a power law, so a few profiles receive most of the likes,
+and a share of pairs like each other back to produce matches.
+"""
+import io
+import json
+import random
+from contextlib import contextmanager
+from datetime import timedelta
+from math import gcd
+
+import django
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.db import connections, transaction
+from django.utils import timezone
+
+from dating.models import Profile
+from .models import Like, Match
+
+LOCATIONS = (
+    'Dublin', 'Cork', 'Galway', 'Limerick', 'Belfast', 'London',
+    'Manchester', 'Edinburgh', 'Paris', 'Berlin', 'Madrid', 'Lisbon',
+    'Amsterdam', 'Rome', 'Vienna', 'Prague', 'Warsaw', 'Oslo',
+)
+INTERESTS = (
+    'Hiking', 'Cooking', 'Reading', 'Music', 'Travel', 'Cycling',
+    'Photography', 'Gaming', 'Yoga', 'Running', 'Films', 'Art',
+    'Dancing', 'Climbing', 'Gardening', 'Coffee',
+)
+BIO_WORDS = (
+    'love', 'weekend', 'adventures', 'quiet', 'nights', 'good', 'food',
+    'long', 'walks', 'new', 'places', 'friends', 'family', 'dogs', 'cats',
+    'live', 'music', 'sunsets', 'mountains', 'sea', 'books', 'laughing',
+)
+GENDERS = ('M', 'F', 'O')
+GENDER_WEIGHTS = (48, 48, 4)
+
+USER_FIELDS = (
+    'id', 'password', 'is_superuser', 'username', 'first_name',
+    'last_name', 'email', 'is_staff', 'is_active', 'date_joined',
+)
+PROFILE_FIELDS = (
+    'user_id', 'age', 'gender', 'location', 'bio', 'interests',
+    'photo_variants', 'photo_hash', 'photo_digest', 'photo_placeholder',
+    'pending_photo', 'createdAt', 'updatedAt', 'is_profile_complete',
+    'is_bot',
+)
+LIKE_FIELDS = ('from_user_id', 'to_user_id', 'action', 'created_at')
+
+# Multiplier used to mix two ids into one pseudo-random 32-bit value
+_MIX = 0x9E3779B1
+_SPREAD_SECONDS = 365 * 24 * 3600
+
+
+class SyntheticPlan:
+    """
+    Parameters shared by every chunk of a synthetic data run.
+
+    Args:
+        seed: Seed every row is derived from
+        users: Number of users to create
+        first_id: Primary key of the first user
+        prefix: Username prefix; users are named ``<prefix><index>``
+        password: Password hash shared by all users
+        mean_swipes: Average likes and passes sent per user
+        like_ratio: Share of swipes that are likes
+        reciprocity: Share of liked pairs that like each other back
+        skew: Popularity exponent; higher values concentrate likes
+        end: Newest timestamp; rows are spread over the year before it
+    """
+
+    def __init__(self, seed, users, first_id, prefix, password,
+                 mean_swipes=50, like_ratio=0.6, reciprocity=0.05,
+                 skew=2.0, end=None):
+        self.seed = seed
+        self.users = users
+        self.first_id = first_id
+        self.prefix = prefix
+        self.password = password
+        self.mean_swipes = mean_swipes
+        self.like_ratio = like_ratio
+        self.reciprocity = reciprocity
+        self.skew = skew
+        self.end = end or timezone.now()
+        # A stride coprime to the user count maps popularity ranks to
+        # users without building a permutation
+        self.stride = 2654435761 % users or 1
+        while gcd(self.stride, users) != 1:
+            self.stride += 1
+        self.offset = seed % users
+
+    def _rng(self, index, stream):
+        return random.Random(f'{self.seed}:{stream}:{index}')
+
+    def _mix(self, a, b):
+        low, high = min(a, b), max(a, b)
+        value = (low * _MIX ^ high * 0x85EBCA77 ^ self.seed) & 0xFFFFFFFF
+        value ^= value >> 16
+        value = (value * 0x7FEB352D) & 0xFFFFFFFF
+        return value ^ (value >> 15)
+
+    def _timestamp(self, value):
+        return self.end - timedelta(seconds=value % _SPREAD_SECONDS)
+
+    def user_id(self, index):
+        return self.first_id + index
+
+    def user_rows(self, start, stop):
+        """Rows for ``USER_FIELDS`` of users ``start`` to ``stop``"""
+        for index in range(start, stop):
+            username = f'{self.prefix}{index}'
+            yield (
+                self.user_id(index), self.password, False, username, '',
+                '', f'{username}@example.com', False, True,
+                self._timestamp(self._mix(index, index)),
+            )
+
+    def profile_rows(self, start, stop):
+        """Rows for ``PROFILE_FIELDS`` of users ``start`` to ``stop``"""
+        for index in range(start, stop):
+            rng = self._rng(index, 'profile')
+            created = self._timestamp(self._mix(index, index))
+            yield (
+                self.user_id(index),
+                min(99, 18 + int(rng.expovariate(1 / 12))),
+                rng.choices(GENDERS, GENDER_WEIGHTS)[0],
+                rng.choice(LOCATIONS),
+                ' '.join(rng.choices(BIO_WORDS, k=rng.randint(6, 30))),
+                ', '.join(rng.sample(INTERESTS, rng.randint(1, 5))),
+                {}, '', '', '', '', created, created, False, False,
+            )
+
+    def swipe_rows(self, start, stop):
+        """
+        Rows for ``LIKE_FIELDS`` sent by users ``start`` to ``stop``.
+
+        A reciprocal pair is emitted as two likes by whichever side drew
+        the other, so the same row may come from two chunks; it is
+        identical either way and inserts ignore the duplicate.
+        """
+        limit = self.users - 1
+        for index in range(start, stop):
+            rng = self._rng(index, 'swipes')
+            wanted = min(limit, int(
+                self.mean_swipes / 2 * rng.paretovariate(2)))
+            targets = set()
+            attempts = 0
+            while len(targets) < wanted and attempts < wanted * 4:
+                attempts += 1
+                rank = int(self.users * rng.random() ** self.skew)
+                target = (rank * self.stride + self.offset) % self.users
+                if target != index:
+                    targets.add(target)
+            from_id = self.user_id(index)
+            for target in sorted(targets):
+                to_id = self.user_id(target)
+                pair = self._mix(index, target)
+                if pair < self.reciprocity * 0xFFFFFFFF:
+                    created = self._timestamp(pair)
+                    yield (from_id, to_id, Like.LIKE, created)
+                    yield (to_id, from_id, Like.LIKE, created)
+                    continue
+                action = (
+                    Like.LIKE if rng.random() < self.like_ratio
+                    else Like.DISLIKE)
+                yield (
+                    from_id, to_id, action,
+                    self._timestamp(rng.getrandbits(32)))
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, dict):
+        value = json.dumps(value)
+    elif hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace(
+        '\n', '\\n').replace('\r', '\\r')
+
+
+def _copy(cursor, sql, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(_copy_value(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    if hasattr(cursor, 'copy_expert'):
+        cursor.copy_expert(sql, buffer)
+    else:
+        with cursor.copy(sql) as copy:
+            copy.write(buffer.getvalue())
+
+
+def _columns(model, fields):
+    return ', '.join(model._meta.get_field(field).column for field in fields)
+
+
+def copy_rows(model, fields, rows, using, ignore_conflicts=False):
+    """
+    Load rows with Postgres ``COPY``.
+
+    With ``ignore_conflicts`` the rows go through a temporary table so
+    duplicates can be dropped with ``ON CONFLICT DO NOTHING``.
+    """
+    table = model._meta.db_table
+    columns = _columns(model, fields)
+    with connections[using].cursor() as cursor:
+        if not ignore_conflicts:
+            _copy(cursor, f'COPY {table} ({columns}) FROM STDIN', rows)
+            return
+        cursor.execute(
+            f'CREATE TEMP TABLE synthetic_stage '
+            f'(LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP')
+        _copy(cursor, f'COPY synthetic_stage ({columns}) FROM STDIN', rows)
+        cursor.execute(
+            f'INSERT INTO {table} ({columns}) '
+            f'SELECT {columns} FROM synthetic_stage '
+            f'ON CONFLICT DO NOTHING')
+
+
+@contextmanager
+def explicit_timestamps(model):
+    """Let bulk_create keep the given auto_now/auto_now_add values"""
+    fields = [
+        field for field in model._meta.concrete_fields
+        if getattr(field, 'auto_now', False) or
+        getattr(field, 'auto_now_add', False)
+    ]
+    saved = [(field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, (auto_now, auto_now_add) in zip(fields, saved):
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def insert_rows(model, fields, rows, using, batch_size,
+                ignore_conflicts=False):
+    """
+    Insert rows with ``COPY`` on Postgres and ``bulk_create`` elsewhere.
+
+    Returns:
+        Number of rows sent to the database
+    """
+    rows = list(rows)
+    with transaction.atomic(using=using):
+        if connections[using].vendor == 'postgresql':
+            copy_rows(model, fields, rows, using, ignore_conflicts)
+            return len(rows)
+        objects = [model(**dict(zip(fields, row))) for row in rows]
+        with explicit_timestamps(model):
+            model.objects.using(using).bulk_create(
+                objects, batch_size=batch_size,
+                ignore_conflicts=ignore_conflicts)
+    return len(rows)
+
+
+def load_chunk(plan, phase, start, stop, using='default', batch_size=5000):
+    """
+    Generate and insert one chunk of users or swipes.
+
+    Args:
+        plan: The SyntheticPlan of the run
+        phase: 'users' (users and profiles) or 'swipes'
+        start: First user index of the chunk
+        stop: User index after the last one in the chunk
+        using: Database alias
+        batch_size: Rows per bulk_create batch
+
+    Returns:
+        Number of rows inserted
+    """
+    if phase == 'users':
+        count = insert_rows(
+            User, USER_FIELDS, plan.user_rows(start, stop), using,
+            batch_size)
+        return count + insert_rows(
+            Profile, PROFILE_FIELDS, plan.profile_rows(start, stop), using,
+            batch_size)
+    return insert_rows(
+        Like, LIKE_FIELDS, plan.swipe_rows(start, stop), using, batch_size,
+        ignore_conflicts=True)
+
+
+def init_worker():
+    """Process pool initializer for spawned workers"""
+    if not apps.ready:
+        django.setup()
+
+
+def create_mutual_matches(plan, using='default'):
+    """
+    Create a Match for every mutual like among the generated users.
+
+    Returns:
+        Number of matches inserted
+    """
+    like = Like._meta.db_table
+    match = Match._meta.db_table
+    last_id = plan.user_id(plan.users)
+    with transaction.atomic(using=using), \
+            connections[using].cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {match} (user1_id, user2_id, created_at, '
+            f'is_active) '
+            f'SELECT a.from_user_id, a.to_user_id, %s, %s '
+            f'FROM {like} a JOIN {like} b '
+            f'ON b.from_user_id = a.to_user_id '
+            f'AND b.to_user_id = a.from_user_id '
+            f'WHERE a.action = %s AND b.action = %s '
+            f'AND a.from_user_id < a.to_user_id '
+            f'AND a.from_user_id >= %s AND a.from_user_id < %s '
+            f'ON CONFLICT DO NOTHING',
+            [plan.end, True, Like.LIKE, Like.LIKE, plan.first_id, last_id],
+        )
+        return cursor.rowcount
+
+
+def reset_sequences(using='default'):
+    """Move Postgres id sequences past explicitly inserted ids"""
+    connection = connections[using]
+    statements = connection.ops.sequence_reset_sql(no_style(), [User])
+    if statements:
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
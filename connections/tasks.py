@@ -0,0 +1,19 @@
+"""
+Background tasks for connections app
+"""
+from taskqueue.queue import task
+
+from .notifications import send_match_digests as send_digests
+from .services import rebuild_like_counters as rebuild_counters
+
+
+@task(timeout=3600)
+def rebuild_like_counters():
+    """Recount every "Liked you" inbox, fixing drift from racing swipes"""
+    rebuild_counters()
+
+
+@task(queue='email')
+def send_match_digests():
+    """Email the new-match digests that are due"""
+    send_digests()
@@ -2,13 +2,59 @@
 Comprehensive test suite for connections app views.
 Tests all views in connections/views.py.
 """
-from django.test import TestCase, Client
+import asyncio
+import csv
+import gzip
+import os
+import shutil
+import smtplib
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core import mail
+from django.core.mail import EmailMessage
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import (
+    AsyncClient, Client, LiveServerTestCase, TestCase, TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
+from django.db import OperationalError, connection, transaction
 from django.urls import reverse
+from django.utils import timezone
 import json
 
 from dating.models import Profile
-from .models import Like, Match
+from match_up import metrics, profiling
+from match_up.mail import Mailer, RateLimiter
+from match_up.metrics import InstrumentedLocMemCache, RequestStats, registry
+from match_up.pagination import EstimatedCountPaginator
+from match_up.testing import QueryBudgetMixin
+from .catalog import ProfileCatalog, catalog
+from .loadtest import SwipeSession, percentile
+from .models import (
+    ChatReadState, HandledEvent, Like, LikeCounter, Match, MatchNotification,
+    Message, OutboxEvent,
+)
+from . import chat, export, notifications, outbox, pubsub, synthetic
+from .services import (
+    ReciprocalFeed, create_match_if_mutual, get_discovery_feed,
+    get_like_count, rebuild_like_counters,
+)
+from .similarity import SimilarityIndex, build_index, similarity_index
+from .snapshot import MappedProfiles, get_discovery_catalog, write_snapshot
+from .views import (
+    DiscoverView, LikedProfilesView, LikedYouView, MatchesListView,
+)
 
 
 class BaseConnectionsTestCase(TestCase):
@@ -583,3 +629,1884 @@ class LikedProfilesViewTests(BaseConnectionsTestCase):
             response.context['is_paginated'] or
             len(response.context['profiles']) <= 3
         )
+
+
+class AdminChangelistTests(BaseConnectionsTestCase):
+    """Tests for the Like and Match admin changelists"""
+
+    def setUp(self):
+        super().setUp()
+        User.objects.create_superuser(
+            username='admin',
+            email='admin@example.com',
+            password='testpass123'
+        )
+        self.client.login(username='admin', password='testpass123')
+
+    def count_changelist_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def add_rows(self, total):
+        """Create likes and matches between extra users"""
+        start = User.objects.count()
+        for i in range(start, start + total):
+            user = User.objects.create(username=f'adminrow{i}')
+            Like.objects.create(
+                from_user=user, to_user=self.user1, action=Like.LIKE)
+            Match.objects.create(user1=self.user2, user2=user)
+
+    def test_like_changelist_queries_do_not_grow_with_rows(self):
+        """Users are joined instead of fetched once per row"""
+        url = reverse('admin:connections_like_changelist')
+        self.add_rows(2)
+        baseline = self.count_changelist_queries(url)
+        self.add_rows(10)
+        self.assertEqual(self.count_changelist_queries(url), baseline)
+
+    def test_match_changelist_queries_do_not_grow_with_rows(self):
+        """Both users of a match are joined in the changelist query"""
+        url = reverse('admin:connections_match_changelist')
+        self.add_rows(2)
+        baseline = self.count_changelist_queries(url)
+        self.add_rows(10)
+        self.assertEqual(self.count_changelist_queries(url), baseline)
+
+    def test_like_add_form_uses_autocomplete(self):
+        """User fields use autocomplete widgets instead of full dropdowns"""
+        response = self.client.get(reverse('admin:connections_like_add'))
+        self.assertContains(response, 'admin-autocomplete')
+        self.assertNotContains(response, '<option value="%d">' % (
+            self.user1.pk))
+
+    def test_estimated_paginator_counts_exactly_on_sqlite(self):
+        """Without table statistics the paginator falls back to COUNT"""
+        self.add_rows(4)
+        paginator = EstimatedCountPaginator(
+            Like.objects.order_by('pk'), 3)
+        self.assertEqual(paginator.count, 4)
+        self.assertEqual(paginator.num_pages, 2)
+
+
+class RequestMetricsTests(BaseConnectionsTestCase):
+    """Tests for the request metrics middleware and endpoint"""
+
+    def setUp(self):
+        super().setUp()
+        registry.reset()
+        self.client.login(username='user1', password='testpass123')
+
+    def test_response_has_server_timing_header(self):
+        """Timings and the query count are reported to the browser"""
+        response = self.client.get(reverse('connections:discover'))
+        timing = response['Server-Timing']
+        self.assertIn('total;dur=', timing)
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="[1-9]\d* queries"')
+        self.assertIn('tpl;dur=', timing)
+        self.assertIn('cache;desc="0 hits, 0 misses"', timing)
+
+    def test_views_are_aggregated_per_view_name(self):
+        """Each request lands in the histogram of its view"""
+        self.client.get(reverse('connections:discover'))
+        self.client.get(reverse('connections:discover'))
+        text = registry.render()
+        labels = 'view="connections:discover",method="GET"'
+        self.assertIn(
+            f'matchup_request_duration_seconds_count{{{labels}}} 2', text)
+        self.assertIn(
+            f'matchup_request_duration_seconds_bucket{{{labels},le="+Inf"}}'
+            ' 2', text)
+        self.assertIn(
+            f'matchup_requests_total{{{labels},status="200"}} 2', text)
+
+    def test_cache_hits_and_misses_are_counted(self):
+        """The instrumented cache reports to the current request"""
+        stats = RequestStats()
+        backend = InstrumentedLocMemCache('metrics-test', {})
+        token = metrics._current_stats.set(stats)
+        try:
+            self.assertIsNone(backend.get('key'))
+            backend.set('key', 'value')
+            self.assertEqual(backend.get('key'), 'value')
+        finally:
+            metrics._current_stats.reset(token)
+        self.assertEqual((stats.cache_hits, stats.cache_misses), (1, 1))
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram((1, 5))
+        for value in (0.5, 3, 3, 10):
+            histogram.observe(value)
+        lines = histogram.render('m', 'view="v"')
+        self.assertEqual(lines[:3], [
+            'm_bucket{view="v",le="1"} 1',
+            'm_bucket{view="v",le="5"} 3',
+            'm_bucket{view="v",le="+Inf"} 4',
+        ])
+
+    def test_metrics_endpoint_is_staff_only(self):
+        """Regular users are refused and staff get Prometheus text"""
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.user1.is_staff = True
+        self.user1.save()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertContains(
+            response, '# TYPE matchup_request_duration_seconds histogram')
+
+    @override_settings(METRICS_TOKEN='scrape-secret')
+    def test_metrics_endpoint_accepts_bearer_token(self):
+        self.client.logout()
+        url = reverse('metrics')
+        response = self.client.get(
+            url, HTTP_AUTHORIZATION='Bearer scrape-secret')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, 403)
+
+
+class QueryBudgetTests(QueryBudgetMixin, BaseConnectionsTestCase):
+    """Query budgets for every connections view"""
+
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='user1', password='testpass123')
+        # Enough rows to fill the largest page size checked below
+        for i in range(12):
+            user = User.objects.create_user(username=f'budget{i}')
+            Profile.objects.create(
+                user=user, age=30, gender='F', location='City',
+                bio='Budget profile bio that is long enough', interests='x')
+            if i % 2:
+                Like.objects.create(
+                    from_user=self.user1, to_user=user, action=Like.LIKE)
+                Match.objects.create(user1=self.user1, user2=user)
+        self.target = Profile.objects.get(user__username='budget0')
+
+    def test_discover_budget(self):
+        # Between catalog refreshes, which tests otherwise force every time
+        catalog.refresh(force=True)
+        with override_settings(DISCOVERY_CATALOG_REFRESH_SECONDS=3600):
+            self.assertViewQueryBudget(
+                reverse('connections:discover'), {3: 6, 10: 6},
+                view_class=DiscoverView, status_code=200)
+            # Pages with interleaved likers cost the same as pages without
+            for user in User.objects.filter(username__startswith='budget'):
+                Like.objects.get_or_create(
+                    from_user=user, to_user=self.user1, action=Like.LIKE)
+            self.assertViewQueryBudget(
+                reverse('connections:discover'), {3: 6, 10: 6},
+                view_class=DiscoverView, status_code=200)
+
+    @override_settings(DISCOVERY_CATALOG_ENABLED=False)
+    def test_discover_without_catalog_budget(self):
+        self.assertViewQueryBudget(
+            reverse('connections:discover'), {3: 6, 10: 6},
+            view_class=DiscoverView, status_code=200)
+
+    def test_matches_budget(self):
+        # Includes the unread message counts of the page's matches
+        self.assertViewQueryBudget(
+            reverse('connections:matches'), {3: 6, 10: 6},
+            view_class=MatchesListView, status_code=200)
+
+    def test_liked_profiles_budget(self):
+        self.assertViewQueryBudget(
+            reverse('connections:liked_profiles'), {3: 5, 10: 5},
+            view_class=LikedProfilesView, status_code=200)
+
+    def test_liked_you_budget(self):
+        for user in User.objects.filter(username__startswith='budget'):
+            Like.objects.create(
+                from_user=user, to_user=self.user1, action=Like.LIKE)
+        self.assertViewQueryBudget(
+            reverse('connections:liked_you'), {3: 5, 12: 5},
+            view_class=LikedYouView, status_code=200)
+        self.assertViewQueryBudget(
+            reverse('connections:liked_you_api'), 4, status_code=200)
+
+    def test_chat_budget(self):
+        match = Match.objects.filter(user1=self.user1).first()
+        other = match.get_other_user(self.user1)
+        for number in range(12):
+            chat.send_message(match, other, f'Message {number}')
+        url = reverse('connections:chat', args=[match.pk])
+        self.assertViewQueryBudget(url, 5, status_code=200)
+        # The first message to a user also creates their read state
+        self.assertViewQueryBudget(
+            url, 7, method='post', data={'body': 'Hi'}, status_code=302)
+        self.assertViewQueryBudget(
+            url, 5, method='post', data={'body': 'Hi'}, status_code=302)
+
+    def test_event_stream_budget(self):
+        # Session and user only; the test client is not ASGI, so the view
+        # answers 204 without opening a stream
+        self.assertViewQueryBudget(
+            reverse('connections:events'), 2, status_code=204)
+
+    def test_chat_messages_api_budget(self):
+        match = Match.objects.filter(user1=self.user1).first()
+        other = match.get_other_user(self.user1)
+        for number in range(12):
+            chat.send_message(match, other, f'Message {number}')
+        url = reverse('connections:chat_messages_api', args=[match.pk])
+        # The match, a page of messages and the read state update
+        self.assertViewQueryBudget(url, 5, status_code=200)
+        self.assertViewQueryBudget(
+            url, 5, data={'after': 0}, status_code=200)
+        # The first message to a user also creates their read state
+        self.assertViewQueryBudget(
+            url, 7, method='post', data={'body': 'Hi'}, status_code=201)
+        self.assertViewQueryBudget(
+            url, 5, method='post', data={'body': 'Hi'}, status_code=201)
+
+    def test_chat_poll_budget(self):
+        match = Match.objects.filter(user1=self.user1).first()
+        other = match.get_other_user(self.user1)
+        for number in range(12):
+            chat.send_message(match, other, f'Message {number}')
+        url = reverse('connections:chat_poll', args=[match.pk])
+        # Messages waiting: answered at once, as the API's ?after= is
+        self.assertViewQueryBudget(
+            url, 5, data={'after': 0}, status_code=200)
+        # None waiting: outside ASGI the view does not wait for any
+        self.assertViewQueryBudget(
+            url, 4, data={'after': match.messages.latest('pk').pk},
+            status_code=200)
+
+    @override_settings(EXPORT_CHUNK_SIZE=5)
+    def test_data_export_budget(self):
+        match = Match.objects.filter(user1=self.user1).first()
+        for number in range(12):
+            chat.send_message(match, self.user1, f'Message {number}')
+        # The export is read as the response streams, so the budget has
+        # to cover reading it all. One query per table and direction,
+        # however many chunks the rows take.
+        url = reverse('connections:export_data')
+        for export_format in ('ndjson', 'csv'):
+            with self.assertQueryBudget(8, label=f'{url} {export_format}'):
+                response = self.client.get(url, {'format': export_format})
+                b''.join(response.streaming_content)
+            self.assertEqual(response.status_code, 200)
+
+    def test_like_budget(self):
+        # Includes the outbox event insert
+        self.assertViewQueryBudget(
+            reverse('connections:like_profile', args=[self.target.id]), 15,
+            method='post', status_code=200)
+
+    def test_pass_budget(self):
+        self.assertViewQueryBudget(
+            reverse('connections:pass_profile', args=[self.target.id]), 9,
+            method='post', status_code=200)
+
+    def test_budget_failure_lists_sql(self):
+        """An exceeded budget reports every captured statement"""
+        with self.assertRaises(AssertionError) as raised:
+            with self.assertQueryBudget(1):
+                list(User.objects.all())
+                list(Profile.objects.all())
+        message = str(raised.exception)
+        self.assertIn('ran 2 queries, budget is 1', message)
+        self.assertIn('FROM "dating_profile"', message)
+
+
+class RequestProfilingTests(BaseConnectionsTestCase):
+    """Tests for the on-demand request profiler"""
+
+    def setUp(self):
+        super().setUp()
+        self.capture_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.capture_dir, True)
+        settings_override = override_settings(PROFILING_DIR=self.capture_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.staff = User.objects.create_user(
+            username='staff', password='testpass123', is_staff=True)
+        self.client.login(username='user1', password='testpass123')
+
+    def test_request_without_token_is_not_profiled(self):
+        response = self.client.get(reverse('connections:discover'))
+        self.assertNotIn('X-Profile-Capture', response)
+        self.assertEqual(profiling.list_captures(), [])
+
+    def test_staff_token_in_header_writes_capture(self):
+        response = self.client.get(
+            reverse('connections:discover'),
+            HTTP_X_PROFILE=profiling.make_token(self.staff))
+        name = response['X-Profile-Capture']
+        self.assertEqual(
+            [capture['name'] for capture in profiling.list_captures()],
+            [name])
+        self.assertIn('connections-discover', name)
+
+    def test_query_flag_triggers_profiling(self):
+        response = self.client.get(
+            reverse('connections:discover'),
+            {'_profile': profiling.make_token(self.staff)})
+        self.assertIn('X-Profile-Capture', response)
+
+    def test_non_staff_or_forged_tokens_are_ignored(self):
+        for token in (profiling.make_token(self.user1), 'forged:token'):
+            response = self.client.get(
+                reverse('connections:discover'), HTTP_X_PROFILE=token)
+            self.assertNotIn('X-Profile-Capture', response)
+
+    def test_sampler_records_collapsed_stacks(self):
+        def slow_function():
+            time.sleep(0.05)
+
+        sampler = profiling.StackSampler(threading.get_ident(), 0.001)
+        sampler.start()
+        slow_function()
+        sampler.stop()
+        line = sampler.collapsed().splitlines()[0]
+        stack, count = line.rsplit(' ', 1)
+        self.assertIn('slow_function', stack.split(';')[-1])
+        self.assertGreater(int(count), 0)
+
+    def test_admin_page_lists_captures_for_staff_only(self):
+        self.client.get(
+            reverse('connections:discover'),
+            HTTP_X_PROFILE=profiling.make_token(self.staff))
+        name = profiling.list_captures()[0]['name']
+        url = reverse('request_profiles')
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+        self.client.login(username='staff', password='testpass123')
+        response = self.client.get(url)
+        self.assertContains(response, name)
+        download = self.client.get(
+            reverse('request_profile_download', args=[name]))
+        self.assertEqual(download.status_code, 200)
+        missing = self.client.get(
+            reverse('request_profile_download', args=['x.txt']))
+        self.assertEqual(missing.status_code, 404)
+
+
+class SyntheticDataTests(TestCase):
+    """Tests for the generate_synthetic_data command"""
+
+    def generate(self, prefix, seed=7):
+        call_command(
+            'generate_synthetic_data', users=60, swipes=10, seed=seed,
+            prefix=prefix, stdout=StringIO())
+        likes = Like.objects.filter(from_user__username__startswith=prefix)
+        return {
+            (like.from_user.username[len(prefix):],
+             like.to_user.username[len(prefix):], like.action)
+            for like in likes.select_related('from_user', 'to_user')
+        }
+
+    def test_generates_users_profiles_and_swipes(self):
+        swipes = self.generate('a')
+        self.assertEqual(
+            User.objects.filter(username__startswith='a').count(), 60)
+        self.assertEqual(Profile.objects.count(), 60)
+        self.assertGreater(len(swipes), 60)
+        self.assertFalse(any(sender == target for sender, target, _ in swipes))
+
+    def test_same_seed_gives_same_swipes(self):
+        self.assertEqual(self.generate('a'), self.generate('b'))
+        self.assertNotEqual(self.generate('c', seed=8), self.generate('d'))
+
+    def test_matches_are_exactly_the_mutual_likes(self):
+        swipes = self.generate('a')
+        likes = {(s, t) for s, t, action in swipes if action == Like.LIKE}
+        mutual = {
+            frozenset(pair) for pair in likes if pair[::-1] in likes
+        }
+        matches = {
+            frozenset((match.user1.username[1:], match.user2.username[1:]))
+            for match in Match.objects.select_related('user1', 'user2')
+        }
+        self.assertTrue(mutual)
+        self.assertEqual(matches, mutual)
+        for match in Match.objects.all():
+            self.assertLess(match.user1_id, match.user2_id)
+
+    def test_existing_prefix_is_refused(self):
+        self.generate('a')
+        with self.assertRaises(CommandError):
+            self.generate('a')
+
+    def test_fields_cover_every_required_column(self):
+        """COPY leaves out columns not listed, which must then be nullable"""
+        for model, fields in ((User, synthetic.USER_FIELDS),
+                              (Profile, synthetic.PROFILE_FIELDS)):
+            required = {
+                field.attname for field in model._meta.concrete_fields
+                if not field.null and not field.primary_key
+            }
+            self.assertEqual(required - set(fields), set(), model.__name__)
+        plan = synthetic.SyntheticPlan(1, 2, 1, 'a', '!')
+        for row in plan.profile_rows(0, 2):
+            self.assertEqual(len(row), len(synthetic.PROFILE_FIELDS))
+
+
+class BotLikeBackTests(BaseConnectionsTestCase):
+    """Tests for bot profiles answering likes"""
+
+    def setUp(self):
+        super().setUp()
+        self.profile2.is_bot = True
+        self.profile2.save()
+        self.client.login(username='user1', password='testpass123')
+
+    def like(self, profile):
+        url = reverse('connections:like_profile', args=[profile.pk])
+        return json.loads(self.client.post(url).content)
+
+    def test_bot_likes_back_and_matches(self):
+        data = self.like(self.profile2)
+        self.assertTrue(data['is_match'])
+        self.assertTrue(Like.objects.filter(
+            from_user=self.user2, to_user=self.user1,
+            action=Like.LIKE).exists())
+
+    def test_regular_profile_does_not_like_back(self):
+        data = self.like(self.profile3)
+        self.assertFalse(data['is_match'])
+        self.assertFalse(Like.objects.filter(from_user=self.user3).exists())
+
+    @override_settings(BOT_LIKE_BACK_RATE=0)
+    def test_like_back_rate_zero_disables_bots(self):
+        self.assertFalse(self.like(self.profile2)['is_match'])
+
+    def test_existing_bot_like_is_not_duplicated(self):
+        """A bot that already liked the user does not fail the request"""
+        Like.objects.create(
+            from_user=self.user2, to_user=self.user1, action=Like.LIKE)
+        self.assertTrue(self.like(self.profile2)['is_match'])
+
+
+class SwipeLoadTestTests(LiveServerTestCase):
+    """Runs the load-testing command against a live test server"""
+
+    def test_sessions_swipe_and_report(self):
+        call_command(
+            'generate_synthetic_data', users=12, swipes=2, seed=3,
+            prefix='load', stdout=StringIO())
+        out = StringIO()
+        call_command(
+            'swipe_load_test', base_url=self.live_server_url,
+            prefix='load', users=2, concurrency=1, iterations=2,
+            set_password=True, bots=2, stdout=out)
+        report = out.getvalue()
+        self.assertIn('Marked 2 bot profile(s).', report)
+        self.assertRegex(report, r'\ndiscover\s+4\s+0\s')
+        self.assertRegex(report, r'\nlogin\s+2\s+0\s')
+        self.assertIn('No failed requests.', report)
+        self.assertTrue(Like.objects.filter(
+            from_user__username__in=['load0', 'load1']).exists())
+
+    def test_bots_are_users_with_the_prefix_and_are_unmarked(self):
+        call_command(
+            'generate_synthetic_data', users=6, swipes=0, seed=3,
+            prefix='load', stdout=StringIO())
+        other = User.objects.create_user(username='someone')
+        Profile.objects.create(user=other, age=30, gender='F')
+        already = Profile.objects.get(user__username='load5')
+        already.is_bot = True
+        already.save(update_fields=['is_bot'])
+        marked = []
+
+        def record_bots(session, iterations):
+            marked.extend(Profile.objects.filter(
+                is_bot=True).values_list('user__username', flat=True))
+
+        out = StringIO()
+        with mock.patch.object(SwipeSession, 'run', record_bots):
+            call_command(
+                'swipe_load_test', base_url=self.live_server_url,
+                prefix='load', users=2, concurrency=1, iterations=1,
+                bots=10, stdout=out)
+        self.assertIn('Marked 3 bot profile(s).', out.getvalue())
+        self.assertEqual(
+            sorted(set(marked)), ['load2', 'load3', 'load4', 'load5'])
+        # Only the profiles the run marked go back to normal
+        self.assertEqual(
+            list(Profile.objects.filter(is_bot=True).values_list(
+                'user__username', flat=True)), ['load5'])
+
+    def test_percentile_uses_nearest_rank(self):
+        values = [0.1, 0.2, 0.3, 0.4]
+        self.assertEqual(percentile(values, 50), 0.2)
+        self.assertEqual(percentile(values, 99), 0.4)
+        self.assertEqual(percentile([], 50), 0.0)
+
+
+class MutualMatchTests(BaseConnectionsTestCase):
+    """Tests for match creation from mutual likes"""
+
+    def test_like_after_commit_sees_reverse_like(self):
+        """A reverse like committed later is matched once ours commits"""
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            Like.objects.create(
+                from_user=self.user1, to_user=self.user2, action=Like.LIKE)
+            # Saved without signals, like a concurrent transaction would
+            Like.objects.bulk_create([Like(
+                from_user=self.user2, to_user=self.user1, action=Like.LIKE)])
+            self.assertFalse(Match.objects.exists())
+        # The match check, then the pushes of the like and of the match
+        self.assertEqual(len(callbacks), 3)
+        self.assertEqual(Match.objects.count(), 1)
+
+    def test_pass_changed_to_like_creates_match(self):
+        Like.objects.create(
+            from_user=self.user2, to_user=self.user1, action=Like.LIKE)
+        like = Like.objects.create(
+            from_user=self.user1, to_user=self.user2, action=Like.DISLIKE)
+        self.assertFalse(Match.objects.exists())
+        like.action = Like.LIKE
+        like.save()
+        match = Match.objects.get()
+        self.assertEqual(
+            (match.user1_id, match.user2_id), (self.user1.id, self.user2.id))
+
+    def test_repeated_checks_keep_one_match(self):
+        Like.objects.create(
+            from_user=self.user1, to_user=self.user2, action=Like.LIKE)
+        Like.objects.create(
+            from_user=self.user2, to_user=self.user1, action=Like.LIKE)
+        first = create_match_if_mutual(self.user2.id, self.user1.id)
+        second = create_match_if_mutual(self.user1.id, self.user2.id)
+        self.assertEqual(first, second)
+        self.assertEqual(Match.objects.count(), 1)
+        self.assertIsNone(create_match_if_mutual(self.user1.id, self.user3.id))
+
+
+@skipUnless(
+    connection.vendor == 'postgresql',
+    'Run with TEST_WITH_DATABASE_URL=True and a Postgres DATABASE_URL')
+class ConcurrentMatchStressTests(TransactionTestCase):
+    """Many threads liking at once against a real Postgres server"""
+    pairs = 25
+
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(
+                username=f'stress{i}', password='testpass123')
+            for i in range(self.pairs * 2)
+        ]
+        for user in self.users:
+            Profile.objects.create(
+                user=user, age=30, gender='F', location='City',
+                bio='Stress profile bio long enough', interests='x')
+
+    def run_threads(self, targets):
+        barrier = threading.Barrier(len(targets))
+        errors = []
+
+        def run(target):
+            try:
+                barrier.wait()
+                target()
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=run, args=(target,))
+            for target in targets
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_every_mutual_pair_gets_exactly_one_match(self):
+        def like(sender, receiver):
+            def target():
+                with transaction.atomic():
+                    Like.objects.create(
+                        from_user=sender, to_user=receiver,
+                        action=Like.LIKE)
+                    # Hold the transaction open so both sides overlap
+                    time.sleep(0.05)
+            return target
+
+        pairs = list(zip(self.users[::2], self.users[1::2]))
+        self.run_threads(
+            [like(a, b) for a, b in pairs] + [like(b, a) for a, b in pairs])
+
+        self.assertEqual(Match.objects.count(), self.pairs)
+        for a, b in pairs:
+            self.assertEqual(
+                Match.objects.filter(user1=a, user2=b).count(), 1)
+
+    def test_double_submitted_likes_all_succeed(self):
+        sender, receiver = self.users[:2]
+        url = reverse(
+            'connections:like_profile', args=[receiver.profile.pk])
+
+        def submit():
+            client = Client()
+            client.force_login(sender)
+            response = client.post(url)
+            self.assertEqual(response.status_code, 200)
+
+        self.run_threads([submit] * 8)
+        self.assertEqual(
+            Like.objects.filter(from_user=sender, to_user=receiver).count(),
+            1)
+
+
+class LikedYouTests(BaseConnectionsTestCase):
+    """Tests for the "Liked you" inbox, its counters and paging"""
+
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='user1', password='testpass123')
+
+    def make_likers(self, total):
+        likers = []
+        for i in range(total):
+            user = User.objects.create_user(username=f'liker{i}')
+            Profile.objects.create(
+                user=user, age=30, gender='F', location='City',
+                bio='Liker profile bio long enough', interests='x')
+            Like.objects.create(
+                from_user=user, to_user=self.user1, action=Like.LIKE)
+            likers.append(user)
+        return likers
+
+    def fetch(self, **params):
+        response = self.client.get(
+            reverse('connections:liked_you_api'), params)
+        return json.loads(response.content)
+
+    def test_inbox_lists_unanswered_likes_only(self):
+        for user in (self.user2, self.user3):
+            Like.objects.create(
+                from_user=user, to_user=self.user1, action=Like.LIKE)
+        data = self.fetch()
+        self.assertEqual(data['count'], 2)
+        self.assertEqual(
+            {row['username'] for row in data['results']}, {'user2', 'user3'})
+
+        # Passing one and liking the other back empties the inbox
+        self.client.post(
+            reverse('connections:pass_profile', args=[self.profile2.pk]))
+        self.client.post(
+            reverse('connections:like_profile', args=[self.profile3.pk]))
+        self.assertTrue(Match.objects.exists())
+        data = self.fetch()
+        self.assertEqual((data['count'], data['results']), (0, []))
+
+    def test_counter_follows_changes_and_deletes(self):
+        like = Like.objects.create(
+            from_user=self.user2, to_user=self.user1, action=Like.LIKE)
+        self.assertEqual(get_like_count(self.user1), 1)
+        like.action = Like.DISLIKE
+        like.save()
+        self.assertEqual(get_like_count(self.user1), 0)
+        like.action = Like.LIKE
+        like.save()
+        self.assertEqual(get_like_count(self.user1), 1)
+        like.delete()
+        self.assertEqual(get_like_count(self.user1), 0)
+
+    def test_answer_deleted_puts_like_back_in_inbox(self):
+        Like.objects.create(
+            from_user=self.user2, to_user=self.user1, action=Like.LIKE)
+        answer = Like.objects.create(
+            from_user=self.user1, to_user=self.user2, action=Like.DISLIKE)
+        self.assertEqual(get_like_count(self.user1), 0)
+        answer.delete()
+        self.assertEqual(get_like_count(self.user1), 1)
+
+    def test_keyset_pages_cover_every_like_once(self):
+        likers = self.make_likers(5)
+        seen = []
+        data = self.fetch(limit=2)
+        while True:
+            seen.extend(row['username'] for row in data['results'])
+            if not data['next_cursor']:
+                break
+            data = self.fetch(limit=2, cursor=data['next_cursor'])
+        self.assertEqual(seen, [user.username for user in reversed(likers)])
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(
+            reverse('connections:liked_you_api'), {'cursor': 'nonsense'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_hot_counter_spreads_over_shards(self):
+        with mock.patch('connections.services.HOT_COUNTER_THRESHOLD', 2):
+            self.make_likers(8)
+        counters = LikeCounter.objects.filter(user=self.user1)
+        self.assertGreater(counters.count(), 1)
+        self.assertEqual(counters.get(shard=0).count, 2)
+        self.assertEqual(get_like_count(self.user1), 8)
+
+    def test_rebuild_matches_incremental_counts(self):
+        self.make_likers(3)
+        Like.objects.create(
+            from_user=self.user2, to_user=self.user3, action=Like.LIKE)
+        expected = {
+            user.pk: get_like_count(user) for user in User.objects.all()}
+        LikeCounter.objects.update(count=99)
+        call_command('rebuild_like_counters', stdout=StringIO())
+        self.assertEqual(
+            {user.pk: get_like_count(user) for user in User.objects.all()},
+            expected)
+
+    def test_rebuild_only_rewrites_drifted_inboxes(self):
+        with mock.patch('connections.services.HOT_COUNTER_THRESHOLD', 2):
+            self.make_likers(5)
+        Like.objects.create(
+            from_user=self.user2, to_user=self.user3, action=Like.LIKE)
+        LikeCounter.objects.filter(user=self.user3).update(count=7)
+        shards = dict(LikeCounter.objects.filter(
+            user=self.user1).values_list('shard', 'count'))
+
+        self.assertEqual(rebuild_like_counters(batch_size=2), 1)
+        self.assertEqual(get_like_count(self.user3), 1)
+        self.assertEqual(dict(LikeCounter.objects.filter(
+            user=self.user1).values_list('shard', 'count')), shards)
+        self.assertEqual(rebuild_like_counters(batch_size=2), 0)
+
+    def test_page_shows_count_and_profiles(self):
+        self.make_likers(2)
+        response = self.client.get(reverse('connections:liked_you'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'connections/liked_you.html')
+        self.assertContains(response, '2 profiles waiting')
+        self.assertContains(response, 'liker0')
+
+
+class ReciprocalDiscoveryTests(BaseConnectionsTestCase):
+    """Tests for interleaving users who liked the viewer into discovery"""
+
+    def setUp(self):
+        super().setUp()
+        self.others = []
+        for i in range(9):
+            user = User.objects.create_user(username=f'other{i}')
+            Profile.objects.create(
+                user=user, age=30, gender='F', location='City',
+                bio='Other profile bio long enough', interests='x')
+            self.others.append(user)
+        # user2 and user3 are the oldest profiles, so last when newest first
+        for user in (self.user2, self.user3):
+            Like.objects.create(
+                from_user=user, to_user=self.user1, action=Like.LIKE)
+
+    def usernames(self, profiles):
+        return [profile.user.username for profile in profiles]
+
+    def test_likers_take_every_third_slot(self):
+        feed = get_discovery_feed(self.user1)
+        self.assertIsInstance(feed, ReciprocalFeed)
+        newest = self.usernames(
+            get_discovery_feed(self.user1, order_by='newest'))
+        shown = self.usernames(feed[0:feed.count()])
+        self.assertEqual(feed.count(), len(newest))
+        self.assertEqual(shown[0], 'user3')
+        self.assertEqual(shown[3], 'user2')
+        self.assertEqual(sorted(shown), sorted(newest))
+        self.assertEqual(
+            [name for name in shown if name.startswith('other')],
+            [name for name in newest if name.startswith('other')])
+
+    def test_pages_line_up(self):
+        feed = get_discovery_feed(self.user1)
+        pages = [
+            profile for start in range(0, feed.count(), 3)
+            for profile in feed[start:start + 3]
+        ]
+        self.assertEqual(pages, feed[0:feed.count()])
+
+    def test_likers_run_out_of_other_profiles(self):
+        Like.objects.bulk_create([
+            Like(from_user=self.user1, to_user=user, action=Like.DISLIKE)
+            for user in self.others[1:]
+        ])
+        feed = get_discovery_feed(self.user1)
+        self.assertEqual(
+            self.usernames(feed[0:feed.count()]),
+            ['user3', 'other0', 'user2'])
+
+    def test_swiped_likers_are_not_interleaved(self):
+        Like.objects.create(
+            from_user=self.user1, to_user=self.user3, action=Like.DISLIKE)
+        feed = get_discovery_feed(self.user1)
+        shown = self.usernames(feed[0:feed.count()])
+        self.assertEqual(shown[0], 'user2')
+        self.assertNotIn('user3', shown)
+
+    @override_settings(DISCOVERY_RECIPROCAL_LIMIT=0)
+    def test_can_be_turned_off(self):
+        feed = get_discovery_feed(self.user1)
+        self.assertNotIsInstance(feed, ReciprocalFeed)
+        self.assertEqual(self.usernames(feed)[-2:], ['user3', 'user2'])
+
+    def test_discover_page_shows_likers_first(self):
+        self.client.login(username='user1', password='testpass123')
+        response = self.client.get(reverse('connections:discover'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.usernames(response.context['profiles'])[0], 'user3')
+
+    def test_benchmark_command_reports_both_orderings(self):
+        out = StringIO()
+        call_command(
+            'benchmark_discovery', prefix='user1', like_ratio=1.0,
+            pages=1, stdout=out)
+        rows = {
+            line.split()[0]: line.split() for line in
+            out.getvalue().splitlines()[2:]
+        }
+        # user1 sees one admirer on the first page only with reciprocal
+        self.assertEqual(rows['newest'][2], '0')
+        self.assertEqual(rows['reciprocal'][2], '1')
+
+
+class ProfileCatalogTests(BaseConnectionsTestCase):
+    """Tests for the in-memory discovery catalog"""
+
+    def setUp(self):
+        super().setUp()
+        # A catalog of its own sees other processes' changes only by refresh
+        self.catalog = ProfileCatalog()
+        self.catalog.reload()
+
+    def user_ids(self, selection):
+        return [profile.user_id for profile in selection]
+
+    def test_filters_combine(self):
+        select = self.catalog.select
+        self.assertEqual(select().count(), 3)
+        self.assertEqual(
+            self.user_ids(select(min_age=26)),
+            [self.user3.pk, self.user2.pk])
+        self.assertEqual(
+            self.user_ids(select(genders=['M'], max_age=29)),
+            [self.user1.pk])
+        self.assertEqual(
+            self.user_ids(select(locations=['  city2 '])), [self.user2.pk])
+        self.assertEqual(select(complete_only=True).count(), 0)
+        self.assertEqual(
+            self.user_ids(select(exclude_user_ids=[self.user3.pk])),
+            [self.user2.pk, self.user1.pk])
+
+    def test_refresh_picks_up_changes_made_elsewhere(self):
+        Profile.objects.filter(pk=self.profile1.pk).update(
+            age=60, updatedAt=timezone.now())
+        user = User.objects.create_user(username='newcomer')
+        Profile.objects.create(
+            user=user, age=40, gender='O', location='City4',
+            bio='Newcomer bio long enough', interests='x')
+        self.catalog.refresh(force=True)
+        self.assertEqual(
+            self.user_ids(self.catalog.select(min_age=40)),
+            [user.pk, self.user1.pk])
+        self.assertEqual(self.catalog.select().ids(0, 1), [user.profile.pk])
+
+    def test_refresh_patches_cached_filters(self):
+        """Rows fetched again unchanged keep the cached bitmaps"""
+        self.catalog.select(min_age=26)
+        cached = dict(self.catalog._bitmaps)
+        self.catalog.refresh(force=True)
+        self.assertEqual(self.catalog._bitmaps, cached)
+
+        Profile.objects.filter(pk=self.profile1.pk).update(
+            age=60, updatedAt=timezone.now())
+        with mock.patch('connections.catalog.matching_bitmap') as build:
+            self.catalog.refresh(force=True)
+            selection = self.catalog.select(min_age=26)
+        build.assert_not_called()
+        self.assertEqual(
+            self.user_ids(selection),
+            [self.user3.pk, self.user2.pk, self.user1.pk])
+
+    def test_late_rows_keep_the_feed_order(self):
+        """A profile older than the newest one is placed by createdAt"""
+        user = User.objects.create_user(username='late')
+        late = Profile.objects.create(
+            user=user, age=40, gender='O', location='City4',
+            bio='Late profile bio long enough', interests='x')
+        Profile.objects.filter(pk=late.pk).update(
+            createdAt=self.profile2.createdAt - timedelta(microseconds=1))
+        self.catalog.refresh(force=True)
+        expected = list(Profile.objects.order_by(
+            '-createdAt', '-id').values_list('pk', flat=True))
+        selection = self.catalog.select()
+        self.assertEqual(selection.ids(0, 10), expected)
+        self.assertEqual(selection.ids(2, 3), expected[2:3])
+
+    def test_deletes_elsewhere_trigger_a_reload(self):
+        self.profile2.delete()
+        self.catalog.refresh(force=True)
+        self.assertEqual(len(self.catalog), 2)
+        self.assertEqual(
+            self.user_ids(self.catalog.select()),
+            [self.user3.pk, self.user1.pk])
+
+    def test_refresh_is_throttled(self):
+        with override_settings(DISCOVERY_CATALOG_REFRESH_SECONDS=3600):
+            with self.assertNumQueries(0):
+                self.catalog.refresh()
+
+    def test_page_loads_with_one_query(self):
+        selection = self.catalog.select()
+        with self.assertNumQueries(1):
+            profiles = selection[1:3]
+        self.assertEqual(
+            [profile.user.username for profile in profiles],
+            ['user2', 'user1'])
+
+    def test_feed_matches_sql_ordering(self):
+        for i in range(7):
+            user = User.objects.create_user(username=f'extra{i}')
+            Profile.objects.create(
+                user=user, age=30, gender='F', location='City',
+                bio='Extra profile bio long enough', interests='x')
+            if i % 3 == 0:
+                Like.objects.create(
+                    from_user=user, to_user=self.user1, action=Like.LIKE)
+        Like.objects.create(
+            from_user=self.user1, to_user=self.user2, action=Like.DISLIKE)
+
+        def usernames():
+            feed = get_discovery_feed(self.user1)
+            return [profile.user.username for profile in feed[0:len(feed)]]
+
+        in_memory = usernames()
+        with override_settings(DISCOVERY_CATALOG_ENABLED=False):
+            self.assertEqual(usernames(), in_memory)
+        self.assertNotIn('user2', in_memory)
+        self.assertEqual(in_memory[0], 'extra6')
+
+
+class ProfileSnapshotTests(BaseConnectionsTestCase):
+    """Tests for the mmap-shared profile snapshot"""
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'profiles.snapshot')
+
+    def test_snapshot_selects_like_the_catalog(self):
+        write_snapshot(self.path)
+        mapped = MappedProfiles(self.path)
+        in_memory = ProfileCatalog()
+        in_memory.reload()
+        for filters in ({}, {'min_age': 26}, {'genders': ['M']},
+                        {'locations': ['CITY2']},
+                        {'exclude_user_ids': [self.user2.pk, 999]}):
+            self.assertEqual(
+                mapped.select(**filters).ids(0, 10),
+                in_memory.select(**filters).ids(0, 10))
+        self.assertEqual(mapped.row_for_user(self.user3.pk), 0)
+        self.assertIsNone(mapped.row_for_user(999))
+
+    def test_replaced_snapshot_is_remapped(self):
+        with override_settings(DISCOVERY_SNAPSHOT_PATH=self.path):
+            self.assertIs(get_discovery_catalog(), catalog)
+            write_snapshot(self.path)
+            old = get_discovery_catalog()
+            self.assertEqual(len(old), 3)
+
+            user = User.objects.create_user(username='newcomer')
+            Profile.objects.create(
+                user=user, age=40, gender='O', location='City4',
+                bio='Newcomer bio long enough', interests='x')
+            self.assertIs(get_discovery_catalog(), old)
+            write_snapshot(self.path)
+            new = get_discovery_catalog()
+            self.assertEqual(len(new), 4)
+            # Readers of the old map are unaffected by the swap
+            self.assertEqual(len(old.select().ids(0, 10)), 3)
+
+    def test_discover_reads_the_snapshot(self):
+        self.client.login(username='user1', password='testpass123')
+        with override_settings(DISCOVERY_SNAPSHOT_PATH=self.path):
+            call_command('write_profile_snapshot', stdout=StringIO())
+            response = self.client.get(reverse('connections:discover'))
+        self.assertEqual(
+            [profile.user.username for profile in response.context[
+                'profiles']],
+            ['user3', 'user2'])
+
+    def test_command_needs_a_path(self):
+        with self.assertRaises(CommandError):
+            call_command('write_profile_snapshot', stdout=StringIO())
+
+    def test_stale_snapshot_falls_back_to_the_catalog(self):
+        with override_settings(DISCOVERY_SNAPSHOT_PATH=self.path):
+            write_snapshot(self.path)
+            mapped = get_discovery_catalog()
+            self.assertIsNot(mapped, catalog)
+            mapped.written_at -= settings.DISCOVERY_SNAPSHOT_MAX_AGE + 1
+            with self.assertLogs('connections.snapshot', 'WARNING'):
+                self.assertIs(get_discovery_catalog(), catalog)
+
+    def test_refresher_writes_changes_and_survives_errors(self):
+        """The refresher rewrites only on changes and outlives failures"""
+        writes = []
+        real_write = write_snapshot
+
+        def flaky_write(path, profiles):
+            writes.append(len(profiles))
+            if len(writes) == 2:
+                raise OperationalError('database is locked')
+            return real_write(path, profiles)
+
+        def sleep(seconds):
+            if len(sleeps) == 1:
+                user = User.objects.create_user(username='newcomer')
+                Profile.objects.create(
+                    user=user, age=40, gender='O', location='City4',
+                    bio='Newcomer bio long enough', interests='x')
+            sleeps.append(seconds)
+            if len(sleeps) == 5:
+                raise KeyboardInterrupt
+
+        sleeps = []
+        command = 'connections.management.commands.write_profile_snapshot'
+        with mock.patch(f'{command}.write_snapshot', flaky_write), \
+                mock.patch(f'{command}.time.sleep', sleep), \
+                self.assertLogs(command, 'ERROR'), \
+                self.assertRaises(KeyboardInterrupt):
+            call_command(
+                'write_profile_snapshot', path=self.path, interval=1,
+                stdout=StringIO())
+        # Written, unchanged, failed on the new profile, written again,
+        # unchanged
+        self.assertEqual(writes, [3, 4, 4])
+        self.assertEqual(len(MappedProfiles(self.path)), 4)
+
+
+class SimilarityTests(BaseConnectionsTestCase):
+    """Tests for "Similar to me" discovery"""
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'similarity.index')
+        self.profile1.bio = (
+            'Weekend hiking in the mountains, wild camping and '
+            'strong coffee by the campfire')
+        self.profile1.interests = 'Hiking, Camping, Coffee'
+        self.profile1.save()
+        self.profile2.bio = (
+            'Hiking in the mountains every weekend, wild camping and '
+            'coffee by the campfire')
+        self.profile2.interests = 'Hiking, Camping'
+        self.profile2.save()
+        self.profile3.bio = 'Board games, horror films and late night pizza'
+        self.profile3.interests = 'Gaming, Films'
+        self.profile3.save()
+
+    def test_similar_bios_rank_first(self):
+        count = build_index(self.path, lambda: [
+            (profile.user_id, profile.bio, profile.interests)
+            for profile in Profile.objects.all()])
+        self.assertEqual(count, 3)
+        index = SimilarityIndex(self.path)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(
+            index.nearest(
+                self.profile1.bio, self.profile1.interests, 1,
+                exclude_user_ids=[self.user1.pk]),
+            [self.user2.pk])
+        self.assertEqual(index.nearest('', '', 10), [])
+
+    def test_large_buckets_are_not_cut_short(self):
+        """Every profile in a probed bucket is a candidate"""
+        build_index(self.path, lambda: [
+            (user_id, self.profile2.bio, self.profile2.interests)
+            for user_id in range(1, 101)])
+        index = SimilarityIndex(self.path)
+        with mock.patch('connections.similarity.FULL_SCAN_ROWS', 0):
+            similar = index.nearest(
+                self.profile2.bio, self.profile2.interests, 100)
+        self.assertEqual(sorted(similar), list(range(1, 101)))
+
+    def test_discover_similar_ordering(self):
+        self.client.login(username='user1', password='testpass123')
+        with override_settings(SIMILARITY_INDEX_PATH=self.path):
+            url = reverse('connections:discover')
+            # Without an index the feed is newest first
+            response = self.client.get(url, {'order': 'similar'})
+            self.assertEqual(
+                [profile.user.username for profile in response.context[
+                    'profiles']],
+                ['user3', 'user2'])
+
+            call_command('build_similarity_index', stdout=StringIO())
+            response = self.client.get(url, {'order': 'similar'})
+            self.assertEqual(response.context['order'], 'similar')
+            self.assertEqual(
+                [profile.user.username for profile in response.context[
+                    'profiles']],
+                ['user2', 'user3'])
+            self.assertContains(response, 'Similar to me')
+
+    def test_similar_skips_swiped_profiles(self):
+        Like.objects.create(
+            from_user=self.user1, to_user=self.user2, action=Like.DISLIKE)
+        with override_settings(SIMILARITY_INDEX_PATH=self.path):
+            call_command('build_similarity_index', stdout=StringIO())
+            for catalog_enabled in (True, False):
+                with override_settings(
+                        DISCOVERY_CATALOG_ENABLED=catalog_enabled):
+                    feed = get_discovery_feed(self.user1, order_by='similar')
+                    self.assertEqual(
+                        [profile.user for profile in feed[0:10]],
+                        [self.user3])
+
+    @override_settings(SIMILARITY_LIMIT=1)
+    def test_swiped_users_do_not_use_up_the_limit(self):
+        """The most similar user not swiped yet fills the only place"""
+        user = User.objects.create_user(username='hiker')
+        hiker = Profile.objects.create(
+            user=user, age=28, gender='F', location='City1',
+            bio='Mountains and hiking at the weekend', interests='Hiking')
+        # Oldest, so it only comes first as the similar profile
+        Profile.objects.filter(pk=hiker.pk).update(
+            createdAt=self.profile1.createdAt - timedelta(days=1))
+        Like.objects.create(
+            from_user=self.user1, to_user=self.user2, action=Like.LIKE)
+        with override_settings(SIMILARITY_INDEX_PATH=self.path):
+            call_command('build_similarity_index', stdout=StringIO())
+            for catalog_enabled in (True, False):
+                with override_settings(
+                        DISCOVERY_CATALOG_ENABLED=catalog_enabled):
+                    feed = get_discovery_feed(self.user1, order_by='similar')
+                    self.assertEqual(feed[0].user, user)
+
+    def test_rebuilt_index_is_reloaded(self):
+        with override_settings(SIMILARITY_INDEX_PATH=self.path):
+            self.assertIsNone(similarity_index.load(force=True))
+            call_command('build_similarity_index', stdout=StringIO())
+            first = similarity_index.load(force=True)
+            self.assertEqual(len(first), 3)
+            Profile.objects.filter(pk=self.profile3.pk).delete()
+            call_command('build_similarity_index', stdout=StringIO())
+            self.assertEqual(len(similarity_index.load(force=True)), 2)
+
+
+class OutboxTests(BaseConnectionsTestCase):
+    """Tests for the transactional outbox"""
+
+    def setUp(self):
+        super().setUp()
+        self.calls = []
+        self.handlers = {
+            kind: list(handlers)
+            for kind, handlers in outbox._handlers.items()
+        }
+        self.addCleanup(self._restore_handlers)
+
+    def _restore_handlers(self):
+        outbox._handlers.clear()
+        outbox._handlers.update(self.handlers)
+
+    def register(self, *kinds, fail=False):
+        def record(event):
+            self.calls.append((event.kind, event.payload))
+            Like.objects.filter(pk=-1).update(action=Like.LIKE)
+            if fail:
+                raise RuntimeError('handler failed')
+        # Handlers are told apart by name
+        record.__qualname__ += '_failing' if fail else ''
+        outbox.handler(*kinds)(record)
+        return record
+
+    def swipe(self, user, target, action):
+        self.client.force_login(user)
+        view = ('connections:like_profile' if action == Like.LIKE
+                else 'connections:pass_profile')
+        return self.client.post(reverse(view, args=[target.profile.id]))
+
+    def test_swipes_and_matches_publish_events(self):
+        self.swipe(self.user1, self.user2, Like.DISLIKE)
+        self.swipe(self.user1, self.user2, Like.LIKE)
+        self.swipe(self.user1, self.user2, Like.LIKE)  # Already liked
+        self.swipe(self.user2, self.user1, Like.LIKE)
+        events = list(OutboxEvent.objects.values_list('kind', 'payload'))
+        match = Match.objects.get()
+        self.assertEqual([kind for kind, _ in events], [
+            OutboxEvent.PASS, OutboxEvent.LIKE, OutboxEvent.LIKE,
+            OutboxEvent.MATCH])
+        self.assertEqual(events[1][1]['from_user_id'], self.user1.pk)
+        self.assertEqual(events[3][1], {
+            'match_id': match.pk, 'user1_id': match.user1_id,
+            'user2_id': match.user2_id})
+
+    def test_events_roll_back_with_the_swipe(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                Like.objects.create(
+                    from_user=self.user1, to_user=self.user2)
+                raise RuntimeError
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_drain_delivers_in_batches(self):
+        self.register(OutboxEvent.LIKE, OutboxEvent.PASS)
+        for target in (self.user2, self.user3):
+            Like.objects.create(from_user=self.user1, to_user=target)
+        Like.objects.create(
+            from_user=self.user2, to_user=self.user3, action=Like.DISLIKE)
+
+        self.assertEqual(outbox.drain(batch_size=2), (2, 0))
+        self.assertEqual(outbox.drain(batch_size=2), (1, 0))
+        self.assertEqual(outbox.drain(batch_size=2), (0, 0))
+        self.assertEqual(
+            [kind for kind, _ in self.calls],
+            [OutboxEvent.LIKE, OutboxEvent.LIKE, OutboxEvent.PASS])
+        self.assertFalse(OutboxEvent.objects.filter(
+            processed_at__isnull=True).exists())
+
+    def test_failed_handler_is_retried_without_repeating_others(self):
+        self.register(OutboxEvent.LIKE)
+        failing = self.register(OutboxEvent.LIKE, fail=True)
+        Like.objects.create(from_user=self.user1, to_user=self.user2)
+        with self.assertLogs('connections.outbox', 'ERROR'):
+            self.assertEqual(outbox.drain(), (0, 1))
+        event = OutboxEvent.objects.get()
+        self.assertEqual(event.attempts, 1)
+        self.assertIn('handler failed', event.last_error)
+        self.assertGreater(event.available_at, timezone.now())
+        self.assertEqual(outbox.drain(), (0, 0))  # Not due yet
+        self.assertEqual(HandledEvent.objects.count(), 1)
+
+        # The working handler is not called again on redelivery
+        outbox._handlers[OutboxEvent.LIKE] = [
+            (name, func) for name, func in outbox.get_handlers(
+                OutboxEvent.LIKE) if func is not failing]
+        OutboxEvent.objects.update(available_at=timezone.now())
+        self.calls.clear()
+        self.assertEqual(outbox.drain(), (1, 0))
+        self.assertEqual(self.calls, [])
+
+    @override_settings(OUTBOX_MAX_ATTEMPTS=2)
+    def test_event_is_given_up_after_max_attempts(self):
+        self.register(OutboxEvent.LIKE, fail=True)
+        Like.objects.create(from_user=self.user1, to_user=self.user2)
+        for _ in range(2):
+            OutboxEvent.objects.update(available_at=timezone.now())
+            with self.assertLogs('connections.outbox', 'ERROR'):
+                outbox.drain()
+        event = OutboxEvent.objects.get()
+        self.assertEqual(event.attempts, 2)
+        self.assertIsNotNone(event.failed_at)
+        self.assertIsNone(event.processed_at)
+
+    def test_command_drains_and_purges(self):
+        Like.objects.create(from_user=self.user1, to_user=self.user2)
+        OutboxEvent.objects.create(
+            kind=OutboxEvent.PASS,
+            processed_at=timezone.now() - timedelta(days=30))
+        out = StringIO()
+        call_command('drain_outbox', '--once', stdout=out)
+        self.assertIn('Purged 1 old events', out.getvalue())
+        self.assertIn('Delivered 1 event(s), 0 failed.', out.getvalue())
+        self.assertEqual(OutboxEvent.objects.count(), 1)
+
+    def test_purge_deletes_failed_events_after_their_retention(self):
+        now = timezone.now()
+        old_failed = OutboxEvent.objects.create(
+            kind=OutboxEvent.PASS, failed_at=now - timedelta(days=60))
+        recent_failed = OutboxEvent.objects.create(
+            kind=OutboxEvent.PASS, failed_at=now - timedelta(days=10))
+        waiting = OutboxEvent.objects.create(kind=OutboxEvent.PASS)
+        OutboxEvent.objects.filter(pk=waiting.pk).update(
+            created_at=now - timedelta(days=60),
+            available_at=now - timedelta(days=60))
+        self.assertEqual(outbox.purge(), 1)
+        self.assertFalse(OutboxEvent.objects.filter(pk=old_failed.pk).exists())
+        self.assertEqual(
+            set(OutboxEvent.objects.values_list('pk', flat=True)),
+            {recent_failed.pk, waiting.pk})
+        self.assertEqual(
+            outbox.purge(failed_older_than=timedelta(days=1)), 1)
+
+    def test_purge_deletes_handled_rows_in_batches(self):
+        delivered = timezone.now() - timedelta(days=30)
+        events = OutboxEvent.objects.bulk_create([
+            OutboxEvent(kind=OutboxEvent.PASS, processed_at=delivered)
+            for _ in range(5)
+        ])
+        HandledEvent.objects.bulk_create([
+            HandledEvent(event=event, handler='tests.handler')
+            for event in events
+        ])
+        kept = OutboxEvent.objects.create(kind=OutboxEvent.PASS)
+        HandledEvent.objects.create(event=kept, handler='tests.handler')
+        # Three batches, each reading ids and running two deletes in a
+        # savepoint of the test's transaction
+        with self.assertNumQueries(3 * 5):
+            self.assertEqual(outbox.purge(batch_size=2), 5)
+        self.assertEqual(
+            list(OutboxEvent.objects.values_list('pk', flat=True)),
+            [kept.pk])
+        self.assertEqual(HandledEvent.objects.get().event_id, kept.pk)
+
+
+class PushNotificationTests(BaseConnectionsTestCase):
+    """Tests for the pub/sub layer and the server-sent event stream"""
+
+    def setUp(self):
+        super().setUp()
+        self.pubsub = pubsub.InMemoryPubSub()
+        patcher = mock.patch.object(pubsub, '_pubsub', self.pubsub)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.async_client = AsyncClient()
+        self.async_client.force_login(self.user1)
+
+    def published(self):
+        return [
+            (message.channel, message.event, message.data)
+            for message in self.pubsub._history
+        ]
+
+    def test_subscription_gets_messages_from_other_threads(self):
+        async def receive():
+            subscription = self.pubsub.subscribe('user:1')
+            thread = threading.Thread(target=self.pubsub.publish, args=(
+                'user:1', 'like', {'like_id': 1}))
+            thread.start()
+            message = await subscription.get(timeout=5)
+            thread.join()
+            subscription.close()
+            return message
+
+        message = asyncio.run(receive())
+        self.assertEqual(message.event, 'like')
+        self.assertEqual(message.data, {'like_id': 1})
+        self.assertEqual(self.pubsub.subscriber_count('user:1'), 0)
+
+    def test_subscription_replays_messages_after_last_id(self):
+        first = self.pubsub.publish('user:1', 'like', {'n': 1})
+        self.pubsub.publish('user:2', 'like', {'n': 2})
+        self.pubsub.publish('user:1', 'match', {'n': 3})
+
+        async def receive():
+            subscription = self.pubsub.subscribe('user:1', last_id=first.id)
+            messages = [
+                await subscription.get(timeout=0),
+                await subscription.get(timeout=0),
+            ]
+            subscription.close()
+            return messages
+
+        messages = asyncio.run(receive())
+        self.assertEqual(messages[0].data, {'n': 3})
+        self.assertIsNone(messages[1])
+
+    @override_settings(PUBSUB_QUEUE_SIZE=2)
+    def test_slow_subscriber_loses_oldest_messages(self):
+        async def receive():
+            subscription = self.pubsub.subscribe('user:1')
+            for n in range(3):
+                self.pubsub.publish('user:1', 'like', {'n': n})
+            await asyncio.sleep(0)
+            messages = [
+                (await subscription.get(timeout=0)).data for _ in range(2)]
+            subscription.close()
+            return messages
+
+        self.assertEqual(asyncio.run(receive()), [{'n': 1}, {'n': 2}])
+
+    def test_likes_and_matches_are_pushed_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Like.objects.create(
+                from_user=self.user1, to_user=self.user2,
+                action=Like.DISLIKE)
+        self.assertEqual(self.published(), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.force_login(self.user2)
+            self.client.post(reverse(
+                'connections:like_profile', args=[self.profile1.id]))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.force_login(self.user1)
+            self.client.post(reverse(
+                'connections:like_profile', args=[self.profile2.id]))
+        match = Match.objects.get()
+        like = Like.objects.get(from_user=self.user1)
+        self.assertEqual(self.published(), [
+            (f'user:{self.user1.pk}', 'like', {
+                'like_id': Like.objects.get(from_user=self.user2).pk,
+                'from_user_id': self.user2.pk}),
+            (f'user:{self.user2.pk}', 'like', {
+                'like_id': like.pk, 'from_user_id': self.user1.pk}),
+            (f'user:{self.user1.pk}', 'match', {
+                'match_id': match.pk, 'user_id': self.user2.pk}),
+            (f'user:{self.user2.pk}', 'match', {
+                'match_id': match.pk, 'user_id': self.user1.pk}),
+        ])
+
+    def test_nothing_is_pushed_when_the_swipe_rolls_back(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError):
+                with transaction.atomic():
+                    Like.objects.create(
+                        from_user=self.user1, to_user=self.user2)
+                    raise RuntimeError
+        self.assertEqual(self.published(), [])
+
+    @override_settings(PUSH_HEARTBEAT_SECONDS=0.05, PUSH_STREAM_SECONDS=0.5)
+    async def test_event_stream_sends_events(self):
+        response = await self.async_client.get(reverse('connections:events'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        chunks = aiter(response.streaming_content)
+        self.assertEqual(await anext(chunks), b'retry: 3000\n\n')
+        self.assertEqual(await anext(chunks), b': keep-alive\n\n')
+
+        message = self.pubsub.publish(
+            f'user:{self.user1.pk}', 'match', {'match_id': 7})
+        self.assertEqual(await anext(chunks), (
+            f'id: {message.id}\nevent: match\n'
+            'data: {"match_id": 7}\n\n').encode())
+        # The stream ends by itself and the subscription is closed
+        async for _ in chunks:
+            pass
+        self.assertEqual(
+            self.pubsub.subscriber_count(f'user:{self.user1.pk}'), 0)
+
+    @override_settings(PUSH_HEARTBEAT_SECONDS=0.05, PUSH_STREAM_SECONDS=0.5)
+    async def test_event_stream_resumes_after_last_event_id(self):
+        channel = f'user:{self.user1.pk}'
+        seen = self.pubsub.publish(channel, 'like', {'like_id': 1})
+        self.pubsub.publish(channel, 'like', {'like_id': 2})
+        response = await self.async_client.get(
+            reverse('connections:events'),
+            headers={'Last-Event-ID': seen.id})
+        chunks = aiter(response.streaming_content)
+        await anext(chunks)
+        self.assertIn(b'"like_id": 2', await anext(chunks))
+        await chunks.aclose()
+
+    async def test_event_stream_needs_login(self):
+        response = await AsyncClient().get(reverse('connections:events'))
+        self.assertEqual(response.status_code, 204)
+
+    def test_event_stream_needs_asgi(self):
+        self.client.force_login(self.user1)
+        response = self.client.get(reverse('connections:events'))
+        self.assertEqual(response.status_code, 204)
+
+
+class ChatTests(BaseConnectionsTestCase):
+    """Tests for match chat"""
+
+    def setUp(self):
+        super().setUp()
+        self.match = Match.objects.create(user1=self.user1, user2=self.user2)
+        self.client.force_login(self.user1)
+        self.pubsub = pubsub.InMemoryPubSub()
+        patcher = mock.patch.object(pubsub, '_pubsub', self.pubsub)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def chat_url(self, match=None):
+        return reverse('connections:chat', args=[(match or self.match).pk])
+
+    def api_url(self, name='chat_messages_api'):
+        return reverse(f'connections:{name}', args=[self.match.pk])
+
+    def unread(self, user):
+        return chat.get_unread_counts(user, [self.match.pk]).get(
+            self.match.pk, 0)
+
+    def test_send_message(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                self.chat_url(), {'body': 'Hello there'})
+        self.assertRedirects(response, self.chat_url())
+        message = Message.objects.get()
+        self.assertEqual(message.sender, self.user1)
+        self.assertEqual(message.body, 'Hello there')
+        self.assertEqual(self.unread(self.user2), 1)
+        self.assertEqual(self.unread(self.user1), 0)
+        self.assertEqual(
+            [(m.channel, m.event) for m in self.pubsub._history], [
+                (f'match:{self.match.pk}', 'message'),
+                (f'user:{self.user2.pk}', 'message'),
+            ])
+
+    def test_empty_message_is_rejected(self):
+        response = self.client.post(self.chat_url(), {'body': '   '})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['form'].errors)
+        self.assertFalse(Message.objects.exists())
+
+    def test_only_users_of_an_active_match_can_chat(self):
+        other = Match.objects.create(user1=self.user2, user2=self.user3)
+        response = self.client.get(self.chat_url(other))
+        self.assertEqual(response.status_code, 404)
+        self.client.post(self.chat_url(other), {'body': 'Hi'})
+        self.assertFalse(Message.objects.exists())
+        Match.objects.filter(pk=self.match.pk).update(is_active=False)
+        self.assertEqual(self.client.get(self.chat_url()).status_code, 404)
+        response = self.client.get(self.api_url())
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(CHAT_PAGE_SIZE=3)
+    def test_history_is_paged_by_message_id(self):
+        sent = [
+            chat.send_message(self.match, self.user2, f'Message {number}')
+            for number in range(7)
+        ]
+        response = self.client.get(self.chat_url())
+        self.assertEqual(list(response.context['chat_messages']), sent[4:])
+        self.assertTrue(response.context['has_older'])
+        response = self.client.get(
+            self.chat_url(), {'before': sent[4].pk})
+        self.assertEqual(list(response.context['chat_messages']), sent[1:4])
+        response = self.client.get(
+            self.chat_url(), {'before': sent[1].pk})
+        self.assertEqual(list(response.context['chat_messages']), sent[:1])
+        self.assertFalse(response.context['has_older'])
+
+    def test_reading_resets_unread_count(self):
+        for number in range(3):
+            chat.send_message(self.match, self.user2, f'Message {number}')
+        self.assertEqual(chat.get_unread_total(self.user1), 3)
+        self.client.get(self.chat_url())
+        self.assertEqual(self.unread(self.user1), 0)
+        # An older page does not mark anything read
+        chat.send_message(self.match, self.user2, 'Later')
+        self.client.get(self.chat_url(), {'before': 1})
+        self.assertEqual(self.unread(self.user1), 1)
+
+    def test_mark_read_counts_messages_after_what_was_read(self):
+        first = chat.send_message(self.match, self.user2, 'First')
+        chat.send_message(self.match, self.user2, 'Second')
+        chat.send_message(self.match, self.user1, 'Mine')
+        chat.mark_read(self.match, self.user1, first.pk)
+        state = ChatReadState.objects.get(user=self.user1)
+        self.assertEqual(state.last_read_id, first.pk)
+        self.assertEqual(state.unread_count, 1)
+        # Going back does nothing
+        chat.mark_read(self.match, self.user1, first.pk - 1)
+        self.assertEqual(self.unread(self.user1), 1)
+
+    def test_matches_page_shows_unread_count(self):
+        chat.send_message(self.match, self.user2, 'Hello')
+        response = self.client.get(reverse('connections:matches'))
+        self.assertEqual(response.context['match_profiles'][0]['unread'], 1)
+        self.assertContains(response, self.chat_url())
+
+    @override_settings(CHAT_PAGE_SIZE=2)
+    def test_api_lists_and_sends_messages(self):
+        sent = [
+            chat.send_message(self.match, self.user2, f'Message {number}')
+            for number in range(3)
+        ]
+        data = self.client.get(self.api_url()).json()
+        self.assertEqual(
+            [message['id'] for message in data['results']],
+            [sent[1].pk, sent[2].pk])
+        self.assertTrue(data['has_older'])
+        data = self.client.get(self.api_url(), {'after': sent[0].pk}).json()
+        self.assertEqual(len(data['results']), 2)
+        self.assertEqual(self.unread(self.user1), 0)
+
+        response = self.client.post(self.api_url(), {'body': 'Hi back'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['body'], 'Hi back')
+        response = self.client.post(self.api_url(), {'body': ''})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(self.api_url(), {'before': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_poll_answers_at_once_under_wsgi(self):
+        message = chat.send_message(self.match, self.user2, 'Hello')
+        data = self.client.get(
+            self.api_url('chat_poll'), {'after': 0}).json()
+        self.assertEqual([m['id'] for m in data['results']], [message.pk])
+        data = self.client.get(
+            self.api_url('chat_poll'), {'after': message.pk}).json()
+        self.assertEqual(data['results'], [])
+
+    async def poll(self, after=0):
+        client = AsyncClient()
+        await sync_to_async(client.force_login)(self.user1)
+        response = await client.get(
+            self.api_url('chat_poll'), {'after': after})
+        self.assertEqual(response.status_code, 200)
+        if not response.streaming:
+            return response.json()
+        content = [chunk async for chunk in response.streaming_content]
+        return json.loads(b''.join(content))
+
+    async def test_poll_answers_at_once_with_new_messages(self):
+        message = await sync_to_async(chat.send_message)(
+            self.match, self.user2, 'Hello')
+        data = await self.poll()
+        self.assertEqual([m['id'] for m in data['results']], [message.pk])
+
+    async def test_poll_waits_for_a_new_message(self):
+        poll = asyncio.ensure_future(self.poll())
+        await asyncio.sleep(0.2)
+        self.assertFalse(poll.done())
+
+        message = await sync_to_async(Message.objects.create)(
+            match=self.match, sender=self.user2, body='Hello')
+        self.pubsub.publish(f'match:{self.match.pk}', 'message', {})
+        data = await asyncio.wait_for(poll, 5)
+        self.assertEqual([m['id'] for m in data['results']], [message.pk])
+
+    @override_settings(CHAT_POLL_SECONDS=0.1)
+    async def test_poll_ends_empty_after_timeout(self):
+        self.assertEqual(await self.poll(), {'results': []})
+        self.assertEqual(
+            self.pubsub.subscriber_count(f'match:{self.match.pk}'), 0)
+
+
+class MatchDigestTests(BaseConnectionsTestCase):
+    """Tests for batched new-match emails"""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('match_up.mail._mailer', Mailer(rate=0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        Site.objects.clear_cache()
+        self.later = timezone.now() + timedelta(
+            seconds=settings.MATCH_EMAIL_WINDOW_SECONDS + 1)
+
+    def make_matches(self, *pairs):
+        for first, second in pairs:
+            Match.objects.create(user1=first, user2=second)
+        outbox.drain()
+
+    def test_matches_in_a_window_share_one_digest(self):
+        self.make_matches((self.user1, self.user2), (self.user1, self.user3))
+        self.assertEqual(MatchNotification.objects.count(), 4)
+        # Nothing goes out before the window is over
+        self.assertEqual(notifications.send_match_digests(), 0)
+        self.assertEqual(mail.outbox, [])
+
+        with self.assertNumQueries(4):
+            sent = notifications.send_match_digests(now=self.later)
+        self.assertEqual(sent, 3)
+        self.assertFalse(MatchNotification.objects.exists())
+        digest = next(
+            message for message in mail.outbox
+            if message.to == ['user1@example.com'])
+        self.assertEqual(
+            digest.subject, 'You have 2 new matches on example.com')
+        self.assertIn('- user2 (City2)', digest.body)
+        self.assertIn('- user3 (City3)', digest.body)
+        self.assertIn('https://example.com/connections/matches/', digest.body)
+        self.assertEqual(digest.alternatives[0][1], 'text/html')
+
+    def test_redelivered_event_adds_no_notification(self):
+        self.make_matches((self.user1, self.user2))
+        event = OutboxEvent.objects.get(kind=OutboxEvent.MATCH)
+        notifications.queue_match_notifications(event)
+        self.assertEqual(MatchNotification.objects.count(), 2)
+
+    def test_users_without_email_and_ended_matches_get_nothing(self):
+        self.make_matches((self.user1, self.user2), (self.user2, self.user3))
+        User.objects.filter(pk=self.user3.pk).update(email='')
+        Match.objects.filter(user1=self.user1).update(is_active=False)
+        self.assertEqual(notifications.send_match_digests(now=self.later), 1)
+        self.assertEqual(mail.outbox[0].to, ['user2@example.com'])
+        self.assertIn('1 new match on', mail.outbox[0].subject)
+        self.assertFalse(MatchNotification.objects.exists())
+
+    def test_failed_send_keeps_the_unsent_digests(self):
+        self.make_matches((self.user1, self.user2))
+        with mock.patch.object(
+                Mailer, 'send', side_effect=[True, smtplib.SMTPException]):
+            with self.assertRaises(smtplib.SMTPException):
+                notifications.send_match_digests(now=self.later)
+        self.assertEqual(MatchNotification.objects.count(), 1)
+
+    def test_digests_are_limited_per_run(self):
+        self.make_matches((self.user1, self.user2), (self.user1, self.user3))
+        self.assertEqual(
+            notifications.send_match_digests(now=self.later, limit=2), 2)
+        self.assertEqual(
+            notifications.send_match_digests(now=self.later, limit=2), 1)
+
+
+class MailerTests(TestCase):
+    """Tests for the pooled, throttled email sender"""
+
+    def message(self, number=0):
+        return EmailMessage(
+            f'Subject {number}', 'Body', to=[f'to{number}@example.com'])
+
+    def test_connection_is_reused_between_messages(self):
+        mailer = Mailer(rate=0)
+        with mock.patch(
+                'match_up.mail.get_connection',
+                wraps=mail.get_connection) as get_connection:
+            for number in range(3):
+                self.assertTrue(mailer.send(self.message(number)))
+        self.assertEqual(get_connection.call_count, 1)
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_file_backend_writes_one_file_per_connection(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        with override_settings(
+                EMAIL_BACKEND='django.core.mail.backends.filebased.'
+                              'EmailBackend',
+                EMAIL_FILE_PATH=path):
+            mailer = Mailer(rate=0)
+            mailer.send(self.message(1))
+            mailer.send(self.message(2))
+            mailer.close()
+        self.assertEqual(len(os.listdir(path)), 1)
+
+    def test_idle_connection_is_replaced(self):
+        mailer = Mailer(rate=0, max_idle=0)
+        with mock.patch(
+                'match_up.mail.get_connection',
+                wraps=mail.get_connection) as get_connection:
+            mailer.send(self.message(1))
+            time.sleep(0.01)
+            mailer.send(self.message(2))
+        self.assertEqual(get_connection.call_count, 2)
+
+    def test_dropped_connection_is_reopened_once(self):
+        dropped = mock.Mock()
+        dropped.send_messages.side_effect = smtplib.SMTPServerDisconnected
+        working = mock.Mock()
+        mailer = Mailer(rate=0)
+        with mock.patch(
+                'match_up.mail.get_connection',
+                side_effect=[dropped, working]):
+            self.assertTrue(mailer.send(self.message()))
+        dropped.close.assert_called_once_with()
+        working.send_messages.assert_called_once()
+
+        working.send_messages.side_effect = smtplib.SMTPServerDisconnected
+        with mock.patch(
+                'match_up.mail.get_connection', return_value=working):
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                mailer.send(self.message())
+
+    def test_refused_recipients_keep_the_connection(self):
+        connection = mock.Mock()
+        connection.send_messages.side_effect = (
+            smtplib.SMTPRecipientsRefused({}))
+        mailer = Mailer(rate=0)
+        with mock.patch(
+                'match_up.mail.get_connection', return_value=connection):
+            with self.assertLogs('match_up.mail', 'WARNING'):
+                self.assertFalse(mailer.send(self.message()))
+        connection.close.assert_not_called()
+
+    def test_rate_limiter_spaces_out_bursts(self):
+        now = [0.0]
+        sleeps = []
+        limiter = RateLimiter(
+            10, clock=lambda: now[0], sleep=sleeps.append)
+        for _ in range(3):
+            limiter.wait()
+        self.assertEqual(sleeps, [0.1, 0.2])
+        now[0] = 10.0
+        limiter.wait()
+        self.assertEqual(len(sleeps), 2)
+
+
+class DataExportTests(BaseConnectionsTestCase):
+    """Tests for the streamed personal data export"""
+
+    def setUp(self):
+        super().setUp()
+        Like.objects.create(from_user=self.user1, to_user=self.user2)
+        Like.objects.create(
+            from_user=self.user3, to_user=self.user1, action=Like.DISLIKE)
+        Like.objects.create(from_user=self.user2, to_user=self.user1)
+        Like.objects.create(from_user=self.user2, to_user=self.user3)
+        self.match = Match.objects.get()
+        chat.send_message(self.match, self.user2, 'Hi there')
+        self.client.force_login(self.user1)
+
+    def download(self, **params):
+        response = self.client.get(
+            reverse('connections:export_data'), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content)
+
+    def test_ndjson_export_has_only_the_users_data(self):
+        response, content = self.download()
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertIn('attachment;', response['Content-Disposition'])
+        self.assertEqual(response['Cache-Control'], 'no-store')
+        records = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual(
+            [record['type'] for record in records],
+            ['account', 'profile', 'like', 'like', 'like', 'match',
+             'message'])
+        self.assertEqual(records[0]['email'], 'user1@example.com')
+        self.assertEqual(records[1]['location'], 'City1')
+        likes = {
+            (record['direction'], record['other_user'], record['action'])
+            for record in records if record['type'] == 'like'
+        }
+        self.assertEqual(likes, {
+            ('sent', 'user2', Like.LIKE),
+            ('received', 'user3', Like.DISLIKE),
+            ('received', 'user2', Like.LIKE),
+        })
+        self.assertEqual(records[5]['other_user'], 'user2')
+        self.assertEqual(records[6]['direction'], 'received')
+        self.assertEqual(records[6]['body'], 'Hi there')
+
+    def test_csv_export_can_be_gzipped(self):
+        response, content = self.download(format='csv', gzip='1')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertRegex(
+            response['Content-Disposition'],
+            r'filename="match-up-user1-\d{8}\.csv\.gz"')
+        rows = list(csv.DictReader(
+            gzip.decompress(content).decode().splitlines()))
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(rows[0]['username'], 'user1')
+        self.assertEqual(rows[6]['body'], 'Hi there')
+
+    def test_export_reads_in_chunks_with_fixed_queries(self):
+        for number in range(5):
+            chat.send_message(self.match, self.user1, f'Message {number}')
+        with mock.patch.object(export, 'CHUNK_BYTES', 100):
+            chunks = list(export.ndjson_chunks(
+                export.export_records(self.user1, chunk_size=2)))
+        self.assertGreater(len(chunks), 5)
+        self.assertEqual(len(b''.join(chunks).splitlines()), 12)
+        # Profile, likes both ways, matches both ways and messages
+        with self.assertNumQueries(6):
+            list(export.export_records(self.user1, chunk_size=2))
+
+    async def test_export_streams_under_asgi(self):
+        client = AsyncClient()
+        await sync_to_async(client.force_login)(self.user1)
+        response = await client.get(
+            reverse('connections:export_data'), {'gzip': '1'})
+        self.assertEqual(response.status_code, 200)
+        # A sync iterator would be read whole before anything was sent
+        self.assertTrue(response.is_async)
+        content = b''.join([
+            chunk async for chunk in response.streaming_content])
+        self.assertEqual(len(gzip.decompress(content).splitlines()), 7)
+
+    def test_unknown_format_and_anonymous_users_are_refused(self):
+        response = self.client.get(
+            reverse('connections:export_data'), {'format': 'xml'})
+        self.assertEqual(response.status_code, 400)
+        self.client.logout()
+        response = self.client.get(reverse('connections:export_data'))
+        self.assertEqual(response.status_code, 302)
@@ -23,8 +23,36 @@ urlpatterns = [
         'liked/',
         views.LikedProfilesView.as_view(),
         name='liked_profiles'),
+    path(
+        'liked-you/',
+        views.LikedYouView.as_view(),
+        name='liked_you'),
+    path(
+        'api/liked-you/',
+        views.LikedYouApiView.as_view(),
+        name='liked_you_api'),
     path(
         'matches/',
         views.MatchesListView.as_view(),
         name='matches'),
+    path(
+        'matches/<int:match_id>/chat/',
+        views.ChatView.as_view(),
+        name='chat'),
+    path(
+        'api/matches/<int:match_id>/messages/',
+        views.ChatMessagesApiView.as_view(),
+        name='chat_messages_api'),
+    path(
+        'api/matches/<int:match_id>/messages/poll/',
+        views.ChatPollView.as_view(),
+        name='chat_poll'),
+    path(
+        'events/',
+        views.EventStreamView.as_view(),
+        name='events'),
+    path(
+        'export/',
+        views.DataExportView.as_view(),
+        name='export_data'),
 ]
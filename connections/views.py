@@ -1,23 +1,43 @@
 """
 Views for connection-related functionality (likes, matches, discovery)
 """
-from django.contrib.auth.models import User
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
 from django.shortcuts import get_object_or_404, redirect
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.views.generic import ListView
+from django.views.generic import ListView, TemplateView
 from django.views import View
-from django.http import JsonResponse, Http404
+from django.http import (
+    HttpResponse, JsonResponse, Http404, StreamingHttpResponse,
+)
 from django.contrib import messages
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
 from dating.models import Profile
+from .chat import (
+    get_chat_match, get_history, get_messages_after, get_unread_counts,
+    mark_read, send_message, serialize_message,
+)
+from .export import csv_chunks, export_records, gzip_chunks, ndjson_chunks
+from .forms import MessageForm
 from .models import Like, Match
-from .services import get_discoverable_profiles
+from .pubsub import get_pubsub, match_channel, user_channel
+from .services import (
+    get_discovery_feed, get_like_count, get_liked_you_page,
+    simulate_bot_like_back,
+)
 
 
 class DiscoverView(LoginRequiredMixin, ListView):
     """
     Display profiles for discovery feed using service function.
-    Shows all profiles, excludes already interacted profiles.
+    Shows all profiles, excludes already interacted profiles and moves
+    users who already liked the viewer into the first pages.
     """
     model = Profile
     template_name = 'connections/discover.html'
@@ -34,17 +54,24 @@ class DiscoverView(LoginRequiredMixin, ListView):
             return redirect('profile_create')
         return super().get(request, *args, **kwargs)
 
+    def get_order(self):
+        """Feed ordering from ?order=, 'similar' or the default"""
+        if self.request.GET.get('order') == 'similar':
+            return 'similar'
+        return 'reciprocal'
+
     def get_queryset(self):
-        """Get discoverable profiles using service function"""
-        return get_discoverable_profiles(
+        """Get the discovery feed using service function"""
+        return get_discovery_feed(
             self.request.user,
-            order_by='newest'
+            order_by=self.get_order()
         )
 
     def get_context_data(self, **kwargs):
         """Add additional context"""
         context = super().get_context_data(**kwargs)
         context['title'] = 'Discover'
+        context['order'] = self.get_order()
         return context
 
 
@@ -68,14 +95,15 @@ class LikeProfileView(LoginRequiredMixin, View):
                     'error': 'Cannot like your own profile'
                 }, status=400)
 
-            # Check if already liked
-            existing_like = Like.objects.filter(
+            # get_or_create also absorbs a double submit racing this one
+            like, created = Like.objects.get_or_create(
                 from_user=request.user,
-                to_user=target_profile.user
-            ).first()
+                to_user=target_profile.user,
+                defaults={'action': Like.LIKE}
+            )
 
-            if existing_like:
-                if existing_like.action == Like.LIKE:
+            if not created:
+                if like.action == Like.LIKE:
                     return JsonResponse({
                         'success': True,
                         'message': 'Already liked!',
@@ -84,25 +112,14 @@ class LikeProfileView(LoginRequiredMixin, View):
                         )
                     })
                 else:
-                    # Update dislike to like
-                    existing_like.action = Like.LIKE
-                    existing_like.save()
-            else:
-                # Create new like
-                Like.objects.create(
-                    from_user=request.user,
-                    to_user=target_profile.user,
-                    action=Like.LIKE
-                )
-
-            # Create a match if the target profile is user 5
-            if target_profile.user.id == 5:
-                print("Creating match")
-                Like.objects.create(
-                    from_user=User.objects.get(id=5),
-                    to_user=request.user,
-                    action=Like.LIKE
-                )
+                    # Update dislike to like, with its outbox event
+                    like.action = Like.LIKE
+                    with transaction.atomic():
+                        like.save()
+
+            # Bot profiles answer likes straight away
+            if target_profile.is_bot:
+                simulate_bot_like_back(target_profile.user, request.user)
 
             # Check if match was created (signal should have created it)
             is_match = self._check_match(request.user, target_profile.user)
@@ -153,29 +170,24 @@ class PassProfileView(LoginRequiredMixin, View):
                     'error': 'Cannot pass on your own profile'
                 }, status=400)
 
-            # Check if already passed
-            existing_like = Like.objects.filter(
+            # get_or_create also absorbs a double submit racing this one
+            like, created = Like.objects.get_or_create(
                 from_user=request.user,
-                to_user=target_profile.user
-            ).first()
+                to_user=target_profile.user,
+                defaults={'action': Like.DISLIKE}
+            )
 
-            if existing_like:
-                if existing_like.action == Like.DISLIKE:
+            if not created:
+                if like.action == Like.DISLIKE:
                     return JsonResponse({
                         'success': True,
                         'message': 'Already passed!'
                     })
                 else:
-                    # Update like to dislike
-                    existing_like.action = Like.DISLIKE
-                    existing_like.save()
-            else:
-                # Create new dislike/pass
-                Like.objects.create(
-                    from_user=request.user,
-                    to_user=target_profile.user,
-                    action=Like.DISLIKE
-                )
+                    # Update like to dislike, with its outbox event
+                    like.action = Like.DISLIKE
+                    with transaction.atomic():
+                        like.save()
 
             return JsonResponse({
                 'success': True,
@@ -214,14 +226,13 @@ class MatchesListView(LoginRequiredMixin, ListView):
 
     def get_queryset(self):
         """Get all active matches for current user"""
+        user = self.request.user
+        # Join both users' profiles so listing a page costs one query
         return Match.objects.filter(
+            Q(user1=user) | Q(user2=user),
             is_active=True
-        ).filter(
-            user1=self.request.user
-        ) | Match.objects.filter(
-            is_active=True
-        ).filter(
-            user2=self.request.user
+        ).select_related(
+            'user1__profile', 'user2__profile'
         ).order_by('-created_at')
 
     def get_context_data(self, **kwargs):
@@ -229,6 +240,9 @@ class MatchesListView(LoginRequiredMixin, ListView):
         context = super().get_context_data(**kwargs)
         matches = context['matches']
 
+        unread = get_unread_counts(
+            self.request.user, [match.pk for match in matches])
+
         # Get profiles for each match
         match_profiles = []
         for match in matches:
@@ -237,7 +251,8 @@ class MatchesListView(LoginRequiredMixin, ListView):
                 profile = other_user.profile
                 match_profiles.append({
                     'match': match,
-                    'profile': profile
+                    'profile': profile,
+                    'unread': unread.get(match.pk, 0),
                 })
             except Profile.DoesNotExist:
                 continue
@@ -275,10 +290,359 @@ class LikedProfilesView(LoginRequiredMixin, ListView):
 
         return Profile.objects.filter(
             user_id__in=liked_user_ids
-        ).order_by('-createdAt')
+        ).select_related('user').order_by('-createdAt')
 
     def get_context_data(self, **kwargs):
         """Add context"""
         context = super().get_context_data(**kwargs)
         context['title'] = 'Profiles I Liked'
         return context
+
+
+class LikedYouView(LoginRequiredMixin, TemplateView):
+    """
+    Profiles that liked the current user and are waiting for an answer.
+    Paged with a cursor instead of page numbers.
+    """
+    template_name = 'connections/liked_you.html'
+    paginate_by = 12
+
+    def get(self, request, *args, **kwargs):
+        """Check if user has a profile"""
+        if not hasattr(request.user, 'profile'):
+            messages.info(
+                request,
+                'You must create a profile to see who liked you.'
+            )
+            return redirect('profile_create')
+        return super().get(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        """Add the current page of likes and the inbox count"""
+        context = super().get_context_data(**kwargs)
+        try:
+            likes, next_cursor = get_liked_you_page(
+                self.request.user,
+                self.request.GET.get('cursor'),
+                self.paginate_by
+            )
+        except ValueError:
+            likes, next_cursor = get_liked_you_page(
+                self.request.user, None, self.paginate_by)
+        context['likes'] = likes
+        context['next_cursor'] = next_cursor
+        context['like_count'] = get_like_count(self.request.user)
+        context['title'] = 'Liked You'
+        return context
+
+
+class LikedYouApiView(LoginRequiredMixin, View):
+    """
+    JSON version of the "Liked you" inbox.
+    Pass the returned next_cursor as ?cursor= to get the following page.
+    """
+    max_limit = 50
+
+    def get(self, request):
+        try:
+            limit = min(
+                max(int(request.GET.get('limit', 20)), 1), self.max_limit)
+            likes, next_cursor = get_liked_you_page(
+                request.user, request.GET.get('cursor'), limit)
+        except ValueError:
+            return JsonResponse({
+                'error': 'Invalid cursor or limit.'
+            }, status=400)
+
+        results = []
+        for like in likes:
+            profile = like.from_user.profile
+            results.append({
+                'profile_id': profile.id,
+                'username': like.from_user.username,
+                'age': profile.age,
+                'gender': profile.gender,
+                'location': profile.location,
+                'photo': profile.photo.url if profile.photo else None,
+                'liked_at': like.created_at.isoformat(),
+            })
+        return JsonResponse({
+            'count': get_like_count(request.user),
+            'results': results,
+            'next_cursor': next_cursor,
+        })
+
+
+async def iterate_in_thread(iterable):
+    """
+    Iterate a synchronous iterable that may use the database from async
+    code, one item at a time in the thread sync_to_async runs code in.
+    """
+    iterator = iter(iterable)
+    next_item = sync_to_async(next)
+    done = object()
+    while (item := await next_item(iterator, done)) is not done:
+        yield item
+
+
+def format_event(message):
+    """A pub/sub Message in the text/event-stream format"""
+    return (
+        f'id: {message.id}\nevent: {message.event}\n'
+        f'data: {json.dumps(message.data)}\n\n'
+    )
+
+
+class EventStreamView(View):
+    """
+    Server-sent events telling the current user about new likes and
+    matches as they happen, instead of the page polling for them.
+
+    Needs an ASGI server (match_up.asgi): the stream is an async
+    generator that waits on the user's pub/sub channel without holding a
+    thread. A stream ends after ``PUSH_STREAM_SECONDS`` and the browser's
+    EventSource reconnects, sending the id of the last event it got so
+    that events published in between are not lost.
+    """
+
+    async def get(self, request):
+        # Loading the user queries the database, which must not happen
+        # on the event loop
+        user_id = await sync_to_async(
+            lambda: request.user.pk if request.user.is_authenticated
+            else None)()
+        # 204 tells EventSource to stop reconnecting. Under WSGI the
+        # stream would hold a worker and arrive all at once at the end.
+        if user_id is None or not isinstance(request, ASGIRequest):
+            return HttpResponse(status=204)
+
+        response = StreamingHttpResponse(
+            self.stream(
+                user_channel(user_id), request.headers.get('Last-Event-ID')),
+            content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Stops nginx from buffering the events
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    async def stream(self, channel, last_id):
+        subscription = get_pubsub().subscribe(channel, last_id)
+        try:
+            yield f'retry: {settings.PUSH_RETRY_MS}\n\n'
+            loop = asyncio.get_running_loop()
+            end = loop.time() + settings.PUSH_STREAM_SECONDS
+            while (remaining := end - loop.time()) > 0:
+                message = await subscription.get(
+                    timeout=min(settings.PUSH_HEARTBEAT_SECONDS, remaining))
+                if message is not None:
+                    yield format_event(message)
+                elif remaining > settings.PUSH_HEARTBEAT_SECONDS:
+                    # A comment keeps proxies from closing an idle stream
+                    # and reveals clients that have gone away
+                    yield ': keep-alive\n\n'
+        finally:
+            subscription.close()
+
+
+def _message_id(value):
+    """A message id from a query parameter, or None if absent"""
+    if value in (None, ''):
+        return None
+    message_id = int(value)
+    if message_id < 0:
+        raise ValueError('Invalid message id')
+    return message_id
+
+
+def _read_new_messages(match, user, after):
+    """Serialized messages after ``after``, which the user has now read"""
+    page = get_messages_after(match, after, settings.CHAT_PAGE_SIZE)
+    if page:
+        mark_read(match, user, page[-1].pk)
+    return [serialize_message(message) for message in page]
+
+
+class ChatView(LoginRequiredMixin, TemplateView):
+    """
+    Conversation with a match: the newest messages, or older ones with
+    ?before=<message id>, and a form to send a message.
+    """
+    template_name = 'connections/chat.html'
+
+    def get_match(self):
+        match = get_chat_match(self.request.user, self.kwargs['match_id'])
+        if match is None:
+            raise Http404('No such match')
+        return match
+
+    def get(self, request, *args, **kwargs):
+        self.match = self.get_match()
+        self.form = MessageForm()
+        return super().get(request, *args, **kwargs)
+
+    def post(self, request, *args, **kwargs):
+        """Send a message"""
+        self.match = self.get_match()
+        self.form = MessageForm(request.POST)
+        if self.form.is_valid():
+            send_message(
+                self.match, request.user, self.form.cleaned_data['body'])
+            return redirect('connections:chat', match_id=self.match.pk)
+        return self.render_to_response(self.get_context_data())
+
+    def get_context_data(self, **kwargs):
+        """Add a page of messages, read up to its newest message"""
+        context = super().get_context_data(**kwargs)
+        try:
+            before = _message_id(self.request.GET.get('before'))
+        except ValueError:
+            before = None
+        chat_messages, has_older = get_history(
+            self.match, before, settings.CHAT_PAGE_SIZE)
+        if before is None and chat_messages:
+            mark_read(self.match, self.request.user, chat_messages[-1].pk)
+        other_user = self.match.get_other_user(self.request.user)
+        context.update({
+            'match': self.match,
+            'other_user': other_user,
+            'chat_messages': chat_messages,
+            'has_older': has_older,
+            'is_newest_page': before is None,
+            'last_message_id': chat_messages[-1].pk if chat_messages else 0,
+            'form': self.form,
+            'title': f'Chat with {other_user.username}',
+        })
+        return context
+
+
+class ChatMessagesApiView(LoginRequiredMixin, View):
+    """
+    JSON version of a conversation.
+    GET returns the newest messages, the ones before ?before=<id> or the
+    ones after ?after=<id>; POST sends a message from ``body``.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.user.is_authenticated:
+            self.match = get_chat_match(request.user, kwargs['match_id'])
+            if self.match is None:
+                return JsonResponse({'error': 'Match not found.'}, status=404)
+        return super().dispatch(request, *args, **kwargs)
+
+    def get(self, request, match_id):
+        try:
+            before = _message_id(request.GET.get('before'))
+            after = _message_id(request.GET.get('after'))
+        except ValueError:
+            return JsonResponse({'error': 'Invalid message id.'}, status=400)
+
+        if after is not None:
+            return JsonResponse({
+                'results': _read_new_messages(self.match, request.user, after)
+            })
+        page, has_older = get_history(
+            self.match, before, settings.CHAT_PAGE_SIZE)
+        if before is None and page:
+            mark_read(self.match, request.user, page[-1].pk)
+        return JsonResponse({
+            'results': [serialize_message(message) for message in page],
+            'has_older': has_older,
+        })
+
+    def post(self, request, match_id):
+        form = MessageForm(request.POST)
+        if not form.is_valid():
+            return JsonResponse({'errors': form.errors}, status=400)
+        message = send_message(
+            self.match, request.user, form.cleaned_data['body'])
+        return JsonResponse(serialize_message(message), status=201)
+
+
+class ChatPollView(View):
+    """
+    Long poll for new messages of a conversation.
+
+    Answers with the messages after ?after=<id> as soon as there are any,
+    or with none after ``CHAT_POLL_SECONDS``. Under ASGI the wait happens
+    in the streamed response body, after the middleware has finished, so
+    a waiting poll holds no thread. Under WSGI it would hold a worker, so
+    the view answers straight away and the page polls again a little
+    later.
+    """
+
+    async def get(self, request, match_id):
+        try:
+            after = _message_id(request.GET.get('after')) or 0
+        except ValueError:
+            return JsonResponse({'error': 'Invalid message id.'}, status=400)
+
+        def load_match():
+            if not request.user.is_authenticated:
+                return None, None
+            return request.user, get_chat_match(request.user, match_id)
+
+        user, match = await sync_to_async(load_match)()
+        if user is None:
+            return JsonResponse({'error': 'Login required.'}, status=401)
+        if match is None:
+            return JsonResponse({'error': 'Match not found.'}, status=404)
+
+        results = await sync_to_async(_read_new_messages)(match, user, after)
+        if results or not isinstance(request, ASGIRequest):
+            return JsonResponse({'results': results})
+        response = StreamingHttpResponse(
+            self.wait(match, user, after), content_type='application/json')
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+    async def wait(self, match, user, after):
+        read_new_messages = sync_to_async(_read_new_messages)
+        subscription = get_pubsub().subscribe(match_channel(match.pk))
+        try:
+            # Look again now that nothing sent can be missed
+            results = await read_new_messages(match, user, after)
+            if not results and await subscription.get(
+                    timeout=settings.CHAT_POLL_SECONDS) is not None:
+                results = await read_new_messages(match, user, after)
+        finally:
+            subscription.close()
+        yield json.dumps({'results': results})
+
+
+class DataExportView(LoginRequiredMixin, View):
+    """
+    Download everything stored about the current user.
+
+    ?format=ndjson (the default) or csv; ?gzip=1 compresses the file.
+    The export is streamed as it is read from the database, so it takes
+    the same memory however long the user's history is (see
+    connections.export). Under ASGI each chunk is produced in the sync
+    thread and handed over as an async iterator, which Django streams
+    instead of reading whole.
+    """
+    formats = {
+        'ndjson': (ndjson_chunks, 'application/x-ndjson'),
+        'csv': (csv_chunks, 'text/csv; charset=utf-8'),
+    }
+
+    def get(self, request):
+        export_format = request.GET.get('format', 'ndjson')
+        if export_format not in self.formats:
+            return JsonResponse({'error': 'Unknown format.'}, status=400)
+        encode, content_type = self.formats[export_format]
+        chunks = encode(export_records(request.user))
+        filename = (
+            f'match-up-{request.user.username}-'
+            f'{timezone.now():%Y%m%d}.{export_format}')
+        if request.GET.get('gzip') == '1':
+            chunks = gzip_chunks(chunks)
+            content_type = 'application/gzip'
+            filename += '.gz'
+
+        if isinstance(request, ASGIRequest):
+            chunks = iterate_in_thread(chunks)
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response['Content-Disposition'] = (
+            f'attachment; filename="{filename}"')
+        response['Cache-Control'] = 'no-store'
+        return response
@@ -1,6 +1,37 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.template.response import TemplateResponse
+from django.urls import path
 from .models import Profile
 from django_summernote.admin import SummernoteModelAdmin
+from match_up.pagination import EstimatedCountPaginator
+from .forms import ProfileImportForm
+from .importer import import_profiles, read_rows
+from .search import search_profiles
+
+# Rejected rows listed after an import; the rest are only counted
+IMPORT_ERRORS_SHOWN = 100
+
+
+class AgeRangeFilter(admin.SimpleListFilter):
+    """Filter profiles by fixed age brackets instead of every distinct age"""
+    title = 'age'
+    parameter_name = 'age_range'
+    ranges = {
+        '18-24': (18, 24),
+        '25-34': (25, 34),
+        '35-44': (35, 44),
+        '45-99': (45, 99),
+    }
+
+    def lookups(self, request, model_admin):
+        return [(key, key) for key in self.ranges]
+
+    def queryset(self, request, queryset):
+        if self.value() not in self.ranges:
+            return queryset
+        low, high = self.ranges[self.value()]
+        return queryset.filter(age__gte=low, age__lte=high)
 
 
 @admin.register(Profile)
@@ -8,6 +39,67 @@ class ProfileAdmin(SummernoteModelAdmin):
     list_display = (
         'user', 'age', 'gender', 'location', 'bio', 'interests', 'photo'
     )
-    list_filter = ('age', 'gender', 'location')
+    list_filter = (
+        AgeRangeFilter, 'gender', 'is_profile_complete', 'is_bot')
+    list_select_related = ('user',)
+    date_hierarchy = 'createdAt'
     search_fields = ('user__username', 'user__email')
+    autocomplete_fields = ('user',)
     summernote_fields = ('bio', 'interests')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        """Search the full-text index instead of scanning with icontains"""
+        if not search_term.strip():
+            return queryset, False
+        return search_profiles(
+            queryset, search_term, rank=False, include_email=True), False
+
+    def get_urls(self):
+        return [
+            path(
+                'import/', self.admin_site.admin_view(self.import_view),
+                name='dating_profile_import'),
+        ] + super().get_urls()
+
+    def import_view(self, request):
+        """
+        Bulk import users and profiles from an uploaded file.
+
+        The import runs within the request; very large files are better
+        loaded with manage.py import_profiles.
+        """
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        form = ProfileImportForm(
+            request.POST or None, request.FILES or None)
+        result = None
+        errors = []
+
+        def on_error(line, row_errors):
+            if len(errors) < IMPORT_ERRORS_SHOWN:
+                errors.append((line, row_errors))
+
+        if request.method == 'POST' and form.is_valid():
+            upload = form.cleaned_data['file']
+            result = import_profiles(
+                read_rows(
+                    upload.file, form.cleaned_data['format'] or None,
+                    name=upload.name),
+                on_error=on_error)
+            self.message_user(
+                request,
+                f'Imported {result.created} profile(s), {result.failed} '
+                f'row(s) rejected.',
+                messages.WARNING if result.failed else messages.SUCCESS)
+
+        return TemplateResponse(
+            request, 'admin/dating/profile/import.html', {
+                **self.admin_site.each_context(request),
+                'opts': self.model._meta,
+                'title': 'Import profiles',
+                'form': form,
+                'result': result,
+                'errors': errors,
+            })
@@ -0,0 +1,329 @@
+"""
+Username and location autocomplete.
+
+On PostgreSQL, suggestions come from ``icontains`` lookups, under a
+``statement_timeout`` of ``AUTOCOMPLETE_TIMEOUT_MS``. Django compiles
+them to ``UPPER(column::text) LIKE UPPER(pattern)``, so the ``pg_trgm``
+GIN indexes are built on that same expression; an index on the bare
+column could not serve them.
+
+Elsewhere each process keeps a ``TrigramIndex`` of the usernames and
+locations of every profile. Once it is ``AUTOCOMPLETE_REFRESH_SECONDS``
+old, the next lookup starts a rebuild in a background thread and
+lookups keep using the old index until the new one is ready; until the
+first build is done they query the database instead. A lookup only
+checks the entries listed under the query's rarest trigram. When its
+time budget runs out, it returns the best of what it has found so far.
+
+Either way, matches that start with the query come first, then the most
+common locations and the shortest names. Results are cached per query
+for ``AUTOCOMPLETE_CACHE_SECONDS``. The query is what the user has typed
+so far, so every prefix is cached on its own.
+"""
+import hashlib
+import heapq
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import (
+    OperationalError, connection, connections, transaction,
+)
+from django.db.models import Case, Count, IntegerField, Value, When
+from django.db.models.functions import Length
+
+from .models import Profile
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ('username', 'location')
+TRIGRAM_INDEXES = (
+    ('auth_user', 'username', 'dating_user_username_upper_trgm'),
+    ('dating_profile', 'location', 'dating_profile_location_upper_trgm'),
+)
+MAX_QUERY_LENGTH = 50
+
+
+def normalize_location(text):
+    """
+    Tidy a location as typed: single spaces and, when typed all in one
+    case, capitalised words.
+    """
+    text = ' '.join((text or '').split())
+    if text.islower() or text.isupper():
+        text = text.title()
+    return text
+
+
+def trigrams(key):
+    """Every three-character run of a casefolded key"""
+    return {key[i:i + 3] for i in range(len(key) - 2)}
+
+
+def create_trigram_indexes(connection):
+    """Create the pg_trgm GIN indexes behind autocomplete on Postgres"""
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        for table, column, name in TRIGRAM_INDEXES:
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS {name} ON {table} '
+                f'USING gin ((UPPER({column}::text)) gin_trgm_ops)')
+
+
+def drop_trigram_indexes(connection):
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        for _, _, name in TRIGRAM_INDEXES:
+            cursor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class TrigramIndex:
+    """
+    Substring search over a fixed list of entries.
+
+    Args:
+        entries: Iterable of (text, weight); entries whose casefolded
+                 text is the same are merged and the text of the heaviest
+                 one is kept
+    """
+
+    def __init__(self, entries):
+        merged = {}
+        for text, weight in entries:
+            key = text.casefold()
+            if not key:
+                continue
+            best = merged.get(key)
+            if best is None:
+                merged[key] = (text, weight, weight)
+            else:
+                best_text, best_weight, total = best
+                if weight > best_weight:
+                    best_text, best_weight = text, weight
+                merged[key] = (best_text, best_weight, total + weight)
+        self.keys = sorted(merged)
+        self.texts = [merged[key][0] for key in self.keys]
+        self.weights = array('q', (merged[key][2] for key in self.keys))
+        postings = {}
+        for entry, key in enumerate(self.keys):
+            for gram in trigrams(key):
+                postings.setdefault(gram, array('I')).append(entry)
+        self.postings = postings
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _candidates(self, key):
+        if len(key) < 3:
+            # Too short for trigrams: prefixes only, from the sorted keys
+            start = bisect_left(self.keys, key)
+            end = bisect_left(self.keys, key + '\U0010ffff', lo=start)
+            return range(start, end)
+        # Every match has all the query's trigrams, so the rarest one's
+        # posting list holds them all; checking those directly is cheaper
+        # than intersecting the longer lists
+        return min(
+            (self.postings.get(gram, ()) for gram in trigrams(key)), key=len)
+
+    def _matches(self, key, deadline):
+        keys = self.keys
+        for checked, entry in enumerate(self._candidates(key)):
+            if (deadline is not None and not checked & 255 and
+                    time.monotonic() > deadline):
+                return
+            if key in keys[entry]:
+                yield entry
+
+    def search(self, query, limit, deadline=None):
+        """
+        Entries containing the query, best first.
+
+        Args:
+            query: Text to look for, any case
+            limit: Number of entries to return
+            deadline: ``time.monotonic()`` value after which the entries
+                      checked so far are ranked and returned
+
+        Returns:
+            List of entry texts
+        """
+        key = query.casefold()
+        keys, weights = self.keys, self.weights
+        best = heapq.nsmallest(
+            limit, self._matches(key, deadline), key=lambda entry: (
+                not keys[entry].startswith(key), -weights[entry],
+                len(keys[entry]), keys[entry]))
+        return [self.texts[entry] for entry in best]
+
+
+class TrigramIndexes:
+    """
+    Per-process trigram indexes of usernames and locations.
+
+    Stale indexes are rebuilt in a background thread while lookups keep
+    using them, unless ``AUTOCOMPLETE_BACKGROUND_REBUILD`` is off, when
+    the lookup that finds them stale rebuilds them itself.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._built_at = None
+        self._rebuilding = False
+        self.indexes = None
+
+    def get(self, field):
+        """The index of a field, or None until the first build is done"""
+        with self._lock:
+            start = not self._rebuilding and (
+                self._built_at is None or time.monotonic() - self._built_at
+                >= settings.AUTOCOMPLETE_REFRESH_SECONDS)
+            if start:
+                self._rebuilding = True
+        if start:
+            if settings.AUTOCOMPLETE_BACKGROUND_REBUILD:
+                threading.Thread(
+                    target=self._rebuild_in_background,
+                    name='autocomplete-rebuild', daemon=True).start()
+            else:
+                self._rebuild_once()
+        indexes = self.indexes
+        return None if indexes is None else indexes[field]
+
+    def rebuild(self):
+        """Build the indexes from the database and start using them"""
+        started = time.monotonic()
+        indexes = self._build()
+        with self._lock:
+            self.indexes = indexes
+            self._built_at = started
+
+    def _rebuild_once(self):
+        try:
+            self.rebuild()
+        finally:
+            with self._lock:
+                self._rebuilding = False
+
+    def _rebuild_in_background(self):
+        try:
+            self._rebuild_once()
+        except Exception:
+            logger.exception('Could not rebuild the autocomplete indexes')
+        finally:
+            # The thread's own connection would otherwise stay open
+            connections.close_all()
+
+    def _build(self):
+        usernames = User.objects.filter(
+            is_active=True, profile__isnull=False
+        ).order_by().values_list('username', flat=True)
+        locations = Profile.objects.order_by().values_list(
+            'location').annotate(count=Count('id'))
+        return {
+            'username': TrigramIndex(
+                (username, 1) for username in usernames.iterator()),
+            'location': TrigramIndex(
+                (normalize_location(location), count)
+                for location, count in locations.iterator()),
+        }
+
+
+trigram_indexes = TrigramIndexes()
+
+
+def _starts_with(field, query):
+    return Case(
+        When(**{f'{field}__istartswith': query}, then=Value(0)),
+        default=Value(1), output_field=IntegerField())
+
+
+def _database_suggestions(field, query, limit):
+    """Suggestions from lookups served by the pg_trgm indexes"""
+    if field == 'username':
+        return list(User.objects.filter(
+            is_active=True, profile__isnull=False,
+            username__icontains=query,
+        ).annotate(prefix=_starts_with('username', query)).order_by(
+            'prefix', Length('username'), 'username'
+        ).values_list('username', flat=True)[:limit])
+    locations = Profile.objects.filter(
+        location__icontains=query
+    ).order_by().values_list('location').annotate(
+        prefix=_starts_with('location', query), count=Count('id')
+    ).order_by('prefix', '-count', 'location')[:limit * 3]
+    # Spellings that differ only in case or spacing count as one
+    results = {}
+    for location, _, _ in locations:
+        location = normalize_location(location)
+        results.setdefault(location.casefold(), location)
+    return list(results.values())[:limit]
+
+
+def suggest(field, query, limit=None):
+    """
+    Autocomplete a username or location.
+
+    Args:
+        field: 'username' or 'location'
+        query: What has been typed so far
+        limit: Number of suggestions; defaults to ``AUTOCOMPLETE_LIMIT``
+
+    Returns:
+        List of suggestions, best first; possibly incomplete when the
+        lookup ran out of time
+    """
+    if field not in FIELDS:
+        raise ValueError(f'Cannot autocomplete {field!r}')
+    query = ' '.join(query.split())[:MAX_QUERY_LENGTH]
+    if not query:
+        return []
+    limit = limit or settings.AUTOCOMPLETE_LIMIT
+    digest = hashlib.blake2b(
+        query.casefold().encode(), digest_size=16).hexdigest()
+    cache_key = f'autocomplete:{field}:{limit}:{digest}'
+    results = cache.get(cache_key)
+    if results is not None:
+        return results
+
+    budget = settings.AUTOCOMPLETE_TIMEOUT_MS
+    if connection.vendor == 'postgresql':
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        'SET LOCAL statement_timeout = %s', [int(budget)])
+                results = _database_suggestions(field, query, limit)
+        except OperationalError:
+            logger.warning(
+                'Autocomplete of %s %r took over %sms', field, query, budget)
+            return []
+    else:
+        index = trigram_indexes.get(field)
+        if index is None:
+            results = _database_suggestions(field, query, limit)
+        else:
+            results = index.search(
+                query, limit, deadline=time.monotonic() + budget / 1000)
+    cache.set(cache_key, results, settings.AUTOCOMPLETE_CACHE_SECONDS)
+    return results
+
+
+def canonical_location(text):
+    """
+    The spelling most profiles use for a location, or the tidied text
+    if no profile uses it yet.
+    """
+    location = normalize_location(text)
+    if not location:
+        return location
+    for suggestion in suggest('location', location):
+        if suggestion.casefold() == location.casefold():
+            return suggestion
+    return location
@@ -2,3 +2,38 @@
 Forms for dating app
 """
 from django import forms
+from django.urls import reverse_lazy
+
+from .autocomplete import canonical_location
+from .models import Profile
+
+
+class ProfileForm(forms.ModelForm):
+    """Profile create and edit form with location suggestions"""
+
+    class Meta:
+        model = Profile
+        fields = ['age', 'gender', 'location', 'bio', 'interests', 'photo']
+        widgets = {
+            'location': forms.TextInput(attrs={
+                'list': 'location-suggestions',
+                'autocomplete': 'off',
+                'data-autocomplete-url': reverse_lazy('profile_autocomplete'),
+            }),
+        }
+
+    def clean_location(self):
+        """Store the spelling other profiles already use"""
+        return canonical_location(self.cleaned_data['location'])
+
+
+class ProfileImportForm(forms.Form):
+    """Upload of a CSV or NDJSON file for dating.importer"""
+    file = forms.FileField(
+        help_text='CSV or NDJSON, optionally gzipped, with the columns '
+                  'username, email, age, gender, location, bio and '
+                  'interests.')
+    format = forms.ChoiceField(
+        choices=[('', 'From the file name'), ('csv', 'CSV'),
+                 ('ndjson', 'NDJSON')],
+        required=False)
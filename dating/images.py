@@ -0,0 +1,280 @@
+"""
+Image helpers for profile photos.
+
+Builds the fixed-size variants used by the profile card templates so that
+pages of cards download small thumbnails instead of the original upload.
+"""
+import base64
+import hashlib
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils.module_loading import import_string
+from PIL import Image, ImageOps
+import requests
+
+# Square variants rendered for each kind of photo slot. Widths cover 1x and
+# 2x screens for the CSS size of the slot given in ``sizes``.
+PHOTO_VARIANTS = {
+    'avatar': {
+        'widths': (120, 240),
+        'sizes': '120px',
+    },
+    'card': {
+        'widths': (200, 400),
+        'sizes': '(min-width: 768px) 150px, 200px',
+    },
+}
+
+# (extension, Pillow format, mime type, save options), best format first
+VARIANT_FORMATS = (
+    ('webp', 'WEBP', 'image/webp', {'quality': 80, 'method': 4}),
+    ('jpeg', 'JPEG', 'image/jpeg', {
+        'quality': 82, 'optimize': True, 'progressive': True}),
+)
+
+VARIANT_FOLDER = 'profile_variants'
+
+# Edge length of the inline low-quality placeholder, in pixels
+PLACEHOLDER_SIZE = 20
+
+# Rows/columns compared by the perceptual hash; 8 gives a 64-bit hash
+PERCEPTUAL_HASH_SIZE = 8
+
+
+def get_photo_storage():
+    """
+    Return the storage that derived photo files are written to.
+
+    Uses ``settings.PROFILE_PHOTO_STORAGE`` (a dotted path to a storage
+    class) when set, otherwise the default file storage, which is
+    ``MediaCloudinaryStorage`` in production.
+    """
+    storage_path = getattr(settings, 'PROFILE_PHOTO_STORAGE', None)
+    if storage_path:
+        return import_string(storage_path)()
+    return default_storage
+
+
+def load_image(source):
+    """Open an uploaded file as an RGB image with EXIF rotation applied"""
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    image = Image.open(source)
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ('RGBA', 'LA', 'P'):
+        # Flatten transparency onto white rather than black
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image
+
+
+def limit_size(image, max_dimension):
+    """Shrink an image in place so its longest side fits max_dimension"""
+    if max(image.size) > max_dimension:
+        image.thumbnail(
+            (max_dimension, max_dimension), Image.Resampling.LANCZOS)
+    return image
+
+
+def content_token(source):
+    """Short content hash used to give each upload unique variant names"""
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    digest = hashlib.sha1()
+    for chunk in iter(lambda: source.read(64 * 1024), b''):
+        digest.update(chunk)
+    source.seek(0)
+    return digest.hexdigest()[:12]
+
+
+def encode_image(image, image_format, options):
+    """Encode a Pillow image and return the raw bytes"""
+    buffer = BytesIO()
+    image.save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+
+def build_variants(image, storage, prefix):
+    """
+    Render every configured variant of ``image`` and save it to ``storage``.
+
+    Returns a mapping of ``{kind: {extension: {width: name}}}`` where each
+    name is the value returned by ``storage.save``.
+    """
+    variants = {}
+    for kind, spec in PHOTO_VARIANTS.items():
+        for width in spec['widths']:
+            square = ImageOps.fit(
+                image, (width, width), Image.Resampling.LANCZOS)
+            for extension, image_format, _, options in VARIANT_FORMATS:
+                data = encode_image(square, image_format, options)
+                name = storage.save(
+                    f'{prefix}/{kind}-{width}.{extension}', ContentFile(data))
+                variants.setdefault(kind, {}).setdefault(
+                    extension, {})[str(width)] = name
+    return variants
+
+
+def placeholder_data_uri(image):
+    """
+    Encode a tiny blurred-up preview of ``image`` as a JPEG data URI.
+
+    The result is well under 1 KB and is inlined in the card templates so
+    the browser can paint something before the real photo arrives.
+    """
+    tiny = ImageOps.fit(
+        image, (PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), Image.Resampling.BOX)
+    data = encode_image(tiny, 'JPEG', {'quality': 50, 'optimize': True})
+    return 'data:image/jpeg;base64,' + base64.b64encode(data).decode('ascii')
+
+
+def perceptual_hash(image):
+    """
+    Compute a 64-bit difference hash (dHash) of an image as 16 hex digits.
+
+    Visually identical photos hash the same even after re-encoding or
+    resizing, so the hash can be used to spot re-uploads.
+    """
+    size = PERCEPTUAL_HASH_SIZE
+    small = image.convert('L').resize(
+        (size + 1, size), Image.Resampling.LANCZOS)
+    pixels = small.getdata()
+    bits = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            left = pixels[offset + col]
+            right = pixels[offset + col + 1]
+            bits = (bits << 1) | (left > right)
+    return f'{bits:0{size * size // 4}x}'
+
+
+def pixel_digest(image):
+    """
+    SHA-256 of an image's size and decoded pixels as 64 hex digits.
+
+    Unlike the perceptual hash, only an exact copy of the picture gives
+    the same digest, whatever file format or metadata it came in.
+    """
+    digest = hashlib.sha256(f'{image.mode}:{image.width}x{image.height}:'
+                            .encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def hamming_distance(first_hash, second_hash):
+    """Number of differing bits between two perceptual hashes"""
+    return (int(first_hash, 16) ^ int(second_hash, 16)).bit_count()
+
+
+def thumbnail_source(profile, storage):
+    """
+    Pick the cheapest copy of a profile photo to build a placeholder from.
+
+    Returns a local path or URL of the smallest stored variant, or a
+    Cloudinary URL that shrinks the original before it is downloaded.
+    Both are cropped to a square, like the placeholder itself.
+    """
+    name = smallest_variant_name(profile.photo_variants)
+    if name:
+        try:
+            return storage.path(name)
+        except NotImplementedError:
+            return storage.url(name)
+    return profile.photo.build_url(
+        width=64, height=64, crop='fill', format='jpg')
+
+
+def original_source(profile):
+    """
+    Cloudinary URL of a profile photo's stored original, untransformed.
+
+    store_profile_photo hashes and digests the decoded upload, which is
+    what Cloudinary stores; any resized or re-encoded copy would give
+    another pixel digest.
+    """
+    return profile.photo.build_url()
+
+
+def open_source(source):
+    """Load an image from a local path or an http(s) URL"""
+    if source.startswith(('http://', 'https://')):
+        response = requests.get(source, timeout=10)
+        response.raise_for_status()
+        return load_image(BytesIO(response.content))
+    with open(source, 'rb') as photo:
+        return load_image(photo)
+
+
+def placeholder_from_source(job):
+    """
+    Build a placeholder for ``(profile_id, source)`` in a worker process.
+
+    ``source`` is a local file path or an http(s) URL. Returns
+    ``(profile_id, data_uri, error)``; no database access happens here so
+    the function is safe to run in a process pool.
+    """
+    profile_id, source = job
+    try:
+        return profile_id, placeholder_data_uri(open_source(source)), None
+    except (OSError, ValueError, requests.RequestException) as e:
+        return profile_id, None, str(e)
+
+
+def fingerprint_from_source(job):
+    """
+    Process pool counterpart of ``placeholder_from_source`` returning
+    ``(profile_id, photo_hash, photo_digest, error)``.
+    """
+    profile_id, source = job
+    try:
+        image = open_source(source)
+        return profile_id, perceptual_hash(image), pixel_digest(image), None
+    except (OSError, ValueError, requests.RequestException) as e:
+        return profile_id, None, None, str(e)
+
+
+def iter_variant_names(variants):
+    """Yield every stored file name in a variants mapping"""
+    for formats in (variants or {}).values():
+        for names in formats.values():
+            yield from names.values()
+
+
+def smallest_variant_name(variants, extension='jpeg'):
+    """Return the stored name of the smallest variant in one format"""
+    candidates = [
+        (int(width), name)
+        for formats in (variants or {}).values()
+        for width, name in formats.get(extension, {}).items()
+    ]
+    return min(candidates)[1] if candidates else None
+
+
+def variant_sources(variants, kind, storage):
+    """
+    Build ``<source>``/``<img>`` data for one kind of variant.
+
+    Returns a list of ``(mime_type, srcset, smallest_url)`` tuples in
+    preference order, or an empty list when the kind was not generated.
+    """
+    formats = (variants or {}).get(kind)
+    if not formats:
+        return []
+    sources = []
+    for extension, _, mime_type, _ in VARIANT_FORMATS:
+        names = formats.get(extension)
+        if not names:
+            continue
+        widths = sorted(names, key=int)
+        srcset = ', '.join(
+            f'{storage.url(names[width])} {width}w' for width in widths)
+        sources.append((mime_type, srcset, storage.url(names[widths[0]])))
+    return sources
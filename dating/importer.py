@@ -0,0 +1,244 @@
+"""
+Bulk import of users and profiles from CSV or NDJSON.
+
+Each input row makes a user and their profile, with the columns
+username, email, age, gender, location, bio and interests. Rows are
+read one at a time and handled in batches:
+
+- every field is cleaned with the model field's own validation (age
+  18-99, bio length, gender choices, username characters...), and the
+  batch's usernames are checked against existing users in one query;
+- the valid rows are inserted with one bulk_create for the users and
+  one for the profiles, and their search documents are written in one
+  statement, all in one transaction per batch.
+
+Invalid rows are reported with their line number and skipped; the other
+rows of their batch are still imported. Imported users get an unusable
+password, so they sign in through a password reset. Photos are not
+imported.
+"""
+import csv
+import gzip
+import io
+import json
+from collections import namedtuple
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.validators import MaxLengthValidator
+from django.db import IntegrityError, connections, transaction
+from django.db.models import TextField
+
+from .autocomplete import normalize_location
+from .models import Profile
+from .search import write_documents
+
+USER_COLUMNS = ('username', 'email')
+PROFILE_COLUMNS = ('age', 'gender', 'location', 'bio', 'interests')
+COLUMNS = USER_COLUMNS + PROFILE_COLUMNS
+
+ImportResult = namedtuple('ImportResult', 'created failed')
+
+
+def read_rows(file, format=None, name=None):
+    """
+    Yield the rows of a CSV or NDJSON file.
+
+    Args:
+        file: Binary file object, seekable unless it has peek(); gzipped
+              input is detected and unpacked
+        format: 'csv' or 'ndjson'; guessed from the file name if None
+        name: File name to guess from; defaults to the file's name
+
+    Yields:
+        Tuples of (line number, dict of column to value); a line that
+        is not a JSON object gives None instead of a dict
+    """
+    name = name or getattr(file, 'name', '') or ''
+    if hasattr(file, 'peek'):
+        magic = file.peek(2)[:2]
+    else:
+        magic = file.read(2)
+        file.seek(0)
+    if magic == b'\x1f\x8b':
+        file = gzip.GzipFile(fileobj=file)
+        if name.endswith('.gz'):
+            name = name[:-3]
+    if format is None:
+        format = 'ndjson' if name.endswith(('.ndjson', '.jsonl')) else 'csv'
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    if format == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for number, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield number, row if isinstance(row, dict) else None
+
+
+def _clean_field(model, name, value, errors):
+    field = model._meta.get_field(name)
+    if isinstance(value, str):
+        value = value.strip()
+    if value in (None, ''):
+        if not field.blank:
+            errors[name] = [field.error_messages['blank']]
+        return ''
+    try:
+        value = field.clean(value, None)
+        # TextField only applies max_length to forms
+        if isinstance(field, TextField) and field.max_length:
+            MaxLengthValidator(field.max_length)(value)
+        return value
+    except ValidationError as error:
+        errors[name] = error.messages
+        return None
+
+
+def clean_row(row):
+    """
+    Validate one input row against the User and Profile fields.
+
+    Returns:
+        Tuple of (cleaned dict, dict of field to error messages)
+    """
+    if row is None:
+        return None, {'row': ['Not a JSON object.']}
+    errors = {}
+    cleaned = {}
+    for name in USER_COLUMNS:
+        cleaned[name] = _clean_field(User, name, row.get(name), errors)
+    for name in PROFILE_COLUMNS:
+        cleaned[name] = _clean_field(Profile, name, row.get(name), errors)
+    if cleaned['location']:
+        cleaned['location'] = normalize_location(cleaned['location'])
+    # csv.DictReader keys values past the header's columns with None
+    unknown = {str(column) for column in row if column not in COLUMNS}
+    if unknown:
+        errors['row'] = [f'Unknown columns: {", ".join(sorted(unknown))}.']
+    return cleaned, errors
+
+
+def _validate_batch(batch, on_error):
+    """Clean a batch of rows and drop the invalid ones"""
+    valid = []
+    seen = set()
+    for line, row in batch:
+        cleaned, errors = clean_row(row)
+        username = cleaned and cleaned['username']
+        if username and username in seen:
+            errors.setdefault('username', []).append(
+                'Duplicate username in the file.')
+        if errors:
+            on_error(line, errors)
+            continue
+        seen.add(username)
+        valid.append((line, cleaned))
+
+    taken = set(User.objects.filter(
+        username__in=[cleaned['username'] for _, cleaned in valid]
+    ).values_list('username', flat=True))
+    if taken:
+        for line, cleaned in valid:
+            if cleaned['username'] in taken:
+                on_error(line, {'username': [
+                    'A user with that username already exists.']})
+        valid = [
+            (line, cleaned) for line, cleaned in valid
+            if cleaned['username'] not in taken
+        ]
+    return valid
+
+
+def _insert_batch(valid, using):
+    # Unusable either way; one random suffix per batch saves most of the
+    # time spent building users
+    password = make_password(None)
+    users = [
+        User(username=cleaned['username'], email=cleaned['email'],
+             password=password)
+        for _, cleaned in valid
+    ]
+    with transaction.atomic(using=using):
+        # Both backends return the new ids, which the profiles need
+        User.objects.using(using).bulk_create(users)
+        profiles = Profile.objects.using(using).bulk_create([
+            Profile(user=user, **{
+                name: cleaned[name] for name in PROFILE_COLUMNS})
+            for user, (_, cleaned) in zip(users, valid)
+        ])
+        write_documents(connections[using], [
+            (profile.pk, user.username, user.email, profile.bio,
+             profile.interests)
+            for user, profile in zip(users, profiles)
+        ])
+
+
+def import_batch(batch, on_error, using='default'):
+    """
+    Validate and insert one batch of rows.
+
+    Args:
+        batch: List of (line number, row dict) from read_rows
+        on_error: Called with (line number, dict of field to messages)
+                  for every row that is not imported
+        using: Database alias
+
+    Returns:
+        Number of users and profiles created
+    """
+    valid = _validate_batch(batch, on_error)
+    if not valid:
+        return 0
+    try:
+        _insert_batch(valid, using)
+    except IntegrityError:
+        # A username was taken while the batch was checked; check again
+        lines = {line for line, _ in valid}
+        valid = _validate_batch(
+            [(line, row) for line, row in batch if line in lines], on_error)
+        if not valid:
+            return 0
+        _insert_batch(valid, using)
+    return len(valid)
+
+
+def import_profiles(rows, batch_size=1000, on_error=None, using='default'):
+    """
+    Import users and profiles from rows, a batch at a time.
+
+    Args:
+        rows: Iterable of (line number, row dict), such as read_rows
+        batch_size: Rows validated and inserted together
+        on_error: Called with (line number, dict of field to messages)
+                  for every row that is not imported
+        using: Database alias
+
+    Returns:
+        ImportResult of the created and failed row counts
+    """
+    failed = 0
+
+    def report(line, errors):
+        nonlocal failed
+        failed += 1
+        if on_error is not None:
+            on_error(line, errors)
+
+    created = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            created += import_batch(batch, report, using)
+            batch = []
+    if batch:
+        created += import_batch(batch, report, using)
+    return ImportResult(created, failed)
@@ -0,0 +1,90 @@
+"""
+Time a bulk profile import of generated rows.
+
+``--rows`` rows are written to a temporary NDJSON or CSV file, one in
+``--invalid-every`` of them with a bad age, and imported with
+dating.importer. The imported users are deleted afterwards unless
+``--keep`` is given.
+"""
+import csv
+import json
+import os
+import random
+import tempfile
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from dating.importer import COLUMNS, import_profiles, read_rows
+
+PREFIX = 'importbench'
+LOCATIONS = ('Dublin', 'Cork', 'Galway', 'London', 'Paris', 'Berlin')
+WORDS = (
+    'love', 'weekend', 'adventures', 'quiet', 'nights', 'good', 'food',
+    'long', 'walks', 'new', 'places', 'friends', 'music', 'books',
+)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the bulk profile import.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100_000)
+        parser.add_argument(
+            '--format', choices=['csv', 'ndjson'], default='ndjson')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--invalid-every', type=int, default=100,
+            help='Make one row in this many invalid (0 for none).')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument(
+            '--keep', action='store_true',
+            help='Keep the imported users.')
+
+    def handle(self, *args, **options):
+        if User.objects.filter(username__startswith=PREFIX).exists():
+            raise CommandError(
+                f'Users starting with "{PREFIX}" already exist; delete them '
+                f'first.')
+        fd, path = tempfile.mkstemp(suffix=f'.{options["format"]}')
+        try:
+            with os.fdopen(fd, 'w', newline='') as file:
+                self._write(file, options)
+            started = time.perf_counter()
+            with open(path, 'rb') as file:
+                result = import_profiles(
+                    read_rows(file), batch_size=options['batch_size'])
+            elapsed = time.perf_counter() - started
+        finally:
+            os.unlink(path)
+            if not options['keep']:
+                User.objects.filter(username__startswith=PREFIX).delete()
+        self.stdout.write(
+            f'Imported {result.created} profiles, rejected {result.failed} '
+            f'rows in {elapsed:.1f}s: '
+            f'{(result.created + result.failed) / elapsed:.0f} rows/s')
+
+    def _write(self, file, options):
+        rng = random.Random(options['seed'])
+        invalid_every = options['invalid_every']
+        writer = None
+        if options['format'] == 'csv':
+            writer = csv.DictWriter(file, COLUMNS)
+            writer.writeheader()
+        for number in range(options['rows']):
+            row = {
+                'username': f'{PREFIX}{number}',
+                'email': f'{PREFIX}{number}@example.com',
+                'age': rng.randint(18, 70),
+                'gender': rng.choice('MFO'),
+                'location': rng.choice(LOCATIONS),
+                'bio': ' '.join(rng.choices(WORDS, k=rng.randint(4, 30))),
+                'interests': ', '.join(rng.sample(WORDS, 3)),
+            }
+            if invalid_every and number % invalid_every == 0:
+                row['age'] = 12
+            if writer:
+                writer.writerow(row)
+            else:
+                file.write(json.dumps(row) + '\n')
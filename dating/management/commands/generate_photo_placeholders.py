@@ -0,0 +1,71 @@
+"""
+Backfill inline photo placeholders for existing profiles.
+
+Images are decoded in a process pool; the main process only reads profiles
+and writes the results back in batches.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from dating.images import (
+    get_photo_storage, placeholder_from_source, thumbnail_source,
+)
+from dating.models import Profile
+
+
+class Command(BaseCommand):
+    help = 'Generate inline placeholders for profiles with a photo.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Number of worker processes (default: CPU count).')
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Profiles read and written per batch.')
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Regenerate placeholders that already exist.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        storage = get_photo_storage()
+
+        queryset = Profile.objects.exclude(photo__isnull=True).exclude(
+            photo='')
+        if not options['force']:
+            queryset = queryset.filter(photo_placeholder='')
+        queryset = queryset.only('pk', 'photo', 'photo_variants')
+
+        done = failed = 0
+        batch = []
+        with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+            for profile in queryset.iterator(chunk_size=batch_size):
+                source = thumbnail_source(profile, storage)
+                batch.append((profile.pk, source))
+                if len(batch) >= batch_size:
+                    ok, bad = self._process_batch(pool, batch)
+                    done, failed = done + ok, failed + bad
+                    batch = []
+            if batch:
+                ok, bad = self._process_batch(pool, batch)
+                done, failed = done + ok, failed + bad
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated {done} placeholder(s), {failed} failed.'
+        ))
+
+    def _process_batch(self, pool, batch):
+        updates = []
+        failed = 0
+        for profile_id, data_uri, error in pool.map(
+                placeholder_from_source, batch, chunksize=16):
+            if error:
+                failed += 1
+                self.stderr.write(f'Profile {profile_id}: {error}')
+                continue
+            updates.append(Profile(pk=profile_id, photo_placeholder=data_uri))
+        Profile.objects.bulk_update(updates, ['photo_placeholder'])
+        return len(updates), failed
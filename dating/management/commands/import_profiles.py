@@ -0,0 +1,70 @@
+"""
+Create users and profiles from a CSV or NDJSON file.
+
+The file is read as a stream, so its size does not matter; ``-`` reads
+standard input and gzipped files are unpacked on the fly. Rows that fail
+validation are skipped and reported with their line number, on stderr or
+as CSV in ``--errors``. See dating.importer for the columns.
+"""
+import csv
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dating.importer import import_profiles, read_rows
+
+
+class Command(BaseCommand):
+    help = 'Bulk import users and profiles from CSV or NDJSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', help='File to import, or - for standard input.')
+        parser.add_argument(
+            '--format', choices=['csv', 'ndjson'],
+            help='Input format (default: from the file name, else csv).')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Rows validated and inserted together.')
+        parser.add_argument(
+            '--errors',
+            help='Write rejected rows to this CSV file instead of stderr.')
+
+    def handle(self, *args, **options):
+        if options['path'] == '-':
+            file = sys.stdin.buffer
+        else:
+            try:
+                file = open(options['path'], 'rb')
+            except OSError as e:
+                raise CommandError(e)
+        error_file = None
+        if options['errors']:
+            error_file = open(options['errors'], 'w', newline='')
+            writer = csv.writer(error_file)
+            writer.writerow(['line', 'field', 'message'])
+
+        def on_error(line, errors):
+            for field, messages in errors.items():
+                for message in messages:
+                    if error_file:
+                        writer.writerow([line, field, message])
+                    else:
+                        self.stderr.write(f'Line {line}: {field}: {message}')
+
+        started = time.monotonic()
+        try:
+            result = import_profiles(
+                read_rows(file, options['format']),
+                batch_size=options['batch_size'], on_error=on_error)
+        finally:
+            if file is not sys.stdin.buffer:
+                file.close()
+            if error_file:
+                error_file.close()
+        elapsed = max(time.monotonic() - started, 1e-6)
+        rows = result.created + result.failed
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {result.created} profile(s), {result.failed} row(s) '
+            f'rejected in {elapsed:.2f}s ({rows / elapsed:.0f} rows/s).'))
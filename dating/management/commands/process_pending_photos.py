@@ -0,0 +1,33 @@
+"""
+Upload photos left in the spool by the deferred upload mode.
+
+Each upload is queued as a background task. This command processes every
+pending photo right away instead, for instance when no task worker runs or
+after tasks have failed for good.
+"""
+from django.core.management.base import BaseCommand
+
+from dating.models import Profile
+from dating.services import process_pending_photo
+
+
+class Command(BaseCommand):
+    help = 'Process profile photos that are still waiting to be uploaded.'
+
+    def handle(self, *args, **options):
+        profile_ids = Profile.objects.exclude(
+            pending_photo=''
+        ).values_list('pk', flat=True)
+
+        processed = failed = 0
+        for profile_id in profile_ids.iterator():
+            try:
+                if process_pending_photo(profile_id):
+                    processed += 1
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f'Profile {profile_id}: {e}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Processed {processed} pending photo(s), {failed} failed.'
+        ))
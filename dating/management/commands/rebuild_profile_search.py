@@ -0,0 +1,26 @@
+"""
+Index every profile for full-text search again.
+
+Profiles are indexed as they are saved, so this is only needed after
+rows were written without signals, e.g. by the synthetic data loader.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from dating.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index of profiles.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=2000,
+            help='Profiles written per batch.')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        count = rebuild_search_index(batch_size=options['batch_size'])
+        self.stdout.write(
+            f'Indexed {count} profiles in {time.monotonic() - started:.2f}s')
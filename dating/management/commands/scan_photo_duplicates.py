@@ -0,0 +1,131 @@
+"""
+Find duplicate profile photos across the whole photo corpus.
+
+Photos without a perceptual hash or pixel digest are fetched one
+original at a time, the same pixels uploads are hashed from, and
+hashed in a process pool, so memory use does not grow with the number
+of photos. Photos with the same perceptual hash are reported as similar.
+Only exact copies, with the same pixel digest as well, can be merged
+onto a single stored asset; photos that only look alike never are.
+"""
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Q
+
+from dating.images import (
+    fingerprint_from_source, hamming_distance, original_source,
+)
+from dating.models import Profile
+from dating.services import merge_duplicate_photos
+
+# Near-duplicate search splits each 64-bit hash into this many 16-bit
+# chunks. Two hashes within 3 bits of each other share at least one chunk.
+HASH_CHUNKS = 4
+
+
+class Command(BaseCommand):
+    help = 'Hash existing profile photos and report or merge duplicates.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Number of worker processes (default: CPU count).')
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Profiles read and written per batch.')
+        parser.add_argument(
+            '--distance', type=int, default=0,
+            choices=range(HASH_CHUNKS),
+            help='Also report near-duplicates up to this many bits apart.')
+        parser.add_argument(
+            '--merge', action='store_true',
+            help='Point exact copies of a photo at a single stored photo.')
+
+    def handle(self, *args, **options):
+        self._fingerprint_missing(options['workers'], options['batch_size'])
+
+        groups = Profile.objects.exclude(
+            photo_hash=''
+        ).values('photo_hash').annotate(
+            total=Count('id')
+        ).filter(total__gt=1).order_by('-total')
+
+        similar_groups = merged = 0
+        for group in groups.iterator():
+            similar_groups += 1
+            self.stdout.write(
+                f"{group['photo_hash']}: {group['total']} profiles")
+            if options['merge']:
+                merged += merge_duplicate_photos(group['photo_hash'])
+        # Counted before the merge, which does not change the digests
+        exact_groups = Profile.objects.exclude(
+            photo_hash=''
+        ).exclude(
+            photo_digest=''
+        ).values('photo_hash', 'photo_digest').annotate(
+            total=Count('id')
+        ).filter(total__gt=1).count()
+
+        if options['distance']:
+            self._report_near_duplicates(options['distance'])
+
+        summary = (
+            f'{similar_groups} similar group(s), of which '
+            f'{exact_groups} exact duplicate group(s).')
+        if options['merge']:
+            summary += f' Repointed {merged} profile(s).'
+        self.stdout.write(self.style.SUCCESS(summary))
+
+    def _fingerprint_missing(self, workers, batch_size):
+        queryset = Profile.objects.exclude(photo__isnull=True).exclude(
+            photo='').filter(Q(photo_hash='') | Q(photo_digest=''))
+        queryset = queryset.only('pk', 'photo')
+
+        batch = []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for profile in queryset.iterator(chunk_size=batch_size):
+                batch.append((profile.pk, original_source(profile)))
+                if len(batch) >= batch_size:
+                    self._store_fingerprints(pool, batch)
+                    batch = []
+            if batch:
+                self._store_fingerprints(pool, batch)
+
+    def _store_fingerprints(self, pool, batch):
+        updates = []
+        for profile_id, photo_hash, photo_digest, error in pool.map(
+                fingerprint_from_source, batch, chunksize=16):
+            if error:
+                self.stderr.write(f'Profile {profile_id}: {error}')
+                continue
+            updates.append(Profile(
+                pk=profile_id, photo_hash=photo_hash,
+                photo_digest=photo_digest))
+        Profile.objects.bulk_update(updates, ['photo_hash', 'photo_digest'])
+
+    def _report_near_duplicates(self, distance):
+        # Index distinct hashes by each 16-bit chunk and only compare
+        # hashes that share a chunk
+        buckets = defaultdict(list)
+        hashes = Profile.objects.exclude(photo_hash='').values_list(
+            'photo_hash', flat=True).distinct()
+        for photo_hash in hashes.iterator():
+            for chunk in range(HASH_CHUNKS):
+                key = (chunk, photo_hash[chunk * 4:chunk * 4 + 4])
+                buckets[key].append(photo_hash)
+
+        pairs = set()
+        for candidates in buckets.values():
+            for i, first in enumerate(candidates):
+                for second in candidates[i + 1:]:
+                    if hamming_distance(first, second) <= distance:
+                        pairs.add(tuple(sorted((first, second))))
+
+        for first, second in sorted(pairs):
+            self.stdout.write(
+                f'Near duplicate: {first} ~ {second} '
+                f'({hamming_distance(first, second)} bits)')
+        self.stdout.write(f'{len(pairs)} near-duplicate pair(s).')
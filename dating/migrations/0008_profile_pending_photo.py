@@ -0,0 +1,18 @@
+# Generated by Django 4.2.27 on 2026-10-19 11:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dating', '0007_profile_photo_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='pending_photo',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
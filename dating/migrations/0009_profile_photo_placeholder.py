@@ -0,0 +1,18 @@
+# Generated by Django 4.2.27 on 2026-10-19 11:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dating', '0008_profile_pending_photo'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='photo_placeholder',
+            field=models.TextField(blank=True),
+        ),
+    ]
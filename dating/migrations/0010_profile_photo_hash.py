@@ -0,0 +1,18 @@
+# Generated by Django 4.2.27 on 2026-10-19 11:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dating', '0009_profile_photo_placeholder'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='photo_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=16),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.27 on 2026-10-19 11:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dating', '0010_profile_photo_hash'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(fields=['createdAt'], name='dating_prof_created_0ca580_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.27 on 2026-10-19 12:09
+
+from django.db import migrations, models
+
+
+def mark_demo_bot(apps, schema_editor):
+    # User 5 used to like back every like, hard-coded in LikeProfileView
+    Profile = apps.get_model('dating', 'Profile')
+    Profile.objects.filter(user_id=5).update(is_bot=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dating', '0011_profile_dating_prof_created_0ca580_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='is_bot',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_demo_bot, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.27 on 2026-10-19 12:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dating', '0012_profile_is_bot'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(fields=['updatedAt'], name='dating_prof_updated_9b3d78_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations
+
+from dating.search import (
+    create_search_table, drop_search_table, write_documents,
+)
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    create_search_table(connection)
+    Profile = apps.get_model('dating', 'Profile')
+    write_documents(connection, Profile.objects.using(
+        connection.alias).order_by().values_list(
+        'id', 'user__username', 'user__email', 'bio', 'interests'
+    ).iterator(chunk_size=2000))
+
+
+def drop_search_index(apps, schema_editor):
+    drop_search_table(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dating', '0013_profile_updatedat_index'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,25 @@
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+from dating.autocomplete import create_trigram_indexes, drop_trigram_indexes
+
+
+def create_indexes(apps, schema_editor):
+    create_trigram_indexes(schema_editor.connection)
+
+
+def drop_indexes(apps, schema_editor):
+    drop_trigram_indexes(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dating', '0014_profile_search'),
+    ]
+
+    operations = [
+        # Only runs on PostgreSQL
+        TrigramExtension(),
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.27 on 2026-10-19 14:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dating', '0015_autocomplete_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='photo_digest',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+    ]
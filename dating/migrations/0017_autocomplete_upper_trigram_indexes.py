@@ -0,0 +1,43 @@
+from django.db import migrations
+
+from dating.autocomplete import create_trigram_indexes, drop_trigram_indexes
+
+# The first indexes were on the bare columns, which the UPPER(...) LIKE
+# of icontains lookups cannot use
+COLUMN_INDEXES = (
+    ('auth_user', 'username', 'dating_user_username_trgm'),
+    ('dating_profile', 'location', 'dating_profile_location_trgm'),
+)
+
+
+def replace_indexes(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        for _, _, name in COLUMN_INDEXES:
+            cursor.execute(f'DROP INDEX IF EXISTS {name}')
+    create_trigram_indexes(connection)
+
+
+def restore_indexes(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    drop_trigram_indexes(connection)
+    with connection.cursor() as cursor:
+        for table, column, name in COLUMN_INDEXES:
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS {name} ON {table} '
+                f'USING gin ({column} gin_trgm_ops)')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dating', '0016_profile_photo_digest'),
+    ]
+
+    operations = [
+        migrations.RunPython(replace_indexes, restore_indexes),
+    ]
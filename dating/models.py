@@ -22,12 +22,29 @@ class Profile(models.Model):
     interests = models.TextField(max_length=250, blank=True)
     photo = CloudinaryField(
         'image', folder='profile_pictures/', blank=True, null=True)
+    # Resized copies of the photo, see dating.images.PHOTO_VARIANTS
+    photo_variants = models.JSONField(default=dict, blank=True)
+    # Perceptual hash of the photo, used to reuse identical uploads
+    photo_hash = models.CharField(max_length=16, blank=True, db_index=True)
+    # SHA-256 of the photo's decoded pixels; only exact copies share it
+    photo_digest = models.CharField(max_length=64, blank=True, db_index=True)
+    # Inline data URI shown while the real photo loads
+    photo_placeholder = models.TextField(blank=True)
+    # Spooled upload waiting for the background photo worker
+    pending_photo = models.CharField(max_length=255, blank=True)
     createdAt = models.DateTimeField(auto_now_add=True)
     updatedAt = models.DateTimeField(auto_now=True)
     is_profile_complete = models.BooleanField(default=False)
+    # Bot profiles like back automatically, see connections.services
+    is_bot = models.BooleanField(default=False)
 
     class Meta:
         ordering = ['-createdAt']
+        indexes = [
+            models.Index(fields=['createdAt']),
+            # Incremental refresh of connections.catalog
+            models.Index(fields=['updatedAt']),
+        ]
 
     def __str__(self):
         return f"{self.user.username}'s Profile"
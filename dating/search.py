@@ -0,0 +1,225 @@
+"""
+Full-text profile search.
+
+Each profile has a search document made of its username, email, bio and
+interests, kept in ``dating_profile_search`` next to the profiles table:
+
+- PostgreSQL: a ``tsvector`` per profile with a GIN index. Username
+  words weigh most, then interests, bio and email.
+- SQLite: an FTS5 virtual table keyed by the profile id, ranked by bm25
+  with the same column weights.
+
+Emails are only matched by the admin search (``include_email=True``);
+searches by users match usernames, bios and interests, so they cannot
+be used to look up who has an account with an address.
+
+Documents are rewritten when a Profile or its User is saved (see
+dating.signals). Rows inserted without signals, such as synthetic load
+test data, are indexed with ``manage.py rebuild_profile_search``.
+
+On other databases search falls back to ``icontains`` lookups.
+"""
+import re
+
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils.html import strip_tags
+
+SEARCH_TABLE = 'dating_profile_search'
+# Words of the query that are used, the rest is ignored
+MAX_TERMS = 8
+TERM_RE = re.compile(r'\w+')
+# bm25 weight of each FTS5 column, in table order
+FTS_WEIGHTS = {'username': 10.0, 'email': 1.0, 'bio': 2.0, 'interests': 4.0}
+FALLBACK_FIELDS = ('user__username', 'user__email', 'bio', 'interests')
+# Columns and tsvector weights searched when emails are left out
+PUBLIC_COLUMNS = ('username', 'bio', 'interests')
+PUBLIC_WEIGHTS = 'ABC'
+
+
+def search_terms(text):
+    """Words of a search, lowercased; punctuation is dropped"""
+    return TERM_RE.findall((text or '').casefold())[:MAX_TERMS]
+
+
+def create_search_table(connection):
+    """Create the search table for the connection's database, if any"""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                f'CREATE TABLE {SEARCH_TABLE} ('
+                'profile_id bigint PRIMARY KEY REFERENCES dating_profile (id) '
+                'ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, '
+                'document tsvector NOT NULL)')
+            cursor.execute(
+                f'CREATE INDEX {SEARCH_TABLE}_document ON {SEARCH_TABLE} '
+                'USING gin (document)')
+        elif connection.vendor == 'sqlite':
+            cursor.execute(
+                f'CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5('
+                f'{", ".join(FTS_WEIGHTS)}, tokenize="unicode61")')
+
+
+def drop_search_table(connection):
+    if connection.vendor in ('postgresql', 'sqlite'):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {SEARCH_TABLE}')
+
+
+def write_documents(connection, rows):
+    """
+    Insert or replace search documents.
+
+    Args:
+        connection: Database connection to write to
+        rows: Iterable of (profile_id, username, email, bio, interests)
+    """
+    rows = [
+        (profile_id, username or '', email or '',
+         strip_tags(bio or ''), interests or '')
+        for profile_id, username, email, bio, interests in rows
+    ]
+    if not rows:
+        return
+    # One transaction per batch; SQLite would sync to disk for every row
+    with transaction.atomic(using=connection.alias), \
+            connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.executemany(
+                f'INSERT INTO {SEARCH_TABLE} (profile_id, document) '
+                "VALUES (%s, setweight(to_tsvector('simple', %s), 'A') || "
+                "setweight(to_tsvector('simple', %s), 'D') || "
+                "setweight(to_tsvector('simple', %s), 'C') || "
+                "setweight(to_tsvector('simple', %s), 'B')) "
+                'ON CONFLICT (profile_id) DO UPDATE '
+                'SET document = EXCLUDED.document', rows)
+        elif connection.vendor == 'sqlite':
+            cursor.executemany(
+                f'INSERT OR REPLACE INTO {SEARCH_TABLE} '
+                f'(rowid, {", ".join(FTS_WEIGHTS)}) '
+                'VALUES (%s, %s, %s, %s, %s)', rows)
+
+
+def delete_documents(connection, profile_ids):
+    """Remove the search documents of some profiles"""
+    profile_ids = list(profile_ids)
+    if not profile_ids or connection.vendor not in ('postgresql', 'sqlite'):
+        return
+    key = 'profile_id' if connection.vendor == 'postgresql' else 'rowid'
+    placeholders = ', '.join(['%s'] * len(profile_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {SEARCH_TABLE} WHERE {key} IN ({placeholders})',
+            profile_ids)
+
+
+def index_profile(profile, using='default'):
+    """Rewrite a saved profile's search document"""
+    if not type(profile).user.is_cached(profile):
+        index_profiles(type(profile).objects.filter(pk=profile.pk), using)
+        return
+    write_documents(connections[using], [(
+        profile.pk, profile.user.username, profile.user.email,
+        profile.bio, profile.interests)])
+
+
+def index_profiles(profiles, using='default'):
+    """
+    Rewrite the search documents of some profiles.
+
+    Args:
+        profiles: QuerySet of the Profile objects to index
+        using: Database alias
+    """
+    write_documents(connections[using], profiles.using(using).order_by(
+    ).values_list(
+        'id', 'user__username', 'user__email', 'bio', 'interests'))
+
+
+def rebuild_search_index(batch_size=2000, using='default'):
+    """
+    Index every profile again.
+
+    Returns:
+        Number of profiles indexed
+    """
+    from .models import Profile
+
+    connection = connections[using]
+    rows = Profile.objects.using(using).order_by().values_list(
+        'id', 'user__username', 'user__email', 'bio', 'interests'
+    ).iterator(chunk_size=batch_size)
+    count = 0
+    batch = []
+    # Searches keep seeing the old index until the new one is complete
+    with transaction.atomic(using=using):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                write_documents(connection, batch)
+                count += len(batch)
+                batch = []
+        write_documents(connection, batch)
+    return count + len(batch)
+
+
+def search_profiles(queryset, text, rank=True, include_email=False):
+    """
+    Filter profiles by a search.
+
+    Every word must match the start of a word of the profile's username,
+    bio or interests, or of their email with ``include_email``.
+
+    Args:
+        queryset: Profile QuerySet to search in
+        text: The search as typed
+        rank: Annotate ``rank`` and order the best matches first
+        include_email: Match emails too; only for staff
+
+    Returns:
+        The filtered QuerySet; empty when the search has no words
+    """
+    terms = search_terms(text)
+    if not terms:
+        return queryset.none()
+    vendor = connections[queryset.db].vendor
+    table = queryset.model._meta.db_table
+    if vendor == 'postgresql':
+        weights = '' if include_email else PUBLIC_WEIGHTS
+        query = ' & '.join(f'{term}:*{weights}' for term in terms)
+        join = f'{SEARCH_TABLE}.profile_id = {table}.id'
+        match = f"{SEARCH_TABLE}.document @@ to_tsquery('simple', %s)"
+        score = f"ts_rank({SEARCH_TABLE}.document, to_tsquery('simple', %s))"
+    elif vendor == 'sqlite':
+        query = ' '.join(f'"{term}"*' for term in terms)
+        if not include_email:
+            query = f'{{{" ".join(PUBLIC_COLUMNS)}}} : ({query})'
+        join = f'{SEARCH_TABLE}.rowid = {table}.id'
+        match = f'{SEARCH_TABLE} MATCH %s'
+        # bm25 is lower for better matches
+        score = f'-bm25({SEARCH_TABLE}, %s)' % ', '.join(
+            str(weight) for weight in FTS_WEIGHTS.values())
+    else:
+        fields = [
+            field for field in FALLBACK_FIELDS
+            if include_email or field != 'user__email'
+        ]
+        condition = Q()
+        for term in terms:
+            condition &= Q(*(
+                Q(**{f'{field}__icontains': term})
+                for field in fields), _connector=Q.OR)
+        return queryset.filter(condition)
+
+    # A join lets the database walk the index matches once; the ORM has
+    # no expression for joining a table without a model
+    queryset = queryset.extra(
+        tables=[SEARCH_TABLE], where=[join, match], params=[query])
+    if rank:
+        queryset = queryset.extra(
+            select={'rank': score},
+            select_params=[query] if vendor == 'postgresql' else [],
+        ).order_by('-rank', '-pk')
+    return queryset
@@ -0,0 +1,337 @@
+"""
+Service functions for profile-related operations
+"""
+import hashlib
+import logging
+import os
+import uuid
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile, UploadedFile
+from django.utils import timezone
+import cloudinary.uploader
+
+from taskqueue.queue import enqueue
+
+from .images import (
+    build_variants, content_token, encode_image, get_photo_storage,
+    iter_variant_names, limit_size, load_image, perceptual_hash,
+    pixel_digest, placeholder_data_uri, VARIANT_FOLDER,
+)
+from .models import Profile
+
+logger = logging.getLogger(__name__)
+
+
+def refresh_photo_variants(profile, photo, storage=None, image=None):
+    """
+    Regenerate the resized variants, placeholder and hashes of a photo.
+
+    Args:
+        profile: The saved Profile instance whose photo changed
+        photo: The newly uploaded file, or a falsy value when the photo
+               was cleared
+        storage: Optional storage for the variant files. Defaults to
+                 ``get_photo_storage()``
+        image: Optional already decoded copy of ``photo``
+
+    Returns:
+        The new variants mapping stored on the profile
+    """
+    storage = storage or get_photo_storage()
+    old_variants, old_hash = profile.photo_variants, profile.photo_hash
+
+    variants = {}
+    placeholder = photo_hash = photo_digest = ''
+    if isinstance(photo, UploadedFile):
+        try:
+            image = image or load_image(photo)
+            prefix = f'{VARIANT_FOLDER}/{profile.pk}/{content_token(photo)}'
+            variants = build_variants(image, storage, prefix)
+            placeholder = placeholder_data_uri(image)
+            photo_hash = perceptual_hash(image)
+            photo_digest = pixel_digest(image)
+        except (OSError, ValueError):
+            # Keep the profile usable with the original photo
+            logger.exception(
+                'Could not build photo variants for profile %s', profile.pk)
+            return profile.photo_variants
+
+    profile.photo_variants = variants
+    profile.photo_placeholder = placeholder
+    profile.photo_hash = photo_hash
+    profile.photo_digest = photo_digest
+    profile.save(update_fields=[
+        'photo_variants', 'photo_placeholder', 'photo_hash', 'photo_digest',
+        'updatedAt'])
+    release_photo_variants(profile, old_variants, old_hash, storage)
+    return variants
+
+
+def release_photo_variants(profile, variants, photo_hash, storage):
+    """
+    Delete variant files a profile no longer uses.
+
+    Variants are shared between profiles that reuse the same photo, so
+    files are only deleted once no other profile has the same hash.
+    """
+    if not variants or variants == profile.photo_variants:
+        return
+    if photo_hash and Profile.objects.filter(
+            photo_hash=photo_hash).exclude(pk=profile.pk).exists():
+        return
+    kept = set(iter_variant_names(profile.photo_variants))
+    for name in iter_variant_names(variants):
+        if name in kept:
+            continue
+        try:
+            storage.delete(name)
+        except Exception:
+            logger.warning('Could not delete photo variant %s', name)
+
+
+def find_duplicate_photo(photo_hash, photo_digest, exclude_pk=None):
+    """
+    Find a stored copy of exactly the same photo.
+
+    Photos that only look alike share a perceptual hash, so the pixel
+    digest has to match as well: reusing a similar photo would show one
+    user's picture on another user's profile.
+
+    Returns:
+        A Profile holding the matching photo and its variants, or None
+    """
+    if not photo_hash or not photo_digest:
+        return None
+    return Profile.objects.filter(
+        photo_digest=photo_digest, photo_hash=photo_hash
+    ).exclude(
+        pk=exclude_pk
+    ).exclude(
+        photo__isnull=True
+    ).exclude(
+        photo=''
+    ).only(
+        'photo', 'photo_variants', 'photo_placeholder', 'photo_hash',
+        'photo_digest',
+    ).first()
+
+
+def store_profile_photo(profile, upload, storage=None):
+    """
+    Save a newly uploaded photo on a profile.
+
+    If exactly the same photo is already stored for another profile,
+    its asset and variants are reused and nothing is uploaded. Otherwise
+    the CloudinaryField uploads the file and new variants are built.
+
+    Returns:
+        True if an existing photo was reused, False if it was uploaded
+    """
+    storage = storage or get_photo_storage()
+    try:
+        image = load_image(upload)
+    except (OSError, ValueError):
+        image = None
+    photo_hash = perceptual_hash(image) if image else ''
+    photo_digest = pixel_digest(image) if image else ''
+
+    original = find_duplicate_photo(
+        photo_hash, photo_digest, exclude_pk=profile.pk)
+    if original is None:
+        # The CloudinaryField uploads the file while the row is saved
+        profile.photo = upload
+        profile.save(update_fields=['photo', 'updatedAt'])
+        refresh_photo_variants(profile, upload, storage, image=image)
+        return False
+
+    old_variants, old_hash = profile.photo_variants, profile.photo_hash
+    profile.photo = original.photo
+    profile.photo_variants = original.photo_variants
+    profile.photo_placeholder = original.photo_placeholder
+    profile.photo_hash = photo_hash
+    profile.photo_digest = photo_digest
+    profile.save(update_fields=[
+        'photo', 'photo_variants', 'photo_placeholder', 'photo_hash',
+        'photo_digest', 'updatedAt',
+    ])
+    release_photo_variants(profile, old_variants, old_hash, storage)
+    return True
+
+
+def merge_duplicate_photos(photo_hash, storage=None):
+    """
+    Point the profiles holding exact copies of a photo at one stored copy.
+
+    Of the profiles sharing ``photo_hash``, only those whose pixel
+    digests match are merged, each group onto its oldest profile's
+    photo. Variant files and Cloudinary originals that are no longer
+    referenced by any profile are deleted.
+
+    Returns:
+        The number of profiles that were repointed
+    """
+    storage = storage or get_photo_storage()
+    profiles = Profile.objects.filter(
+        photo_hash=photo_hash
+    ).exclude(
+        photo_digest=''
+    ).exclude(
+        photo__isnull=True
+    ).exclude(
+        photo=''
+    ).order_by('pk').only(
+        'photo', 'photo_variants', 'photo_placeholder', 'photo_hash',
+        'photo_digest',
+    )
+    copies = {}
+    for profile in profiles:
+        copies.setdefault(profile.photo_digest, []).append(profile)
+    return sum(
+        _merge_photo_copies(group, storage) for group in copies.values()
+        if len(group) > 1)
+
+
+def _merge_photo_copies(profiles, storage):
+    """Repoint profiles[1:] at the photo of profiles[0]"""
+    canonical, duplicates = profiles[0], profiles[1:]
+    kept = set(iter_variant_names(canonical.photo_variants))
+    canonical_value = str(canonical.photo)
+    duplicates = [
+        profile for profile in duplicates
+        if str(profile.photo) != canonical_value
+    ]
+    if not duplicates:
+        return 0
+
+    Profile.objects.filter(
+        pk__in=[profile.pk for profile in duplicates]
+    ).update(
+        photo=canonical.photo,
+        photo_variants=canonical.photo_variants,
+        photo_placeholder=canonical.photo_placeholder,
+        updatedAt=timezone.now(),
+    )
+
+    for profile in duplicates:
+        for name in iter_variant_names(profile.photo_variants):
+            if name not in kept:
+                try:
+                    storage.delete(name)
+                except Exception:
+                    logger.warning('Could not delete photo variant %s', name)
+        public_id = getattr(profile.photo, 'public_id', None)
+        if public_id and not Profile.objects.filter(
+                photo=profile.photo).exists():
+            try:
+                cloudinary.uploader.destroy(public_id, invalidate=True)
+            except Exception:
+                logger.warning('Could not delete photo %s', public_id)
+    return len(duplicates)
+
+
+def handle_photo_upload(profile, upload):
+    """
+    Store a photo taken off a profile form by ``detach_photo_upload``.
+
+    Returns:
+        True if the upload was deferred to the background worker
+    """
+    if settings.PROFILE_PHOTO_DEFERRED_UPLOAD:
+        schedule_photo_upload(profile, upload)
+        return True
+    store_profile_photo(profile, upload)
+    return False
+
+
+def get_spool_storage():
+    """Local storage holding photos that are waiting to be uploaded"""
+    return FileSystemStorage(location=settings.PROFILE_PHOTO_SPOOL_DIR)
+
+
+def detach_photo_upload(form):
+    """
+    Take a new photo off a profile form so saving it does not upload.
+
+    The instance keeps its previous photo so the profile row can be
+    committed first; the upload is then passed to ``handle_photo_upload``.
+
+    Returns:
+        The detached UploadedFile, or None when no new file was uploaded
+    """
+    photo = form.cleaned_data.get('photo')
+    if not isinstance(photo, UploadedFile):
+        return None
+    form.instance.photo = form.initial.get('photo')
+    return photo
+
+
+def schedule_photo_upload(profile, upload):
+    """
+    Spool an uploaded photo to local disk and queue it for processing.
+
+    The task is queued in the surrounding transaction, so the worker
+    always sees the saved profile.
+    """
+    spool = get_spool_storage()
+    # The token keeps each upload's name, and so its task's unique key,
+    # apart from earlier uploads of a file with the same name
+    name = spool.save(
+        f'{profile.pk}-{uuid.uuid4().hex[:12]}-'
+        f'{os.path.basename(upload.name)}', upload)
+    stale = profile.pending_photo
+    profile.pending_photo = name
+    profile.save(update_fields=['pending_photo'])
+    if stale and stale != name:
+        spool.delete(stale)
+    queue_photo_job(profile.pk, name)
+    return name
+
+
+def queue_photo_job(profile_id, name):
+    """
+    Queue the processing of a spooled photo, unless already queued.
+
+    Spool names are unique per upload (see schedule_photo_upload), so the
+    key only stops the same upload from being queued twice.
+    """
+    digest = hashlib.blake2b(name.encode(), digest_size=8).hexdigest()
+    return enqueue(
+        'dating.process_pending_photo', [profile_id],
+        unique_key=f'photo:{profile_id}:{digest}')
+
+
+def process_pending_photo(profile_id):
+    """
+    Resize a spooled photo, push it to storage and update the profile.
+
+    Safe to call more than once: a profile without a pending photo, or one
+    that was deleted in the meantime, is skipped.
+
+    Returns:
+        True if a photo was processed, False otherwise
+    """
+    spool = get_spool_storage()
+    profile = Profile.objects.filter(pk=profile_id).first()
+    if profile is None or not profile.pending_photo:
+        return False
+    name = profile.pending_photo
+    if not spool.exists(name):
+        Profile.objects.filter(pk=profile_id, pending_photo=name).update(
+            pending_photo='')
+        return False
+
+    with spool.open(name) as spooled:
+        image = limit_size(
+            load_image(spooled), settings.PROFILE_PHOTO_MAX_DIMENSION)
+    data = encode_image(image, 'JPEG', {'quality': 85, 'optimize': True})
+    base_name = os.path.splitext(os.path.basename(name))[0]
+    upload = SimpleUploadedFile(f'{base_name}.jpg', data, 'image/jpeg')
+
+    store_profile_photo(profile, upload)
+    # A newer upload may have been spooled while this one was processing
+    Profile.objects.filter(pk=profile_id, pending_photo=name).update(
+        pending_photo='')
+    spool.delete(name)
+    return True
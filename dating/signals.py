@@ -0,0 +1,33 @@
+from django.contrib.auth.models import User
+from django.db import connections
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Profile
+from .search import delete_documents, index_profile, index_profiles
+
+PROFILE_SEARCH_FIELDS = {'bio', 'interests'}
+USER_SEARCH_FIELDS = {'username', 'email'}
+
+
+@receiver(post_save, sender=Profile)
+def index_profile_on_save(sender, instance, using, update_fields, **kwargs):
+    """Rewrite the search document unless only other fields were saved"""
+    if update_fields and not PROFILE_SEARCH_FIELDS & set(update_fields):
+        return
+    index_profile(instance, using)
+
+
+@receiver(post_save, sender=User)
+def index_profile_on_user_save(sender, instance, created, using,
+                               update_fields, **kwargs):
+    """Username and email are searched too; a new user has no profile"""
+    if created or (
+            update_fields and not USER_SEARCH_FIELDS & set(update_fields)):
+        return
+    index_profiles(Profile.objects.filter(user_id=instance.pk), using)
+
+
+@receiver(post_delete, sender=Profile)
+def remove_profile_from_search(sender, instance, using, **kwargs):
+    delete_documents(connections[using], [instance.pk])
@@ -0,0 +1,23 @@
+"""
+Background tasks for dating app
+"""
+from taskqueue.queue import task
+
+from .models import Profile
+from .services import (
+    process_pending_photo as process_photo, queue_photo_job,
+)
+
+
+@task(queue='photos', max_attempts=8)
+def process_pending_photo(profile_id):
+    """Upload a profile's spooled photo"""
+    process_photo(profile_id)
+
+
+@task()
+def process_pending_photos():
+    """Queue the spooled photos that have no task yet, such as old uploads"""
+    for profile_id, name in Profile.objects.exclude(
+            pending_photo='').values_list('pk', 'pending_photo').iterator():
+        queue_photo_job(profile_id, name)
@@ -0,0 +1,48 @@
+"""
+Template tags for rendering profile photos at the right size
+"""
+from django import template
+
+from ..images import PHOTO_VARIANTS, get_photo_storage, variant_sources
+
+register = template.Library()
+
+
+@register.inclusion_tag('dating/includes/profile_photo.html')
+def profile_photo(profile, kind='avatar', css_class=''):
+    """
+    Render a profile photo as a ``<picture>`` with WebP and JPEG srcsets.
+
+    Usage: ``{% profile_photo profile 'card' css_class='profile-photo' %}``
+
+    Falls back to the original photo URL for profiles whose variants have
+    not been generated yet, and to the placeholder image without a photo.
+    """
+    spec = PHOTO_VARIANTS[kind]
+    context = {
+        'css_class': css_class,
+        'sizes': spec['sizes'],
+        'width': spec['widths'][0],
+        'sources': [],
+        'src': None,
+        'fallback_srcset': '',
+    }
+    if not profile.photo:
+        context['alt'] = 'No photo'
+        return context
+
+    context['alt'] = f"{profile.user.username}'s photo"
+    context['placeholder'] = profile.photo_placeholder
+    sources = variant_sources(
+        profile.photo_variants, kind, get_photo_storage())
+    if not sources:
+        context['src'] = profile.photo.url
+        return context
+
+    # The last source is the most compatible format and becomes the <img>
+    context['sources'] = [
+        {'type': mime_type, 'srcset': srcset}
+        for mime_type, srcset, _ in sources[:-1]
+    ]
+    _, context['fallback_srcset'], context['src'] = sources[-1]
+    return context
@@ -2,11 +2,55 @@
 Comprehensive test suite for dating app views.
 Tests all views in dating/views.py.
 """
-from django.test import TestCase, Client
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
+
+from cloudinary import CloudinaryResource
+
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.template import Context, Template
+from django.test import TestCase, Client, override_settings
 from django.contrib.auth.models import User
+from django.db import connection, transaction
 from django.urls import reverse
+from PIL import Image, ImageDraw
 
+from match_up.testing import QueryBudgetMixin
+from taskqueue.models import Task
+from .autocomplete import (
+    TrigramIndex, TrigramIndexes, canonical_location, normalize_location,
+    suggest, trigram_indexes,
+)
+from .importer import import_profiles, read_rows
 from .models import Profile
+from .search import rebuild_search_index, search_profiles
+from .views import ProfileSearch
+from .services import (
+    merge_duplicate_photos, process_pending_photo, refresh_photo_variants,
+    schedule_photo_upload, store_profile_photo,
+)
+
+
+def make_upload(name='photo.png', size=(800, 600), stripe=100):
+    """Build an in-memory gradient image with a white stripe at ``stripe``"""
+    gradient = Image.linear_gradient('L').rotate(90).resize(size)
+    image = Image.merge(
+        'RGB', (gradient, gradient.point(lambda v: v // 2), gradient))
+    ImageDraw.Draw(image).rectangle(
+        (stripe, 0, stripe + 150, size[1]), fill=(255, 255, 255))
+    buffer = BytesIO()
+    image.save(buffer, 'PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), 'image/png')
 
 
 class BaseViewTestCase(TestCase):
@@ -437,3 +481,852 @@ class ContactViewTests(TestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, 'dating/contact.html')
+
+
+class PhotoVariantTests(BaseViewTestCase):
+    """Tests for resized profile photo variants"""
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        self.storage = FileSystemStorage(
+            location=self.media_root, base_url='/media/')
+        self.profile = Profile.objects.create(
+            user=self.user,
+            age=25,
+            gender='M',
+            location='Test City',
+            bio='This is a test bio that is long enough',
+            interests='Reading'
+        )
+
+    def test_variants_generated_for_each_size_and_format(self):
+        """Every kind gets WebP and JPEG files at each width"""
+        variants = refresh_photo_variants(
+            self.profile, make_upload(), storage=self.storage)
+        self.assertEqual(set(variants), {'avatar', 'card'})
+        for formats in variants.values():
+            self.assertEqual(set(formats), {'webp', 'jpeg'})
+        name = variants['avatar']['webp']['240']
+        with self.storage.open(name) as stored:
+            image = Image.open(stored)
+            self.assertEqual(image.format, 'WEBP')
+            self.assertEqual(image.size, (240, 240))
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.photo_variants, variants)
+
+    def test_clearing_photo_removes_variants(self):
+        """Clearing the photo deletes the old variant files"""
+        variants = refresh_photo_variants(
+            self.profile, make_upload(), storage=self.storage)
+        old_name = variants['card']['jpeg']['200']
+        refresh_photo_variants(self.profile, None, storage=self.storage)
+        self.assertEqual(self.profile.photo_variants, {})
+        self.assertFalse(self.storage.exists(old_name))
+
+    def test_invalid_image_keeps_existing_variants(self):
+        """A file Pillow cannot read leaves the profile untouched"""
+        bogus = SimpleUploadedFile('photo.png', b'not an image', 'image/png')
+        with self.assertLogs('dating.services', level='ERROR'):
+            variants = refresh_photo_variants(
+                self.profile, bogus, storage=self.storage)
+        self.assertEqual(variants, {})
+
+    def test_profile_photo_tag_renders_srcset(self):
+        """The template tag emits a WebP source and a JPEG fallback"""
+        with override_settings(
+                MEDIA_ROOT=self.media_root,
+                PROFILE_PHOTO_STORAGE=(
+                    'django.core.files.storage.FileSystemStorage')):
+            refresh_photo_variants(self.profile, make_upload())
+            Profile.objects.filter(pk=self.profile.pk).update(
+                photo='profile_pictures/sample')
+            self.profile.refresh_from_db()
+            html = Template(
+                "{% load profile_images %}"
+                "{% profile_photo profile 'avatar' css_class='x' %}"
+            ).render(Context({'profile': self.profile}))
+        self.assertIn('<source type="image/webp"', html)
+        self.assertIn('240w', html)
+        self.assertIn('.jpeg 120w', html)
+        self.assertIn('sizes="120px"', html)
+        self.assertIn("background-image: url('data:image/jpeg", html)
+
+    def test_placeholder_generated_with_variants(self):
+        """A small inline data URI is stored alongside the variants"""
+        refresh_photo_variants(
+            self.profile, make_upload(), storage=self.storage)
+        self.profile.refresh_from_db()
+        placeholder = self.profile.photo_placeholder
+        self.assertTrue(placeholder.startswith('data:image/jpeg;base64,'))
+        self.assertLess(len(placeholder), 2000)
+
+    def test_placeholder_command_backfills_profiles(self):
+        """The batch command fills in missing placeholders"""
+        with override_settings(
+                MEDIA_ROOT=self.media_root,
+                PROFILE_PHOTO_STORAGE=(
+                    'django.core.files.storage.FileSystemStorage')):
+            refresh_photo_variants(self.profile, make_upload())
+            Profile.objects.filter(pk=self.profile.pk).update(
+                photo='profile_pictures/sample', photo_placeholder='')
+            call_command(
+                'generate_photo_placeholders', workers=1, stdout=StringIO())
+        self.profile.refresh_from_db()
+        self.assertTrue(
+            self.profile.photo_placeholder.startswith('data:image/jpeg'))
+
+    def test_profile_photo_tag_without_photo(self):
+        """Profiles without a photo fall back to the placeholder image"""
+        html = Template(
+            "{% load profile_images %}{% profile_photo profile %}"
+        ).render(Context({'profile': self.profile}))
+        self.assertIn('images/nobody.jpg', html)
+        self.assertNotIn('srcset', html)
+
+
+class DeferredPhotoUploadTests(BaseViewTestCase):
+    """Tests for the deferred photo upload mode"""
+
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir, ignore_errors=True)
+        settings_override = override_settings(
+            MEDIA_ROOT=self.tmp_dir + '/media',
+            PROFILE_PHOTO_STORAGE=(
+                'django.core.files.storage.FileSystemStorage'),
+            PROFILE_PHOTO_DEFERRED_UPLOAD=True,
+            PROFILE_PHOTO_SPOOL_DIR=self.tmp_dir + '/spool',
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.client.login(username='testuser', password='testpass123')
+
+    def post_profile(self):
+        data = {
+            'age': 25,
+            'gender': 'M',
+            'location': 'Test City',
+            'bio': 'This is a test bio that is long enough for validation',
+            'interests': 'Reading',
+            'photo': make_upload(),
+        }
+        return self.client.post(reverse('profile_create'), data)
+
+    def test_create_spools_photo_instead_of_uploading(self):
+        """The profile is saved without uploading the photo"""
+        with mock.patch('cloudinary.uploader.upload_resource') as upload:
+            response = self.post_profile()
+        self.assertEqual(response.status_code, 302)
+        upload.assert_not_called()
+        profile = Profile.objects.get(user=self.user)
+        task = Task.objects.get()
+        self.assertEqual(task.name, 'dating.process_pending_photo')
+        self.assertEqual(task.args, [profile.pk])
+        self.assertFalse(profile.photo)
+        self.assertTrue(profile.pending_photo)
+        spool = FileSystemStorage(location=self.tmp_dir + '/spool')
+        self.assertTrue(spool.exists(profile.pending_photo))
+
+    def test_same_file_name_is_queued_again_after_processing(self):
+        """A second upload named like the first one gets its own task"""
+        with self.captureOnCommitCallbacks():
+            self.post_profile()
+        profile = Profile.objects.get(user=self.user)
+        with mock.patch(
+                'cloudinary.uploader.upload_resource',
+                return_value=CloudinaryResource(
+                    'profile_pictures/new', resource_type='image')):
+            self.assertTrue(process_pending_photo(profile.pk))
+        Task.objects.update(status=Task.DONE)
+
+        profile.refresh_from_db()
+        name = schedule_photo_upload(profile, make_upload())
+        queued = Task.objects.get(status=Task.QUEUED)
+        self.assertEqual(queued.args, [profile.pk])
+        profile.refresh_from_db()
+        self.assertEqual(profile.pending_photo, name)
+
+    def test_process_pending_photo_uploads_and_cleans_up(self):
+        """The worker uploads the spooled photo and builds variants"""
+        with self.captureOnCommitCallbacks():
+            self.post_profile()
+        profile = Profile.objects.get(user=self.user)
+        spooled = profile.pending_photo
+
+        with mock.patch(
+                'cloudinary.uploader.upload_resource',
+                return_value=CloudinaryResource(
+                    'profile_pictures/new', resource_type='image')
+        ) as upload:
+            self.assertTrue(process_pending_photo(profile.pk))
+        upload.assert_called_once()
+
+        profile.refresh_from_db()
+        self.assertEqual(profile.photo.public_id, 'profile_pictures/new')
+        self.assertEqual(profile.pending_photo, '')
+        self.assertIn('avatar', profile.photo_variants)
+        spool = FileSystemStorage(location=self.tmp_dir + '/spool')
+        self.assertFalse(spool.exists(spooled))
+        # Running the job again is a no-op
+        self.assertFalse(process_pending_photo(profile.pk))
+
+
+class PhotoDeduplicationTests(BaseViewTestCase):
+    """Tests for reusing identical profile photos"""
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        self.storage = FileSystemStorage(
+            location=self.media_root, base_url='/media/')
+        self.profile = Profile.objects.create(
+            user=self.user,
+            age=25,
+            gender='M',
+            location='Test City',
+            bio='This is a test bio that is long enough',
+            interests='Reading'
+        )
+        self.other = Profile.objects.create(
+            user=self.user2,
+            age=30,
+            gender='F',
+            location='Other City',
+            bio='This is another test bio that is long enough',
+            interests='Dancing'
+        )
+        refresh_photo_variants(
+            self.profile, make_upload(), storage=self.storage)
+        Profile.objects.filter(pk=self.profile.pk).update(
+            photo='image/upload/profile_pictures/original')
+        self.profile.refresh_from_db()
+
+    def uploaded_resource(self, public_id):
+        return CloudinaryResource(public_id, resource_type='image')
+
+    def test_identical_photo_is_not_uploaded_again(self):
+        """An exact copy of a stored photo reuses the stored asset"""
+        buffer = BytesIO()
+        Image.open(make_upload()).save(buffer, 'BMP')
+        copy = SimpleUploadedFile('copy.bmp', buffer.getvalue(), 'image/bmp')
+        with mock.patch('cloudinary.uploader.upload_resource') as upload:
+            reused = store_profile_photo(
+                self.other, copy, storage=self.storage)
+        self.assertTrue(reused)
+        upload.assert_not_called()
+        self.other.refresh_from_db()
+        self.assertEqual(
+            self.other.photo.public_id, 'profile_pictures/original')
+        self.assertEqual(
+            self.other.photo_variants, self.profile.photo_variants)
+        self.assertEqual(self.other.photo_hash, self.profile.photo_hash)
+        self.assertEqual(self.other.photo_digest, self.profile.photo_digest)
+
+    def test_similar_photo_is_uploaded(self):
+        """A photo with the same perceptual hash but other pixels is not
+        shared"""
+        buffer = BytesIO()
+        Image.open(make_upload()).resize((400, 300)).save(buffer, 'JPEG')
+        similar = SimpleUploadedFile(
+            'similar.jpg', buffer.getvalue(), 'image/jpeg')
+        with mock.patch(
+                'cloudinary.uploader.upload_resource',
+                return_value=self.uploaded_resource('profile_pictures/new')
+        ) as upload:
+            reused = store_profile_photo(
+                self.other, similar, storage=self.storage)
+        self.assertFalse(reused)
+        upload.assert_called_once()
+        self.other.refresh_from_db()
+        self.assertEqual(self.other.photo_hash, self.profile.photo_hash)
+        self.assertNotEqual(
+            self.other.photo_digest, self.profile.photo_digest)
+
+    def test_different_photo_is_uploaded(self):
+        """A visually different photo is uploaded as usual"""
+        different = make_upload(stripe=500)
+        with mock.patch(
+                'cloudinary.uploader.upload_resource',
+                return_value=self.uploaded_resource('profile_pictures/new')
+        ) as upload:
+            reused = store_profile_photo(
+                self.other, different, storage=self.storage)
+        self.assertFalse(reused)
+        upload.assert_called_once()
+        self.other.refresh_from_db()
+        self.assertNotEqual(self.other.photo_hash, self.profile.photo_hash)
+
+    def test_shared_variants_survive_photo_change(self):
+        """Changing a reused photo keeps the files the original uses"""
+        store_profile_photo(self.other, make_upload(), storage=self.storage)
+        shared = self.profile.photo_variants['avatar']['webp']['120']
+        with mock.patch(
+                'cloudinary.uploader.upload_resource',
+                return_value=self.uploaded_resource('profile_pictures/new')):
+            store_profile_photo(
+                self.other, make_upload(stripe=500), storage=self.storage)
+        self.assertTrue(self.storage.exists(shared))
+
+    def test_merge_duplicate_photos(self):
+        """Existing duplicates are repointed at the oldest stored copy"""
+        refresh_photo_variants(
+            self.other, make_upload(), storage=self.storage)
+        Profile.objects.filter(pk=self.other.pk).update(
+            photo='image/upload/profile_pictures/duplicate')
+        self.other.refresh_from_db()
+        duplicate_file = self.other.photo_variants['card']['jpeg']['200']
+
+        with mock.patch('cloudinary.uploader.destroy') as destroy:
+            merged = merge_duplicate_photos(
+                self.profile.photo_hash, storage=self.storage)
+        self.assertEqual(merged, 1)
+        destroy.assert_called_once_with(
+            'profile_pictures/duplicate', invalidate=True)
+        self.other.refresh_from_db()
+        self.assertEqual(
+            self.other.photo.public_id, 'profile_pictures/original')
+        self.assertFalse(self.storage.exists(duplicate_file))
+
+    def test_merge_skips_similar_photos(self):
+        """Profiles whose photos only look alike keep their own photo"""
+        Profile.objects.filter(pk=self.other.pk).update(
+            photo='image/upload/profile_pictures/similar',
+            photo_hash=self.profile.photo_hash, photo_digest='0' * 64)
+        with mock.patch('cloudinary.uploader.destroy') as destroy:
+            merged = merge_duplicate_photos(
+                self.profile.photo_hash, storage=self.storage)
+        self.assertEqual(merged, 0)
+        destroy.assert_not_called()
+        self.other.refresh_from_db()
+        self.assertEqual(
+            self.other.photo.public_id, 'profile_pictures/similar')
+
+    def original_file(self, upload):
+        """Save an upload where the scan can fetch it as an original"""
+        path = os.path.join(self.media_root, upload.name)
+        with open(path, 'wb') as original:
+            original.write(upload.read())
+        return path
+
+    def test_scan_merges_legacy_duplicates(self):
+        """Photos stored before hashing get both fingerprints and merge"""
+        path = self.original_file(make_upload())
+        Profile.objects.filter(pk=self.other.pk).update(
+            photo='image/upload/profile_pictures/duplicate')
+        Profile.objects.update(photo_hash='', photo_digest='')
+        out = StringIO()
+        with mock.patch(
+                'dating.management.commands.scan_photo_duplicates.'
+                'original_source', return_value=path), \
+                mock.patch('cloudinary.uploader.destroy') as destroy:
+            call_command(
+                'scan_photo_duplicates', workers=1, merge=True, stdout=out)
+        destroy.assert_called_once_with(
+            'profile_pictures/duplicate', invalidate=True)
+        self.assertIn(
+            '1 similar group(s), of which 1 exact duplicate group(s). '
+            'Repointed 1 profile(s).', out.getvalue())
+        self.assertEqual(
+            set(Profile.objects.values_list('photo_hash', 'photo_digest')),
+            {(self.profile.photo_hash, self.profile.photo_digest)})
+        self.other.refresh_from_db()
+        self.assertEqual(
+            self.other.photo.public_id, 'profile_pictures/original')
+
+    def test_scan_command_reports_duplicates(self):
+        """The scan command fingerprints missing photos and lists groups"""
+        path = self.original_file(make_upload())
+        Profile.objects.filter(pk=self.profile.pk).update(photo_digest='')
+        Profile.objects.filter(pk=self.other.pk).update(
+            photo='image/upload/profile_pictures/similar',
+            photo_hash=self.profile.photo_hash, photo_digest='0' * 64)
+        out = StringIO()
+        with mock.patch(
+                'dating.management.commands.scan_photo_duplicates.'
+                'original_source', return_value=path):
+            call_command('scan_photo_duplicates', workers=1, stdout=out)
+        self.assertIn(f'{self.profile.photo_hash}: 2 profiles', out.getvalue())
+        self.assertIn(
+            '1 similar group(s), of which 0 exact duplicate group(s).',
+            out.getvalue())
+
+
+class ProfileAdminTests(BaseViewTestCase):
+    """Tests for the Profile admin changelist"""
+
+    def setUp(self):
+        super().setUp()
+        User.objects.create_superuser(
+            username='admin',
+            email='admin@example.com',
+            password='testpass123'
+        )
+        for user, age in ((self.user, 22), (self.user2, 40)):
+            Profile.objects.create(
+                user=user,
+                age=age,
+                gender='M',
+                location='Test City',
+                bio='This is a test bio that is long enough',
+                interests='Reading'
+            )
+        self.client.login(username='admin', password='testpass123')
+
+    def test_search_uses_full_text_index(self):
+        """Admin search matches words of the bio, username and email"""
+        Profile.objects.filter(user=self.user2).update(
+            bio='Sailing around the islands every summer')
+        rebuild_search_index()
+        url = reverse('admin:dating_profile_changelist')
+        for term in ('sailing', 'testuser2', 'test2@example'):
+            response = self.client.get(url, {'q': term})
+            self.assertEqual(
+                [p.user for p in response.context['cl'].result_list],
+                [self.user2])
+
+    def test_age_range_filter(self):
+        """The age bracket filter limits the changelist"""
+        url = reverse('admin:dating_profile_changelist')
+        response = self.client.get(url, {'age_range': '35-44'})
+        self.assertEqual(response.status_code, 200)
+        results = response.context['cl'].result_list
+        self.assertEqual([p.user for p in results], [self.user2])
+
+
+@override_settings(AUTOCOMPLETE_REFRESH_SECONDS=3600)
+class QueryBudgetTests(QueryBudgetMixin, BaseViewTestCase):
+    """Query budgets for every dating view"""
+    profile_data = {
+        'age': 28,
+        'gender': 'F',
+        'location': 'Budget City',
+        'bio': 'A budget bio that is long enough to pass validation',
+        'interests': 'Hiking',
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.profile = Profile.objects.create(user=self.user2, age=30)
+        self.client.login(username='testuser2', password='testpass123')
+        # Location suggestions come from a warm index, as they would
+        # between refreshes
+        cache.clear()
+        trigram_indexes.get('location')
+
+    def test_public_pages_budget(self):
+        for name in ('home', 'about', 'contact'):
+            self.assertViewQueryBudget(reverse(name), 2, status_code=200)
+
+    def test_get_started_budget(self):
+        self.assertViewQueryBudget(
+            reverse('profile_getstarted'), 3, status_code=302)
+
+    def test_profile_create_budget(self):
+        self.client.login(username='testuser', password='testpass123')
+        self.assertViewQueryBudget(
+            reverse('profile_create'), 3, status_code=200)
+        self.assertViewQueryBudget(
+            reverse('profile_create'), 5, method='post',
+            data=self.profile_data, status_code=302)
+
+    def test_profile_update_budget(self):
+        self.assertViewQueryBudget(
+            reverse('profile_update'), 3, status_code=200)
+        # The save also rewrites the profile's search document
+        self.assertViewQueryBudget(
+            reverse('profile_update'), 5, method='post',
+            data=self.profile_data, status_code=302)
+
+    def test_profile_delete_budget(self):
+        self.assertViewQueryBudget(
+            reverse('profile_delete'), 3, status_code=200)
+        self.assertViewQueryBudget(
+            reverse('profile_delete'), 5, method='post', status_code=302)
+
+    def test_profile_about_budget(self):
+        self.assertViewQueryBudget(
+            reverse('profile_about'), 3, status_code=200)
+
+    def test_profile_detail_budget(self):
+        self.assertViewQueryBudget(
+            reverse('profile_detail', args=[self.profile.pk]), 3,
+            status_code=200)
+
+    def test_profile_search_budget(self):
+        for i in range(12):
+            user = User.objects.create_user(username=f'budget{i}')
+            Profile.objects.create(
+                user=user, age=30, gender='F', location='Budget City',
+                bio='Budget profile bio that is long enough',
+                interests='Hiking')
+        # One count and one page query, both through the search index
+        self.assertViewQueryBudget(
+            reverse('profile_search'), {3: 4, 10: 4}, data={'q': 'hiking'},
+            view_class=ProfileSearch, status_code=200)
+
+    def test_profile_autocomplete_budget(self):
+        # Session and user only: suggestions come from the warm index
+        for field in ('username', 'location'):
+            self.assertViewQueryBudget(
+                reverse('profile_autocomplete'), 2,
+                data={'field': field, 'q': 'bud'}, status_code=200)
+
+
+class ProfileSearchTests(BaseViewTestCase):
+    """Tests for full-text profile search"""
+
+    def setUp(self):
+        super().setUp()
+        self.user3 = User.objects.create_user(
+            username='climber', email='climber@example.com',
+            password='testpass123')
+        self.profile = Profile.objects.create(
+            user=self.user, age=30, gender='F', location='Test City',
+            bio='Looking for someone to share long walks', interests='Films')
+        self.hiker = Profile.objects.create(
+            user=self.user2, age=28, gender='M', location='Test City',
+            bio='<p>Weekend <b>hiking</b> and mountain huts</p>',
+            interests='Cooking')
+        self.climber = Profile.objects.create(
+            user=self.user3, age=35, gender='M', location='Test City',
+            bio='Mostly indoor bouldering, some hiking in summer',
+            interests='Hiking, Climbing')
+        self.client.login(username='testuser', password='testpass123')
+
+    def search(self, text):
+        return list(search_profiles(Profile.objects.all(), text))
+
+    def test_ranks_better_matches_first(self):
+        # Interests weigh more than a bio
+        self.assertEqual(self.search('hiking'), [self.climber, self.hiker])
+        self.assertEqual(self.search('mountain hik'), [self.hiker])
+        self.assertEqual(self.search('CLIMB'), [self.climber])
+        # Markup in bios is not indexed
+        self.assertEqual(self.search('p'), [])
+        self.assertEqual(self.search('  "!  '), [])
+
+    def test_index_follows_saves_and_deletes(self):
+        self.hiker.bio = 'Now mostly into sailing'
+        self.hiker.save()
+        self.assertEqual(self.search('sailing'), [self.hiker])
+        self.assertEqual(self.search('mountain'), [])
+
+        self.user2.username = 'sailor'
+        self.user2.save()
+        self.assertEqual(self.search('sailor'), [self.hiker])
+
+        self.hiker.delete()
+        self.assertEqual(self.search('sailing'), [])
+
+    def test_rebuild_command(self):
+        Profile.objects.filter(pk=self.hiker.pk).update(bio='Kayaking')
+        self.assertEqual(self.search('kayaking'), [])
+        out = StringIO()
+        call_command('rebuild_profile_search', stdout=out)
+        self.assertIn('Indexed 3 profiles', out.getvalue())
+        self.assertEqual(self.search('kayaking'), [self.hiker])
+
+    def test_search_view(self):
+        response = self.client.get(reverse('profile_search'), {'q': 'hiking'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            list(response.context['profiles']), [self.climber, self.hiker])
+        self.assertEqual(response.context['query'], 'hiking')
+
+        # The viewer is never in the results
+        response = self.client.get(reverse('profile_search'), {'q': 'walks'})
+        self.assertEqual(list(response.context['profiles']), [])
+        self.assertContains(response, 'No profiles found')
+
+    def test_search_view_does_not_match_emails(self):
+        response = self.client.get(
+            reverse('profile_search'), {'q': 'climber@example.com'})
+        self.assertEqual(list(response.context['profiles']), [])
+        response = self.client.get(reverse('profile_search'), {'q': 'example'})
+        self.assertEqual(list(response.context['profiles']), [])
+        self.assertEqual(
+            list(search_profiles(
+                Profile.objects.all(), 'climber@example.com',
+                include_email=True)),
+            [self.climber])
+
+    def test_search_view_requires_login(self):
+        self.client.logout()
+        response = self.client.get(reverse('profile_search'), {'q': 'x'})
+        self.assertEqual(response.status_code, 302)
+
+
+class AutocompleteTests(BaseViewTestCase):
+    """Tests for username and location autocomplete"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        for username, location in (
+                ('testuser', 'Dublin'), ('testuser2', 'dublin '),
+                ('dubliner', 'Dún Laoghaire'), ('rose', 'Rosslare')):
+            user = User.objects.filter(username=username).first() or \
+                User.objects.create_user(username=username)
+            Profile.objects.create(
+                user=user, age=30, gender='F', location=location,
+                bio='A bio that is long enough', interests='Music')
+        User.objects.create_user(username='dubious')  # No profile
+        self.client.login(username='testuser', password='testpass123')
+
+    def test_normalize_location(self):
+        self.assertEqual(normalize_location('  new   york '), 'New York')
+        self.assertEqual(normalize_location('LONDON'), 'London')
+        self.assertEqual(normalize_location('McAllen'), 'McAllen')
+
+    def test_trigram_index_ranks_prefixes_then_weight(self):
+        index = TrigramIndex([
+            ('Cork', 5), ('New York', 9), ('York', 1), ('cork', 2), ('', 3)])
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.search('york', 10), ['York', 'New York'])
+        self.assertEqual(index.search('or', 10), [])
+        self.assertEqual(index.search('co', 10), ['Cork'])
+        self.assertEqual(index.search('ork', 1), ['New York'])
+        self.assertEqual(index.search('xyz', 10), [])
+
+    def test_suggest(self):
+        self.assertEqual(suggest('location', 'dub'), ['Dublin'])
+        self.assertEqual(suggest('location', 'ros'), ['Rosslare'])
+        self.assertEqual(
+            suggest('username', 'DUB'), ['dubliner'])
+        self.assertEqual(suggest('username', 'user'), [
+            'testuser', 'testuser2'])
+        self.assertEqual(suggest('location', '   '), [])
+        with self.assertRaises(ValueError):
+            suggest('email', 'x')
+
+    def test_suggestions_are_cached_per_prefix(self):
+        self.assertEqual(suggest('location', 'ros'), ['Rosslare'])
+        Profile.objects.filter(location='Rosslare').update(location='Roscrea')
+        self.assertEqual(suggest('location', 'ros'), ['Rosslare'])
+        self.assertEqual(suggest('location', 'rosc'), ['Roscrea'])
+        cache.clear()
+        self.assertEqual(suggest('location', 'ros'), ['Roscrea'])
+
+    @override_settings(
+        AUTOCOMPLETE_REFRESH_SECONDS=0, AUTOCOMPLETE_BACKGROUND_REBUILD=True)
+    def test_stale_index_is_used_while_it_is_rebuilt(self):
+        indexes = TrigramIndexes()
+        indexes.rebuild()
+        old = indexes.indexes['location']
+        new = {
+            'username': TrigramIndex([]),
+            'location': TrigramIndex([('Galway', 1)]),
+        }
+        release = threading.Event()
+        builds = []
+
+        def slow_build():
+            builds.append(1)
+            release.wait(5)
+            return new
+
+        with mock.patch.object(indexes, '_build', slow_build):
+            self.assertIs(indexes.get('location'), old)
+            self.assertIs(indexes.get('location'), old)
+            release.set()
+            deadline = time.monotonic() + 5
+            while indexes.indexes is not new and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertIs(indexes.indexes, new)
+        self.assertEqual(len(builds), 1)
+
+    @override_settings(AUTOCOMPLETE_BACKGROUND_REBUILD=True)
+    def test_suggest_queries_the_database_before_the_first_build(self):
+        release = threading.Event()
+        indexes = TrigramIndexes()
+
+        def slow_build():
+            release.wait(5)
+            return {'username': TrigramIndex([]),
+                    'location': TrigramIndex([])}
+
+        with mock.patch('dating.autocomplete.trigram_indexes', indexes), \
+                mock.patch.object(indexes, '_build', slow_build):
+            self.assertEqual(suggest('location', 'dub'), ['Dublin'])
+            self.assertEqual(suggest('username', 'DUB'), ['dubliner'])
+            release.set()
+
+    def test_canonical_location(self):
+        self.assertEqual(canonical_location(' DUBLIN'), 'Dublin')
+        self.assertEqual(canonical_location('galway  city'), 'Galway City')
+
+    def test_autocomplete_view(self):
+        url = reverse('profile_autocomplete')
+        response = self.client.get(url, {'field': 'location', 'q': 'laog'})
+        self.assertEqual(response.json(), {'results': ['Dún Laoghaire']})
+        response = self.client.get(url, {'field': 'bio', 'q': 'x'})
+        self.assertEqual(response.status_code, 400)
+        self.client.logout()
+        response = self.client.get(url, {'field': 'location', 'q': 'dub'})
+        self.assertEqual(response.status_code, 302)
+
+    def test_profile_form_uses_existing_spelling(self):
+        Profile.objects.filter(user=self.user).delete()
+        self.client.post(reverse('profile_create'), {
+            'age': 30, 'gender': 'F', 'location': 'dublin',
+            'bio': 'A bio that is long enough', 'interests': 'Music',
+        })
+        self.assertEqual(
+            Profile.objects.get(user=self.user).location, 'Dublin')
+        response = self.client.get(reverse('profile_update'))
+        self.assertContains(response, 'data-autocomplete-url=')
+
+
+@skipUnless(
+    connection.vendor == 'postgresql',
+    'Run with TEST_WITH_DATABASE_URL=True and a Postgres DATABASE_URL')
+class AutocompleteIndexTests(TestCase):
+    """The suggestion lookups are served by the pg_trgm indexes"""
+
+    def test_lookups_use_the_trigram_indexes(self):
+        lookups = (
+            (User.objects.filter(username__icontains='dub'),
+             'dating_user_username_upper_trgm'),
+            (Profile.objects.filter(location__icontains='dub'),
+             'dating_profile_location_upper_trgm'),
+        )
+        for queryset, index in lookups:
+            with transaction.atomic():
+                # The test tables are small enough for a scan to win
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+                plan = queryset.explain()
+            self.assertIn(index, plan)
+
+
+class ProfileImportTests(BaseViewTestCase):
+    """Tests for the bulk profile import"""
+
+    header = 'username,email,age,gender,location,bio,interests\n'
+
+    def row(self, username, age=30, gender='F', bio='Long walks and books'):
+        return (
+            f'{username},{username}@example.com,{age},{gender},'
+            f'dublin,{bio},Music\n')
+
+    def run_import(self, content, name='profiles.csv', batch_size=1000):
+        errors = []
+        result = import_profiles(
+            read_rows(BytesIO(content.encode()), name=name),
+            batch_size=batch_size,
+            on_error=lambda line, messages: errors.append((line, messages)))
+        return result, errors
+
+    def test_valid_rows_are_imported_and_searchable(self):
+        result, errors = self.run_import(
+            self.header + self.row('alice') + self.row('bob', gender='M'),
+            batch_size=1)
+        self.assertEqual((result.created, result.failed), (2, 0))
+        self.assertEqual(errors, [])
+        profile = Profile.objects.get(user__username='alice')
+        self.assertEqual(profile.age, 30)
+        self.assertEqual(profile.location, 'Dublin')
+        self.assertEqual(profile.user.email, 'alice@example.com')
+        self.assertFalse(profile.user.has_usable_password())
+        self.assertEqual(
+            sorted(p.user.username for p in search_profiles(
+                Profile.objects.all(), 'books')),
+            ['alice', 'bob'])
+
+    def test_invalid_rows_are_reported_by_line(self):
+        content = (
+            self.header + self.row('carol') +
+            self.row('young', age=12) +
+            self.row('odd', gender='X') +
+            self.row('short', bio='Hi') +
+            self.row('bad name!') +
+            self.row('testuser') +
+            self.row('carol') +
+            'extra,extra@example.com,30,M,Cork,Bio that is long,Art,more\n')
+        result, errors = self.run_import(content)
+        self.assertEqual((result.created, result.failed), (1, 7))
+        self.assertEqual(
+            {line: sorted(messages) for line, messages in errors}, {
+                3: ['age'], 4: ['gender'], 5: ['bio'],
+                6: ['email', 'username'], 7: ['username'], 8: ['username'],
+                9: ['row'],
+            })
+        messages = dict(errors)
+        self.assertIn('18', messages[3]['age'][0])
+        self.assertIn('already exists', messages[7]['username'][0])
+        self.assertIn('Duplicate', messages[8]['username'][0])
+        self.assertFalse(User.objects.filter(username='young').exists())
+
+    def test_gzipped_ndjson_is_read(self):
+        lines = [
+            json.dumps({
+                'username': 'dave', 'email': '', 'age': 44, 'gender': 'M',
+                'location': 'Cork', 'bio': 'Sailing every summer'}),
+            '',
+            '[1, 2]',
+            'not json',
+        ]
+        file = BytesIO(gzip.compress('\n'.join(lines).encode()))
+        errors = []
+        result = import_profiles(
+            read_rows(file, name='profiles.ndjson.gz'),
+            on_error=lambda line, messages: errors.append(line))
+        self.assertEqual((result.created, result.failed), (1, 2))
+        self.assertEqual(errors, [3, 4])
+        self.assertEqual(Profile.objects.get().interests, '')
+
+    def test_batches_take_a_fixed_number_of_queries(self):
+        content = self.header + ''.join(
+            self.row(f'user{number}') for number in range(50))
+        # Savepoint, username check, users, profiles, search documents
+        # and their savepoint
+        with self.assertNumQueries(8):
+            result, _ = self.run_import(content)
+        self.assertEqual(result.created, 50)
+
+    def test_command_writes_rejected_rows_to_a_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'profiles.csv')
+        errors_path = os.path.join(directory, 'errors.csv')
+        with open(path, 'w') as file:
+            file.write(self.header + self.row('erin') + self.row('x', age=9))
+        out = StringIO()
+        call_command(
+            'import_profiles', path, '--errors', errors_path, stdout=out)
+        self.assertIn(
+            'Imported 1 profile(s), 1 row(s) rejected', out.getvalue())
+        with open(errors_path) as file:
+            lines = file.read().splitlines()
+        self.assertEqual(lines[0], 'line,field,message')
+        self.assertTrue(lines[1].startswith('3,age,'))
+
+    def test_admin_import_page(self):
+        User.objects.create_superuser(
+            username='admin', email='admin@example.com',
+            password='testpass123')
+        self.client.login(username='admin', password='testpass123')
+        response = self.client.get(
+            reverse('admin:dating_profile_changelist'))
+        url = reverse('admin:dating_profile_import')
+        self.assertContains(response, url)
+
+        upload = SimpleUploadedFile(
+            'profiles.csv',
+            (self.header + self.row('frank') + self.row('kid', age=5))
+            .encode())
+        response = self.client.post(url, {'file': upload})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Imported 1 profile(s), 1 row(s)')
+        self.assertContains(response, '<td>3</td><td>age</td>', html=False)
+        self.assertTrue(Profile.objects.filter(
+            user__username='frank').exists())
+
+        self.client.force_login(self.user)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
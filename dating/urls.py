@@ -28,6 +28,16 @@ urlpatterns = [
         views.ProfileAbout.as_view(),
         name='profile_about',
     ),
+    path(
+        'profile/search/',
+        views.ProfileSearch.as_view(),
+        name='profile_search',
+    ),
+    path(
+        'profile/autocomplete/',
+        views.ProfileAutocomplete.as_view(),
+        name='profile_autocomplete',
+    ),
     path(
         'profile/<int:pk>/',
         views.ProfileDetail.as_view(),
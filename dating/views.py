@@ -5,8 +5,19 @@ from django.utils.http import url_has_allowed_host_and_scheme
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib import messages
 from django.urls import reverse_lazy, reverse
+from django.http import JsonResponse
 from django.shortcuts import redirect
+from .autocomplete import suggest
+from .forms import ProfileForm
 from .models import Profile
+from .search import search_profiles
+from .services import (
+    detach_photo_upload, handle_photo_upload, refresh_photo_variants,
+)
+
+PHOTO_PENDING_MESSAGE = (
+    'Your new photo is being processed and will appear shortly.'
+)
 
 
 class Home(generic.TemplateView):
@@ -24,14 +35,18 @@ class ProfileGetStarted(generic.TemplateView):
 
 class ProfileCreate(LoginRequiredMixin, generic.CreateView):
     model = Profile
-    fields = ['age', 'gender', 'location', 'bio', 'interests', 'photo']
+    form_class = ProfileForm
     template_name = 'dating/profile_form.html'
 
     def form_valid(self, form):
         form.instance.user = self.request.user
         try:
+            # The photo is stored once the profile row has committed
+            upload = detach_photo_upload(form)
             with transaction.atomic():
                 response = super().form_valid(form)
+            if upload:
+                self._store_photo(upload)
             # Add success message after profile is created
             messages.success(
                 self.request,
@@ -61,6 +76,20 @@ class ProfileCreate(LoginRequiredMixin, generic.CreateView):
                 "Please try again."
             )
             return self.form_invalid(form)
+
+    def _store_photo(self, upload):
+        # The profile is already saved, so a failed upload must not
+        # send the user back to the form
+        try:
+            if handle_photo_upload(self.object, upload):
+                messages.info(self.request, PHOTO_PENDING_MESSAGE)
+        except Exception:
+            messages.warning(
+                self.request,
+                'Your profile was saved but the photo could not be '
+                'uploaded. Please try again from Edit Profile.'
+            )
+
     # Redirect to profile detail page after successful profile creation
 
     def get_success_url(self):
@@ -70,14 +99,21 @@ class ProfileCreate(LoginRequiredMixin, generic.CreateView):
 
 class ProfileUpdate(LoginRequiredMixin, generic.UpdateView):
     model = Profile
-    fields = ['age', 'gender', 'location', 'bio', 'interests', 'photo']
+    form_class = ProfileForm
     template_name = 'dating/profile_form.html'
 
     def get_object(self):
         return self.request.user.profile
 
     def form_valid(self, form):
+        upload = detach_photo_upload(form)
         response = super().form_valid(form)
+        if upload:
+            if handle_photo_upload(self.object, upload):
+                messages.info(self.request, PHOTO_PENDING_MESSAGE)
+        elif 'photo' in form.changed_data:
+            # The photo was cleared
+            refresh_photo_variants(self.object, None)
         # Add success message after profile is updated
         messages.success(
             self.request,
@@ -115,6 +151,7 @@ class ProfileDelete(LoginRequiredMixin, generic.DeleteView):
 
 class ProfileDetail(LoginRequiredMixin, generic.DetailView):
     model = Profile
+    queryset = Profile.objects.select_related('user')
     template_name = 'dating/profile_detail.html'
     context_object_name = 'profile'
 
@@ -130,6 +167,46 @@ class ProfileDetail(LoginRequiredMixin, generic.DetailView):
         return context
 
 
+class ProfileSearch(LoginRequiredMixin, generic.ListView):
+    """Other users' profiles matching ?q=, best matches first"""
+    model = Profile
+    template_name = 'dating/profile_search.html'
+    context_object_name = 'profiles'
+    paginate_by = 12
+
+    def get_query(self):
+        return self.request.GET.get('q', '').strip()
+
+    def get_queryset(self):
+        return search_profiles(
+            Profile.objects.select_related('user').exclude(
+                user=self.request.user),
+            self.get_query())
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['query'] = self.get_query()
+        context['title'] = 'Search'
+        return context
+
+
+class ProfileAutocomplete(LoginRequiredMixin, generic.View):
+    """
+    JSON suggestions for ?field=username or ?field=location given the
+    text typed so far in ?q=
+    """
+
+    def get(self, request):
+        try:
+            results = suggest(
+                request.GET.get('field', ''), request.GET.get('q', ''))
+        except ValueError:
+            return JsonResponse({
+                'error': 'Unknown autocomplete field.'
+            }, status=400)
+        return JsonResponse({'results': results})
+
+
 class ProfileAbout(LoginRequiredMixin, generic.DetailView):
     model = Profile
     template_name = 'dating/profile_detail.html'
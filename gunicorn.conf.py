@@ -0,0 +1,44 @@
+"""
+gunicorn settings read automatically from the project root.
+
+When DISCOVERY_SNAPSHOT_PATH is set, the master starts one snapshot
+refresher next to the workers so they can share the discovery catalog
+through mmap instead of each loading their own.
+
+Each worker maps the similarity index as it starts, so the first
+"Similar to me" request does not pay for it.
+"""
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+# The project root, so the refresher starts wherever gunicorn was run from
+BASE_DIR = Path(__file__).resolve().parent
+
+_refresher = None
+
+
+def when_ready(server):
+    global _refresher
+    if not os.environ.get('DISCOVERY_SNAPSHOT_PATH'):
+        return
+    _refresher = subprocess.Popen([
+        sys.executable, str(BASE_DIR / 'manage.py'), 'write_profile_snapshot',
+        '--interval', os.environ.get('DISCOVERY_SNAPSHOT_INTERVAL', '5'),
+    ], cwd=BASE_DIR)
+    server.log.info('Started profile snapshot refresher %s', _refresher.pid)
+
+
+def on_exit(server):
+    if _refresher is not None:
+        _refresher.terminate()
+        _refresher.wait()
+
+
+def post_worker_init(worker):
+    from connections.similarity import similarity_index
+    try:
+        similarity_index.load(force=True)
+    except ValueError:
+        worker.log.exception('Could not load the similarity index')
@@ -3,6 +3,12 @@ ASGI config for match_up project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+This is what the Procfile's web process serves, with
+``gunicorn match_up.asgi -k uvicorn_worker.UvicornWorker``. The push
+notification stream (connections.views.EventStreamView) only works under
+an ASGI server; under WSGI (match_up.wsgi) it answers 204 and the pages
+poll as before.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
@@ -0,0 +1,140 @@
+"""
+Sending many emails over one connection.
+
+django.core.mail.send_mail opens a connection for each call, which for
+SMTP means a new TCP and TLS handshake and login per message. Mailer
+keeps one connection per thread open between messages and between
+batches, and opens a new one when it has been idle for
+``EMAIL_CONNECTION_MAX_IDLE`` seconds, which mail servers tend to drop,
+or when the server disconnected. Messages are throttled to
+``EMAIL_RATE_LIMIT`` per second to stay within the provider's limits.
+
+``EMAIL_BACKEND`` decides where messages go. Locally, the console and
+file backends print or save them instead of sending.
+"""
+import logging
+import smtplib
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """
+    Token bucket allowing ``rate`` events per second on average, with
+    bursts of up to ``burst``. A rate of 0 never waits.
+    """
+
+    def __init__(self, rate, burst=1, clock=time.monotonic,
+                 sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next event is allowed"""
+        if not self.rate:
+            return
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay:
+            self.sleep(delay)
+
+
+class Mailer:
+    """
+    Args:
+        rate: Messages per second, shared by all threads; defaults to
+              ``EMAIL_RATE_LIMIT``
+        max_idle: Seconds a connection is reused after its last message;
+                  defaults to ``EMAIL_CONNECTION_MAX_IDLE``
+    """
+
+    def __init__(self, rate=None, max_idle=None):
+        self.limiter = RateLimiter(
+            settings.EMAIL_RATE_LIMIT if rate is None else rate)
+        self.max_idle = (
+            settings.EMAIL_CONNECTION_MAX_IDLE if max_idle is None
+            else max_idle)
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        idle = time.monotonic() - getattr(self._local, 'used', 0)
+        if connection is not None and idle > self.max_idle:
+            self.close()
+            connection = None
+        if connection is None:
+            connection = get_connection(fail_silently=False)
+            connection.open()
+            self._local.connection = connection
+        return connection
+
+    def send(self, message):
+        """
+        Send one EmailMessage over this thread's connection.
+
+        Returns:
+            False when the server refused every recipient, otherwise True
+
+        Raises:
+            Any error of the backend other than refused recipients; the
+            connection is closed first
+        """
+        self.limiter.wait()
+        for attempt in (1, 2):
+            connection = self._connection()
+            try:
+                connection.send_messages([message])
+            except smtplib.SMTPServerDisconnected:
+                self.close()
+                if attempt == 2:
+                    raise
+                # Dropped while idle; a new connection is worth one try
+                continue
+            except smtplib.SMTPRecipientsRefused:
+                self._local.used = time.monotonic()
+                logger.warning('Recipients refused: %s', message.to)
+                return False
+            except Exception:
+                self.close()
+                raise
+            self._local.used = time.monotonic()
+            return True
+
+    def close(self):
+        """Close this thread's connection"""
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                logger.warning('Could not close email connection',
+                               exc_info=True)
+
+
+_mailer = None
+_mailer_lock = threading.Lock()
+
+
+def get_mailer():
+    """The process's Mailer"""
+    global _mailer
+    with _mailer_lock:
+        if _mailer is None:
+            _mailer = Mailer()
+        return _mailer
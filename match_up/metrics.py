@@ -0,0 +1,267 @@
+"""
+Per-request performance metrics.
+
+``RequestMetricsMiddleware`` records the total time, database time, query
+count, cache hits and misses and template render time of every request.
+The numbers are sent back in a ``Server-Timing`` header and aggregated into
+per-view histograms that ``metrics_view`` exposes in the Prometheus text
+format.
+
+Metrics are kept in memory per process, so with several gunicorn workers
+each scrape sees the worker that served it.
+"""
+import threading
+from bisect import bisect_left
+from contextlib import ExitStack
+from contextvars import ContextVar
+from time import perf_counter
+
+from django.conf import settings
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import PermissionDenied
+from django.db import connections
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+
+DURATION_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+_current_stats = ContextVar('request_stats', default=None)
+_MISSING = object()
+
+
+class RequestStats:
+    """Counters collected while a single request is handled"""
+    __slots__ = (
+        'db_time', 'queries', 'cache_hits', 'cache_misses', 'template_time',
+    )
+
+    def __init__(self):
+        self.db_time = 0.0
+        self.queries = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.template_time = 0.0
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        """Database execute wrapper that times every query"""
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += perf_counter() - start
+            self.queries += 1
+
+    def server_timing(self, duration):
+        """Format the stats as a Server-Timing header value"""
+        return ', '.join([
+            f'total;dur={duration * 1000:.1f}',
+            f'db;dur={self.db_time * 1000:.1f};desc="{self.queries} queries"',
+            f'tpl;dur={self.template_time * 1000:.1f}',
+            f'cache;desc="{self.cache_hits} hits, '
+            f'{self.cache_misses} misses"',
+        ])
+
+
+def get_request_stats():
+    """Return the stats of the request being handled, if any"""
+    return _current_stats.get()
+
+
+def record_cache_access(hit):
+    """Count a cache hit or miss against the current request"""
+    stats = _current_stats.get()
+    if stats is None:
+        return
+    if hit:
+        stats.cache_hits += 1
+    else:
+        stats.cache_misses += 1
+
+
+class InstrumentedCacheMixin:
+    """Cache backend mixin that reports hits and misses per request"""
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, _MISSING, version)
+        if value is _MISSING:
+            record_cache_access(False)
+            return default
+        record_cache_access(True)
+        return value
+
+
+class InstrumentedLocMemCache(InstrumentedCacheMixin, LocMemCache):
+    pass
+
+
+class Histogram:
+    """Fixed-bucket histogram in the Prometheus style"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(
+                f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum:.6f}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class MetricsRegistry:
+    """Thread-safe store of per-view request metrics"""
+    HISTOGRAMS = (
+        ('matchup_request_duration_seconds',
+         'Total request handling time.', DURATION_BUCKETS),
+        ('matchup_request_db_seconds',
+         'Time spent in database queries per request.', DURATION_BUCKETS),
+        ('matchup_request_template_seconds',
+         'Time spent rendering templates per request.', DURATION_BUCKETS),
+        ('matchup_request_queries',
+         'Database queries per request.', QUERY_BUCKETS),
+    )
+    COUNTERS = (
+        ('matchup_requests_total', 'Requests handled.'),
+        ('matchup_cache_hits_total', 'Cache hits.'),
+        ('matchup_cache_misses_total', 'Cache misses.'),
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {name: {} for name, _, _ in self.HISTOGRAMS}
+            self._counters = {name: {} for name, _ in self.COUNTERS}
+
+    def observe(self, view, method, status, duration, stats):
+        labels = f'view="{_escape(view)}",method="{_escape(method)}"'
+        values = (
+            duration, stats.db_time, stats.template_time, stats.queries,
+        )
+        with self._lock:
+            for (name, _, buckets), value in zip(self.HISTOGRAMS, values):
+                series = self._histograms[name]
+                if labels not in series:
+                    series[labels] = Histogram(buckets)
+                series[labels].observe(value)
+            self._increment(
+                'matchup_requests_total', f'{labels},status="{status}"', 1)
+            self._increment(
+                'matchup_cache_hits_total', labels, stats.cache_hits)
+            self._increment(
+                'matchup_cache_misses_total', labels, stats.cache_misses)
+
+    def _increment(self, name, labels, amount):
+        series = self._counters[name]
+        series[labels] = series.get(labels, 0) + amount
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name, help_text, _ in self.HISTOGRAMS:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} histogram')
+                for labels, histogram in sorted(
+                        self._histograms[name].items()):
+                    lines.extend(histogram.render(name, labels))
+            for name, help_text in self.COUNTERS:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} counter')
+                for labels, value in sorted(self._counters[name].items()):
+                    lines.append(f'{name}{{{labels}}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+registry = MetricsRegistry()
+
+
+class RequestMetricsMiddleware:
+    """
+    Time each request and publish the results.
+
+    Place it first in ``MIDDLEWARE`` so the timings cover the whole stack.
+    Set ``REQUEST_METRICS_SERVER_TIMING = False`` to stop sending the
+    ``Server-Timing`` header.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.server_timing = getattr(
+            settings, 'REQUEST_METRICS_SERVER_TIMING', True)
+
+    def __call__(self, request):
+        stats = RequestStats()
+        token = _current_stats.set(stats)
+        start = perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(
+                        connection.execute_wrapper(stats.execute_wrapper))
+                response = self.get_response(request)
+        finally:
+            _current_stats.reset(token)
+        duration = perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unresolved'
+        registry.observe(
+            view, request.method, response.status_code, duration, stats)
+        if self.server_timing:
+            response['Server-Timing'] = stats.server_timing(duration)
+        return response
+
+    def process_template_response(self, request, response):
+        stats = _current_stats.get()
+        if stats is None:
+            return response
+        started = perf_counter()
+
+        def rendered(response):
+            stats.template_time += perf_counter() - started
+
+        response.add_post_render_callback(rendered)
+        return response
+
+
+def metrics_view(request):
+    """
+    Expose request metrics for Prometheus.
+
+    Readable by staff users, or by a scraper sending
+    ``Authorization: Bearer <METRICS_TOKEN>`` when that setting is set.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    header = request.headers.get('Authorization', '')
+    has_token = bool(token) and constant_time_compare(
+        header, f'Bearer {token}')
+    if not (has_token or request.user.is_staff):
+        raise PermissionDenied
+    return HttpResponse(
+        registry.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )
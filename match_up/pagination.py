@@ -0,0 +1,48 @@
+"""
+Paginators shared by the project's apps
+"""
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+
+def estimated_row_count(model, using='default'):
+    """
+    Return the planner's row estimate for a model's table on Postgres.
+
+    Returns None on other databases or when the table has not been
+    analysed yet.
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT reltuples::bigint FROM pg_class WHERE relname = %s',
+            [model._meta.db_table],
+        )
+        row = cursor.fetchone()
+    if not row or row[0] < 0:
+        return None
+    return row[0]
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that avoids ``COUNT(*)`` on large unfiltered tables.
+
+    For an unfiltered queryset on Postgres the table estimate from
+    ``pg_class`` is used once it exceeds ``estimate_threshold`` rows.
+    Filtered querysets and small tables are counted exactly.
+    """
+    estimate_threshold = 100000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        query = getattr(queryset, 'query', None)
+        if query is not None and not query.where:
+            estimate = estimated_row_count(queryset.model, queryset.db)
+            if estimate and estimate > self.estimate_threshold:
+                return estimate
+        return super().count
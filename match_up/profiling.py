@@ -0,0 +1,185 @@
+"""
+On-demand sampling profiler for single requests.
+
+A staff member copies a token from the "Request profiles" admin page and
+sends it in an ``X-Profile`` header or a ``_profile`` query parameter.
+While that request runs, a background thread samples the request thread's
+stack and the result is written to ``PROFILING_DIR`` in the collapsed
+stack format read by flamegraph.pl and speedscope.
+
+Requests without a token only pay for a header lookup and a substring test.
+"""
+import os
+import re
+import sys
+import threading
+import uuid
+from collections import Counter
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib.auth.models import User
+from django.core import signing
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import FileResponse, Http404
+from django.shortcuts import render
+
+TOKEN_SALT = 'match_up.profiling'
+CAPTURE_SUFFIX = '.folded'
+MAX_STACK_DEPTH = 128
+
+
+class StackSampler:
+    """Periodically record the stack of one thread"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples[collapse_stack(frame)] += 1
+
+    def collapsed(self):
+        """Return the samples as ``frame;frame;frame count`` lines"""
+        return ''.join(
+            f'{stack} {count}\n'
+            for stack, count in self.samples.most_common())
+
+
+def collapse_stack(frame):
+    """Join a frame's call stack, outermost first, with semicolons"""
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        module = frame.f_globals.get('__name__', '?')
+        name = getattr(code, 'co_qualname', code.co_name)
+        names.append(f'{module}.{name}'.replace(' ', '_').replace(';', ':'))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def make_token(user):
+    """Return a signed profiling token for a staff user"""
+    return signing.TimestampSigner(salt=TOKEN_SALT).sign(str(user.pk))
+
+
+def token_is_valid(token):
+    """Check the signature, age and that the signer is still staff"""
+    try:
+        user_id = signing.TimestampSigner(salt=TOKEN_SALT).unsign(
+            token, max_age=settings.PROFILING_TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return False
+    return User.objects.filter(
+        pk=user_id, is_staff=True, is_active=True).exists()
+
+
+def write_capture(sampler, request):
+    """
+    Write a sampler's stacks to the capture directory.
+
+    Args:
+        sampler: A stopped StackSampler
+        request: The profiled request, used to name the file
+
+    Returns:
+        The capture's file name
+    """
+    os.makedirs(settings.PROFILING_DIR, exist_ok=True)
+    slug = re.sub(r'[^A-Za-z0-9]+', '-', request.path).strip('-') or 'root'
+    name = '{}-{}-{}{}'.format(
+        datetime.now().strftime('%Y%m%d-%H%M%S'), slug[:60],
+        uuid.uuid4().hex[:6], CAPTURE_SUFFIX)
+    with open(os.path.join(settings.PROFILING_DIR, name), 'w') as capture:
+        capture.write(sampler.collapsed())
+    return name
+
+
+def list_captures(limit=50):
+    """Return the newest captures as dicts of name, size and modified"""
+    try:
+        entries = [
+            entry for entry in os.scandir(settings.PROFILING_DIR)
+            if entry.is_file() and entry.name.endswith(CAPTURE_SUFFIX)
+        ]
+    except FileNotFoundError:
+        return []
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    return [
+        {
+            'name': entry.name,
+            'size': entry.stat().st_size,
+            'modified': datetime.fromtimestamp(entry.stat().st_mtime),
+        }
+        for entry in entries[:limit]
+    ]
+
+
+class RequestProfilingMiddleware:
+    """
+    Profile a request when it carries a valid staff profiling token.
+
+    Disabled entirely when ``REQUEST_PROFILING_ENABLED`` is False.
+    """
+
+    def __init__(self, get_response):
+        if not settings.REQUEST_PROFILING_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = request.META.get('HTTP_X_PROFILE')
+        if token is None and '_profile=' in request.META.get(
+                'QUERY_STRING', ''):
+            token = request.GET.get('_profile')
+        if not token or not token_is_valid(token):
+            return self.get_response(request)
+
+        sampler = StackSampler(
+            threading.get_ident(), settings.PROFILING_INTERVAL)
+        sampler.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            sampler.stop()
+        response['X-Profile-Capture'] = write_capture(sampler, request)
+        return response
+
+
+@staff_member_required
+def captures_view(request):
+    """Admin page listing recent captures and a fresh token"""
+    return render(request, 'admin/request_profiles.html', {
+        'title': 'Request profiles',
+        'captures': list_captures(),
+        'token': make_token(request.user),
+        'token_max_age': settings.PROFILING_TOKEN_MAX_AGE,
+        'profiling_enabled': settings.REQUEST_PROFILING_ENABLED,
+    })
+
+
+@staff_member_required
+def capture_download_view(request, name):
+    """Serve a single capture file"""
+    if os.path.basename(name) != name or not name.endswith(CAPTURE_SUFFIX):
+        raise Http404
+    path = os.path.join(settings.PROFILING_DIR, name)
+    if not os.path.isfile(path):
+        raise Http404
+    return FileResponse(
+        open(path, 'rb'), as_attachment=True, filename=name,
+        content_type='text/plain')
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 import os
 import sys
+import tempfile
 from pathlib import Path
 import dj_database_url
 if os.path.isfile('env.py'):
@@ -50,12 +51,15 @@ INSTALLED_APPS = [
     'cloudinary',
     'dating',
     'connections.apps.ConnectionsConfig',
+    'taskqueue.apps.TaskQueueConfig',
 ]
 
 SITE_ID = 1
 
 
 MIDDLEWARE = [
+    'match_up.metrics.RequestMetricsMiddleware',
+    'match_up.profiling.RequestProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -98,7 +102,10 @@ DATABASES = {
         'default': dj_database_url.parse(os.environ.get("DATABASE_URL"))
     }
 
-if 'test' in sys.argv:
+# Tests run on SQLite unless TEST_WITH_DATABASE_URL=True, which keeps the
+# DATABASE_URL engine, e.g. a local Postgres for the concurrency tests
+if ('test' in sys.argv and
+        os.environ.get('TEST_WITH_DATABASE_URL', 'False') != 'True'):
     DATABASES['default']['ENGINE'] = 'django.db.backends.sqlite3'
 
 
@@ -169,6 +176,182 @@ MEDIA_URL = '/media/'
 DEFAULT_FILE_STORAGE = 'cloudinary_storage.storage.MediaCloudinaryStorage'
 CLOUDINARY_URL = os.environ.get('CLOUDINARY_URL')
 
+# Storage for resized profile photo variants (dotted path to a storage
+# class). Defaults to DEFAULT_FILE_STORAGE when unset.
+PROFILE_PHOTO_STORAGE = os.environ.get('PROFILE_PHOTO_STORAGE')
+
+# Deferred photo uploads: new photos are spooled to local disk and pushed to
+# Cloudinary by a background task instead of inside the request. The spool
+# must be shared with the task workers.
+PROFILE_PHOTO_DEFERRED_UPLOAD = (
+    os.environ.get('PROFILE_PHOTO_DEFERRED_UPLOAD', 'False') == 'True')
+PROFILE_PHOTO_SPOOL_DIR = os.environ.get(
+    'PROFILE_PHOTO_SPOOL_DIR',
+    os.path.join(tempfile.gettempdir(), 'match_up_photos'))
+PROFILE_PHOTO_MAX_DIMENSION = 1600
+
+# Request metrics: the cache counts hits and misses per request, responses
+# carry a Server-Timing header and /metrics/ serves Prometheus text to staff
+# or to a scraper presenting METRICS_TOKEN as a bearer token.
+CACHES = {
+    'default': {
+        'BACKEND': 'match_up.metrics.InstrumentedLocMemCache',
+    }
+}
+REQUEST_METRICS_SERVER_TIMING = (
+    os.environ.get('REQUEST_METRICS_SERVER_TIMING', 'True') == 'True')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# On-demand request profiling: staff copy a token from
+# /admin/request-profiles/ and captures are written to PROFILING_DIR.
+REQUEST_PROFILING_ENABLED = (
+    os.environ.get('REQUEST_PROFILING_ENABLED', 'True') == 'True')
+PROFILING_DIR = os.environ.get(
+    'PROFILING_DIR',
+    os.path.join(tempfile.gettempdir(), 'match_up_profiles'))
+PROFILING_INTERVAL = 0.005
+PROFILING_TOKEN_MAX_AGE = 3600
+
+# Share of likes that bot profiles (Profile.is_bot) answer with a like back
+BOT_LIKE_BACK_RATE = float(os.environ.get('BOT_LIKE_BACK_RATE', 1.0))
+
+# Users who already liked the viewer are interleaved into the first pages
+# of discovery: at most DISCOVERY_RECIPROCAL_LIMIT of them, one every
+# DISCOVERY_RECIPROCAL_SPACING profiles. A limit of 0 turns this off.
+DISCOVERY_RECIPROCAL_LIMIT = int(
+    os.environ.get('DISCOVERY_RECIPROCAL_LIMIT', 30))
+DISCOVERY_RECIPROCAL_SPACING = 3
+
+# Discovery filters and orders candidates in an in-memory profile catalog
+# (connections.catalog) refreshed from the database at most this often.
+# Tests change profiles between requests, so they refresh every time.
+DISCOVERY_CATALOG_ENABLED = (
+    os.environ.get('DISCOVERY_CATALOG_ENABLED', 'True') == 'True')
+DISCOVERY_CATALOG_REFRESH_SECONDS = (
+    0 if 'test' in sys.argv else
+    float(os.environ.get('DISCOVERY_CATALOG_REFRESH_SECONDS', 5)))
+# With a path set, workers read the catalog from a snapshot file shared
+# through mmap instead of each keeping their own (connections.snapshot).
+# gunicorn.conf.py starts the refresher that checks for changed profiles
+# every DISCOVERY_SNAPSHOT_INTERVAL seconds and rewrites the file when
+# there are any, or at least every half DISCOVERY_SNAPSHOT_MAX_AGE.
+# Workers ignore a snapshot older than that and use their own catalog.
+DISCOVERY_SNAPSHOT_PATH = os.environ.get('DISCOVERY_SNAPSHOT_PATH')
+DISCOVERY_SNAPSHOT_INTERVAL = float(
+    os.environ.get('DISCOVERY_SNAPSHOT_INTERVAL', 5))
+DISCOVERY_SNAPSHOT_MAX_AGE = float(
+    os.environ.get('DISCOVERY_SNAPSHOT_MAX_AGE', 60))
+
+# "Similar to me" discovery reads the index written by
+# build_similarity_index and puts up to SIMILARITY_LIMIT profiles first
+SIMILARITY_INDEX_PATH = os.environ.get(
+    'SIMILARITY_INDEX_PATH',
+    os.path.join(tempfile.gettempdir(), 'match_up_similarity.index'))
+SIMILARITY_LIMIT = 60
+
+# Username and location autocomplete (dating.autocomplete). Lookups stop
+# after AUTOCOMPLETE_TIMEOUT_MS; the in-memory trigram index used off
+# Postgres is rebuilt every AUTOCOMPLETE_REFRESH_SECONDS, in a background
+# thread unless AUTOCOMPLETE_BACKGROUND_REBUILD is off.
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_TIMEOUT_MS = int(os.environ.get('AUTOCOMPLETE_TIMEOUT_MS', 50))
+AUTOCOMPLETE_CACHE_SECONDS = 60
+AUTOCOMPLETE_REFRESH_SECONDS = (
+    0 if 'test' in sys.argv else
+    float(os.environ.get('AUTOCOMPLETE_REFRESH_SECONDS', 300)))
+AUTOCOMPLETE_BACKGROUND_REBUILD = 'test' not in sys.argv
+
+# Swipe and match events are drained from the outbox by drain_outbox
+# (connections.outbox), the Procfile's outbox process. Failed events are retried with exponential backoff
+# from OUTBOX_RETRY_SECONDS and given up after OUTBOX_MAX_ATTEMPTS.
+# Delivered events are deleted after OUTBOX_RETENTION_DAYS; failed ones
+# are kept longer for inspection, for OUTBOX_FAILED_RETENTION_DAYS.
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 100))
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_RETRY_SECONDS = 30
+OUTBOX_MAX_RETRY_SECONDS = 3600
+OUTBOX_RETENTION_DAYS = 7
+OUTBOX_FAILED_RETENTION_DAYS = 30
+
+# New likes and matches are pushed to connected users over server-sent
+# events (connections.views.EventStreamView), which needs the ASGI server
+# the Procfile's web process runs (match_up.asgi under uvicorn workers).
+# The in-memory pub/sub only reaches users connected to the same process;
+# set PUBSUB_BACKEND to a shared broker's backend when running several,
+# including several web workers (WEB_CONCURRENCY).
+PUBSUB_BACKEND = os.environ.get(
+    'PUBSUB_BACKEND', 'connections.pubsub.InMemoryPubSub')
+PUBSUB_QUEUE_SIZE = 100
+PUBSUB_HISTORY = 1000
+PUSH_HEARTBEAT_SECONDS = 15
+PUSH_STREAM_SECONDS = 300
+PUSH_RETRY_MS = 3000
+
+# Match chat (connections.chat). History is loaded CHAT_PAGE_SIZE messages
+# at a time; a long poll for new messages waits up to CHAT_POLL_SECONDS.
+CHAT_PAGE_SIZE = 50
+CHAT_POLL_SECONDS = 25
+
+# Personal data exports (connections.export) read each table
+# EXPORT_CHUNK_SIZE rows at a time through a server-side cursor.
+EXPORT_CHUNK_SIZE = 2000
+
+# Background tasks (taskqueue), run by manage.py run_task_worker from the
+# database; the Procfile's worker process takes every queue. Failed tasks are retried with exponential backoff from
+# TASK_RETRY_SECONDS, up to TASK_MAX_ATTEMPTS runs. A task not finished
+# within TASK_TIMEOUT_SECONDS is given to another worker.
+TASK_MAX_ATTEMPTS = 5
+TASK_RETRY_SECONDS = 10
+TASK_MAX_RETRY_SECONDS = 3600
+TASK_TIMEOUT_SECONDS = 600
+TASK_POLL_SECONDS = float(os.environ.get('TASK_POLL_SECONDS', 1))
+TASK_RETENTION_DAYS = 7
+# Recurring tasks, each queued once every `seconds`
+TASK_SCHEDULE = {
+    'process-pending-photos': {
+        'task': 'dating.process_pending_photos', 'seconds': 3600},
+    'rebuild-like-counters': {
+        'task': 'connections.rebuild_like_counters', 'seconds': 86400},
+    'purge-tasks': {'task': 'taskqueue.purge_tasks', 'seconds': 86400},
+    'send-match-digests': {
+        'task': 'connections.send_match_digests', 'seconds': 60},
+}
+
+# Outgoing email (match_up.mail). Without EMAIL_HOST, emails are printed
+# to the console; set EMAIL_BACKEND to
+# django.core.mail.backends.filebased.EmailBackend to write them to
+# EMAIL_FILE_PATH instead. Mailer keeps its SMTP connection open between
+# messages for up to EMAIL_CONNECTION_MAX_IDLE idle seconds and sends at
+# most EMAIL_RATE_LIMIT messages per second (0 for no limit).
+EMAIL_BACKEND = os.environ.get(
+    'EMAIL_BACKEND',
+    'django.core.mail.backends.smtp.EmailBackend'
+    if os.environ.get('EMAIL_HOST') else
+    'django.core.mail.backends.console.EmailBackend')
+EMAIL_HOST = os.environ.get('EMAIL_HOST', 'localhost')
+EMAIL_PORT = int(os.environ.get('EMAIL_PORT', 587))
+EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER', '')
+EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD', '')
+EMAIL_USE_TLS = os.environ.get('EMAIL_USE_TLS', 'True') == 'True'
+EMAIL_TIMEOUT = 10
+EMAIL_FILE_PATH = os.environ.get(
+    'EMAIL_FILE_PATH', os.path.join(BASE_DIR, 'sent_emails'))
+DEFAULT_FROM_EMAIL = os.environ.get(
+    'DEFAULT_FROM_EMAIL', 'Match Up <noreply@example.com>')
+EMAIL_CONNECTION_MAX_IDLE = 60
+EMAIL_RATE_LIMIT = float(os.environ.get('EMAIL_RATE_LIMIT', 10))
+
+# New matches are emailed as one digest per user, sent
+# MATCH_EMAIL_WINDOW_SECONDS after the first match it lists
+# (connections.notifications). Both of the Procfile's background
+# processes are needed: the outbox process (drain_outbox) turns match
+# events into notifications, and the worker process (run_task_worker)
+# runs the send-match-digests task on the "email" queue, sending up to
+# MATCH_EMAIL_BATCH_SIZE digests per run.
+MATCH_EMAIL_WINDOW_SECONDS = int(
+    os.environ.get('MATCH_EMAIL_WINDOW_SECONDS', 900))
+MATCH_EMAIL_BATCH_SIZE = 500
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -0,0 +1,87 @@
+"""
+Test helpers shared by the project's apps
+"""
+import re
+from contextlib import contextmanager
+from unittest import mock
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import CaptureQueriesContext
+
+SAVEPOINT_RE = re.compile(r'(RELEASE |ROLLBACK TO )?SAVEPOINT ', re.I)
+
+
+class QueryBudgetMixin:
+    """
+    TestCase mixin that fails when code runs more queries than budgeted.
+
+    ``assertQueryBudget`` wraps any block; ``assertViewQueryBudget`` requests
+    a URL, optionally once per page size, so list views are checked for
+    queries that grow with the number of rows shown. Failures list every
+    captured SQL statement.
+    """
+
+    @contextmanager
+    def assertQueryBudget(self, budget, using=DEFAULT_DB_ALIAS, label=''):
+        with CaptureQueriesContext(connections[using]) as context:
+            yield context
+        # TestCase turns every transaction into a savepoint, so savepoint
+        # statements are not counted against the budget
+        queries = [
+            query for query in context.captured_queries
+            if not SAVEPOINT_RE.match(query['sql'])
+        ]
+        if len(queries) > budget:
+            self.fail(self._format_budget_failure(budget, queries, label))
+
+    def assertViewQueryBudget(self, url, budget, method='get', data=None,
+                              view_class=None, page_sizes=None,
+                              status_code=None, **extra):
+        """
+        Request ``url`` and check its query count against ``budget``.
+
+        Args:
+            url: URL to request with ``self.client``
+            budget: Maximum queries, or a dict of page size to maximum
+            method: Client method name, 'get' or 'post'
+            data: Request data passed to the client
+            view_class: ListView class whose ``paginate_by`` is patched
+            page_sizes: Page sizes to try; defaults to the budget's keys
+            status_code: Expected response status, if any
+            **extra: Extra arguments passed to the client
+
+        Returns:
+            The last response
+        """
+        if page_sizes is None and isinstance(budget, dict):
+            page_sizes = sorted(budget)
+        if not page_sizes:
+            return self._request_within_budget(
+                url, budget, method, data, status_code, extra)
+
+        response = None
+        for page_size in page_sizes:
+            limit = budget[page_size] if isinstance(budget, dict) else budget
+            with mock.patch.object(view_class, 'paginate_by', page_size):
+                response = self._request_within_budget(
+                    url, limit, method, data, status_code, extra,
+                    label=f' at page size {page_size}')
+        return response
+
+    def _request_within_budget(self, url, budget, method, data,
+                               status_code, extra, label=''):
+        request = getattr(self.client, method)
+        with self.assertQueryBudget(budget, label=f'{url}{label}'):
+            response = request(url, data, **extra)
+        if status_code is not None:
+            self.assertEqual(response.status_code, status_code)
+        return response
+
+    def _format_budget_failure(self, budget, queries, label):
+        lines = [
+            f'{label or "Block"} ran {len(queries)} queries, '
+            f'budget is {budget}:'
+        ]
+        for number, query in enumerate(queries, start=1):
+            lines.append(f'{number}. {query["sql"]}')
+        return '\n'.join(lines)
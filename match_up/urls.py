@@ -16,6 +16,8 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from match_up.metrics import metrics_view
+from match_up.profiling import capture_download_view, captures_view
 
 
 urlpatterns = [
@@ -23,7 +25,18 @@ urlpatterns = [
     path('connections/', include('connections.urls')),
     path('summernote/', include('django_summernote.urls')),
     path("account/", include("allauth.urls")),
+    path(
+        'admin/request-profiles/',
+        captures_view,
+        name='request_profiles',
+    ),
+    path(
+        'admin/request-profiles/<str:name>/',
+        capture_download_view,
+        name='request_profile_download',
+    ),
     path('admin/', admin.site.urls),
+    path('metrics/', metrics_view, name='metrics'),
 ]
 
 # Custom error handlers
@@ -78,8 +78,146 @@ function handleLikeButtons() {
     });  
 }
 
+function handleAutocomplete() {
+    document.querySelectorAll('input[data-autocomplete-url]').forEach(input => {
+        const list = document.getElementById(input.getAttribute('list'));
+        let timer;
+
+        input.addEventListener('input', function() {
+            clearTimeout(timer);
+            const query = input.value.trim();
+            if (!list || !query) {
+                return;
+            }
+            timer = setTimeout(() => {
+                const params = new URLSearchParams({field: input.name, q: query});
+                fetch(`${input.dataset.autocompleteUrl}?${params}`)
+                .then(response => response.ok ? response.json() : {results: []})
+                .then(data => {
+                    list.replaceChildren(...data.results.map(value => {
+                        const option = document.createElement('option');
+                        option.value = value;
+                        return option;
+                    }));
+                })
+                .catch(error => {
+                    console.error(error);
+                });
+            }, 150);
+        });
+    });
+}
+
+function showNotification(text, link, label) {
+    const container = document.querySelector('main');
+    if (!container) {
+        return;
+    }
+    const alert = document.createElement('div');
+    alert.className = 'alert alert-success alert-dismissible fade show';
+    alert.setAttribute('role', 'alert');
+    alert.append(`${text} `);
+    const anchor = document.createElement('a');
+    anchor.href = link;
+    anchor.className = 'alert-link';
+    anchor.textContent = label;
+    alert.append(anchor);
+    const close = document.createElement('button');
+    close.type = 'button';
+    close.className = 'btn-close';
+    close.setAttribute('data-bs-dismiss', 'alert');
+    close.setAttribute('aria-label', 'Close');
+    alert.append(close);
+    container.prepend(alert);
+}
+
+function handlePushNotifications() {
+    const url = document.body.dataset.pushUrl;
+    if (!url || !window.EventSource) {
+        return;
+    }
+    // Reconnects by itself, resuming after the last event it received
+    const events = new EventSource(url);
+    events.addEventListener('like', () => {
+        showNotification('Someone liked you!', '/connections/liked-you/', 'See who');
+    });
+    events.addEventListener('match', () => {
+        showNotification("It's a match!", '/connections/matches/?new_match=true', 'See your matches');
+    });
+    events.addEventListener('message', event => {
+        const data = JSON.parse(event.data);
+        const chat = document.getElementById('chat');
+        // The open conversation shows its messages itself
+        if (chat && chat.dataset.matchId === String(data.match_id)) {
+            return;
+        }
+        showNotification('New message!', `/connections/matches/${data.match_id}/chat/`, 'Read it');
+    });
+}
+
+function appendChatMessage(chat, message) {
+    if (chat.querySelector(`[data-message-id="${message.id}"]`)) {
+        return;
+    }
+    chat.querySelector('.chat-empty')?.remove();
+    const item = document.createElement('div');
+    item.className = 'chat-message';
+    if (String(message.sender_id) === chat.dataset.userId) {
+        item.classList.add('chat-message-own');
+    }
+    item.dataset.messageId = message.id;
+    const body = document.createElement('p');
+    body.className = 'mb-1 text-break';
+    body.textContent = message.body;
+    const time = document.createElement('small');
+    time.className = 'text-muted';
+    time.textContent = new Date(message.created_at).toLocaleString();
+    item.append(body, time);
+    chat.append(item);
+}
+
+function handleChat() {
+    const chat = document.getElementById('chat');
+    if (!chat || !chat.dataset.pollUrl) {
+        return;
+    }
+    chat.lastElementChild?.scrollIntoView();
+
+    // Long poll: the server answers when a message arrives or after a while
+    async function poll() {
+        const started = Date.now();
+        // Servers that cannot hold the request answer at once
+        let delay = 5000;
+        try {
+            const params = new URLSearchParams({after: chat.dataset.after});
+            const response = await fetch(`${chat.dataset.pollUrl}?${params}`);
+            if (!response.ok) {
+                throw new Error("Request failed");
+            }
+            const data = await response.json();
+            data.results.forEach(message => {
+                appendChatMessage(chat, message);
+                chat.dataset.after = message.id;
+            });
+            if (data.results.length) {
+                chat.lastElementChild.scrollIntoView({behavior: 'smooth'});
+            }
+            if (data.results.length || Date.now() - started >= 1000) {
+                delay = 0;
+            }
+        } catch (error) {
+            console.error(error);
+        }
+        setTimeout(poll, delay);
+    }
+    poll();
+}
+
 // Handle like/pass buttons with AJAX
 document.addEventListener('DOMContentLoaded', function() {
     handleLikeButtons();
     handleNewMatch();
+    handleAutocomplete();
+    handlePushNotifications();
+    handleChat();
 });
\ No newline at end of file
@@ -0,0 +1,30 @@
+from django.contrib import admin
+from django.utils import timezone
+
+from match_up.pagination import EstimatedCountPaginator
+from .models import Task
+
+
+@admin.register(Task)
+class TaskAdmin(admin.ModelAdmin):
+    list_display = [
+        'id', 'name', 'queue', 'status', 'run_at', 'attempts', 'duration',
+        'finished_at']
+    list_filter = ['status', 'queue']
+    search_fields = ['=name']
+    readonly_fields = [
+        'name', 'queue', 'args', 'kwargs', 'status', 'run_at', 'attempts',
+        'created_at', 'started_at', 'finished_at', 'duration', 'locked_by',
+        'locked_until', 'last_error', 'unique_key']
+    actions = ['retry_now']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    @admin.action(description='Run selected failed or queued tasks now')
+    def retry_now(self, request, queryset):
+        count = queryset.filter(
+            status__in=[Task.FAILED, Task.QUEUED]
+        ).update(
+            status=Task.QUEUED, run_at=timezone.now(), attempts=0,
+            finished_at=None)
+        self.message_user(request, f'Queued {count} task(s).')
@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+from django.utils.module_loading import autodiscover_modules
+
+
+class TaskQueueConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'taskqueue'
+    verbose_name = 'Background tasks'
+
+    def ready(self):
+        """Register the tasks defined in every app's tasks module"""
+        autodiscover_modules('tasks')
@@ -0,0 +1,87 @@
+"""
+Run background tasks from the database queue.
+
+Each process runs ``--threads`` tasks at a time; ``--processes`` starts
+that many worker processes and waits for them. Start as many workers as
+needed, on one machine or several: on PostgreSQL they claim tasks with
+SKIP LOCKED and never wait for each other. SIGTERM and SIGINT let the
+running tasks finish before the worker exits.
+"""
+import signal
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand
+
+from taskqueue.queue import enqueue_scheduled, requeue_expired
+from taskqueue.worker import Worker, run_ready
+
+
+class Command(BaseCommand):
+    help = 'Run queued background tasks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--queue', action='append', dest='queues',
+            help='Queue to take tasks from; repeat for several '
+                 '(default: default).')
+        parser.add_argument(
+            '--threads', type=int, default=4,
+            help='Tasks each process runs at the same time.')
+        parser.add_argument(
+            '--processes', type=int, default=1,
+            help='Worker processes to start.')
+        parser.add_argument(
+            '--poll-interval', type=float,
+            help='Seconds to wait when no task is ready '
+                 '(default: TASK_POLL_SECONDS).')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Run the tasks that are ready now, then stop.')
+
+    def handle(self, *args, **options):
+        queues = options['queues'] or ['default']
+        if options['once']:
+            enqueue_scheduled()
+            requeue_expired()
+            count = run_ready(queues)
+            self.stdout.write(self.style.SUCCESS(f'Ran {count} task(s).'))
+            return
+        if options['processes'] > 1:
+            self._supervise(queues, options)
+            return
+
+        worker = Worker(
+            queues, options['threads'], options['poll_interval'])
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *args: worker.stop())
+        self.stdout.write(
+            f'Running tasks from {", ".join(queues)} with '
+            f'{options["threads"]} thread(s)')
+        worker.run()
+        self.stdout.write(self.style.SUCCESS(
+            f'Ran {worker.processed} task(s).'))
+
+    def _supervise(self, queues, options):
+        command = [
+            sys.executable, sys.argv[0], 'run_task_worker',
+            '--threads', str(options['threads']),
+        ]
+        for queue in queues:
+            command += ['--queue', queue]
+        if options['poll_interval']:
+            command += ['--poll-interval', str(options['poll_interval'])]
+        children = [
+            subprocess.Popen(command) for _ in range(options['processes'])]
+
+        def stop(*args):
+            for child in children:
+                child.terminate()
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, stop)
+        self.stdout.write(
+            f'Started {len(children)} worker processes: '
+            f'{", ".join(str(child.pid) for child in children)}')
+        for child in children:
+            child.wait()
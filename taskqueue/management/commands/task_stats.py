@@ -0,0 +1,67 @@
+"""
+Report per-task run times and the state of the queues.
+
+Durations come from the tasks that finished in the last ``--hours``;
+purged tasks are no longer counted. Queue lag is the age of the oldest
+task that is ready but not yet claimed.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from taskqueue.models import Task
+
+
+def percentile(values, rank):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * rank / 100))]
+
+
+class Command(BaseCommand):
+    help = 'Show run time percentiles per task and queue lag.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours', type=float, default=24,
+            help='Look at tasks finished in this many hours.')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        since = now - timedelta(hours=options['hours'])
+        durations = defaultdict(list)
+        statuses = defaultdict(lambda: defaultdict(int))
+        finished = Task.objects.filter(finished_at__gte=since).values_list(
+            'name', 'status', 'duration').order_by()
+        for name, status, duration in finished.iterator(chunk_size=5000):
+            statuses[name][status] += 1
+            if status == Task.DONE and duration is not None:
+                durations[name].append(duration)
+
+        self.stdout.write(
+            f'{"task":<40} {"done":>7} {"failed":>7} {"p50 ms":>9} '
+            f'{"p95 ms":>9} {"max ms":>9}')
+        for name in sorted(statuses):
+            values = sorted(durations[name])
+            self.stdout.write(
+                f'{name:<40} {statuses[name][Task.DONE]:>7} '
+                f'{statuses[name][Task.FAILED]:>7} '
+                f'{percentile(values, 50) * 1000:>9.1f} '
+                f'{percentile(values, 95) * 1000:>9.1f} '
+                f'{(values[-1] if values else 0) * 1000:>9.1f}')
+
+        ready = Task.objects.filter(
+            status=Task.QUEUED, run_at__lte=now
+        ).values('queue').annotate(
+            count=Count('id'), oldest=Min('run_at')).order_by('queue')
+        for row in ready:
+            lag = (now - row['oldest']).total_seconds()
+            self.stdout.write(
+                f'Queue {row["queue"]}: {row["count"]} ready, '
+                f'oldest waiting {lag:.1f}s')
+        running = Task.objects.filter(status=Task.RUNNING).count()
+        self.stdout.write(f'{running} task(s) running')
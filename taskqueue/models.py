@@ -0,0 +1,56 @@
+from django.db import models
+from django.utils import timezone
+
+
+class Task(models.Model):
+    """
+    A call of a registered task function, waiting for or run by a worker.
+
+    See taskqueue.queue for enqueueing and taskqueue.worker for running.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    name = models.CharField(max_length=200)
+    queue = models.CharField(max_length=50, default='default')
+    args = models.JSONField(default=list, blank=True)
+    kwargs = models.JSONField(default=dict, blank=True)
+    status = models.CharField(
+            max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    # Earliest time a worker runs the task, pushed back on retry
+    run_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Seconds the last run took
+    duration = models.FloatField(null=True, blank=True)
+    locked_by = models.CharField(max_length=100, blank=True)
+    # A running task whose lease is over is given to another worker
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    # Tasks with the same key are only enqueued once
+    unique_key = models.CharField(
+            max_length=200, null=True, blank=True, unique=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            # Workers only look for tasks that are ready to run
+            models.Index(
+                fields=['queue', 'run_at', 'id'], name='task_ready_idx',
+                condition=models.Q(status='queued')),
+            models.Index(
+                fields=['locked_until'], name='task_lease_idx',
+                condition=models.Q(status='running')),
+            models.Index(fields=['finished_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.get_status_display()})"
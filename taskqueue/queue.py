@@ -0,0 +1,373 @@
+"""
+Database-backed background tasks.
+
+Functions decorated with ``@task`` in an app's ``tasks`` module can be
+enqueued from anywhere. The Task row is written in the caller's
+transaction, so it commits or rolls back with the work that asked for
+it. ``manage.py run_task_worker`` runs the tasks (see taskqueue.worker).
+
+A worker claims one task at a time. On PostgreSQL it uses ``SELECT ...
+FOR UPDATE SKIP LOCKED``, so workers never wait for each other. Other
+databases have no SKIP LOCKED; there the worker claims a task with an
+UPDATE that only succeeds while the task is still queued, and tries the
+next candidate when another worker got there first.
+
+A claimed task holds a lease of its ``timeout`` seconds. If a worker dies
+mid-task, the task is run again when its lease is over, so tasks must be
+safe to run twice. A task that raises is retried with exponential
+backoff, up to its ``max_attempts`` runs.
+
+Claiming a task and recording its outcome are tried again when the
+database reports an error, such as SQLite's "database table is locked",
+so a busy database does not leave finished tasks to run a second time.
+
+Recurring tasks are listed in ``TASK_SCHEDULE``. Each period is enqueued
+once, however many workers are running, through the task's unique key.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Task
+
+logger = logging.getLogger(__name__)
+
+_registry = {}
+# Candidates tried per claim where SKIP LOCKED is not available
+CLAIM_CANDIDATES = 10
+# Tries of each queue update that a worker depends on, 50ms apart at
+# first and twice as long each time
+DATABASE_ATTEMPTS = 5
+
+
+class TaskFunction:
+    """
+    A registered task. Calling it runs the function in the current
+    process; ``enqueue`` and ``enqueue_at`` leave it to a worker.
+    """
+
+    def __init__(self, func, name, queue, max_attempts, timeout):
+        self.func = func
+        self.name = name
+        self.queue = queue
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.__doc__ = func.__doc__
+        self.__wrapped__ = func
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+    def enqueue(self, *args, **kwargs):
+        """Queue a call to run as soon as a worker is free"""
+        return enqueue(self.name, args, kwargs)
+
+    def enqueue_at(self, run_at, *args, **kwargs):
+        """
+        Queue a call to run later.
+
+        Args:
+            run_at: datetime, or timedelta from now
+        """
+        return enqueue(self.name, args, kwargs, run_at=run_at)
+
+    def get_max_attempts(self):
+        return self.max_attempts or settings.TASK_MAX_ATTEMPTS
+
+    def get_timeout(self):
+        return self.timeout or settings.TASK_TIMEOUT_SECONDS
+
+
+def task(name=None, queue='default', max_attempts=None, timeout=None):
+    """
+    Register a function as a task.
+
+    Args:
+        name: Name stored on queued tasks; defaults to
+              ``<app label>.<function name>``
+        queue: Queue the task runs on
+        max_attempts: Runs before giving up; defaults to
+                      ``TASK_MAX_ATTEMPTS``
+        timeout: Lease in seconds; defaults to ``TASK_TIMEOUT_SECONDS``
+    """
+    def register(func):
+        task_name = name or (
+            f'{func.__module__.split(".")[0]}.{func.__name__}')
+        registered = TaskFunction(
+            func, task_name, queue, max_attempts, timeout)
+        _registry[task_name] = registered
+        return registered
+    return register
+
+
+def get_task(name):
+    """The registered TaskFunction with a name, or None"""
+    return _registry.get(name)
+
+
+def enqueue(name, args=(), kwargs=None, run_at=None, queue=None,
+            unique_key=None, using='default'):
+    """
+    Queue a task in the current transaction.
+
+    Args:
+        name: Registered task name
+        args: JSON-serializable positional arguments
+        kwargs: JSON-serializable keyword arguments
+        run_at: datetime, or timedelta from now; defaults to now
+        queue: Queue to use instead of the task's own
+        unique_key: Skip the task if one with this key was ever queued
+                    and not purged
+        using: Database alias
+
+    Returns:
+        The Task, or None when its unique key was already taken
+
+    Raises:
+        LookupError: If no task has the name
+    """
+    registered = get_task(name)
+    if registered is None:
+        raise LookupError(f'No task named {name!r}')
+    if isinstance(run_at, timedelta):
+        run_at = timezone.now() + run_at
+    new_task = Task(
+        name=name, queue=queue or registered.queue, args=list(args),
+        kwargs=kwargs or {}, run_at=run_at or timezone.now(),
+        unique_key=unique_key)
+    if unique_key is None:
+        new_task.save(using=using)
+        return new_task
+    try:
+        with transaction.atomic(using=using):
+            new_task.save(using=using)
+    except IntegrityError:
+        return None
+    return new_task
+
+
+def worker_id():
+    """Identifies this thread's claims, for finishing and in the admin"""
+    return (
+        f'{socket.gethostname()}:{os.getpid()}:'
+        f'{threading.current_thread().name}')[:100]
+
+
+def _retrying(operation, using):
+    """
+    Call ``operation``, trying again when it raises a DatabaseError.
+
+    Inside a transaction the error cannot be retried and is raised.
+    """
+    for attempt in range(1, DATABASE_ATTEMPTS + 1):
+        try:
+            return operation()
+        except DatabaseError as error:
+            if (attempt == DATABASE_ATTEMPTS or
+                    connections[using].in_atomic_block):
+                raise
+            logger.warning('Task queue update failed, retrying: %s', error)
+            time.sleep(0.05 * 2 ** (attempt - 1))
+
+
+def _lease(task_name, now):
+    registered = get_task(task_name)
+    timeout = (
+        registered.get_timeout() if registered
+        else settings.TASK_TIMEOUT_SECONDS)
+    return now + timedelta(seconds=timeout)
+
+
+def claim(queues, worker=None, using='default'):
+    """
+    Take the next ready task off some queues.
+
+    Args:
+        queues: Names of the queues to take from
+        worker: Claimant name; defaults to worker_id()
+        using: Database alias
+
+    Returns:
+        The claimed Task, now running, or None when none is ready
+    """
+    worker = worker or worker_id()
+    now = timezone.now()
+    tasks = Task.objects.using(using)
+    ready = tasks.filter(
+        status=Task.QUEUED, queue__in=queues, run_at__lte=now
+    ).order_by('run_at', 'id')
+
+    if connections[using].features.has_select_for_update_skip_locked:
+        with transaction.atomic(using=using):
+            claimed = ready.select_for_update(skip_locked=True).first()
+            if claimed is None:
+                return None
+            claimed.status = Task.RUNNING
+            claimed.attempts += 1
+            claimed.started_at = now
+            claimed.locked_by = worker
+            claimed.locked_until = _lease(claimed.name, now)
+            claimed.save(update_fields=[
+                'status', 'attempts', 'started_at', 'locked_by',
+                'locked_until'])
+            return claimed
+
+    candidates = _retrying(
+        lambda: list(ready.values_list('id', 'name')[:CLAIM_CANDIDATES]),
+        using)
+    for task_id, task_name in candidates:
+        # Only one worker's update finds the task still queued
+        claimed = tasks.filter(pk=task_id, status=Task.QUEUED)
+        if _retrying(lambda: claimed.update(
+                status=Task.RUNNING, attempts=F('attempts') + 1,
+                started_at=now, locked_by=worker,
+                locked_until=_lease(task_name, now)), using):
+            return _retrying(lambda: tasks.get(pk=task_id), using)
+    return None
+
+
+def retry_delay(attempts):
+    """How long a failed task waits before its next run"""
+    return timedelta(seconds=min(
+        settings.TASK_RETRY_SECONDS * 2 ** (attempts - 1),
+        settings.TASK_MAX_RETRY_SECONDS))
+
+
+def run(claimed, using='default'):
+    """
+    Run a claimed task and record the outcome.
+
+    Returns:
+        The Task's new status
+
+    Raises:
+        DatabaseError: If the outcome could not be recorded; the task
+                       then runs again once its lease is over
+    """
+    registered = get_task(claimed.name)
+    started = time.perf_counter()
+    error = None
+    try:
+        if registered is None:
+            raise LookupError(f'No task named {claimed.name!r}')
+        registered.func(*claimed.args, **claimed.kwargs)
+    except Exception:
+        logger.exception('Task %s (%s) failed', claimed.pk, claimed.name)
+        error = traceback.format_exc()
+    duration = time.perf_counter() - started
+    now = timezone.now()
+
+    changes = {
+        'finished_at': now, 'duration': duration, 'locked_by': '',
+        'locked_until': None, 'last_error': error or '',
+    }
+    max_attempts = (
+        registered.get_max_attempts() if registered
+        else settings.TASK_MAX_ATTEMPTS)
+    if error is None:
+        changes['status'] = Task.DONE
+    elif claimed.attempts >= max_attempts:
+        changes['status'] = Task.FAILED
+    else:
+        changes['status'] = Task.QUEUED
+        changes['run_at'] = now + retry_delay(claimed.attempts)
+    # A task whose lease ran out may already belong to another worker
+    owned = Task.objects.using(using).filter(
+        pk=claimed.pk, status=Task.RUNNING, locked_by=claimed.locked_by)
+    try:
+        updated = _retrying(lambda: owned.update(**changes), using)
+    except DatabaseError:
+        logger.exception(
+            'Could not record the outcome of task %s (%s)',
+            claimed.pk, claimed.name)
+        raise
+    if not updated:
+        logger.warning(
+            'Task %s (%s) finished after its lease ran out',
+            claimed.pk, claimed.name)
+    logger.info(
+        'Task %s (%s) %s in %.3fs', claimed.pk, claimed.name,
+        changes['status'], duration)
+    return changes['status']
+
+
+def requeue_expired(using='default'):
+    """
+    Give tasks whose lease ran out back to the queue, or fail them when
+    they have used up their attempts.
+
+    Returns:
+        Number of tasks requeued or failed
+    """
+    now = timezone.now()
+    expired = Task.objects.using(using).filter(
+        status=Task.RUNNING, locked_until__lt=now)
+    count = 0
+    for task_id, task_name, attempts in expired.values_list(
+            'id', 'name', 'attempts'):
+        registered = get_task(task_name)
+        max_attempts = (
+            registered.get_max_attempts() if registered
+            else settings.TASK_MAX_ATTEMPTS)
+        changes = {
+            'locked_by': '', 'locked_until': None,
+            'last_error': 'The worker did not finish before the lease ran '
+                          'out.',
+        }
+        if attempts >= max_attempts:
+            changes.update(status=Task.FAILED, finished_at=now)
+        else:
+            changes.update(status=Task.QUEUED, run_at=now)
+        count += expired.filter(pk=task_id).update(**changes)
+    if count:
+        logger.warning('Requeued %s task(s) whose lease ran out', count)
+    return count
+
+
+def enqueue_scheduled(now=None, using='default'):
+    """
+    Queue the ``TASK_SCHEDULE`` tasks whose period has started.
+
+    Every entry is queued once per period of its ``seconds``, counted
+    from the Unix epoch, so workers can all call this.
+
+    Returns:
+        Number of tasks queued
+    """
+    now = now or timezone.now()
+    count = 0
+    for key, entry in settings.TASK_SCHEDULE.items():
+        period = int(now.timestamp() // entry['seconds'])
+        if enqueue(
+                entry['task'], entry.get('args', ()), entry.get('kwargs'),
+                unique_key=f'schedule:{key}:{period}', using=using):
+            count += 1
+    return count
+
+
+def purge(older_than=None, using='default'):
+    """
+    Delete tasks that finished more than ``TASK_RETENTION_DAYS`` ago.
+
+    Failed tasks are kept for inspection.
+
+    Returns:
+        Number of tasks deleted
+    """
+    cutoff = timezone.now() - (
+        older_than or timedelta(days=settings.TASK_RETENTION_DAYS))
+    finished = Task.objects.using(using).filter(
+        status=Task.DONE, finished_at__lt=cutoff)
+    count = finished.count()
+    if count:
+        finished.delete()
+    return count
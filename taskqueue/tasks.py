@@ -0,0 +1,10 @@
+"""
+Housekeeping tasks of the task queue itself
+"""
+from .queue import purge, task
+
+
+@task()
+def purge_tasks():
+    """Delete tasks that finished more than TASK_RETENTION_DAYS ago"""
+    return purge()
@@ -0,0 +1,236 @@
+"""
+Tests for the database-backed task queue
+"""
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import OperationalError, transaction
+from django.db.models import QuerySet
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from .models import Task
+from .queue import (
+    claim, enqueue, enqueue_scheduled, get_task, purge, requeue_expired,
+    retry_delay, run, task,
+)
+from .worker import Worker, run_ready
+
+calls = []
+calls_lock = threading.Lock()
+
+
+@task(name='taskqueue.test_record')
+def record(value, fail=False):
+    with calls_lock:
+        calls.append(value)
+    if fail:
+        raise RuntimeError('task failed')
+
+
+@task(name='taskqueue.test_limited', max_attempts=2, timeout=1)
+def limited():
+    raise RuntimeError('task failed')
+
+
+class TaskQueueTests(TestCase):
+    """Tests for enqueueing, claiming and running tasks"""
+
+    def setUp(self):
+        calls.clear()
+
+    def test_enqueued_task_runs_once(self):
+        queued = record.enqueue('a')
+        self.assertEqual(queued.status, Task.QUEUED)
+        self.assertEqual(run_ready(['default']), 1)
+        self.assertEqual(calls, ['a'])
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, Task.DONE)
+        self.assertEqual(queued.attempts, 1)
+        self.assertIsNotNone(queued.duration)
+        self.assertEqual(run_ready(['default']), 0)
+
+    def test_calling_a_task_runs_it_inline(self):
+        record('inline')
+        self.assertEqual(calls, ['inline'])
+        self.assertFalse(Task.objects.exists())
+
+    def test_task_rolls_back_with_the_transaction(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                record.enqueue('lost')
+                raise RuntimeError
+        self.assertFalse(Task.objects.exists())
+
+    def test_unknown_task_cannot_be_queued(self):
+        with self.assertRaises(LookupError):
+            enqueue('taskqueue.missing')
+
+    def test_tasks_only_run_from_their_queues(self):
+        enqueue('taskqueue.test_record', ['other'], queue='other')
+        self.assertEqual(run_ready(['default']), 0)
+        self.assertEqual(run_ready(['default', 'other']), 1)
+        self.assertEqual(calls, ['other'])
+
+    def test_scheduled_task_waits_for_its_time(self):
+        queued = record.enqueue_at(timedelta(minutes=5), 'later')
+        self.assertIsNone(claim(['default']))
+        Task.objects.filter(pk=queued.pk).update(run_at=timezone.now())
+        self.assertEqual(run_ready(['default']), 1)
+        self.assertEqual(calls, ['later'])
+
+    def test_claimed_task_is_not_claimed_again(self):
+        record.enqueue('once')
+        first = claim(['default'], worker='one')
+        self.assertEqual(first.status, Task.RUNNING)
+        self.assertEqual(first.locked_by, 'one')
+        self.assertIsNone(claim(['default'], worker='two'))
+
+    @override_settings(TASK_RETRY_SECONDS=10, TASK_MAX_ATTEMPTS=3)
+    def test_failed_task_is_retried_with_backoff(self):
+        queued = record.enqueue('boom', fail=True)
+        with self.assertLogs('taskqueue.queue', 'ERROR'):
+            run_ready(['default'])
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, Task.QUEUED)
+        self.assertIn('task failed', queued.last_error)
+        self.assertGreater(
+            queued.run_at, timezone.now() + timedelta(seconds=9))
+        self.assertEqual(retry_delay(1), timedelta(seconds=10))
+        self.assertEqual(retry_delay(3), timedelta(seconds=40))
+
+        for _ in range(2):
+            Task.objects.filter(pk=queued.pk).update(run_at=timezone.now())
+            with self.assertLogs('taskqueue.queue', 'ERROR'):
+                run_ready(['default'])
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, Task.FAILED)
+        self.assertEqual(queued.attempts, 3)
+        self.assertEqual(calls, ['boom'] * 3)
+
+    def test_task_options_override_settings(self):
+        self.assertEqual(get_task('taskqueue.test_limited').timeout, 1)
+        queued = limited.enqueue()
+        for _ in range(2):
+            Task.objects.filter(pk=queued.pk).update(run_at=timezone.now())
+            with self.assertLogs('taskqueue.queue', 'ERROR'):
+                run_ready(['default'])
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, Task.FAILED)
+
+    def test_expired_lease_gives_the_task_to_another_worker(self):
+        record.enqueue('slow')
+        stalled = claim(['default'], worker='stalled')
+        Task.objects.filter(pk=stalled.pk).update(
+            locked_until=timezone.now() - timedelta(seconds=1))
+        with self.assertLogs('taskqueue.queue', 'WARNING'):
+            self.assertEqual(requeue_expired(), 1)
+        self.assertEqual(run_ready(['default']), 1)
+        # The stalled worker finishing late does not overwrite the result
+        with self.assertLogs('taskqueue.queue', 'WARNING') as logs:
+            run(stalled)
+        self.assertIn('after its lease ran out', logs.output[0])
+        stalled.refresh_from_db()
+        self.assertEqual(stalled.status, Task.DONE)
+        self.assertEqual(stalled.attempts, 2)
+
+    def test_unique_key_queues_a_task_once(self):
+        self.assertIsNotNone(enqueue(
+            'taskqueue.test_record', ['x'], unique_key='only-once'))
+        self.assertIsNone(enqueue(
+            'taskqueue.test_record', ['x'], unique_key='only-once'))
+        self.assertEqual(Task.objects.count(), 1)
+
+    @override_settings(TASK_SCHEDULE={
+        'record': {
+            'task': 'taskqueue.test_record', 'seconds': 60,
+            'args': ['tick']},
+    })
+    def test_schedule_queues_each_period_once(self):
+        now = timezone.now().replace(second=1)
+        self.assertEqual(enqueue_scheduled(now), 1)
+        self.assertEqual(enqueue_scheduled(now + timedelta(seconds=30)), 0)
+        self.assertEqual(enqueue_scheduled(now + timedelta(seconds=60)), 1)
+        run_ready(['default'])
+        self.assertEqual(calls, ['tick', 'tick'])
+
+    def test_purge_keeps_recent_and_failed_tasks(self):
+        old = timezone.now() - timedelta(days=30)
+        Task.objects.create(
+            name='taskqueue.test_record', status=Task.DONE, finished_at=old)
+        Task.objects.create(
+            name='taskqueue.test_record', status=Task.FAILED,
+            finished_at=old)
+        Task.objects.create(
+            name='taskqueue.test_record', status=Task.DONE,
+            finished_at=timezone.now())
+        self.assertEqual(purge(), 1)
+        self.assertEqual(Task.objects.count(), 2)
+
+    def test_commands_run_tasks_and_report_timings(self):
+        record.enqueue('a')
+        record.enqueue('b')
+        out = StringIO()
+        with override_settings(TASK_SCHEDULE={}):
+            call_command('run_task_worker', '--once', stdout=out)
+        self.assertIn('Ran 2 task(s).', out.getvalue())
+
+        limited.enqueue_at(timedelta(hours=-1))
+        out = StringIO()
+        call_command('task_stats', stdout=out)
+        output = out.getvalue()
+        self.assertRegex(output, r'taskqueue\.test_record\s+2\s+0')
+        self.assertIn('Queue default: 1 ready', output)
+
+
+class WorkerTests(TransactionTestCase):
+    """Tests for the threaded worker"""
+
+    def setUp(self):
+        calls.clear()
+
+    def test_outcome_is_recorded_after_a_locked_table(self):
+        """A failed status update is tried again, not left to the lease"""
+        queued = record.enqueue('a')
+        update = QuerySet.update
+        failures = [OperationalError('database table is locked')]
+
+        def flaky_update(queryset, **kwargs):
+            if 'finished_at' in kwargs and failures:
+                raise failures.pop()
+            return update(queryset, **kwargs)
+
+        claimed = claim(['default'])
+        with mock.patch.object(QuerySet, 'update', flaky_update), \
+                mock.patch('taskqueue.queue.time.sleep'):
+            self.assertEqual(run(claimed), Task.DONE)
+        self.assertEqual(failures, [])
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, Task.DONE)
+        self.assertEqual(calls, ['a'])
+
+    @override_settings(TASK_SCHEDULE={})
+    def test_threads_run_every_task_once(self):
+        for number in range(20):
+            record.enqueue(number)
+        worker = Worker(['default'], threads=3, poll_interval=0.05)
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+        deadline = time.monotonic() + 30
+        done = 0
+        while done < 20 and time.monotonic() < deadline:
+            time.sleep(0.05)
+            try:
+                done = Task.objects.filter(status=Task.DONE).count()
+            except OperationalError:
+                # The shared in-memory test database reports locked
+                # tables instead of waiting; just look again
+                pass
+        worker.stop()
+        thread.join()
+        self.assertEqual(sorted(calls), list(range(20)))
+        self.assertEqual(worker.processed, 20)
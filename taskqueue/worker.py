@@ -0,0 +1,105 @@
+"""
+Task worker: a pool of threads taking tasks off the queue.
+
+Each thread claims and runs one task at a time with its own database
+connection. The main thread queues scheduled tasks and requeues tasks
+whose lease ran out. Several worker processes, on one machine or many,
+can run against the same database (see run_task_worker --processes).
+"""
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+from .queue import claim, enqueue_scheduled, requeue_expired, run
+
+logger = logging.getLogger(__name__)
+
+
+def run_ready(queues, limit=None, using='default'):
+    """
+    Run ready tasks in the current thread until there are none left.
+
+    Args:
+        queues: Names of the queues to take from
+        limit: Most tasks to run
+        using: Database alias
+
+    Returns:
+        Number of tasks run
+    """
+    count = 0
+    while limit is None or count < limit:
+        claimed = claim(queues, using=using)
+        if claimed is None:
+            break
+        run(claimed, using=using)
+        count += 1
+    return count
+
+
+class Worker:
+    """
+    Args:
+        queues: Names of the queues to take from
+        threads: Number of tasks run at the same time
+        poll_interval: Seconds a thread waits when no task is ready;
+                       defaults to ``TASK_POLL_SECONDS``
+    """
+
+    def __init__(self, queues, threads=1, poll_interval=None):
+        self.queues = list(queues)
+        self.threads = threads
+        self.poll_interval = poll_interval or settings.TASK_POLL_SECONDS
+        self.stopping = threading.Event()
+        self.processed = 0
+        self._lock = threading.Lock()
+
+    def stop(self):
+        """Finish the running tasks and return from run()"""
+        self.stopping.set()
+
+    def run(self):
+        threads = [
+            threading.Thread(
+                target=self._work, name=f'task-worker-{number}')
+            for number in range(self.threads)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            while not self.stopping.is_set():
+                self._maintain()
+                self.stopping.wait(self.poll_interval)
+        finally:
+            self.stopping.set()
+            for thread in threads:
+                thread.join()
+            connections.close_all()
+
+    def _maintain(self):
+        try:
+            enqueue_scheduled()
+            requeue_expired()
+        except Exception:
+            logger.exception('Could not queue scheduled tasks')
+        finally:
+            close_old_connections()
+
+    def _work(self):
+        try:
+            while not self.stopping.is_set():
+                try:
+                    count = run_ready(self.queues, limit=100)
+                except Exception:
+                    # Usually the database going away; try again later
+                    logger.exception('Task worker thread failed')
+                    count = 0
+                with self._lock:
+                    self.processed += count
+                close_old_connections()
+                if not count:
+                    self.stopping.wait(self.poll_interval)
+        finally:
+            connections.close_all()